@@ -32,7 +32,7 @@ class User(AbstractUser, BaseAuditModel):
     default_agent_tbl_tab = models.CharField(
         max_length=50, choices=AGENT_TBL_TAB_CHOICES, default="server"
     )
-    agents_per_page = models.PositiveIntegerField(default=50)  # not currently used
+    agents_per_page = models.PositiveIntegerField(default=50)
     client_tree_sort = models.CharField(
         max_length=50, choices=CLIENT_TREE_SORT_CHOICES, default="alphafail"
     )
@@ -78,6 +78,7 @@ class Command(BaseCommand):
         if agents:
             if offline:
                 agents.update(offline_time=time)
+                agents.set_overdue_deadline()
                 self.stdout.write(
                     self.style.SUCCESS(
                         f"Changed offline time on {len(agents)} agents to {time} minutes"
@@ -86,6 +87,7 @@ class Command(BaseCommand):
 
             if overdue:
                 agents.update(overdue_time=time)
+                agents.set_overdue_deadline()
                 self.stdout.write(
                     self.style.SUCCESS(
                         f"Changed overdue time on {len(agents)} agents to {time} minutes"
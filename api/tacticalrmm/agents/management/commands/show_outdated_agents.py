@@ -8,10 +8,11 @@ class Command(BaseCommand):
     help = "Shows online agents that are not on the latest version"
 
     def handle(self, *args, **kwargs):
-        q = Agent.objects.exclude(version=settings.LATEST_AGENT_VER).only(
-            "pk", "version", "last_seen", "overdue_time", "offline_time"
+        agents = (
+            Agent.objects.online()
+            .exclude(version=settings.LATEST_AGENT_VER)
+            .only("pk", "hostname", "version")
         )
-        agents = [i for i in q if i.status == "online"]
         for agent in agents:
             self.stdout.write(
                 self.style.SUCCESS(f"{agent.hostname} - v{agent.version}")
@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-17 00:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("agents", "0036_auto_20261017_0046"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="agent",
+            name="last_seen",
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
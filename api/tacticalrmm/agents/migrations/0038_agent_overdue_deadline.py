@@ -0,0 +1,22 @@
+# Generated by Django 3.2 on 2026-10-17 00:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agents', '0037_alter_agent_last_seen'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='agent',
+            name='overdue_deadline',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunSQL(
+            "UPDATE agents_agent SET overdue_deadline = last_seen + overdue_time * interval '1 minute'",
+            migrations.RunSQL.noop,
+        ),
+    ]
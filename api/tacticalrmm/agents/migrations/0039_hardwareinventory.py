@@ -0,0 +1,45 @@
+# Generated by Django 3.2 on 2026-10-17 01:14
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agents', '0038_agent_overdue_deadline'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HardwareInventory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('make', models.CharField(blank=True, db_index=True, max_length=255, null=True)),
+                ('model', models.CharField(blank=True, db_index=True, max_length=255, null=True)),
+                ('make_model', models.CharField(default='unknown make/model', max_length=255)),
+                ('cpus', django.contrib.postgres.fields.ArrayField(base_field=models.CharField(blank=True, max_length=255), blank=True, default=list, size=None)),
+                ('cpu_cores', models.PositiveIntegerField(blank=True, null=True)),
+                ('gpus', django.contrib.postgres.fields.ArrayField(base_field=models.CharField(blank=True, max_length=255), blank=True, null=True, size=None)),
+                ('disks', models.JSONField(blank=True, default=list)),
+                ('local_ips', django.contrib.postgres.fields.ArrayField(base_field=models.GenericIPAddressField(protocol='IPv4'), blank=True, default=list, size=None)),
+                ('total_memory', models.BigIntegerField(blank=True, null=True)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('agent', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='hardware', to='agents.agent')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='hardwareinventory',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['cpus'], name='agents_hard_cpus_45699d_gin'),
+        ),
+        migrations.AddIndex(
+            model_name='hardwareinventory',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['gpus'], name='agents_hard_gpus_884746_gin'),
+        ),
+        migrations.AddIndex(
+            model_name='hardwareinventory',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['local_ips'], name='agents_hard_local_i_d2709d_gin'),
+        ),
+    ]
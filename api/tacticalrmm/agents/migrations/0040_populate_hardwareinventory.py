@@ -0,0 +1,157 @@
+import validators
+from django.db import migrations
+
+
+# frozen copy of agents.utils as of this migration, so later changes to the live
+# parser don't change the fields this migration writes
+def wmi_value(obj, key):
+    # each wmi object is sent as a list of single key dicts
+    return [x[key] for x in obj if key in x][0]
+
+
+def parse_cpus(sysinfo):
+    cpus, cores = [], 0
+    try:
+        for cpu in sysinfo["cpu"]:
+            cpus.append(wmi_value(cpu, "Name"))
+            try:
+                cores += int(wmi_value(cpu, "NumberOfCores"))
+            except:
+                pass
+    except:
+        return [], None
+
+    return cpus, cores or None
+
+
+def parse_gpus(sysinfo):
+    # None means the agent is too old to report graphics
+    try:
+        return [wmi_value(i, "Caption") for i in sysinfo["graphics"]]
+    except:
+        return None
+
+
+def parse_local_ips(sysinfo):
+    ret = []
+    try:
+        ips = sysinfo["network_config"]
+    except:
+        return ret
+
+    for i in ips:
+        try:
+            addr = wmi_value(i, "IPAddress")
+        except:
+            continue
+
+        if addr is None:
+            continue
+
+        for ip in addr:
+            if validators.ipv4(ip):
+                ret.append(ip)
+
+    return ret
+
+
+def parse_make_model(sysinfo):
+    try:
+        comp_sys = sysinfo["comp_sys"][0]
+        comp_sys_prod = sysinfo["comp_sys_prod"][0]
+        make = wmi_value(comp_sys_prod, "Vendor")
+        model = wmi_value(comp_sys, "Model")
+
+        if "to be filled" in model.lower():
+            mobo = sysinfo["base_board"][0]
+            make = wmi_value(mobo, "Manufacturer")
+            model = wmi_value(mobo, "Product")
+
+        return make, model, f"{make} {model}"
+    except:
+        pass
+
+    try:
+        comp_sys_prod = sysinfo["comp_sys_prod"][0]
+        return None, None, wmi_value(comp_sys_prod, "Version")
+    except:
+        pass
+
+    return None, None, "unknown make/model"
+
+
+def parse_disks(sysinfo):
+    ret = []
+    try:
+        for disk in sysinfo["disk"]:
+            interface_type = wmi_value(disk, "InterfaceType")
+            if interface_type == "USB":
+                continue
+
+            ret.append(
+                {
+                    "model": wmi_value(disk, "Caption"),
+                    "size": int(wmi_value(disk, "Size")),
+                    "interface": interface_type,
+                }
+            )
+    except:
+        return []
+
+    return ret
+
+
+def parse_total_memory(sysinfo):
+    try:
+        return sum(int(wmi_value(mem, "Capacity")) for mem in sysinfo["mem"]) or None
+    except:
+        return None
+
+
+def parse_sysinfo(sysinfo):
+    cpus, cpu_cores = parse_cpus(sysinfo)
+    make, model, make_model = parse_make_model(sysinfo)
+    return {
+        "make": make,
+        "model": model,
+        "make_model": make_model,
+        "cpus": cpus,
+        "cpu_cores": cpu_cores,
+        "gpus": parse_gpus(sysinfo),
+        "disks": parse_disks(sysinfo),
+        "local_ips": parse_local_ips(sysinfo),
+        "total_memory": parse_total_memory(sysinfo),
+    }
+
+
+def populate_hardware_inventory(apps, schema_editor):
+    Agent = apps.get_model("agents", "Agent")
+    HardwareInventory = apps.get_model("agents", "HardwareInventory")
+
+    inventory = []
+    for agent in (
+        Agent.objects.exclude(wmi_detail__isnull=True)
+        .only("pk", "wmi_detail")
+        .iterator()
+    ):
+        if isinstance(agent.wmi_detail, dict):
+            inventory.append(
+                HardwareInventory(agent_id=agent.pk, **parse_sysinfo(agent.wmi_detail))
+            )
+
+        if len(inventory) >= 500:
+            HardwareInventory.objects.bulk_create(inventory)
+            inventory = []
+
+    HardwareInventory.objects.bulk_create(inventory)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("agents", "0039_hardwareinventory"),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_hardware_inventory, migrations.RunPython.noop),
+    ]
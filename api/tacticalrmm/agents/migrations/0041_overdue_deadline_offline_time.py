@@ -0,0 +1,17 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("agents", "0040_populate_hardwareinventory"),
+    ]
+
+    operations = [
+        # agents are only overdue once they are offline too
+        migrations.RunSQL(
+            "UPDATE agents_agent SET overdue_deadline = last_seen "
+            "+ GREATEST(offline_time, overdue_time) * interval '1 minute'",
+            migrations.RunSQL.noop,
+        ),
+    ]
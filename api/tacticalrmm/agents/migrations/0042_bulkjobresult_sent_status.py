@@ -0,0 +1,29 @@
+# Generated by Django 3.2 on 2026-10-17 03:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("agents", "0041_overdue_deadline_offline_time"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="bulkjobresult",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("dispatched", "Dispatched"),
+                    ("sent", "Sent"),
+                    ("completed", "Completed"),
+                    ("timeout", "Timeout"),
+                    ("failed", "Failed"),
+                ],
+                default="pending",
+                max_length=30,
+            ),
+        ),
+    ]
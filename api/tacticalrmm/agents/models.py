@@ -1,32 +1,150 @@
 import asyncio
 import base64
+import datetime as dt
 import re
 import time
 from collections import Counter
 from distutils.version import LooseVersion
-from typing import Any
+from typing import Any, Callable, Iterable, Iterator, Optional, Union
 
-import msgpack
-import validators
 from Crypto.Cipher import AES
 from Crypto.Hash import SHA3_384
 from Crypto.Random import get_random_bytes
 from Crypto.Util.Padding import pad
 from django.conf import settings
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
+from django.db.models import (
+    Case,
+    CharField,
+    Count,
+    DateTimeField,
+    DurationField,
+    Exists,
+    ExpressionWrapper,
+    F,
+    Min,
+    OuterRef,
+    Q,
+    Subquery,
+    Value,
+    When,
+)
+from django.db.models.functions import Coalesce, Greatest, Now
 from django.utils import timezone as djangotime
 from loguru import logger
-from nats.aio.client import Client as NATS
-from nats.aio.errors import ErrTimeout
 
-from core.models import TZ_CHOICES, CoreSettings
+from core.models import TZ_CHOICES
 from logs.models import BaseAuditModel
+from tacticalrmm.nats_client import nats_manager
+
+from .utils import parse_sysinfo
 
 logger.configure(**settings.LOG_CONFIG)
 
 
+def _last_seen_cutoff(field: str) -> ExpressionWrapper:
+    # now() - <field> minutes, evaluated by the database
+    return ExpressionWrapper(
+        Now()
+        - ExpressionWrapper(
+            F(field) * djangotime.timedelta(minutes=1), output_field=DurationField()
+        ),
+        output_field=DateTimeField(),
+    )
+
+
+class AgentQuerySet(models.QuerySet):
+    """
+    Same rules as Agent.status but computed in SQL so agents can be filtered
+    and counted without loading them.
+    """
+
+    @staticmethod
+    def online_q() -> Q:
+        return Q(last_seen__gte=_last_seen_cutoff("offline_time"))
+
+    @staticmethod
+    def overdue_q() -> Q:
+        return Q(last_seen__lt=_last_seen_cutoff("offline_time")) & Q(
+            last_seen__lt=_last_seen_cutoff("overdue_time")
+        )
+
+    @staticmethod
+    def offline_q() -> Q:
+        return Q(last_seen__isnull=True) | (
+            Q(last_seen__lt=_last_seen_cutoff("offline_time"))
+            & Q(last_seen__gte=_last_seen_cutoff("overdue_time"))
+        )
+
+    def set_overdue_deadline(self) -> int:
+        # for bulk .update() calls that change last_seen, offline_time or overdue_time
+        return self.update(
+            overdue_deadline=ExpressionWrapper(
+                F("last_seen")
+                + ExpressionWrapper(
+                    Greatest("offline_time", "overdue_time")
+                    * djangotime.timedelta(minutes=1),
+                    output_field=DurationField(),
+                ),
+                output_field=DateTimeField(),
+            )
+        )
+
+    def annotate_status(self):
+        return self.annotate(
+            agent_status=Case(
+                When(self.online_q(), then=Value("online")),
+                When(self.overdue_q(), then=Value("overdue")),
+                default=Value("offline"),
+                output_field=CharField(),
+            )
+        )
+
+    def annotate_table(self):
+        # everything the agent table needs per row, computed in the same query
+        from checks.models import Check
+        from logs.models import PendingAction
+        from winupdate.models import WinUpdate
+
+        def count(qs):
+            return Coalesce(
+                Subquery(
+                    qs.filter(agent=OuterRef("pk"))
+                    .order_by()
+                    .values("agent")
+                    .annotate(count=Count("pk"))
+                    .values("count")
+                ),
+                0,
+            )
+
+        return self.annotate_status().annotate(
+            pending_actions=count(PendingAction.objects.filter(status="pending")),
+            patches_pending=Exists(
+                WinUpdate.objects.filter(
+                    agent=OuterRef("pk"), action="approve", installed=False
+                )
+            ),
+            checks_total=count(Check.objects.all()),
+            checks_passing=count(Check.objects.filter(status="passing")),
+            checks_failing=count(Check.objects.filter(status="failing")),
+        )
+
+    def online(self):
+        return self.filter(self.online_q())
+
+    def offline(self):
+        return self.filter(self.offline_q())
+
+    def overdue(self):
+        return self.filter(self.overdue_q())
+
+
 class Agent(BaseAuditModel):
+    objects = AgentQuerySet.as_manager()
+
     version = models.CharField(default="0.1.0", max_length=255)
     salt_ver = models.CharField(default="1.0.3", max_length=255)
     operating_system = models.CharField(null=True, blank=True, max_length=255)
@@ -36,7 +154,10 @@ class Agent(BaseAuditModel):
     salt_id = models.CharField(null=True, blank=True, max_length=255)
     local_ip = models.TextField(null=True, blank=True)  # deprecated
     agent_id = models.CharField(max_length=200)
-    last_seen = models.DateTimeField(null=True, blank=True)
+    last_seen = models.DateTimeField(null=True, blank=True, db_index=True)
+    # when the agent becomes overdue, last_seen + the larger of offline_time and
+    # overdue_time. Lets agent_outages_task only look at new outages
+    overdue_deadline = models.DateTimeField(null=True, blank=True, db_index=True)
     services = models.JSONField(null=True, blank=True)
     public_ip = models.CharField(null=True, max_length=255)
     total_ram = models.IntegerField(null=True, blank=True)
@@ -87,21 +208,20 @@ class Agent(BaseAuditModel):
 
     def save(self, *args, **kwargs):
 
-        # get old agent if exists
-        old_agent = type(self).objects.get(pk=self.pk) if self.pk else None
-        super(BaseAuditModel, self).save(*args, **kwargs)
+        update_fields = kwargs.get("update_fields")
+        deadline_fields = {"last_seen", "offline_time", "overdue_time"}
+        if update_fields is None or deadline_fields & set(update_fields):
+            overdue = max(self.offline_time, self.overdue_time)
+            self.overdue_deadline = (
+                self.last_seen + djangotime.timedelta(minutes=overdue)
+                if self.last_seen
+                else None
+            )
+            if update_fields is not None:
+                kwargs["update_fields"] = [*update_fields, "overdue_deadline"]
 
-        # check if new agent has been created
-        # or check if policy have changed on agent
-        # or if site has changed on agent and if so generate-policies
-        if (
-            not old_agent
-            or old_agent
-            and old_agent.policy != self.policy
-            or old_agent.site != self.site
-        ):
-            self.generate_checks_from_policies()
-            self.generate_tasks_from_policies()
+        # policy changes are picked up by automation.signals
+        super(BaseAuditModel, self).save(*args, **kwargs)
 
     def __str__(self):
         return self.hostname
@@ -147,11 +267,16 @@ class Agent(BaseAuditModel):
 
     @property
     def status(self):
+        # set by Agent.objects.annotate_status()
+        if "agent_status" in self.__dict__:
+            return self.agent_status
+
         offline = djangotime.now() - djangotime.timedelta(minutes=self.offline_time)
         overdue = djangotime.now() - djangotime.timedelta(minutes=self.overdue_time)
 
         if self.last_seen is not None:
-            if (self.last_seen < offline) and (self.last_seen > overdue):
+            # same comparisons as online_q, offline_q and overdue_q
+            if (self.last_seen < offline) and (self.last_seen >= overdue):
                 return "offline"
             elif (self.last_seen < offline) and (self.last_seen < overdue):
                 return "overdue"
@@ -185,124 +310,80 @@ class Agent(BaseAuditModel):
         return ret
 
     @property
-    def cpu_model(self):
-        ret = []
+    def hardware_inventory(self) -> Optional["HardwareInventory"]:
         try:
-            cpus = self.wmi_detail["cpu"]
-            for cpu in cpus:
-                ret.append([x["Name"] for x in cpu if "Name" in x][0])
-            return ret
-        except:
+            return self.hardware  # type: ignore
+        except HardwareInventory.DoesNotExist:
+            return None
+
+    @property
+    def cpu_model(self):
+        hw = self.hardware_inventory
+        if hw is None or not hw.cpus:
             return ["unknown cpu model"]
 
+        return hw.cpus
+
     @property
     def graphics(self):
-        ret, mrda = [], []
-        try:
-            graphics = self.wmi_detail["graphics"]
-            for i in graphics:
-                caption = [x["Caption"] for x in i if "Caption" in x][0]
-                if "microsoft remote display adapter" in caption.lower():
-                    mrda.append("yes")
-                    continue
+        hw = self.hardware_inventory
+        if hw is None or hw.gpus is None:
+            return "Graphics info requires agent v1.4.14"
 
-                ret.append([x["Caption"] for x in i if "Caption" in x][0])
+        ret = [
+            i for i in hw.gpus if "microsoft remote display adapter" not in i.lower()
+        ]
 
-            # only return this if no other graphics cards
-            if not ret and mrda:
-                return "Microsoft Remote Display Adapter"
+        # only return this if no other graphics cards
+        if not ret and hw.gpus:
+            return "Microsoft Remote Display Adapter"
 
-            return ", ".join(ret)
-        except:
-            return "Graphics info requires agent v1.4.14"
+        return ", ".join(ret)
 
     @property
     def local_ips(self):
-        ret = []
-        try:
-            ips = self.wmi_detail["network_config"]
-        except:
+        hw = self.hardware_inventory
+        if hw is None or not hw.local_ips:
             return "error getting local ips"
 
-        for i in ips:
-            try:
-                addr = [x["IPAddress"] for x in i if "IPAddress" in x][0]
-            except:
-                continue
-
-            if addr is None:
-                continue
-
-            for ip in addr:
-                if validators.ipv4(ip):
-                    ret.append(ip)
-
-        if len(ret) == 1:
-            return ret[0]
-        else:
-            return ", ".join(ret) if ret else "error getting local ips"
+        return ", ".join(hw.local_ips)
 
     @property
     def make_model(self):
-        try:
-            comp_sys = self.wmi_detail["comp_sys"][0]
-            comp_sys_prod = self.wmi_detail["comp_sys_prod"][0]
-            make = [x["Vendor"] for x in comp_sys_prod if "Vendor" in x][0]
-            model = [x["Model"] for x in comp_sys if "Model" in x][0]
-
-            if "to be filled" in model.lower():
-                mobo = self.wmi_detail["base_board"][0]
-                make = [x["Manufacturer"] for x in mobo if "Manufacturer" in x][0]
-                model = [x["Product"] for x in mobo if "Product" in x][0]
-
-            return f"{make} {model}"
-        except:
-            pass
-
-        try:
-            comp_sys_prod = self.wmi_detail["comp_sys_prod"][0]
-            return [x["Version"] for x in comp_sys_prod if "Version" in x][0]
-        except:
-            pass
-
-        return "unknown make/model"
+        hw = self.hardware_inventory
+        return hw.make_model if hw is not None else "unknown make/model"
 
     @property
     def physical_disks(self):
-        try:
-            disks = self.wmi_detail["disk"]
-            ret = []
-            for disk in disks:
-                interface_type = [
-                    x["InterfaceType"] for x in disk if "InterfaceType" in x
-                ][0]
-
-                if interface_type == "USB":
-                    continue
+        hw = self.hardware_inventory
+        if hw is None:
+            return ["unknown disk"]
 
-                model = [x["Caption"] for x in disk if "Caption" in x][0]
-                size = [x["Size"] for x in disk if "Size" in x][0]
+        ret = []
+        for disk in hw.disks:
+            size_in_gb = round(disk["size"] / 1_073_741_824)
+            ret.append(f"{disk['model']} {size_in_gb:,}GB {disk['interface']}")
 
-                size_in_gb = round(int(size) / 1_073_741_824)
-                ret.append(f"{model} {size_in_gb:,}GB {interface_type}")
+        return ret
 
-            return ret
-        except:
-            return ["unknown disk"]
+    def update_hardware_inventory(self) -> None:
+        if not isinstance(self.wmi_detail, dict):
+            return
 
-    def check_run_interval(self) -> int:
-        interval = self.check_interval
-        # determine if any agent checks have a custom interval and set the lowest interval
-        for check in self.agentchecks.filter(overriden_by_policy=False):  # type: ignore
-            if check.run_interval and check.run_interval < interval:
+        HardwareInventory.objects.update_or_create(
+            agent=self, defaults=parse_sysinfo(self.wmi_detail)
+        )
 
-                # don't allow check runs less than 15s
-                if check.run_interval < 15:
-                    interval = 15
-                else:
-                    interval = check.run_interval
+    def check_run_interval(self) -> int:
+        # the lowest custom interval of the agent's checks, if below the agent's own
+        lowest = self.agentchecks.filter(  # type: ignore
+            overriden_by_policy=False,
+            run_interval__gt=0,
+            run_interval__lt=self.check_interval,
+        ).aggregate(lowest=Min("run_interval"))["lowest"]
 
-        return interval
+        # don't allow check runs less than 15s
+        return max(lowest, 15) if lowest else self.check_interval
 
     def run_script(
         self,
@@ -340,13 +421,7 @@ class Agent(BaseAuditModel):
             if r == "pong":
                 running_agent = self
             else:
-                online = [
-                    agent
-                    for agent in Agent.objects.only(
-                        "pk", "agent_id", "last_seen", "overdue_time", "offline_time"
-                    )
-                    if agent.status == "online"
-                ]
+                online = Agent.objects.online().only("pk", "agent_id")
 
                 for agent in online:
                     r = asyncio.run(agent.nats_cmd(nats_ping, timeout=1))
@@ -400,60 +475,26 @@ class Agent(BaseAuditModel):
 
     # returns agent policy merged with a client or site specific policy
     def get_patch_policy(self):
+        from automation.models import AgentEffectivePolicy
+        from winupdate.models import WinUpdatePolicy
 
-        # check if site has a patch policy and if so use it
-        site = self.site
-        core_settings = CoreSettings.objects.first()
-        patch_policy = None
         agent_policy = self.winupdatepolicy.get()  # type: ignore
 
-        if self.monitoring_type == "server":
-            # check agent policy first which should override client or site policy
-            if self.policy and self.policy.winupdatepolicy.exists():
-                patch_policy = self.policy.winupdatepolicy.get()
-
-            # check site policy if agent policy doesn't have one
-            elif site.server_policy and site.server_policy.winupdatepolicy.exists():
-                patch_policy = site.server_policy.winupdatepolicy.get()
-
-            # if site doesn't have a patch policy check the client
-            elif (
-                site.client.server_policy
-                and site.client.server_policy.winupdatepolicy.exists()
-            ):
-                patch_policy = site.client.server_policy.winupdatepolicy.get()
-
-            # if patch policy still doesn't exist check default policy
-            elif (
-                core_settings.server_policy
-                and core_settings.server_policy.winupdatepolicy.exists()
-            ):
-                patch_policy = core_settings.server_policy.winupdatepolicy.get()
-
-        elif self.monitoring_type == "workstation":
-            # check agent policy first which should override client or site policy
-            if self.policy and self.policy.winupdatepolicy.exists():
-                patch_policy = self.policy.winupdatepolicy.get()
-
-            elif (
-                site.workstation_policy
-                and site.workstation_policy.winupdatepolicy.exists()
-            ):
-                patch_policy = site.workstation_policy.winupdatepolicy.get()
-
-            # if site doesn't have a patch policy check the client
-            elif (
-                site.client.workstation_policy
-                and site.client.workstation_policy.winupdatepolicy.exists()
-            ):
-                patch_policy = site.client.workstation_policy.winupdatepolicy.get()
-
-            # if patch policy still doesn't exist check default policy
-            elif (
-                core_settings.workstation_policy
-                and core_settings.workstation_policy.winupdatepolicy.exists()
-            ):
-                patch_policy = core_settings.workstation_policy.winupdatepolicy.get()
+        # agent, site, client and then the default policy for the monitoring type
+        policies = [
+            pk
+            for pk in AgentEffectivePolicy.agent_rows(
+                Agent.objects.filter(pk=self.pk), "pk"
+            )[0]["effective_policy__policies"]
+            if pk
+        ]
+        patch_policies = {
+            i.policy_id: i
+            for i in WinUpdatePolicy.objects.filter(policy_id__in=policies)
+        }
+        patch_policy = next(
+            (patch_policies[pk] for pk in policies if pk in patch_policies), None
+        )
 
         # if policy still doesn't exist return the agent patch policy
         if not patch_policy:
@@ -500,131 +541,28 @@ class Agent(BaseAuditModel):
     # sets alert template assigned in the following order: policy, site, client, global
     # sets None if nothing is found
     def set_alert_template(self):
+        from alerts.models import AlertTemplate
 
-        site = self.site
-        client = self.client
-        core = CoreSettings.objects.first()
-
-        templates = list()
-        # check if alert template is on a policy assigned to agent
-        if (
-            self.policy
-            and self.policy.alert_template
-            and self.policy.alert_template.is_active
-        ):
-            templates.append(self.policy.alert_template)
-
-        # check if policy with alert template is assigned to the site
-        if (
-            self.monitoring_type == "server"
-            and site.server_policy
-            and site.server_policy.alert_template
-            and site.server_policy.alert_template.is_active
-        ):
-            templates.append(site.server_policy.alert_template)
-        if (
-            self.monitoring_type == "workstation"
-            and site.workstation_policy
-            and site.workstation_policy.alert_template
-            and site.workstation_policy.alert_template.is_active
-        ):
-            templates.append(site.workstation_policy.alert_template)
-
-        # check if alert template is assigned to site
-        if site.alert_template and site.alert_template.is_active:
-            templates.append(site.alert_template)
-
-        # check if policy with alert template is assigned to the client
-        if (
-            self.monitoring_type == "server"
-            and client.server_policy
-            and client.server_policy.alert_template
-            and client.server_policy.alert_template.is_active
-        ):
-            templates.append(client.server_policy.alert_template)
-        if (
-            self.monitoring_type == "workstation"
-            and client.workstation_policy
-            and client.workstation_policy.alert_template
-            and client.workstation_policy.alert_template.is_active
-        ):
-            templates.append(client.workstation_policy.alert_template)
-
-        # check if alert template is on client and return
-        if client.alert_template and client.alert_template.is_active:
-            templates.append(client.alert_template)
-
-        # check if alert template is applied globally and return
-        if core.alert_template and core.alert_template.is_active:
-            templates.append(core.alert_template)
-
-        # if agent is a workstation, check if policy with alert template is assigned to the site, client, or core
-        if (
-            self.monitoring_type == "server"
-            and core.server_policy
-            and core.server_policy.alert_template
-            and core.server_policy.alert_template.is_active
-        ):
-            templates.append(core.server_policy.alert_template)
-        if (
-            self.monitoring_type == "workstation"
-            and core.workstation_policy
-            and core.workstation_policy.alert_template
-            and core.workstation_policy.alert_template.is_active
-        ):
-            templates.append(core.workstation_policy.alert_template)
-
-        # go through the templates and return the first one that isn't excluded
-        for template in templates:
-            # check if client, site, or agent has been excluded from template
-            if (
-                client.pk
-                in template.excluded_clients.all().values_list("pk", flat=True)
-                or site.pk in template.excluded_sites.all().values_list("pk", flat=True)
-                or self.pk
-                in template.excluded_agents.all()
-                .only("pk")
-                .values_list("pk", flat=True)
-            ):
-                continue
-
-            # check if template is excluding desktops
-            elif (
-                self.monitoring_type == "workstation" and template.exclude_workstations
-            ):
-                continue
-
-            # check if template is excluding servers
-            elif self.monitoring_type == "server" and template.exclude_servers:
-                continue
-
-            else:
-                # save alert_template to agent cache field
-                self.alert_template = template
-                self.save()
-
-                return template
+        pk = AlertTemplate.resolve_for_agents(Agent.objects.filter(pk=self.pk))[self.pk]
 
-        # no alert templates found or agent has been excluded
-        self.alert_template = None
-        self.save()
+        # save alert_template to agent cache field
+        if pk != self.alert_template_id:
+            self.alert_template_id = pk
+            self.save(update_fields=["alert_template"])
 
-        return None
+        return self.alert_template
 
     def generate_checks_from_policies(self):
         from automation.models import Policy
 
-        # Clear agent checks that have overriden_by_policy set
-        self.agentchecks.update(overriden_by_policy=False)  # type: ignore
-
         # Generate checks based on policies
-        Policy.generate_policy_checks(self)
+        Policy.generate_policy_checks_and_tasks([self.pk])
 
     def generate_tasks_from_policies(self):
         from automation.models import Policy
 
         # Generate tasks based on policies
-        Policy.generate_policy_tasks(self)
+        Policy.generate_policy_checks_and_tasks([self.pk], checks=False, tasks=True)
 
     # https://github.com/Ylianst/MeshCentral/issues/59#issuecomment-521965347
     def get_login_token(self, key, user, action=3):
@@ -651,39 +589,28 @@ class Agent(BaseAuditModel):
             return "err"
 
     async def nats_cmd(self, data: dict, timeout: int = 30, wait: bool = True):
-        nc = NATS()
-        options = {
-            "servers": f"tls://{settings.ALLOWED_HOSTS[0]}:4222",
-            "user": "tacticalrmm",
-            "password": settings.SECRET_KEY,
-            "connect_timeout": 3,
-            "max_reconnect_attempts": 2,
-        }
-        try:
-            await nc.connect(**options)
-        except:
-            return "natsdown"
-
+        # uses the shared per-process connection instead of connecting on every call
         if wait:
-            try:
-                msg = await nc.request(
-                    self.agent_id, msgpack.dumps(data), timeout=timeout
-                )
-            except ErrTimeout:
-                ret = "timeout"
-            else:
-                try:
-                    ret = msgpack.loads(msg.data)  # type: ignore
-                except Exception as e:
-                    logger.error(e)
-                    ret = str(e)
-
-            await nc.close()
-            return ret
+            return await nats_manager.request(self.agent_id, data, timeout=timeout)
         else:
-            await nc.publish(self.agent_id, msgpack.dumps(data))
-            await nc.flush()
-            await nc.close()
+            return await nats_manager.publish(self.agent_id, data)
+
+    @staticmethod
+    def nats_cmd_many(
+        agent_ids: Iterable[str],
+        data: Union[dict, Callable[[str], dict]],
+        timeout: int = 30,
+        wait: bool = True,
+        concurrency: int = 100,
+    ) -> Iterator[tuple[str, Any]]:
+        # data can be a callable that returns the payload for each agent_id
+        messages = (
+            (agent_id, data(agent_id) if callable(data) else data)
+            for agent_id in agent_ids
+        )
+        return nats_manager.request_many(
+            messages, timeout=timeout, wait=wait, concurrency=concurrency
+        )
 
     @staticmethod
     def serialize(agent):
@@ -769,7 +696,7 @@ class Agent(BaseAuditModel):
             )
         )
 
-    def send_outage_email(self):
+    def send_outage_email(self, idempotency_key=None):
         from core.models import CoreSettings
 
         CORE = CoreSettings.objects.first()
@@ -782,9 +709,10 @@ class Agent(BaseAuditModel):
                 "within the expected time."
             ),
             alert_template=self.alert_template,
+            idempotency_key=idempotency_key,
         )
 
-    def send_recovery_email(self):
+    def send_recovery_email(self, idempotency_key=None):
         from core.models import CoreSettings
 
         CORE = CoreSettings.objects.first()
@@ -797,24 +725,27 @@ class Agent(BaseAuditModel):
                 "after an interruption in data transmission."
             ),
             alert_template=self.alert_template,
+            idempotency_key=idempotency_key,
         )
 
-    def send_outage_sms(self):
+    def send_outage_sms(self, idempotency_key=None):
         from core.models import CoreSettings
 
         CORE = CoreSettings.objects.first()
         CORE.send_sms(
             f"{self.client.name}, {self.site.name}, {self.hostname} - data overdue",
             alert_template=self.alert_template,
+            idempotency_key=idempotency_key,
         )
 
-    def send_recovery_sms(self):
+    def send_recovery_sms(self, idempotency_key=None):
         from core.models import CoreSettings
 
         CORE = CoreSettings.objects.first()
         CORE.send_sms(
             f"{self.client.name}, {self.site.name}, {self.hostname} - data received",
             alert_template=self.alert_template,
+            idempotency_key=idempotency_key,
         )
 
 
@@ -894,3 +825,266 @@ class AgentCustomField(models.Model):
             return self.bool_value
         else:
             return self.string_value
+
+
+BULK_JOB_STATUS_CHOICES = [
+    ("pending", "Pending"),
+    ("running", "Running"),
+    ("completed", "Completed"),
+]
+
+BULK_RESULT_STATUS_CHOICES = [
+    ("pending", "Pending"),
+    ("dispatched", "Dispatched"),
+    ("sent", "Sent"),
+    ("completed", "Completed"),
+    ("timeout", "Timeout"),
+    ("failed", "Failed"),
+]
+
+# results written per batch
+BULK_JOB_FLUSH_SIZE = 100
+
+
+class BulkJob(models.Model):
+    mode = models.CharField(max_length=30)
+    username = models.CharField(max_length=255, null=True, blank=True)
+    status = models.CharField(
+        max_length=30, choices=BULK_JOB_STATUS_CHOICES, default="pending"
+    )
+    details = models.JSONField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.mode} - {self.created}"
+
+    @classmethod
+    def create_job(cls, mode: str, username: str, agentpks: list[int], details=None):
+        job = cls.objects.create(mode=mode, username=username, details=details)
+        BulkJobResult.objects.bulk_create(
+            [BulkJobResult(job=job, agent_id=pk) for pk in agentpks],
+            batch_size=1000,
+        )
+        return job
+
+    @property
+    def group_name(self) -> str:
+        return f"bulkjob_{self.pk}"
+
+    @property
+    def progress(self) -> dict[str, int]:
+        counts = dict(
+            self.results.values_list("status")  # type: ignore
+            .annotate(count=models.Count("pk"))
+            .order_by()
+        )
+        ret = {
+            status: counts.get(status, 0) for status, _ in BULK_RESULT_STATUS_CHOICES
+        }
+        ret["total"] = sum(counts.values())
+        return ret
+
+    def pending_agents(self):
+        return Agent.objects.filter(
+            bulkjobresults__job=self, bulkjobresults__status="pending"
+        )
+
+    def skip(self, agentpks: list[int], reason: str) -> None:
+        self.results.filter(status="pending", agent_id__in=agentpks).update(  # type: ignore
+            status="failed", stderr=reason, completed=djangotime.now()
+        )
+
+    def expire_dispatched(self, before: dt.datetime) -> int:
+        # dispatched by a run that died before the reply was written back, the
+        # agent may or may not have received it so it is never sent again
+        return (
+            self.results.filter(status="dispatched")
+            .filter(  # type: ignore
+                Q(dispatched__lt=before) | Q(dispatched__isnull=True)
+            )
+            .update(
+                status="failed",
+                stderr="The job was interrupted before the agent replied",
+                completed=djangotime.now(),
+            )
+        )
+
+    def send_progress(self) -> None:
+        from asgiref.sync import async_to_sync
+        from channels.layers import get_channel_layer
+
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+
+        try:
+            async_to_sync(channel_layer.group_send)(
+                self.group_name,
+                {
+                    "type": "bulkjob.progress",
+                    "data": {"id": self.pk, "status": self.status, **self.progress},
+                },
+            )
+        except Exception as e:
+            logger.error(f"Unable to send bulk job progress: {e}")
+
+    def _flush(self, results: list) -> None:
+        BulkJobResult.objects.bulk_update(
+            results,
+            fields=[
+                "status",
+                "completed",
+                "retcode",
+                "stdout",
+                "stderr",
+                "execution_time",
+            ],
+        )
+        self.send_progress()
+
+    def run(
+        self,
+        data: Union[dict, Callable[[str], dict]],
+        timeout: int = 30,
+        wait: bool = True,
+        concurrency: int = 100,
+    ) -> None:
+        """
+        Dispatches to every agent that has not been dispatched yet and writes the results
+        back in batches as they arrive. Running it again after a worker died resumes
+        the job, agents that were already dispatched are never sent the command twice
+        and are marked failed once they have been dispatched for longer than `timeout`.
+        """
+        started = djangotime.now()
+        self.status = "running"
+        self.save(update_fields=["status"])
+        self.expire_dispatched(started - djangotime.timedelta(seconds=timeout))
+
+        pending = {
+            result.agent.agent_id: result
+            for result in self.results.filter(status="pending")  # type: ignore
+            .select_related("agent")
+            .only("pk", "status", "agent__agent_id")
+        }
+
+        # agents are pulled as slots free up, so at most `concurrency` agents are
+        # marked as dispatched ahead of being sent
+        def dispatch() -> Iterator[str]:
+            agent_ids = list(pending.keys())
+            for i in range(0, len(agent_ids), concurrency):
+                chunk = agent_ids[i : i + concurrency]
+                BulkJobResult.objects.filter(
+                    pk__in=[pending[agent_id].pk for agent_id in chunk]
+                ).update(status="dispatched", dispatched=djangotime.now())
+                yield from chunk
+
+        batch = []
+        for agent_id, r in Agent.nats_cmd_many(
+            dispatch(), data, timeout=timeout, wait=wait, concurrency=concurrency
+        ):
+            result = pending[agent_id]
+            result.set_result(r, wait=wait)
+            batch.append(result)
+            if len(batch) >= BULK_JOB_FLUSH_SIZE:
+                self._flush(batch)
+                batch = []
+
+        if batch:
+            self._flush(batch)
+
+        # anything still dispatched was left behind by an earlier run
+        self.expire_dispatched(started)
+
+        self.status = "completed"
+        self.finished = djangotime.now()
+        self.save(update_fields=["status", "finished"])
+        self.send_progress()
+
+
+class BulkJobResult(models.Model):
+    job = models.ForeignKey(
+        BulkJob,
+        related_name="results",
+        on_delete=models.CASCADE,
+    )
+    agent = models.ForeignKey(
+        Agent,
+        related_name="bulkjobresults",
+        on_delete=models.CASCADE,
+    )
+    status = models.CharField(
+        max_length=30, choices=BULK_RESULT_STATUS_CHOICES, default="pending"
+    )
+    dispatched = models.DateTimeField(null=True, blank=True)
+    completed = models.DateTimeField(null=True, blank=True)
+    retcode = models.IntegerField(null=True, blank=True)
+    stdout = models.TextField(null=True, blank=True)
+    stderr = models.TextField(null=True, blank=True)
+    execution_time = models.CharField(max_length=100, null=True, blank=True)
+
+    class Meta:
+        unique_together = (("job", "agent"),)
+        indexes = [models.Index(fields=["job", "status"])]
+
+    def __str__(self):
+        return f"{self.job} - {self.agent}"
+
+    def set_result(self, r: Any, wait: bool = True) -> None:
+        self.completed = djangotime.now()
+
+        if r == "timeout":
+            self.status = "timeout"
+        elif r == "natsdown":
+            self.status = "failed"
+            self.stderr = "Unable to contact the agent"
+        elif isinstance(r, dict):
+            self.status = "completed"
+            self.retcode = r.get("retcode")
+            self.stdout = r.get("stdout")
+            self.stderr = r.get("stderr")
+            if "execution_time" in r:
+                self.execution_time = "{:.4f}".format(r["execution_time"])
+        elif not wait:
+            # published without waiting, the agent never acknowledges it
+            self.status = "sent"
+        else:
+            # raw command with plain text output
+            self.status = "completed"
+            self.stdout = r
+
+
+class HardwareInventory(models.Model):
+    agent = models.OneToOneField(
+        Agent,
+        related_name="hardware",
+        on_delete=models.CASCADE,
+    )
+    make = models.CharField(max_length=255, null=True, blank=True, db_index=True)
+    model = models.CharField(max_length=255, null=True, blank=True, db_index=True)
+    make_model = models.CharField(max_length=255, default="unknown make/model")
+    cpus = ArrayField(
+        models.CharField(max_length=255, blank=True), blank=True, default=list
+    )
+    cpu_cores = models.PositiveIntegerField(null=True, blank=True)
+    # null if the agent doesn't report graphics
+    gpus = ArrayField(
+        models.CharField(max_length=255, blank=True), null=True, blank=True
+    )
+    # list of {"model": str, "size": bytes, "interface": str}, usb disks excluded
+    disks = models.JSONField(blank=True, default=list)
+    local_ips = ArrayField(
+        models.GenericIPAddressField(protocol="IPv4"), blank=True, default=list
+    )
+    total_memory = models.BigIntegerField(null=True, blank=True)
+    last_updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=["cpus"]),
+            GinIndex(fields=["gpus"]),
+            GinIndex(fields=["local_ips"]),
+        ]
+
+    def __str__(self):
+        return self.agent.hostname
@@ -4,7 +4,7 @@ from rest_framework import serializers
 from clients.serializers import ClientSerializer
 from winupdate.serializers import WinUpdatePolicySerializer
 
-from .models import Agent, AgentCustomField, Note
+from .models import Agent, AgentCustomField, BulkJob, BulkJobResult, Note
 
 
 class AgentSerializer(serializers.ModelSerializer):
@@ -45,16 +45,17 @@ class AgentOverdueActionSerializer(serializers.ModelSerializer):
 
 
 class AgentTableSerializer(serializers.ModelSerializer):
-    patches_pending = serializers.ReadOnlyField(source="has_patches_pending")
-    pending_actions = serializers.SerializerMethodField()
+    # reads the counters from Agent.objects.annotate_table()
+    patches_pending = serializers.ReadOnlyField()
+    pending_actions = serializers.ReadOnlyField()
     status = serializers.ReadOnlyField()
-    checks = serializers.ReadOnlyField()
+    checks = serializers.SerializerMethodField()
     last_seen = serializers.SerializerMethodField()
-    client_name = serializers.ReadOnlyField(source="client.name")
+    client_name = serializers.ReadOnlyField(source="site.client.name")
     site_name = serializers.ReadOnlyField(source="site.name")
     logged_username = serializers.SerializerMethodField()
     italic = serializers.SerializerMethodField()
-    policy = serializers.ReadOnlyField(source="policy.id")
+    policy = serializers.ReadOnlyField(source="policy_id")
     alert_template = serializers.SerializerMethodField()
 
     def get_alert_template(self, obj):
@@ -69,8 +70,13 @@ class AgentTableSerializer(serializers.ModelSerializer):
                 "always_alert": obj.alert_template.agent_always_alert,
             }
 
-    def get_pending_actions(self, obj):
-        return obj.pendingactions.filter(status="pending").count()
+    def get_checks(self, obj):
+        return {
+            "total": obj.checks_total,
+            "passing": obj.checks_passing,
+            "failing": obj.checks_failing,
+            "has_failing_checks": obj.checks_failing > 0,
+        }
 
     def get_last_seen(self, obj) -> str:
         if obj.time_zone is not None:
@@ -210,3 +216,19 @@ class NotesSerializer(serializers.ModelSerializer):
     class Meta:
         model = Agent
         fields = ["hostname", "pk", "notes"]
+
+
+class BulkJobSerializer(serializers.ModelSerializer):
+    progress = serializers.ReadOnlyField()
+
+    class Meta:
+        model = BulkJob
+        fields = "__all__"
+
+
+class BulkJobResultSerializer(serializers.ModelSerializer):
+    hostname = serializers.ReadOnlyField(source="agent.hostname")
+
+    class Meta:
+        model = BulkJobResult
+        fields = "__all__"
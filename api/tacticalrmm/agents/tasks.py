@@ -1,6 +1,5 @@
 import asyncio
 import datetime as dt
-import random
 from time import sleep
 from typing import Union
 
@@ -10,14 +9,18 @@ from loguru import logger
 from packaging import version as pyver
 
 from agents.models import Agent
+from clients.models import clear_tree_cache
 from core.models import CoreSettings
 from logs.models import PendingAction
 from scripts.models import Script
 from tacticalrmm.celery import app
+from tacticalrmm.redis_client import redis_client
 from tacticalrmm.utils import run_nats_api_cmd
 
 logger.configure(**settings.LOG_CONFIG)
 
+AGENT_OUTAGES_LAST_RUN_KEY = "agent_outages_last_run"
+
 
 def agent_update(pk: int) -> str:
     agent = Agent.objects.get(pk=pk)
@@ -112,22 +115,7 @@ def auto_self_agent_update_task() -> None:
 def agent_outage_email_task(pk: int, alert_interval: Union[float, None] = None) -> str:
     from alerts.models import Alert
 
-    alert = Alert.objects.get(pk=pk)
-
-    if not alert.email_sent:
-        sleep(random.randint(1, 15))
-        alert.agent.send_outage_email()
-        alert.email_sent = djangotime.now()
-        alert.save(update_fields=["email_sent"])
-    else:
-        if alert_interval:
-            # send an email only if the last email sent is older than alert interval
-            delta = djangotime.now() - dt.timedelta(days=alert_interval)
-            if alert.email_sent < delta:
-                sleep(random.randint(1, 10))
-                alert.agent.send_outage_email()
-                alert.email_sent = djangotime.now()
-                alert.save(update_fields=["email_sent"])
+    Alert.notify(pk, "email_sent", "send_outage_email", alert_interval)
 
     return "ok"
 
@@ -136,11 +124,7 @@ def agent_outage_email_task(pk: int, alert_interval: Union[float, None] = None)
 def agent_recovery_email_task(pk: int) -> str:
     from alerts.models import Alert
 
-    sleep(random.randint(1, 15))
-    alert = Alert.objects.get(pk=pk)
-    alert.agent.send_recovery_email()
-    alert.resolved_email_sent = djangotime.now()
-    alert.save(update_fields=["resolved_email_sent"])
+    Alert.notify(pk, "resolved_email_sent", "send_recovery_email")
 
     return "ok"
 
@@ -149,22 +133,7 @@ def agent_recovery_email_task(pk: int) -> str:
 def agent_outage_sms_task(pk: int, alert_interval: Union[float, None] = None) -> str:
     from alerts.models import Alert
 
-    alert = Alert.objects.get(pk=pk)
-
-    if not alert.sms_sent:
-        sleep(random.randint(1, 15))
-        alert.agent.send_outage_sms()
-        alert.sms_sent = djangotime.now()
-        alert.save(update_fields=["sms_sent"])
-    else:
-        if alert_interval:
-            # send an sms only if the last sms sent is older than alert interval
-            delta = djangotime.now() - dt.timedelta(days=alert_interval)
-            if alert.sms_sent < delta:
-                sleep(random.randint(1, 10))
-                alert.agent.send_outage_sms()
-                alert.sms_sent = djangotime.now()
-                alert.save(update_fields=["sms_sent"])
+    Alert.notify(pk, "sms_sent", "send_outage_sms", alert_interval)
 
     return "ok"
 
@@ -173,20 +142,26 @@ def agent_outage_sms_task(pk: int, alert_interval: Union[float, None] = None) ->
 def agent_recovery_sms_task(pk: int) -> str:
     from alerts.models import Alert
 
-    sleep(random.randint(1, 3))
-    alert = Alert.objects.get(pk=pk)
-    alert.agent.send_recovery_sms()
-    alert.resolved_sms_sent = djangotime.now()
-    alert.save(update_fields=["resolved_sms_sent"])
+    Alert.notify(pk, "resolved_sms_sent", "send_recovery_sms")
 
     return "ok"
 
 
 @app.task
-def agent_outages_task() -> None:
+def agent_outages_task(full: bool = False) -> None:
+    """
+    Queues failure events for overdue agents and resolve events for agents that
+    came back online. The minutely run only looks at agents that went overdue
+    since the previous run. Repeat notifications for outages that are still open
+    (alert_interval) and alert setting changes are only picked up by the hourly
+    full run, so reminders are sent up to an hour late.
+    """
     from alerts.models import Alert
 
-    agents = Agent.objects.only(
+    started = djangotime.now()
+    last_run = None if full else redis_client.get(AGENT_OUTAGES_LAST_RUN_KEY)
+
+    agents = Agent.objects.overdue().only(
         "pk",
         "last_seen",
         "offline_time",
@@ -196,9 +171,32 @@ def agent_outages_task() -> None:
         "overdue_dashboard_alert",
     )
 
-    for agent in agents:
-        if agent.status == "overdue":
-            Alert.handle_alert_failure(agent)
+    # only agents that went overdue since the previous run, the ones that go
+    # overdue while this run is going are left for the next one
+    if last_run:
+        agents = agents.filter(
+            overdue_deadline__gt=dt.datetime.fromtimestamp(
+                float(last_run), tz=dt.timezone.utc
+            ),
+            overdue_deadline__lte=started,
+        )
+
+    events = [("failure", agent) for agent in agents]
+
+    # agents that came back online with an outage alert still open
+    recovered = Agent.objects.online().filter(
+        agent__alert_type="availability", agent__resolved=False
+    )
+    events += [("resolve", agent) for agent in recovered.distinct().only("pk")]
+
+    Alert.queue_alert_events(events)
+    if events:
+        clear_tree_cache()
+
+    # moved forward only once the events are queued, a run that fails is covered
+    # by the next one
+    if not full:
+        redis_client.set(AGENT_OUTAGES_LAST_RUN_KEY, started.timestamp())
 
 
 @app.task
@@ -226,48 +224,20 @@ def run_script_email_results_task(
         + f"\nReturn code: {r['retcode']}\nExecution time: {exec_time} seconds\nStdout: {r['stdout']}\nStderr: {r['stderr']}"
     )
 
-    import smtplib
-    from email.message import EmailMessage
-
-    msg = EmailMessage()
-    msg["Subject"] = subject
-    msg["From"] = CORE.smtp_from_email
-
-    if emails:
-        msg["To"] = ", ".join(emails)
-    else:
-        msg["To"] = ", ".join(CORE.email_alert_recipients)
-
-    msg.set_content(body)
-
-    try:
-        with smtplib.SMTP(CORE.smtp_host, CORE.smtp_port, timeout=20) as server:
-            if CORE.smtp_requires_auth:
-                server.ehlo()
-                server.starttls()
-                server.login(CORE.smtp_host_user, CORE.smtp_host_password)
-                server.send_message(msg)
-                server.quit()
-            else:
-                server.send_message(msg)
-                server.quit()
-    except Exception as e:
-        logger.error(e)
+    CORE.send_mail(subject, body, recipients=emails)
 
 
 @app.task
 def monitor_agents_task() -> None:
-    agents = Agent.objects.only(
-        "pk", "agent_id", "last_seen", "overdue_time", "offline_time"
+    ids = list(
+        Agent.objects.exclude(Agent.objects.online_q()).values_list(
+            "agent_id", flat=True
+        )
     )
-    ids = [i.agent_id for i in agents if i.status != "online"]
     run_nats_api_cmd("monitor", ids)
 
 
 @app.task
 def get_wmi_task() -> None:
-    agents = Agent.objects.only(
-        "pk", "agent_id", "last_seen", "overdue_time", "offline_time"
-    )
-    ids = [i.agent_id for i in agents if i.status == "online"]
+    ids = list(Agent.objects.online().values_list("agent_id", flat=True))
     run_nats_api_cmd("wmi", ids)
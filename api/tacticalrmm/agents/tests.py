@@ -4,7 +4,8 @@ from itertools import cycle
 from unittest.mock import patch
 
 from django.conf import settings
-from model_bakery import baker
+from django.utils import timezone as djangotime
+from model_bakery import baker, seq
 from packaging import version as pyver
 
 from logs.models import PendingAction
@@ -12,9 +13,10 @@ from tacticalrmm.test import TacticalTestCase
 from winupdate.models import WinUpdatePolicy
 from winupdate.serializers import WinUpdatePolicySerializer
 
-from .models import Agent, AgentCustomField
+from .models import Agent, AgentCustomField, BulkJob, HardwareInventory
 from .serializers import AgentSerializer
 from .tasks import auto_self_agent_update_task
+from .utils import parse_sysinfo
 
 
 class TestAgentsList(TacticalTestCase):
@@ -73,6 +75,141 @@ class TestAgentsList(TacticalTestCase):
 
         self.check_not_authenticated("patch", url)
 
+    def test_agents_list_pagination(self):
+        url = "/agents/listagents/"
+
+        site = baker.make("clients.Site")
+        baker.make_recipe(
+            "agents.online_agent",
+            site=site,
+            hostname=seq("AGENT-"),
+            monitoring_type="server",
+            _quantity=25,
+        )
+        baker.make_recipe(
+            "agents.online_agent",
+            hostname="WORKSTATION",
+            monitoring_type="workstation",
+            description="front desk",
+            logged_in_username="jsmith",
+            _quantity=2,
+        )
+
+        # page through everything sorted by hostname
+        data = {"pagination": {"sortBy": "hostname", "rowsPerPage": 10}}
+        hostnames = []
+        while True:
+            r = self.client.patch(url, data, format="json")
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.data["total"], 27)  # type: ignore
+            self.assertFalse(r.data["total_is_estimate"])  # type: ignore
+            hostnames += [i["hostname"] for i in r.data["agents"]]  # type: ignore
+            if not r.data["next_cursor"]:  # type: ignore
+                break
+            data["pagination"]["cursor"] = r.data["next_cursor"]  # type: ignore
+
+        self.assertEqual(len(hostnames), 27)
+        self.assertEqual(hostnames, sorted(hostnames))
+
+        # page size falls back to the user's agents_per_page
+        self.john.agents_per_page = 5
+        self.john.save()
+        data = {"pagination": {"sortBy": "status", "descending": True}}
+        r = self.client.patch(url, data, format="json")
+        self.assertEqual(len(r.data["agents"]), 5)  # type: ignore
+
+        # search hostname, description and logged in user
+        for search in ("workst", "FRONT", "jsmi"):
+            data = {"pagination": {"sortBy": "client"}, "search": search}
+            r = self.client.patch(url, data, format="json")
+            self.assertEqual(r.data["total"], 2)  # type: ignore
+
+        # one tab of the table
+        data = {"pagination": {"sortBy": "hostname"}, "monitoringType": "workstation"}
+        r = self.client.patch(url, data, format="json")
+        self.assertEqual(r.data["total"], 2)  # type: ignore
+
+        data = {"pagination": {"sortBy": "site"}, "sitePK": site.pk, "search": "1"}
+        r = self.client.patch(url, data, format="json")
+        # AGENT-1, AGENT-10 ... AGENT-19, AGENT-21
+        self.assertEqual(r.data["total"], 12)  # type: ignore
+
+        data = {"pagination": {"sortBy": "agent_id"}}
+        r = self.client.patch(url, data, format="json")
+        self.assertEqual(r.status_code, 400)
+
+        data = {"pagination": {"sortBy": "hostname", "cursor": "notacursor"}}
+        r = self.client.patch(url, data, format="json")
+        self.assertEqual(r.status_code, 400)
+
+        # page size is clamped and must be a number
+        data = {"pagination": {"sortBy": "hostname", "rowsPerPage": -5}}
+        r = self.client.patch(url, data, format="json")
+        self.assertEqual(len(r.data["agents"]), 1)  # type: ignore
+
+        with patch("agents.views.AGENT_TABLE_MAX_PAGE_SIZE", 20):
+            data = {"pagination": {"sortBy": "hostname", "rowsPerPage": 5000}}
+            r = self.client.patch(url, data, format="json")
+            self.assertEqual(len(r.data["agents"]), 20)  # type: ignore
+
+        data = {"pagination": {"sortBy": "hostname", "rowsPerPage": "all"}}
+        r = self.client.patch(url, data, format="json")
+        self.assertEqual(r.status_code, 400)
+
+    @patch("agents.views.estimated_count", return_value=50000)
+    def test_agents_list_estimated_count(self, estimated_count):
+        url = "/agents/listagents/"
+        site = baker.make("clients.Site")
+        baker.make_recipe("agents.online_agent", site=site, _quantity=3)
+
+        data = {"pagination": {"sortBy": "hostname"}}
+        r = self.client.patch(url, data, format="json")
+        self.assertEqual(r.data["total"], 50000)  # type: ignore
+        self.assertTrue(r.data["total_is_estimate"])  # type: ignore
+
+        # exact count when filtered
+        data["sitePK"] = site.pk
+        r = self.client.patch(url, data, format="json")
+        self.assertEqual(r.data["total"], 3)  # type: ignore
+        self.assertFalse(r.data["total_is_estimate"])  # type: ignore
+
+    def test_agents_list_counters(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        url = "/agents/listagents/"
+
+        agent = baker.make_recipe("agents.online_agent")
+        baker.make_recipe("checks.ping_check", agent=agent, status="passing")
+        baker.make_recipe(
+            "checks.ping_check", agent=agent, status="failing", _quantity=2
+        )
+        baker.make("logs.PendingAction", agent=agent, status="pending", _quantity=3)
+        baker.make("logs.PendingAction", agent=agent, status="completed")
+        baker.make_recipe("winupdate.approved_winupdate", agent=agent, installed=False)
+        baker.make_recipe("agents.online_agent", _quantity=4)
+
+        with CaptureQueriesContext(connection) as few:
+            r = self.client.patch(url, format="json")
+
+        row = [i for i in r.data if i["id"] == agent.pk][0]  # type: ignore
+        self.assertEqual(row["pending_actions"], 3)
+        self.assertTrue(row["patches_pending"])
+        self.assertEqual(row["status"], "online")
+        self.assertEqual(row["client_name"], agent.client.name)
+        self.assertEqual(
+            row["checks"],
+            {"total": 3, "passing": 1, "failing": 2, "has_failing_checks": True},
+        )
+
+        # the number of queries does not grow with the number of agents
+        baker.make_recipe("agents.online_agent", _quantity=20)
+        with CaptureQueriesContext(connection) as many:
+            r = self.client.patch(url, format="json")
+
+        self.assertEqual(len(r.data), 25)  # type: ignore
+        self.assertEqual(len(few), len(many))
+
 
 class TestAgentViews(TacticalTestCase):
     def setUp(self):
@@ -914,6 +1051,77 @@ class TestAgentTasks(TacticalTestCase):
         self.authenticate()
         self.setup_coresettings()
 
+    @patch("alerts.models.Alert.queue_alert_events")
+    @patch("agents.tasks.redis_client")
+    def test_agent_outages_task(self, redis_client, queue_events):
+        from alerts.models import Alert
+
+        from .tasks import agent_outages_task
+
+        now = djangotime.now()
+        new_outage = baker.make_recipe(
+            "agents.agent", last_seen=now - djangotime.timedelta(minutes=31)
+        )
+        old_outage = baker.make_recipe(
+            "agents.agent", last_seen=now - djangotime.timedelta(days=2)
+        )
+        # overdue once it is offline, 61 minutes after it was last seen
+        slow_outage = baker.make_recipe(
+            "agents.agent",
+            last_seen=now - djangotime.timedelta(minutes=61),
+            offline_time=60,
+        )
+        recovered = baker.make_recipe("agents.agent", last_seen=now)
+        baker.make_recipe("agents.agent", last_seen=now)
+        baker.make("alerts.Alert", agent=recovered, alert_type="availability")
+        baker.make("alerts.Alert", agent=old_outage, alert_type="availability")
+
+        # deadline is kept in sync with last_seen and overdue_time
+        self.assertEqual(
+            new_outage.overdue_deadline, now - djangotime.timedelta(minutes=1)
+        )
+        self.assertEqual(
+            slow_outage.overdue_deadline, now - djangotime.timedelta(minutes=1)
+        )
+
+        # the previous run isn't moved forward when queuing the events fails
+        redis_client.get.return_value = str(
+            (now - djangotime.timedelta(minutes=2)).timestamp()
+        ).encode()
+        queue_events.side_effect = Exception("redis down")
+        with self.assertRaises(Exception):
+            agent_outages_task()
+        redis_client.set.assert_not_called()
+        queue_events.side_effect = None
+        queue_events.reset_mock()
+
+        # only agents that went overdue since the previous run
+        agent_outages_task()
+        self.assertCountEqual(
+            queue_events.call_args.args[0],
+            [("failure", new_outage), ("failure", slow_outage), ("resolve", recovered)],
+        )
+        redis_client.set.assert_called_once()
+        self.assertGreaterEqual(redis_client.set.call_args.args[1], now.timestamp())
+
+        # full run goes through every overdue agent
+        queue_events.reset_mock()
+        redis_client.reset_mock()
+        agent_outages_task(full=True)
+        self.assertEqual(
+            {i for e, i in queue_events.call_args.args[0] if e == "failure"},
+            {new_outage, slow_outage, old_outage},
+        )
+        redis_client.set.assert_not_called()
+
+        # bulk changes to overdue_time
+        Agent.objects.filter(pk=new_outage.pk).update(overdue_time=60)
+        Agent.objects.filter(pk=new_outage.pk).set_overdue_deadline()
+        new_outage.refresh_from_db()
+        self.assertEqual(
+            new_outage.overdue_deadline, now + djangotime.timedelta(minutes=29)
+        )
+
     @patch("agents.models.Agent.nats_cmd")
     def test_agent_update(self, nats_cmd):
         from agents.tasks import agent_update
@@ -1013,3 +1221,321 @@ class TestAgentTasks(TacticalTestCase):
 
         r = auto_self_agent_update_task.s().apply()
         self.assertEqual(agent_update.call_count, 33)
+
+
+class TestBulkJobs(TacticalTestCase):
+    def setUp(self):
+        self.authenticate()
+        self.setup_coresettings()
+
+    @patch("scripts.tasks.handle_bulk_command_task.delay")
+    def test_bulk_creates_job(self, bulk_command):
+        agents = baker.make_recipe(
+            "agents.agent", last_seen=djangotime.now(), _quantity=3
+        )
+        offline = baker.make_recipe("agents.agent")
+        payload = {
+            "mode": "command",
+            "monType": "all",
+            "target": "agents",
+            "client": None,
+            "site": None,
+            "agentPKs": [i.pk for i in agents] + [offline.pk],
+            "cmd": "gpupdate /force",
+            "timeout": 300,
+            "shell": "cmd",
+        }
+
+        r = self.client.post("/agents/bulk/", payload, format="json")
+        self.assertEqual(r.status_code, 200)
+
+        job = BulkJob.objects.get()
+        self.assertEqual(job.mode, "command")
+        self.assertEqual(job.progress["pending"], 3)
+        # offline agents are failed without being dispatched
+        self.assertEqual(job.progress["failed"], 1)
+        self.assertEqual(
+            job.results.get(agent=offline).stderr, "Agent is offline"  # type: ignore
+        )
+        bulk_command.assert_called_with(job.pk, "gpupdate /force", "cmd", 300)
+
+        self.check_not_authenticated("post", "/agents/bulk/")
+
+    @patch("agents.models.Agent.nats_cmd_many")
+    def test_run_resumes_pending_agents(self, nats_cmd_many):
+        agents = baker.make_recipe("agents.agent", _quantity=4)
+        job = BulkJob.create_job("command", "tactical", [i.pk for i in agents])
+
+        # simulate a worker that died after dispatching the first agent
+        job.results.filter(agent=agents[0]).update(status="dispatched")
+
+        sent = []
+
+        def fake_nats_cmd_many(agent_ids, data, **kwargs):
+            for agent_id in agent_ids:
+                sent.append(agent_id)
+            return [
+                (sent[0], "timeout"),
+                (sent[1], "natsdown"),
+                (sent[2], "output"),
+            ]
+
+        nats_cmd_many.side_effect = fake_nats_cmd_many
+        job.run({"func": "rawcmd"})
+
+        self.assertEqual(sorted(sent), sorted(i.agent_id for i in agents[1:]))
+        job.refresh_from_db()
+        self.assertEqual(job.status, "completed")
+        self.assertIsNotNone(job.finished)
+        progress = job.progress
+        # the agent left dispatched by the dead worker is never sent it again
+        self.assertEqual(progress["dispatched"], 0)
+        self.assertEqual(progress["timeout"], 1)
+        self.assertEqual(progress["failed"], 2)
+        self.assertEqual(progress["completed"], 1)
+        self.assertEqual(progress["total"], 4)
+        self.assertEqual(
+            job.results.get(agent=agents[0]).stderr,  # type: ignore
+            "The job was interrupted before the agent replied",
+        )
+
+    @patch("agents.models.Agent.nats_cmd_many")
+    def test_run_expires_stale_dispatched(self, nats_cmd_many):
+        agents = baker.make_recipe("agents.agent", _quantity=3)
+        job = BulkJob.create_job("command", "tactical", [i.pk for i in agents])
+        now = djangotime.now()
+        job.results.filter(agent=agents[0]).update(  # type: ignore
+            status="dispatched", dispatched=now - djangotime.timedelta(minutes=5)
+        )
+        job.results.filter(agent=agents[1]).update(  # type: ignore
+            status="dispatched", dispatched=now
+        )
+
+        expired = job.expire_dispatched(now - djangotime.timedelta(seconds=30))
+        self.assertEqual(expired, 1)
+        self.assertEqual(job.progress["dispatched"], 1)
+
+        # wait=False results are only published, never acknowledged
+        nats_cmd_many.side_effect = lambda agent_ids, data, **kwargs: [
+            (agent_id, None) for agent_id in agent_ids
+        ]
+        job.run({"func": "installwinupdates"}, wait=False)
+
+        progress = job.progress
+        self.assertEqual(progress["dispatched"], 0)
+        self.assertEqual(progress["failed"], 2)
+        self.assertEqual(progress["sent"], 1)
+        self.assertEqual(progress["completed"], 0)
+        self.assertIsNone(job.results.get(agent=agents[2]).stdout)  # type: ignore
+
+    def test_get_bulk_job(self):
+        agents = baker.make_recipe("agents.agent", _quantity=15)
+        job = BulkJob.create_job("command", "tactical", [i.pk for i in agents])
+        job.results.filter(agent__in=agents[:5]).update(status="failed")
+
+        r = self.client.get("/agents/bulkjobs/", format="json")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(r.data), 1)
+
+        url = f"/agents/bulkjobs/{job.pk}/"
+        data = {
+            "pagination": {
+                "rowsPerPage": 10,
+                "page": 1,
+                "sortBy": "hostname",
+                "descending": False,
+            }
+        }
+        r = self.client.patch(url, data, format="json")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(r.data["results"]), 10)
+        self.assertEqual(
+            [i["hostname"] for i in r.data["results"]],
+            sorted(i.hostname for i in agents)[:10],
+        )
+        self.assertEqual(r.data["total"], 15)
+        self.assertEqual(r.data["job"]["progress"]["failed"], 5)
+
+        data["status"] = ["failed"]
+        r = self.client.patch(url, data, format="json")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.data["total"], 5)
+
+        # only known columns can be sorted by
+        data["pagination"]["sortBy"] = "agent__site__client__notafield"
+        r = self.client.patch(url, data, format="json")
+        self.assertEqual(r.status_code, 400)
+
+        r = self.client.patch("/agents/bulkjobs/500/", data, format="json")
+        self.assertEqual(r.status_code, 404)
+
+        self.check_not_authenticated("patch", url)
+
+
+class TestAgentStatusQuerySet(TacticalTestCase):
+    def setUp(self):
+        self.setup_coresettings()
+        now = djangotime.now()
+        self.online = baker.make_recipe("agents.agent", last_seen=now, _quantity=2)
+        self.offline = baker.make_recipe(
+            "agents.agent", last_seen=now - djangotime.timedelta(minutes=7)
+        )
+        self.never_seen = baker.make_recipe("agents.agent", last_seen=None)
+        self.overdue = baker.make_recipe(
+            "agents.agent", last_seen=now - djangotime.timedelta(minutes=35)
+        )
+        # custom thresholds are per agent
+        self.custom = baker.make_recipe(
+            "agents.agent",
+            last_seen=now - djangotime.timedelta(minutes=7),
+            offline_time=10,
+        )
+
+    def test_filters(self):
+        self.assertEqual(set(Agent.objects.online()), set(self.online) | {self.custom})
+        self.assertEqual(set(Agent.objects.offline()), {self.offline, self.never_seen})
+        self.assertEqual(set(Agent.objects.overdue()), {self.overdue})
+
+    def test_annotate_status_matches_property(self):
+        agents = Agent.objects.annotate_status()
+        self.assertEqual(agents.count(), 6)
+        for agent in agents:
+            self.assertEqual(agent.agent_status, Agent.objects.get(pk=agent.pk).status)
+
+        self.assertEqual(
+            agents.filter(agent_status="offline").count(),
+            Agent.objects.offline().count(),
+        )
+
+    def test_status_at_the_overdue_cutoff(self):
+        now = djangotime.now()
+        agent = baker.make_recipe(
+            "agents.agent",
+            last_seen=now - djangotime.timedelta(minutes=30),
+            offline_time=4,
+            overdue_time=30,
+        )
+        with patch("agents.models.djangotime.now", return_value=now):
+            self.assertEqual(agent.status, "offline")
+
+            agent.last_seen -= djangotime.timedelta(microseconds=1)
+            self.assertEqual(agent.status, "overdue")
+
+
+class TestHardwareInventory(TacticalTestCase):
+    def setUp(self):
+        self.authenticate()
+        self.setup_coresettings()
+
+    def test_parse_sysinfo(self):
+        with open(
+            os.path.join(
+                settings.BASE_DIR, "tacticalrmm/test_data/wmi_python_agent.json"
+            )
+        ) as f:
+            sysinfo = json.load(f)
+
+        ret = parse_sysinfo(sysinfo)
+        self.assertEqual(ret["make"], "Dell Inc.")
+        self.assertEqual(ret["model"], "Inspiron 3493")
+        self.assertEqual(ret["make_model"], "Dell Inc. Inspiron 3493")
+        self.assertEqual(ret["cpus"], ["Intel(R) Core(TM) i5-1035G4 CPU @ 1.10GHz"])
+        self.assertEqual(ret["cpu_cores"], 4)
+        self.assertIsNone(ret["gpus"])
+        self.assertEqual(
+            ret["disks"],
+            [
+                {
+                    "model": "NVMe SAMSUNG MZVLW256",
+                    "size": 256052966400,
+                    "interface": "SCSI",
+                }
+            ],
+        )
+        self.assertEqual(ret["local_ips"], ["172.17.9.241", "10.8.0.188"])
+        self.assertEqual(ret["total_memory"], 8589934592)
+
+        # missing or malformed keys fall back to empty values
+        ret = parse_sysinfo({"cpu": "bad", "disk": [[{"Caption": "no interface"}]]})
+        self.assertEqual(ret["cpus"], [])
+        self.assertIsNone(ret["cpu_cores"])
+        self.assertEqual(ret["disks"], [])
+        self.assertEqual(ret["local_ips"], [])
+        self.assertEqual(ret["make_model"], "unknown make/model")
+
+    def test_agent_properties(self):
+        agent = baker.make_recipe("agents.agent")
+
+        # no sysinfo received yet
+        self.assertEqual(agent.cpu_model, ["unknown cpu model"])
+        self.assertEqual(agent.graphics, "Graphics info requires agent v1.4.14")
+        self.assertEqual(agent.local_ips, "error getting local ips")
+        self.assertEqual(agent.make_model, "unknown make/model")
+        self.assertEqual(agent.physical_disks, ["unknown disk"])
+
+        baker.make(
+            "agents.HardwareInventory",
+            agent=agent,
+            make_model="Dell Inc. Inspiron 3493",
+            cpus=["Intel(R) Core(TM) i5-1035G4 CPU @ 1.10GHz"],
+            gpus=["Microsoft Remote Display Adapter", "Intel(R) UHD Graphics"],
+            disks=[{"model": "Samsung SSD", "size": 256052966400, "interface": "SCSI"}],
+            local_ips=["10.0.0.5", "192.168.1.20"],
+        )
+        agent = Agent.objects.select_related("hardware").get(pk=agent.pk)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                agent.cpu_model, ["Intel(R) Core(TM) i5-1035G4 CPU @ 1.10GHz"]
+            )
+            self.assertEqual(agent.graphics, "Intel(R) UHD Graphics")
+            self.assertEqual(agent.local_ips, "10.0.0.5, 192.168.1.20")
+            self.assertEqual(agent.make_model, "Dell Inc. Inspiron 3493")
+            self.assertEqual(agent.physical_disks, ["Samsung SSD 238GB SCSI"])
+
+        agent.hardware.gpus = ["Microsoft Remote Display Adapter"]
+        agent.hardware.local_ips = ["10.0.0.5"]
+        self.assertEqual(agent.graphics, "Microsoft Remote Display Adapter")
+        self.assertEqual(agent.local_ips, "10.0.0.5")
+
+    def test_update_hardware_inventory(self):
+        agent = baker.make_recipe("agents.agent")
+
+        # nothing to parse
+        agent.update_hardware_inventory()
+        self.assertFalse(HardwareInventory.objects.filter(agent=agent).exists())
+
+        with open(
+            os.path.join(
+                settings.BASE_DIR, "tacticalrmm/test_data/wmi_python_agent.json"
+            )
+        ) as f:
+            agent.wmi_detail = json.load(f)
+
+        agent.update_hardware_inventory()
+        hw = HardwareInventory.objects.get(agent=agent)
+        self.assertEqual(hw.make_model, "Dell Inc. Inspiron 3493")
+        self.assertEqual(hw.local_ips, ["172.17.9.241", "10.8.0.188"])
+
+        # re-ingesting updates the existing row
+        agent.wmi_detail["network_config"] = []
+        agent.update_hardware_inventory()
+        self.assertEqual(HardwareInventory.objects.filter(agent=agent).count(), 1)
+        hw.refresh_from_db()
+        self.assertEqual(hw.local_ips, [])
+
+        # fleet wide queries use the indexed columns
+        self.assertEqual(
+            Agent.objects.filter(hardware__make="Dell Inc.").count(),
+            1,
+        )
+        self.assertEqual(
+            Agent.objects.filter(
+                hardware__cpus__contains=["Intel(R) Core(TM) i5-1035G4 CPU @ 1.10GHz"]
+            ).count(),
+            1,
+        )
+
+        r = self.client.get(f"/agents/{agent.pk}/agentdetail/", format="json")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.data["make_model"], "Dell Inc. Inspiron 3493")  # type: ignore
@@ -27,6 +27,8 @@ urlpatterns = [
     path("<int:pk>/notes/", views.GetAddNotes.as_view()),
     path("<int:pk>/note/", views.GetEditDeleteNote.as_view()),
     path("bulk/", views.bulk),
+    path("bulkjobs/", views.BulkJobs.as_view()),
+    path("bulkjobs/<int:pk>/", views.GetBulkJob.as_view()),
     path("maintenance/", views.agent_maintenance),
     path("<int:pk>/wmi/", views.WMI.as_view()),
 ]
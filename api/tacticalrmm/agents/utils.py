@@ -0,0 +1,127 @@
+from typing import Any, Optional
+
+import validators
+
+
+def wmi_value(obj: list[dict], key: str) -> Any:
+    # each wmi object is sent as a list of single key dicts
+    return [x[key] for x in obj if key in x][0]
+
+
+def parse_cpus(sysinfo: dict) -> tuple[list[str], Optional[int]]:
+    cpus, cores = [], 0
+    try:
+        for cpu in sysinfo["cpu"]:
+            cpus.append(wmi_value(cpu, "Name"))
+            try:
+                cores += int(wmi_value(cpu, "NumberOfCores"))
+            except:
+                pass
+    except:
+        return [], None
+
+    return cpus, cores or None
+
+
+def parse_gpus(sysinfo: dict) -> Optional[list[str]]:
+    # None means the agent is too old to report graphics
+    try:
+        return [wmi_value(i, "Caption") for i in sysinfo["graphics"]]
+    except:
+        return None
+
+
+def parse_local_ips(sysinfo: dict) -> list[str]:
+    ret = []
+    try:
+        ips = sysinfo["network_config"]
+    except:
+        return ret
+
+    for i in ips:
+        try:
+            addr = wmi_value(i, "IPAddress")
+        except:
+            continue
+
+        if addr is None:
+            continue
+
+        for ip in addr:
+            if validators.ipv4(ip):
+                ret.append(ip)
+
+    return ret
+
+
+def parse_make_model(sysinfo: dict) -> tuple[Optional[str], Optional[str], str]:
+    try:
+        comp_sys = sysinfo["comp_sys"][0]
+        comp_sys_prod = sysinfo["comp_sys_prod"][0]
+        make = wmi_value(comp_sys_prod, "Vendor")
+        model = wmi_value(comp_sys, "Model")
+
+        if "to be filled" in model.lower():
+            mobo = sysinfo["base_board"][0]
+            make = wmi_value(mobo, "Manufacturer")
+            model = wmi_value(mobo, "Product")
+
+        return make, model, f"{make} {model}"
+    except:
+        pass
+
+    try:
+        comp_sys_prod = sysinfo["comp_sys_prod"][0]
+        return None, None, wmi_value(comp_sys_prod, "Version")
+    except:
+        pass
+
+    return None, None, "unknown make/model"
+
+
+def parse_disks(sysinfo: dict) -> list[dict]:
+    ret = []
+    try:
+        for disk in sysinfo["disk"]:
+            interface_type = wmi_value(disk, "InterfaceType")
+            if interface_type == "USB":
+                continue
+
+            ret.append(
+                {
+                    "model": wmi_value(disk, "Caption"),
+                    "size": int(wmi_value(disk, "Size")),
+                    "interface": interface_type,
+                }
+            )
+    except:
+        return []
+
+    return ret
+
+
+def parse_total_memory(sysinfo: dict) -> Optional[int]:
+    try:
+        return sum(int(wmi_value(mem, "Capacity")) for mem in sysinfo["mem"]) or None
+    except:
+        return None
+
+
+def parse_sysinfo(sysinfo: dict) -> dict[str, Any]:
+    """
+    Flattens the raw wmi sysinfo sent by the agent into the columns
+    of agents.HardwareInventory
+    """
+    cpus, cpu_cores = parse_cpus(sysinfo)
+    make, model, make_model = parse_make_model(sysinfo)
+    return {
+        "make": make,
+        "model": model,
+        "make_model": make_model,
+        "cpus": cpus,
+        "cpu_cores": cpu_cores,
+        "gpus": parse_gpus(sysinfo),
+        "disks": parse_disks(sysinfo),
+        "local_ips": parse_local_ips(sysinfo),
+        "total_memory": parse_total_memory(sysinfo),
+    }
@@ -5,6 +5,8 @@ import random
 import string
 
 from django.conf import settings
+from django.core.paginator import Paginator
+from django.db.models import Q
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
 from loguru import logger
@@ -14,15 +16,22 @@ from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from clients.models import clear_tree_cache
 from core.models import CoreSettings
 from logs.models import AuditLog, PendingAction
 from scripts.models import Script
 from scripts.tasks import handle_bulk_command_task, handle_bulk_script_task
-from tacticalrmm.utils import get_default_timezone, notify_error, reload_nats
+from tacticalrmm.utils import (
+    estimated_count,
+    get_default_timezone,
+    keyset_paginate,
+    notify_error,
+    reload_nats,
+)
 from winupdate.serializers import WinUpdatePolicySerializer
 from winupdate.tasks import bulk_check_for_updates_task, bulk_install_updates_task
 
-from .models import Agent, AgentCustomField, Note, RecoveryAction
+from .models import Agent, AgentCustomField, BulkJob, Note, RecoveryAction
 from .serializers import (
     AgentCustomFieldSerializer,
     AgentEditSerializer,
@@ -30,6 +39,8 @@ from .serializers import (
     AgentOverdueActionSerializer,
     AgentSerializer,
     AgentTableSerializer,
+    BulkJobResultSerializer,
+    BulkJobSerializer,
     NoteSerializer,
     NotesSerializer,
 )
@@ -157,7 +168,7 @@ def meshcentral(request, pk):
 
 @api_view()
 def agent_detail(request, pk):
-    agent = get_object_or_404(Agent, pk=pk)
+    agent = get_object_or_404(Agent.objects.select_related("hardware"), pk=pk)
     return Response(AgentSerializer(agent).data)
 
 
@@ -231,39 +242,65 @@ def send_raw_cmd(request):
     return Response(r)
 
 
+AGENT_TABLE_SORT_KEYS = {
+    "hostname": "hostname",
+    "last_seen": "last_seen",
+    "status": "agent_status",
+    "client": "site__client__name",
+    "site": "site__name",
+}
+
+# below this many agents an exact count is cheap enough
+AGENT_COUNT_ESTIMATE_THRESHOLD = 10000
+
+# largest page of the agents table
+AGENT_TABLE_MAX_PAGE_SIZE = 1000
+
+
 class AgentsTableList(APIView):
     def patch(self, request):
+        queryset = Agent.objects.select_related("site__client", "alert_template")
+        broad = True
+
         if "sitePK" in request.data.keys():
-            queryset = (
-                Agent.objects.select_related("site", "policy", "alert_template")
-                .prefetch_related("agentchecks")
-                .filter(site_id=request.data["sitePK"])
-            )
+            queryset = queryset.filter(site_id=request.data["sitePK"])
+            broad = False
         elif "clientPK" in request.data.keys():
-            queryset = (
-                Agent.objects.select_related("site", "policy", "alert_template")
-                .prefetch_related("agentchecks")
-                .filter(site__client_id=request.data["clientPK"])
+            queryset = queryset.filter(site__client_id=request.data["clientPK"])
+            broad = False
+
+        if request.data.get("monitoringType") in ("server", "workstation"):
+            queryset = queryset.filter(monitoring_type=request.data["monitoringType"])
+            broad = False
+
+        if "search" in request.data.keys() and request.data["search"]:
+            broad = False
+            search = request.data["search"]
+            queryset = queryset.filter(
+                Q(hostname__icontains=search)
+                | Q(description__icontains=search)
+                | Q(logged_in_username__icontains=search)
+                | Q(last_logged_in_user__icontains=search)
             )
-        else:
-            queryset = Agent.objects.select_related(
-                "site", "policy", "alert_template"
-            ).prefetch_related("agentchecks")
 
-        queryset = queryset.only(
+        filtered = queryset
+        queryset = queryset.annotate_table().only(
             "pk",
             "hostname",
             "agent_id",
-            "site",
+            "site__name",
+            "site__client__name",
             "policy",
-            "alert_template",
+            "alert_template__name",
+            "alert_template__agent_always_email",
+            "alert_template__agent_always_text",
+            "alert_template__agent_always_alert",
             "monitoring_type",
             "description",
             "needs_reboot",
             "overdue_text_alert",
             "overdue_email_alert",
-            "overdue_time",
-            "offline_time",
+            "overdue_dashboard_alert",
             "last_seen",
             "boot_time",
             "logged_in_username",
@@ -272,8 +309,51 @@ class AgentsTableList(APIView):
             "maintenance_mode",
         )
         ctx = {"default_tz": get_default_timezone()}
-        serializer = AgentTableSerializer(queryset, many=True, context=ctx)
-        return Response(serializer.data)
+
+        # without pagination every agent is returned, for clients that expect a list
+        if "pagination" not in request.data.keys():
+            serializer = AgentTableSerializer(queryset, many=True, context=ctx)
+            return Response(serializer.data)
+
+        pagination = request.data["pagination"]
+        sort_by = pagination.get("sortBy") or "hostname"
+        if sort_by not in AGENT_TABLE_SORT_KEYS.keys():
+            return notify_error(f"Unable to sort by {sort_by}")
+
+        try:
+            page_size = int(
+                pagination.get("rowsPerPage") or request.user.agents_per_page
+            )
+        except (ValueError, TypeError):
+            return notify_error("Invalid rowsPerPage")
+
+        page_size = min(max(page_size, 1), AGENT_TABLE_MAX_PAGE_SIZE)
+
+        try:
+            agents, next_cursor = keyset_paginate(
+                queryset,
+                sort_by=AGENT_TABLE_SORT_KEYS[sort_by],
+                descending=pagination.get("descending", False),
+                page_size=page_size,
+                cursor=pagination.get("cursor"),
+            )
+        except (ValueError, TypeError):
+            return notify_error("Invalid cursor")
+
+        total = None
+        if broad:
+            total = estimated_count(Agent)
+            if total is not None and total < AGENT_COUNT_ESTIMATE_THRESHOLD:
+                total = None
+
+        return Response(
+            {
+                "agents": AgentTableSerializer(agents, many=True, context=ctx).data,
+                "next_cursor": next_cursor,
+                "total": total if total is not None else filtered.count(),
+                "total_is_estimate": total is not None,
+            }
+        )
 
 
 @api_view()
@@ -643,32 +723,95 @@ def bulk(request):
         q = q.filter(monitoring_type="workstation")
 
     agents: list[int] = [agent.pk for agent in q]
+    online = set(q.online().values_list("pk", flat=True))
+
+    if request.data["mode"] not in ("command", "script", "install", "scan"):
+        return notify_error("Something went wrong")
+
+    if request.data["mode"] == "script":
+        script = get_object_or_404(Script, pk=request.data["scriptPK"])
 
     AuditLog.audit_bulk_action(request.user, request.data["mode"], request.data)
 
+    job = BulkJob.create_job(
+        mode=request.data["mode"],
+        username=request.user.username,
+        agentpks=agents,
+        details={
+            k: v
+            for k, v in request.data.items()
+            if k in ("cmd", "shell", "scriptPK", "args", "timeout")
+        },
+    )
+    # offline agents would only hold a slot until they time out
+    job.skip([pk for pk in agents if pk not in online], "Agent is offline")
+
     if request.data["mode"] == "command":
         handle_bulk_command_task.delay(
-            agents, request.data["cmd"], request.data["shell"], request.data["timeout"]
+            job.pk, request.data["cmd"], request.data["shell"], request.data["timeout"]
         )
         return Response(f"Command will now be run on {len(agents)} agents")
 
     elif request.data["mode"] == "script":
-        script = get_object_or_404(Script, pk=request.data["scriptPK"])
         handle_bulk_script_task.delay(
-            script.pk, agents, request.data["args"], request.data["timeout"]
+            job.pk, script.pk, request.data["args"], request.data["timeout"]
         )
         return Response(f"{script.name} will now be run on {len(agents)} agents")
 
     elif request.data["mode"] == "install":
-        bulk_install_updates_task.delay(agents)
+        bulk_install_updates_task.delay(job.pk)
         return Response(
             f"Pending updates will now be installed on {len(agents)} agents"
         )
-    elif request.data["mode"] == "scan":
-        bulk_check_for_updates_task.delay(agents)
-        return Response(f"Patch status scan will now run on {len(agents)} agents")
 
-    return notify_error("Something went wrong")
+    bulk_check_for_updates_task.delay(job.pk)
+    return Response(f"Patch status scan will now run on {len(agents)} agents")
+
+
+BULK_JOB_RESULT_SORT_KEYS = {
+    "hostname": "agent__hostname",
+    "status": "status",
+    "dispatched": "dispatched",
+    "completed": "completed",
+    "retcode": "retcode",
+    "execution_time": "execution_time",
+}
+
+
+class BulkJobs(APIView):
+    def get(self, request):
+        jobs = BulkJob.objects.order_by("-created")[:50]
+        return Response(BulkJobSerializer(jobs, many=True).data)
+
+
+class GetBulkJob(APIView):
+    def patch(self, request, pk):
+        job = get_object_or_404(BulkJob, pk=pk)
+        pagination = request.data["pagination"]
+
+        sort_by = pagination.get("sortBy") or "hostname"
+        if sort_by not in BULK_JOB_RESULT_SORT_KEYS.keys():
+            return notify_error(f"Unable to sort by {sort_by}")
+
+        order_by = BULK_JOB_RESULT_SORT_KEYS[sort_by]
+        if pagination.get("descending"):
+            order_by = f"-{order_by}"
+
+        results = job.results.select_related("agent").order_by(order_by)  # type: ignore
+        if "status" in request.data and request.data["status"]:
+            results = results.filter(status__in=request.data["status"])
+
+        paginator = Paginator(results, pagination["rowsPerPage"])
+
+        return Response(
+            {
+                "job": BulkJobSerializer(job).data,
+                "results": BulkJobResultSerializer(
+                    paginator.get_page(pagination["page"]), many=True
+                ).data,
+                "total": paginator.count,
+            }
+        )
 
 
 @api_view(["POST"])
@@ -691,6 +834,8 @@ def agent_maintenance(request):
     else:
         return notify_error("Invalid data")
 
+    # bulk updates don't send signals
+    clear_tree_cache()
     return Response("ok")
 
 
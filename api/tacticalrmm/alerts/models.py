@@ -1,15 +1,22 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, Union
+import datetime as dt
+import json
+from collections import defaultdict
+from typing import TYPE_CHECKING, Any, Optional, Union
 
 from django.conf import settings
 from django.contrib.postgres.fields import ArrayField
-from django.db import models
+from django.db import models, transaction
 from django.db.models.fields import BooleanField, PositiveIntegerField
 from django.utils import timezone as djangotime
 from loguru import logger
 
+from tacticalrmm.redis_client import redis_client
+
 if TYPE_CHECKING:
+    from django.db.models import QuerySet
+
     from agents.models import Agent
     from autotasks.models import AutomatedTask
     from checks.models import Check
@@ -29,6 +36,32 @@ ALERT_TYPE_CHOICES = [
     ("custom", "Custom"),
 ]
 
+# alert events from agent requests are processed in batches by a celery task
+ALERT_EVENTS_QUEUE_KEY = "alert_events"
+ALERT_EVENTS_BATCH = 500
+# seconds the run that processes the queue holds its lock
+ALERT_EVENTS_LOCK_TIMEOUT = 300
+
+# moves a batch from the queue to the processing list in one step
+MOVE_ALERT_EVENTS_SCRIPT = """
+local events = redis.call("lrange", KEYS[1], 0, ARGV[1] - 1)
+if #events > 0 then
+    redis.call("ltrim", KEYS[1], ARGV[1], -1)
+    redis.call("rpush", KEYS[2], unpack(events))
+end
+return events
+"""
+
+# fields written when alert events are applied to existing alerts
+ALERT_STATE_FIELDS = [
+    "severity",
+    "hidden",
+    "resolved",
+    "resolved_on",
+    "snoozed",
+    "snooze_until",
+]
+
 
 class Alert(models.Model):
     agent = models.ForeignKey(
@@ -90,344 +123,505 @@ class Alert(models.Model):
         self.snooze_until = None
         self.save()
 
-    @classmethod
-    def create_or_return_availability_alert(cls, agent):
-        if not cls.objects.filter(agent=agent, resolved=False).exists():
-            return cls.objects.create(
-                agent=agent,
-                alert_type="availability",
-                severity="error",
-                message=f"{agent.hostname} in {agent.client.name}\\{agent.site.name} is overdue.",
-                hidden=True,
-            )
-        else:
-            return cls.objects.get(agent=agent, resolved=False)
-
-    @classmethod
-    def create_or_return_check_alert(cls, check):
-
-        if not cls.objects.filter(assigned_check=check, resolved=False).exists():
-            return cls.objects.create(
-                assigned_check=check,
-                alert_type="check",
-                severity=check.alert_severity,
-                message=f"{check.agent.hostname} has a {check.check_type} check: {check.readable_desc} that failed.",
-                hidden=True,
-            )
-        else:
-            return cls.objects.get(assigned_check=check, resolved=False)
-
-    @classmethod
-    def create_or_return_task_alert(cls, task):
-
-        if not cls.objects.filter(assigned_task=task, resolved=False).exists():
-            return cls.objects.create(
-                assigned_task=task,
-                alert_type="task",
-                severity=task.alert_severity,
-                message=f"{task.agent.hostname} has task: {task.name} that failed.",
-                hidden=True,
-            )
-        else:
-            return cls.objects.get(assigned_task=task, resolved=False)
-
-    @classmethod
-    def handle_alert_failure(cls, instance: Union[Agent, AutomatedTask, Check]) -> None:
+    @staticmethod
+    def alert_settings(
+        instance: Union[Agent, AutomatedTask, Check]
+    ) -> Optional[dict[str, Any]]:
+        """The alerting configuration that applies to an agent, check or task"""
         from agents.models import Agent
         from autotasks.models import AutomatedTask
         from checks.models import Check
 
-        # set variables
-        dashboard_severities = None
-        email_severities = None
-        text_severities = None
-        always_dashboard = None
-        always_email = None
-        always_text = None
-        alert_interval = None
-        email_task = None
-        text_task = None
+        ret: dict[str, Any] = {
+            "dashboard_severities": None,
+            "email_severities": None,
+            "text_severities": None,
+            "always_dashboard": None,
+            "always_email": None,
+            "always_text": None,
+            "alert_interval": None,
+            "email_on_resolved": False,
+            "text_on_resolved": False,
+        }
 
         # check what the instance passed is
         if isinstance(instance, Agent):
-            from agents.tasks import agent_outage_email_task, agent_outage_sms_task
-
-            email_task = agent_outage_email_task
-            text_task = agent_outage_sms_task
+            from agents.tasks import (
+                agent_outage_email_task,
+                agent_outage_sms_task,
+                agent_recovery_email_task,
+                agent_recovery_sms_task,
+            )
 
-            email_alert = instance.overdue_email_alert
-            text_alert = instance.overdue_text_alert
-            dashboard_alert = instance.overdue_dashboard_alert
-            alert_template = instance.alert_template
-            maintenance_mode = instance.maintenance_mode
-            alert_severity = "error"
             agent = instance
+            alert_template = instance.alert_template
+            ret.update(
+                alert_type="availability",
+                email_task=agent_outage_email_task,
+                text_task=agent_outage_sms_task,
+                resolved_email_task=agent_recovery_email_task,
+                resolved_text_task=agent_recovery_sms_task,
+                email_alert=instance.overdue_email_alert,
+                text_alert=instance.overdue_text_alert,
+                dashboard_alert=instance.overdue_dashboard_alert,
+                alert_severity="error",
+            )
 
             # set alert_template settings
             if alert_template:
-                dashboard_severities = ["error"]
-                email_severities = ["error"]
-                text_severities = ["error"]
-                always_dashboard = alert_template.agent_always_alert
-                always_email = alert_template.agent_always_email
-                always_text = alert_template.agent_always_text
-                alert_interval = alert_template.agent_periodic_alert_days
-
-            if instance.should_create_alert(alert_template):
-                alert = cls.create_or_return_availability_alert(instance)
+                ret.update(
+                    dashboard_severities=["error"],
+                    email_severities=["error"],
+                    text_severities=["error"],
+                    always_dashboard=alert_template.agent_always_alert,
+                    always_email=alert_template.agent_always_email,
+                    always_text=alert_template.agent_always_text,
+                    alert_interval=alert_template.agent_periodic_alert_days,
+                    email_on_resolved=alert_template.agent_email_on_resolved,
+                    text_on_resolved=alert_template.agent_text_on_resolved,
+                )
+
+        elif isinstance(instance, (Check, AutomatedTask)):
+            if isinstance(instance, Check):
+                from checks.tasks import (
+                    handle_check_email_alert_task,
+                    handle_check_sms_alert_task,
+                    handle_resolved_check_email_alert_task,
+                    handle_resolved_check_sms_alert_task,
+                )
+
+                prefix = "check"
+                ret.update(
+                    email_task=handle_check_email_alert_task,
+                    text_task=handle_check_sms_alert_task,
+                    resolved_email_task=handle_resolved_check_email_alert_task,
+                    resolved_text_task=handle_resolved_check_sms_alert_task,
+                )
             else:
-                # check if there is an alert that exists
-                if cls.objects.filter(agent=instance, resolved=False).exists():
-                    alert = cls.objects.get(agent=instance, resolved=False)
-                else:
-                    alert = None
-
-        elif isinstance(instance, Check):
-            from checks.tasks import (
-                handle_check_email_alert_task,
-                handle_check_sms_alert_task,
-            )
+                from autotasks.tasks import (
+                    handle_resolved_task_email_alert,
+                    handle_resolved_task_sms_alert,
+                    handle_task_email_alert,
+                    handle_task_sms_alert,
+                )
 
-            email_task = handle_check_email_alert_task
-            text_task = handle_check_sms_alert_task
+                prefix = "task"
+                ret.update(
+                    email_task=handle_task_email_alert,
+                    text_task=handle_task_sms_alert,
+                    resolved_email_task=handle_resolved_task_email_alert,
+                    resolved_text_task=handle_resolved_task_sms_alert,
+                )
 
-            email_alert = instance.email_alert
-            text_alert = instance.text_alert
-            dashboard_alert = instance.dashboard_alert
-            alert_template = instance.agent.alert_template
-            maintenance_mode = instance.agent.maintenance_mode
-            alert_severity = instance.alert_severity
             agent = instance.agent
+            alert_template = agent.alert_template
+            ret.update(
+                alert_type=prefix,
+                email_alert=instance.email_alert,
+                text_alert=instance.text_alert,
+                dashboard_alert=instance.dashboard_alert,
+                alert_severity=instance.alert_severity,
+            )
 
             # set alert_template settings
             if alert_template:
-                dashboard_severities = alert_template.check_dashboard_alert_severity
-                email_severities = alert_template.check_email_alert_severity
-                text_severities = alert_template.check_text_alert_severity
-                always_dashboard = alert_template.check_always_alert
-                always_email = alert_template.check_always_email
-                always_text = alert_template.check_always_text
-                alert_interval = alert_template.check_periodic_alert_days
-
-            if instance.should_create_alert(alert_template):
-                alert = cls.create_or_return_check_alert(instance)
-            else:
-                # check if there is an alert that exists
-                if cls.objects.filter(assigned_check=instance, resolved=False).exists():
-                    alert = cls.objects.get(assigned_check=instance, resolved=False)
-                else:
-                    alert = None
-
-        elif isinstance(instance, AutomatedTask):
-            from autotasks.tasks import handle_task_email_alert, handle_task_sms_alert
-
-            email_task = handle_task_email_alert
-            text_task = handle_task_sms_alert
-
-            email_alert = instance.email_alert
-            text_alert = instance.text_alert
-            dashboard_alert = instance.dashboard_alert
-            alert_template = instance.agent.alert_template
-            maintenance_mode = instance.agent.maintenance_mode
-            alert_severity = instance.alert_severity
-            agent = instance.agent
+                ret.update(
+                    {
+                        i: getattr(alert_template, f"{prefix}_{field}")
+                        for i, field in (
+                            ("dashboard_severities", "dashboard_alert_severity"),
+                            ("email_severities", "email_alert_severity"),
+                            ("text_severities", "text_alert_severity"),
+                            ("always_dashboard", "always_alert"),
+                            ("always_email", "always_email"),
+                            ("always_text", "always_text"),
+                            ("alert_interval", "periodic_alert_days"),
+                            ("email_on_resolved", "email_on_resolved"),
+                            ("text_on_resolved", "text_on_resolved"),
+                        )
+                    }
+                )
+        else:
+            return None
 
-            # set alert_template settings
-            if alert_template:
-                dashboard_severities = alert_template.task_dashboard_alert_severity
-                email_severities = alert_template.task_email_alert_severity
-                text_severities = alert_template.task_text_alert_severity
-                always_dashboard = alert_template.task_always_alert
-                always_email = alert_template.task_always_email
-                always_text = alert_template.task_always_text
-                alert_interval = alert_template.task_periodic_alert_days
-
-            if instance.should_create_alert(alert_template):
-                alert = cls.create_or_return_task_alert(instance)
-            else:
-                # check if there is an alert that exists
-                if cls.objects.filter(assigned_task=instance, resolved=False).exists():
-                    alert = cls.objects.get(assigned_task=instance, resolved=False)
-                else:
-                    alert = None
+        ret.update(
+            agent=agent,
+            alert_template=alert_template,
+            maintenance_mode=agent.maintenance_mode,
+        )
+        return ret
+
+    @classmethod
+    def new_alert(cls, instance: Union[Agent, AutomatedTask, Check], alert_type: str):
+        # unsaved, the dashboard alert is shown once the settings allow it
+        if alert_type == "availability":
+            return cls(
+                agent=instance,
+                alert_type="availability",
+                severity="error",
+                message=f"{instance.hostname} in {instance.client.name}\\{instance.site.name} is overdue.",
+                hidden=True,
+            )
+        elif alert_type == "check":
+            return cls(
+                assigned_check=instance,
+                alert_type="check",
+                severity=instance.alert_severity,
+                message=f"{instance.agent.hostname} has a {instance.check_type} check: {instance.readable_desc} that failed.",
+                hidden=True,
+            )
         else:
-            return
+            return cls(
+                assigned_task=instance,
+                alert_type="task",
+                severity=instance.alert_severity,
+                message=f"{instance.agent.hostname} has task: {instance.name} that failed.",
+                hidden=True,
+            )
 
-        # return if agent is in maintenance mode
-        if maintenance_mode or not alert:
-            return
+    @classmethod
+    def unresolved_alerts(
+        cls, instances: list[Union[Agent, AutomatedTask, Check]]
+    ) -> dict[tuple[str, int], Alert]:
+        """Unresolved alerts of the instances keyed by (alert_type, pk)"""
+        pks: dict[str, set[int]] = defaultdict(set)
+        for instance in instances:
+            pks[instance._meta.model_name].add(instance.pk)
+
+        lookups = {
+            "agent": ("availability", "agent"),
+            "check": ("check", "assigned_check"),
+            "automatedtask": ("task", "assigned_task"),
+        }
+        ret = {}
+        for model_name, (alert_type, field) in lookups.items():
+            if not pks[model_name]:
+                continue
+
+            alerts = cls.objects.filter(
+                resolved=False, **{f"{field}_id__in": pks[model_name]}
+            ).order_by("-pk")
+            for alert in alerts:
+                ret[(alert_type, getattr(alert, f"{field}_id"))] = alert
+
+        return ret
 
-        # check if alert severity changed on check and update the alert
-        if alert_severity != alert.severity:
-            alert.severity = alert_severity
-            alert.save(update_fields=["severity"])
+    @classmethod
+    def process_events(
+        cls, events: list[tuple[str, Union[Agent, AutomatedTask, Check]]]
+    ) -> None:
+        """
+        Applies a batch of ("failure" | "resolve", instance) alert events in order.
+        The alerts of the batch are loaded with one query per instance type and
+        written with bulk writes, notifications and alert actions are handed to
+        celery once the writes are done.
+        """
+        from .tasks import run_alert_action_task
+
+        unresolved = cls.unresolved_alerts([instance for _, instance in events])
+        created: list[Alert] = []
+        updated: dict[int, Alert] = {}
+        # keyed by task and alert so repeated events in a batch dispatch once
+        dispatch: dict[tuple, tuple[Any, Alert, dict[str, Any]]] = {}
+
+        def _dispatch(item: tuple[Any, Alert, dict[str, Any]]) -> None:
+            dispatch[(item[0].name, id(item[1]), item[2].get("resolved"))] = item
+
+        for event, instance in events:
+            conf = cls.alert_settings(instance)
+            if conf is None:
+                continue
+
+            key = (conf["alert_type"], instance.pk)
+            alert = unresolved.get(key)
+            alert_template = conf["alert_template"]
+
+            if event == "failure":
+                if alert is None and instance.should_create_alert(alert_template):
+                    alert = cls.new_alert(instance, conf["alert_type"])
+                    created.append(alert)
+                    unresolved[key] = alert
+
+                # skip if agent is in maintenance mode
+                if conf["maintenance_mode"] or not alert:
+                    continue
+
+                # check if alert severity changed on check and update the alert
+                if conf["alert_severity"] != alert.severity:
+                    alert.severity = conf["alert_severity"]
+
+                # create alert in dashboard if enabled
+                if conf["dashboard_alert"] or conf["always_dashboard"]:
+
+                    # check if alert template is set and specific severities are configured
+                    if not alert_template or alert.severity in conf["dashboard_severities"]:  # type: ignore
+                        alert.hidden = False
+
+                # send email if enabled
+                if conf["email_alert"] or conf["always_email"]:
+                    if not alert_template or alert.severity in conf["email_severities"]:  # type: ignore
+                        _dispatch(
+                            (
+                                conf["email_task"],
+                                alert,
+                                {"alert_interval": conf["alert_interval"]},
+                            )
+                        )
+
+                # send text if enabled
+                if conf["text_alert"] or conf["always_text"]:
+                    if not alert_template or alert.severity in conf["text_severities"]:  # type: ignore
+                        _dispatch(
+                            (
+                                conf["text_task"],
+                                alert,
+                                {"alert_interval": conf["alert_interval"]},
+                            )
+                        )
+
+                # check if any scripts should be run
+                if alert_template and alert_template.action_id and not alert.action_run:
+                    _dispatch(
+                        (
+                            run_alert_action_task,
+                            alert,
+                            {
+                                "agent_pk": conf["agent"].pk,
+                                "script_pk": alert_template.action_id,
+                                "args": alert_template.action_args,
+                                "timeout": alert_template.action_timeout,
+                                "resolved": False,
+                            },
+                        )
+                    )
+
+            elif event == "resolve":
+                # skip if agent is in maintenance mode
+                if conf["maintenance_mode"] or not alert:
+                    continue
+
+                alert.resolved = True
+                alert.resolved_on = djangotime.now()
+                alert.snoozed = False
+                alert.snooze_until = None
+                del unresolved[key]
+
+                # check if a resolved email notification should be send
+                if conf["email_on_resolved"] and not alert.resolved_email_sent:
+                    _dispatch((conf["resolved_email_task"], alert, {}))
+
+                # check if resolved text should be sent
+                if conf["text_on_resolved"] and not alert.resolved_sms_sent:
+                    _dispatch((conf["resolved_text_task"], alert, {}))
+
+                # check if resolved script should be run
+                if (
+                    alert_template
+                    and alert_template.resolved_action_id
+                    and not alert.resolved_action_run
+                ):
+                    _dispatch(
+                        (
+                            run_alert_action_task,
+                            alert,
+                            {
+                                "agent_pk": conf["agent"].pk,
+                                "script_pk": alert_template.resolved_action_id,
+                                "args": alert_template.resolved_action_args,
+                                "timeout": alert_template.resolved_action_timeout,
+                                "resolved": True,
+                            },
+                        )
+                    )
+
+            if alert.pk:
+                updated[alert.pk] = alert
+
+        with transaction.atomic():
+            cls.objects.bulk_create(created)
+            cls.objects.bulk_update(updated.values(), ALERT_STATE_FIELDS)
+
+        for task, alert, kwargs in dispatch.values():
+            task.delay(pk=alert.pk, **kwargs)
 
-        # create alert in dashboard if enabled
-        if dashboard_alert or always_dashboard:
+    @classmethod
+    def handle_alert_failure(cls, instance: Union[Agent, AutomatedTask, Check]) -> None:
+        cls.process_events([("failure", instance)])
 
-            # check if alert template is set and specific severities are configured
-            if alert_template and alert.severity not in dashboard_severities:  # type: ignore
-                pass
-            else:
-                alert.hidden = False
-                alert.save()
+    @classmethod
+    def handle_alert_resolve(cls, instance: Union[Agent, AutomatedTask, Check]) -> None:
+        cls.process_events([("resolve", instance)])
 
-        # send email if enabled
-        if email_alert or always_email:
+    @classmethod
+    def queue_alert_events(
+        cls, events: list[tuple[str, Union[Agent, AutomatedTask, Check]]]
+    ) -> None:
+        """
+        Queues alert events for process_alert_events_task so the request
+        that caused them doesn't wait on alerting
+        """
+        if not events:
+            return
 
-            # check if alert template is set and specific severities are configured
-            if alert_template and alert.severity not in email_severities:  # type: ignore
-                pass
-            else:
-                email_task.delay(
-                    pk=alert.pk,
-                    alert_interval=alert_interval,
+        queued = redis_client.rpush(
+            ALERT_EVENTS_QUEUE_KEY,
+            *[
+                json.dumps(
+                    {
+                        "event": event,
+                        "model": instance._meta.model_name,
+                        "pk": instance.pk,
+                    }
                 )
+                for event, instance in events
+            ],
+        )
 
-        # send text if enabled
-        if text_alert or always_text:
-
-            # check if alert template is set and specific severities are configured
-            if alert_template and alert.severity not in text_severities:  # type: ignore
-                pass
-            else:
-                text_task.delay(pk=alert.pk, alert_interval=alert_interval)
-
-        # check if any scripts should be run
-        if alert_template and alert_template.action and not alert.action_run:
-            r = agent.run_script(
-                scriptpk=alert_template.action.pk,
-                args=alert_template.action_args,
-                timeout=alert_template.action_timeout,
-                wait=True,
-                full=True,
-                run_on_any=True,
-            )
+        # the consumer drains the whole queue, so only start one if it was empty
+        if queued == len(events):
+            from .tasks import process_alert_events_task
 
-            # command was successful
-            if type(r) == dict:
-                alert.action_retcode = r["retcode"]
-                alert.action_stdout = r["stdout"]
-                alert.action_stderr = r["stderr"]
-                alert.action_execution_time = "{:.4f}".format(r["execution_time"])
-                alert.action_run = djangotime.now()
-                alert.save()
-            else:
-                logger.error(
-                    f"Failure action: {alert_template.action.name} failed to run on any agent for {agent.hostname} failure alert"
-                )
+            process_alert_events_task.delay()
 
     @classmethod
-    def handle_alert_resolve(cls, instance: Union[Agent, AutomatedTask, Check]) -> None:
+    def process_queued_events(cls) -> int:
+        """
+        Processes the queued alert events in batches of ALERT_EVENTS_BATCH.
+        A batch stays in a processing list until it has been applied, so the
+        events of a run that fails or dies are processed by the next run.
+        Returns the number of events processed.
+        """
         from agents.models import Agent
         from autotasks.models import AutomatedTask
         from checks.models import Check
 
-        # set variables
-        email_on_resolved = False
-        text_on_resolved = False
-        resolved_email_task = None
-        resolved_text_task = None
-
-        # check what the instance passed is
-        if isinstance(instance, Agent):
-            from agents.tasks import agent_recovery_email_task, agent_recovery_sms_task
-
-            resolved_email_task = agent_recovery_email_task
-            resolved_text_task = agent_recovery_sms_task
-
-            alert_template = instance.alert_template
-            alert = cls.objects.get(agent=instance, resolved=False)
-            maintenance_mode = instance.maintenance_mode
-            agent = instance
+        processing_key = f"{ALERT_EVENTS_QUEUE_KEY}:processing"
+        lock_key = f"{ALERT_EVENTS_QUEUE_KEY}:lock"
+
+        # one run at a time, a batch left in the processing list belongs to a run
+        # that didn't finish
+        if not redis_client.set(lock_key, 1, nx=True, ex=ALERT_EVENTS_LOCK_TIMEOUT):
+            return 0
+
+        querysets = {
+            "agent": Agent.objects.select_related("alert_template", "site__client"),
+            "check": Check.objects.select_related("agent__alert_template", "script"),
+            "automatedtask": AutomatedTask.objects.select_related(
+                "agent__alert_template"
+            ),
+        }
+
+        processed = 0
+        try:
+            while True:
+                batch = redis_client.lrange(processing_key, 0, -1) or redis_client.eval(
+                    MOVE_ALERT_EVENTS_SCRIPT,
+                    2,
+                    ALERT_EVENTS_QUEUE_KEY,
+                    processing_key,
+                    ALERT_EVENTS_BATCH,
+                )
+                if not batch:
+                    return processed
+
+                raw = [json.loads(i) for i in batch]
+                pks: dict[str, set[int]] = defaultdict(set)
+                for i in raw:
+                    pks[i["model"]].add(i["pk"])
+
+                instances = {
+                    (model_name, instance.pk): instance
+                    for model_name, qs in querysets.items()
+                    if pks[model_name]
+                    for instance in qs.filter(pk__in=pks[model_name])
+                }
+
+                # events of deleted objects are dropped
+                cls.process_events(
+                    [
+                        (i["event"], instances[(i["model"], i["pk"])])
+                        for i in raw
+                        if (i["model"], i["pk"]) in instances
+                    ]
+                )
+                redis_client.delete(processing_key)
+                processed += len(raw)
+        finally:
+            redis_client.delete(lock_key)
 
-            if alert_template:
-                email_on_resolved = alert_template.agent_email_on_resolved
-                text_on_resolved = alert_template.agent_text_on_resolved
+    @classmethod
+    def notify(
+        cls, pk: int, field: str, send: str, alert_interval: Optional[float] = None
+    ) -> None:
+        """
+        Queues an email or text for the alert unless field shows it was already
+        sent, or was sent less than alert_interval days ago. send is the method of
+        the agent, check or task that builds the notification. The notification is
+        added to the outbox in the transaction that sets field, so it is neither
+        lost nor queued twice when a worker dies or the task runs again.
+        """
+        with transaction.atomic():
+            alert = cls.objects.select_for_update().get(pk=pk)
+            last_sent = getattr(alert, field)
+            if last_sent:
+                if not alert_interval:
+                    return
+
+                delta = djangotime.now() - dt.timedelta(days=alert_interval)
+                if last_sent >= delta:
+                    return
+
+            if alert.alert_type == "availability":
+                instance = alert.agent
+            elif alert.alert_type == "check":
+                instance = alert.assigned_check
+            else:
+                instance = alert.assigned_task
 
-        elif isinstance(instance, Check):
-            from checks.tasks import (
-                handle_resolved_check_email_alert_task,
-                handle_resolved_check_sms_alert_task,
+            # the same for every attempt until field is set, so a retry after a
+            # crash queues nothing new
+            previous = last_sent.timestamp() if last_sent else 0
+            getattr(instance, send)(
+                idempotency_key=f"alert:{alert.pk}:{field}:{previous}"
             )
+            setattr(alert, field, djangotime.now())
+            alert.save(update_fields=[field])
+
+    def run_action(
+        self, agent: Agent, script_pk: int, args: list[str], timeout: int, resolved
+    ) -> None:
+        """Runs a failure or resolved alert action and stores the result"""
+        prefix = "resolved_action" if resolved else "action"
+        r = agent.run_script(
+            scriptpk=script_pk,
+            args=args,
+            timeout=timeout,
+            wait=True,
+            full=True,
+            run_on_any=True,
+        )
 
-            resolved_email_task = handle_resolved_check_email_alert_task
-            resolved_text_task = handle_resolved_check_sms_alert_task
-
-            alert_template = instance.agent.alert_template
-            alert = cls.objects.get(assigned_check=instance, resolved=False)
-            maintenance_mode = instance.agent.maintenance_mode
-            agent = instance.agent
-
-            if alert_template:
-                email_on_resolved = alert_template.check_email_on_resolved
-                text_on_resolved = alert_template.check_text_on_resolved
-
-        elif isinstance(instance, AutomatedTask):
-            from autotasks.tasks import (
-                handle_resolved_task_email_alert,
-                handle_resolved_task_sms_alert,
+        # command was successful
+        if type(r) == dict:
+            setattr(self, f"{prefix}_retcode", r["retcode"])
+            setattr(self, f"{prefix}_stdout", r["stdout"])
+            setattr(self, f"{prefix}_stderr", r["stderr"])
+            setattr(
+                self, f"{prefix}_execution_time", "{:.4f}".format(r["execution_time"])
+            )
+            setattr(self, f"{prefix}_run", djangotime.now())
+            self.save(
+                update_fields=[
+                    f"{prefix}_{i}"
+                    for i in ("retcode", "stdout", "stderr", "execution_time", "run")
+                ]
             )
-
-            resolved_email_task = handle_resolved_task_email_alert
-            resolved_text_task = handle_resolved_task_sms_alert
-
-            alert_template = instance.agent.alert_template
-            alert = cls.objects.get(assigned_task=instance, resolved=False)
-            maintenance_mode = instance.agent.maintenance_mode
-            agent = instance.agent
-
-            if alert_template:
-                email_on_resolved = alert_template.task_email_on_resolved
-                text_on_resolved = alert_template.task_text_on_resolved
-
         else:
-            return
-
-        # return if agent is in maintenance mode
-        if maintenance_mode:
-            return
-
-        alert.resolve()
-
-        # check if a resolved email notification should be send
-        if email_on_resolved and not alert.resolved_email_sent:
-            resolved_email_task.delay(pk=alert.pk)
-
-        # check if resolved text should be sent
-        if text_on_resolved and not alert.resolved_sms_sent:
-            resolved_text_task.delay(pk=alert.pk)
-
-        # check if resolved script should be run
-        if (
-            alert_template
-            and alert_template.resolved_action
-            and not alert.resolved_action_run
-        ):
-            r = agent.run_script(
-                scriptpk=alert_template.resolved_action.pk,
-                args=alert_template.resolved_action_args,
-                timeout=alert_template.resolved_action_timeout,
-                wait=True,
-                full=True,
-                run_on_any=True,
+            kind = "resolved" if resolved else "failure"
+            logger.error(
+                f"{kind.capitalize()} action: script {script_pk} failed to run on any agent for {agent.hostname} {kind} alert"
             )
 
-            # command was successful
-            if type(r) == dict:
-                alert.resolved_action_retcode = r["retcode"]
-                alert.resolved_action_stdout = r["stdout"]
-                alert.resolved_action_stderr = r["stderr"]
-                alert.resolved_action_execution_time = "{:.4f}".format(
-                    r["execution_time"]
-                )
-                alert.resolved_action_run = djangotime.now()
-                alert.save()
-            else:
-                logger.error(
-                    f"Resolved action: {alert_template.action.name} failed to run on any agent for {agent.hostname} resolved alert"
-                )
-
 
 class AlertTemplate(models.Model):
     name = models.CharField(max_length=100)
@@ -596,3 +790,102 @@ class AlertTemplate(models.Model):
     @property
     def is_default_template(self) -> bool:
         return self.default_alert_template.exists()  # type: ignore
+
+    @classmethod
+    def resolve_for_agents(cls, agents: QuerySet[Agent]) -> dict[int, Optional[int]]:
+        """
+        The effective alert template pk of each agent. Templates, exclusions and
+        policy templates are loaded once and the agents with one query, instead of
+        walking the relations per agent.
+        """
+        from automation.models import AgentEffectivePolicy, Policy
+        from core.models import CoreSettings
+
+        core = CoreSettings.objects.values("alert_template_id").first()
+        templates = {i.pk: i for i in cls.objects.filter(is_active=True)}
+        policy_templates = dict(
+            Policy.objects.filter(alert_template__is_active=True).values_list(
+                "pk", "alert_template_id"
+            )
+        )
+
+        excluded = set()
+        for field in ("excluded_clients", "excluded_sites", "excluded_agents"):
+            through = getattr(cls, field).through
+            target = f"{getattr(cls, field).field.related_model._meta.model_name}_id"
+            rows = through.objects.values_list("alerttemplate_id", target)
+            if field == "excluded_agents":
+                rows = rows.filter(agent__in=agents)
+            excluded |= {(field, template, pk) for template, pk in rows}
+
+        ret = {}
+        for agent in AgentEffectivePolicy.agent_rows(
+            agents,
+            "pk",
+            "monitoring_type",
+            "site_id",
+            "site__alert_template_id",
+            "site__client_id",
+            "site__client__alert_template_id",
+        ):
+            mon_type = agent["monitoring_type"]
+            agent_policy, site_policy, client_policy, default_policy = agent[
+                "effective_policy__policies"
+            ]
+
+            # in order of precedence
+            candidates = [
+                policy_templates.get(agent_policy),
+                policy_templates.get(site_policy),
+                agent["site__alert_template_id"],
+                policy_templates.get(client_policy),
+                agent["site__client__alert_template_id"],
+                core["alert_template_id"] if core else None,
+                policy_templates.get(default_policy),
+            ]
+
+            ret[agent["pk"]] = None
+            for pk in candidates:
+                template = templates.get(pk)
+                if not template:
+                    continue
+
+                # check if client, site, or agent has been excluded from template
+                if (
+                    ("excluded_clients", pk, agent["site__client_id"]) in excluded
+                    or ("excluded_sites", pk, agent["site_id"]) in excluded
+                    or ("excluded_agents", pk, agent["pk"]) in excluded
+                ):
+                    continue
+
+                # check if template is excluding workstations or servers
+                if (mon_type == "workstation" and template.exclude_workstations) or (
+                    mon_type == "server" and template.exclude_servers
+                ):
+                    continue
+
+                ret[agent["pk"]] = pk
+                break
+
+        return ret
+
+    @classmethod
+    def cache_on_agents(cls, agents: Optional[QuerySet[Agent]] = None) -> int:
+        """
+        Stores the effective alert template on the agents, all of them unless a
+        queryset is passed. Only agents whose template changed are written.
+        Returns the number of agents updated.
+        """
+        from agents.models import Agent
+
+        if agents is None:
+            agents = Agent.objects.all()
+
+        resolved = cls.resolve_for_agents(agents)
+        changed = [
+            Agent(pk=pk, alert_template_id=resolved[pk])
+            for pk, current in agents.values_list("pk", "alert_template_id")
+            if resolved.get(pk, current) != current
+        ]
+        Agent.objects.bulk_update(changed, ["alert_template"], batch_size=1000)
+        return len(changed)
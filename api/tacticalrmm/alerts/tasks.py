@@ -1,6 +1,8 @@
+from typing import Optional
+
 from django.utils import timezone as djangotime
 
-from alerts.models import Alert
+from alerts.models import Alert, AlertTemplate
 from tacticalrmm.celery import app
 
 
@@ -15,10 +17,52 @@ def unsnooze_alerts() -> str:
 
 
 @app.task
-def cache_agents_alert_template():
+def cache_agents_alert_template(
+    client: Optional[int] = None,
+    site: Optional[int] = None,
+    policy: Optional[int] = None,
+) -> str:
+    """
+    Recomputes the cached alert template of the agents, only of the agents under a
+    client or site, or that a policy applies to, when one is passed
+    """
+    from agents.models import Agent
+
+    agents = Agent.objects.all()
+    if client:
+        agents = agents.filter(site__client_id=client)
+    elif site:
+        agents = agents.filter(site_id=site)
+    elif policy:
+        agents = agents.filter(effective_policy__policies__contains=[policy])
+
+    AlertTemplate.cache_on_agents(agents)
+
+    return "ok"
+
+
+@app.task
+def process_alert_events_task() -> str:
+    Alert.process_queued_events()
+
+    return "ok"
+
+
+@app.task
+def run_alert_action_task(
+    pk: int, agent_pk: int, script_pk: int, args: list[str], timeout: int, resolved
+) -> str:
     from agents.models import Agent
 
-    for agent in Agent.objects.only("pk"):
-        agent.set_alert_template()
+    alert = Alert.objects.filter(pk=pk).first()
+    agent = Agent.objects.filter(pk=agent_pk).first()
+    if not alert or not agent:
+        return "alert or agent no longer exists"
+
+    # the action might have been queued more than once before it ran
+    if alert.resolved_action_run if resolved else alert.action_run:
+        return "ok"
+
+    alert.run_action(agent, script_pk, args, timeout, resolved)
 
     return "ok"
@@ -1,13 +1,16 @@
 from datetime import datetime, timedelta
 from unittest.mock import patch
+from uuid import uuid4
 
 from django.conf import settings
 from django.utils import timezone as djangotime
 from model_bakery import baker, seq
 
-from alerts.tasks import cache_agents_alert_template
+from agents.models import Agent
+from alerts.tasks import cache_agents_alert_template, run_alert_action_task
 from autotasks.models import AutomatedTask
 from core.models import CoreSettings
+from tacticalrmm.redis_client import redis_client
 from tacticalrmm.test import TacticalTestCase
 
 from .models import Alert, AlertTemplate
@@ -353,6 +356,19 @@ class TestAlertTasks(TacticalTestCase):
         self.authenticate()
         self.setup_coresettings()
 
+        # tests running in parallel share redis, so each test gets its own queue
+        patcher = patch(
+            "alerts.models.ALERT_EVENTS_QUEUE_KEY", f"alert_events_{uuid4()}"
+        )
+        self.queue_key = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(
+            redis_client.delete,
+            self.queue_key,
+            f"{self.queue_key}:processing",
+            f"{self.queue_key}:lock",
+        )
+
     def test_unsnooze_alert_task(self):
         from alerts.tasks import unsnooze_alerts
 
@@ -385,7 +401,9 @@ class TestAlertTasks(TacticalTestCase):
             ).exists()
         )
 
-    def test_agent_gets_correct_alert_template(self):
+    @patch("automation.models.Policy.queue_regeneration")
+    def test_agent_gets_correct_alert_template(self, queue_regeneration):
+        from automation.models import AgentEffectivePolicy
 
         core = CoreSettings.objects.first()
         # setup data
@@ -406,6 +424,7 @@ class TestAlertTasks(TacticalTestCase):
         core.workstation_policy = policy
         core.server_policy = policy
         core.save()
+        AgentEffectivePolicy.refresh()
 
         self.assertEquals(server.set_alert_template().pk, alert_templates[0].pk)  # type: ignore
         self.assertEquals(workstation.set_alert_template().pk, alert_templates[0].pk)  # type: ignore
@@ -431,6 +450,7 @@ class TestAlertTasks(TacticalTestCase):
         server.client.server_policy = policy
         workstation.client.save()
         server.client.save()
+        AgentEffectivePolicy.refresh()
 
         self.assertEquals(workstation.set_alert_template().pk, alert_templates[0].pk)  # type: ignore
         self.assertEquals(server.set_alert_template().pk, alert_templates[0].pk)  # type: ignore
@@ -449,6 +469,7 @@ class TestAlertTasks(TacticalTestCase):
         server.site.server_policy = policy
         workstation.site.save()
         server.site.save()
+        AgentEffectivePolicy.refresh()
 
         self.assertEquals(workstation.set_alert_template().pk, alert_templates[0].pk)  # type: ignore
         self.assertEquals(server.set_alert_template().pk, alert_templates[0].pk)  # type: ignore
@@ -458,6 +479,7 @@ class TestAlertTasks(TacticalTestCase):
         server.policy = policy
         workstation.save()
         server.save()
+        AgentEffectivePolicy.refresh()
 
         self.assertEquals(workstation.set_alert_template().pk, alert_templates[0].pk)  # type: ignore
         self.assertEquals(server.set_alert_template().pk, alert_templates[0].pk)  # type: ignore
@@ -489,6 +511,83 @@ class TestAlertTasks(TacticalTestCase):
         self.assertEquals(workstation.set_alert_template().pk, alert_templates[1].pk)  # type: ignore
         self.assertEquals(server.set_alert_template().pk, alert_templates[2].pk)  # type: ignore
 
+    @patch("automation.models.Policy.queue_regeneration")
+    @patch("alerts.tasks.cache_agents_alert_template.delay")
+    def test_cache_agents_alert_template(
+        self, cache_alert_template, queue_regeneration
+    ):
+        from automation.models import AgentEffectivePolicy
+
+        core = CoreSettings.objects.first()
+        templates = baker.make("alerts.AlertTemplate", is_active=True, _quantity=3)
+        policy = baker.make("automation.Policy", alert_template=templates[1])
+        site1 = baker.make("clients.Site")
+        site2 = baker.make("clients.Site")
+        agents1 = baker.make_recipe("agents.agent", site=site1, _quantity=5)
+        agents2 = baker.make_recipe(
+            "agents.agent", site=site2, monitoring_type="server", _quantity=5
+        )
+
+        core.alert_template = templates[0]  # type: ignore
+        core.save()
+        AgentEffectivePolicy.refresh()
+
+        # nothing is loaded per agent
+        with self.assertNumQueries(9):
+            self.assertEqual(AlertTemplate.cache_on_agents(), 10)
+
+        self.assertFalse(
+            Agent.objects.exclude(alert_template=templates[0]).exists()  # type: ignore
+        )
+
+        # nothing changed so nothing is written
+        self.assertEqual(AlertTemplate.cache_on_agents(), 0)
+
+        # only the agents of the site are recomputed
+        site1.alert_template = templates[2]  # type: ignore
+        site1.save()
+        site2.server_policy = policy
+        site2.save()
+        AgentEffectivePolicy.refresh()
+        cache_alert_template.assert_any_call(site=site1.pk)
+        cache_agents_alert_template(site=site1.pk)
+
+        self.assertEqual(
+            Agent.objects.filter(alert_template=templates[2]).count(), 5  # type: ignore
+        )
+        self.assertEqual(
+            Agent.objects.filter(alert_template=templates[0]).count(), 5  # type: ignore
+        )
+
+        # only the agents the policy applies to are recomputed
+        cache_agents_alert_template(policy=policy.pk)
+
+        self.assertEqual(
+            set(
+                Agent.objects.filter(alert_template=templates[1]).values_list(  # type: ignore
+                    "pk", flat=True
+                )
+            ),
+            {i.pk for i in agents2},
+        )
+
+        # excluded agents fall through to the next template
+        templates[1].excluded_agents.set([agents2[0].pk])  # type: ignore
+        cache_agents_alert_template(client=site2.client.pk)
+
+        self.assertEqual(
+            Agent.objects.get(pk=agents2[0].pk).alert_template,
+            templates[0],  # type: ignore
+        )
+        self.assertEqual(
+            Agent.objects.get(pk=agents1[0].pk).alert_template,
+            templates[2],  # type: ignore
+        )
+
+    @patch(
+        "alerts.tasks.process_alert_events_task.delay",
+        side_effect=Alert.process_queued_events,
+    )
     @patch("agents.tasks.sleep")
     @patch("core.models.CoreSettings.send_mail")
     @patch("core.models.CoreSettings.send_sms")
@@ -505,6 +604,7 @@ class TestAlertTasks(TacticalTestCase):
         send_sms,
         send_email,
         sleep,
+        process_events,
     ):
         from agents.models import Agent
         from agents.tasks import (
@@ -519,7 +619,7 @@ class TestAlertTasks(TacticalTestCase):
         agent_dashboard_alert = baker.make_recipe("agents.overdue_agent")
 
         # call outages task and no alert should be created
-        agent_outages_task()
+        agent_outages_task(full=True)
 
         self.assertEquals(Alert.objects.count(), 0)
 
@@ -569,7 +669,7 @@ class TestAlertTasks(TacticalTestCase):
         )
 
         cache_agents_alert_template()
-        agent_outages_task()
+        agent_outages_task(full=True)
 
         # should have created 6 alerts
         self.assertEquals(Alert.objects.count(), 6)
@@ -627,7 +727,7 @@ class TestAlertTasks(TacticalTestCase):
         self.assertFalse(Alert.objects.get(agent=agent_dashboard_alert).sms_sent)
 
         # calling agent outage task again shouldn't create duplicate alerts and won't send alerts
-        agent_outages_task()
+        agent_outages_task(full=True)
         self.assertEquals(Alert.objects.count(), 6)
 
         # test periodic notification
@@ -642,7 +742,7 @@ class TestAlertTasks(TacticalTestCase):
         send_sms.reset_mock()
         send_email.reset_mock()
 
-        agent_outages_task()
+        agent_outages_task(full=True)
 
         outage_sms.assert_any_call(
             pk=Alert.objects.get(agent=agent_template_text).pk, alert_interval=5
@@ -710,7 +810,6 @@ class TestAlertTasks(TacticalTestCase):
             Alert.objects.get(agent=agent_template_email).resolved_email_sent
         )
 
-    @patch("checks.tasks.sleep")
     @patch("core.models.CoreSettings.send_mail")
     @patch("core.models.CoreSettings.send_sms")
     @patch("checks.tasks.handle_check_sms_alert_task.delay")
@@ -725,7 +824,6 @@ class TestAlertTasks(TacticalTestCase):
         outage_sms,
         send_sms,
         send_email,
-        sleep,
     ):
         from alerts.tasks import cache_agents_alert_template
         from checks.models import Check
@@ -994,7 +1092,6 @@ class TestAlertTasks(TacticalTestCase):
         send_email.assert_called()
         send_sms.assert_called()
 
-    @patch("autotasks.tasks.sleep")
     @patch("core.models.CoreSettings.send_mail")
     @patch("core.models.CoreSettings.send_sms")
     @patch("autotasks.tasks.handle_task_sms_alert.delay")
@@ -1009,7 +1106,6 @@ class TestAlertTasks(TacticalTestCase):
         outage_sms,
         send_sms,
         send_email,
-        sleep,
     ):
         from alerts.tasks import cache_agents_alert_template
         from autotasks.models import AutomatedTask
@@ -1258,10 +1354,8 @@ class TestAlertTasks(TacticalTestCase):
         send_email.assert_called()
         send_sms.assert_called()
 
-    @patch("core.models.TwClient")
-    @patch("smtplib.SMTP")
-    def test_override_core_settings(self, smtp, sms):
-        from core.models import CoreSettings
+    def test_override_core_settings(self):
+        from core.models import CoreSettings, Notification
 
         # setup data
         alert_template = baker.make(
@@ -1281,17 +1375,40 @@ class TestAlertTasks(TacticalTestCase):
 
         # test sending email with alert template settings
         core.send_mail("Test", "Test", alert_template=alert_template)
+        email = Notification.objects.get(channel="email")
+        self.assertEqual(email.sender, "from@email.com")
+        self.assertEqual(email.recipients, ["example@example.com"])
 
         core.send_sms("Test", alert_template=alert_template)
-
+        sms = Notification.objects.get(channel="sms")
+        self.assertEqual(sms.recipients, ["+12321233212"])
+
+    @patch(
+        "alerts.tasks.run_alert_action_task.delay", side_effect=run_alert_action_task
+    )
+    @patch(
+        "alerts.tasks.process_alert_events_task.delay",
+        side_effect=Alert.process_queued_events,
+    )
+    @patch("agents.tasks.redis_client")
     @patch("agents.models.Agent.nats_cmd")
     @patch("agents.tasks.agent_outage_sms_task.delay")
     @patch("agents.tasks.agent_outage_email_task.delay")
     @patch("agents.tasks.agent_recovery_email_task.delay")
     @patch("agents.tasks.agent_recovery_sms_task.delay")
     def test_alert_actions(
-        self, recovery_sms, recovery_email, outage_email, outage_sms, nats_cmd
+        self,
+        recovery_sms,
+        recovery_email,
+        outage_email,
+        outage_sms,
+        nats_cmd,
+        redis_client,
+        process_events,
+        run_action,
     ):
+        # no previous run recorded, every overdue agent is processed
+        redis_client.get.return_value = None
 
         from agents.tasks import agent_outages_task
 
@@ -1338,7 +1455,22 @@ class TestAlertTasks(TacticalTestCase):
 
         nats_cmd.assert_called_with(data, timeout=30, wait=True)
 
+        # the action runs in a celery task instead of the event consumer
+        run_action.assert_called_once_with(
+            pk=Alert.objects.get(agent=agent).pk,
+            agent_pk=agent.pk,
+            script_pk=failure_action.pk,
+            args=[],
+            timeout=30,
+            resolved=False,
+        )
+
+        # the action is only run once per alert
         nats_cmd.reset_mock()
+        run_action.reset_mock()
+        agent_outages_task(full=True)
+        run_action.assert_not_called()
+        nats_cmd.assert_not_called()
 
         # Setup cmd mock
         success = {
@@ -1387,3 +1519,102 @@ class TestAlertTasks(TacticalTestCase):
         self.assertEqual(alert.resolved_action_execution_time, "5.0000")
         self.assertEqual(alert.resolved_action_stdout, "success!")
         self.assertEqual(alert.resolved_action_stderr, "")
+
+    @patch("checks.tasks.handle_check_email_alert_task.delay")
+    @patch("alerts.tasks.process_alert_events_task.delay")
+    def test_process_queued_events(self, process_events, email_task):
+        agents = baker.make_recipe(
+            "agents.overdue_agent", overdue_dashboard_alert=True, _quantity=3
+        )
+        check = baker.make_recipe(
+            "checks.diskspace_check",
+            agent=agents[0],
+            dashboard_alert=True,
+            email_alert=True,
+            alert_severity="error",
+        )
+
+        # the consumer is only started when the queue was empty
+        Alert.queue_alert_events([("failure", agent) for agent in agents])
+        Alert.queue_alert_events(
+            [("failure", check), ("resolve", agents[1]), ("failure", check)]
+        )
+        process_events.assert_called_once()
+
+        # the batch is loaded and written with a fixed number of queries
+        with self.assertNumQueries(7):
+            self.assertEqual(Alert.process_queued_events(), 6)
+        self.assertEqual(redis_client.llen(self.queue_key), 0)
+
+        self.assertEqual(Alert.objects.filter(alert_type="availability").count(), 3)
+        self.assertFalse(Alert.objects.get(agent=agents[0]).hidden)
+        self.assertTrue(Alert.objects.get(agent=agents[1]).resolved)
+
+        # repeated events in a batch send one notification
+        check_alert = Alert.objects.get(assigned_check=check)
+        self.assertFalse(check_alert.hidden)
+        email_task.assert_called_once_with(pk=check_alert.pk, alert_interval=None)
+
+        # a batch that fails is processed again by the next run
+        Alert.queue_alert_events([("resolve", agent) for agent in agents])
+        with patch.object(Alert, "process_events", side_effect=Exception("died")):
+            with self.assertRaises(Exception):
+                Alert.process_queued_events()
+        self.assertEqual(redis_client.llen(self.queue_key), 0)
+        self.assertEqual(redis_client.llen(f"{self.queue_key}:processing"), 3)
+
+        # events are applied to existing alerts with a bulk update
+        self.assertEqual(Alert.process_queued_events(), 3)
+        self.assertFalse(Alert.objects.filter(resolved=False, agent__isnull=False))
+        self.assertEqual(redis_client.llen(f"{self.queue_key}:processing"), 0)
+
+        # only one run processes the queue at a time
+        redis_client.set(f"{self.queue_key}:lock", 1)
+        Alert.queue_alert_events([("resolve", agent) for agent in agents])
+        self.assertEqual(Alert.process_queued_events(), 0)
+        self.assertEqual(redis_client.llen(self.queue_key), 3)
+
+    def test_notify(self):
+        from core.models import CoreSettings, Notification
+
+        core = CoreSettings.objects.first()
+        core.sms_alert_recipients = ["+1111"]
+        core.twilio_number = "+9999"
+        core.twilio_account_sid = "sid"
+        core.twilio_auth_token = "token"
+        core.save()
+
+        agent = baker.make_recipe("agents.agent")
+        alert = baker.make("alerts.Alert", agent=agent, alert_type="availability")
+
+        # the text is queued in the transaction that marks it as sent
+        Alert.notify(alert.pk, "sms_sent", "send_outage_sms")
+        alert.refresh_from_db()
+        self.assertIsNotNone(alert.sms_sent)
+        self.assertEqual(Notification.objects.filter(channel="sms").count(), 1)
+
+        # a task that runs again doesn't queue it twice
+        Alert.notify(alert.pk, "sms_sent", "send_outage_sms")
+        self.assertEqual(Notification.objects.filter(channel="sms").count(), 1)
+
+        # an attempt that queued the text but didn't mark the alert is not repeated
+        Alert.objects.filter(pk=alert.pk).update(sms_sent=None)
+        Alert.notify(alert.pk, "sms_sent", "send_outage_sms")
+        self.assertEqual(Notification.objects.filter(channel="sms").count(), 1)
+
+        # periodic reminder
+        Alert.objects.filter(pk=alert.pk).update(
+            sms_sent=djangotime.now() - djangotime.timedelta(days=2)
+        )
+        Alert.notify(alert.pk, "sms_sent", "send_outage_sms", alert_interval=1)
+        self.assertEqual(Notification.objects.filter(channel="sms").count(), 2)
+
+        # the alert isn't marked as sent when queuing fails
+        with patch(
+            "agents.models.Agent.send_outage_email", side_effect=Exception("error")
+        ):
+            with self.assertRaises(Exception):
+                Alert.notify(alert.pk, "email_sent", "send_outage_email")
+
+        alert.refresh_from_db()
+        self.assertIsNone(alert.email_sent)
@@ -6,6 +6,8 @@ from django.conf import settings
 from django.utils import timezone as djangotime
 from model_bakery import baker
 
+from agents.models import HardwareInventory
+from checks.models import Check, next_run_at_expression
 from tacticalrmm.test import TacticalTestCase
 
 
@@ -35,11 +37,26 @@ class TestAPIv3(TacticalTestCase):
         self.assertEqual(r.data["check_interval"], 20)  # type: ignore
         self.assertEqual(len(r.data["checks"]), 2)  # type: ignore
 
-        # Set last_run on both checks and should return an empty list
-        check1.last_run = djangotime.now()
-        check1.save()
-        check2.last_run = djangotime.now()
-        check2.save()
+        # run both checks and should return an empty list
+        for check in (check1, check2):
+            payload = {
+                "id": check.pk,
+                "output": "Reply from 10.10.10.10: bytes=32 time=1ms TTL=128",
+                "has_stdout": True,
+                "has_stderr": False,
+            }
+            r = self.client.patch("/api/v3/checkrunner/", payload, format="json")
+            self.assertEqual(r.status_code, 200)
+
+        check1.refresh_from_db()
+        check2.refresh_from_db()
+        self.assertEqual(
+            check1.next_run_at,
+            check1.last_run + djangotime.timedelta(seconds=self.agent.check_interval),
+        )
+        self.assertEqual(
+            check2.next_run_at, check2.last_run + djangotime.timedelta(seconds=20)
+        )
 
         r = self.client.get(url)
         self.assertEqual(r.status_code, 200)
@@ -47,16 +64,72 @@ class TestAPIv3(TacticalTestCase):
         self.assertFalse(r.data["checks"])  # type: ignore
 
         # set last_run greater than interval
-        check1.last_run = djangotime.now() - djangotime.timedelta(seconds=200)
-        check1.save()
-        check2.last_run = djangotime.now() - djangotime.timedelta(seconds=200)
-        check2.save()
+        Check.objects.filter(pk__in=[check1.pk, check2.pk]).update(
+            last_run=djangotime.now() - djangotime.timedelta(seconds=200)
+        )
+        Check.objects.filter(pk__in=[check1.pk, check2.pk]).update(
+            next_run_at=next_run_at_expression()
+        )
 
         r = self.client.get(url)
         self.assertEqual(r.status_code, 200)
         self.assertEqual(r.data["check_interval"], 20)  # type: ignore
         self.assertEquals(len(r.data["checks"]), 2)  # type: ignore
 
+        # only check2 is due once its interval has passed
+        Check.objects.filter(pk__in=[check1.pk, check2.pk]).update(
+            last_run=djangotime.now() - djangotime.timedelta(seconds=60)
+        )
+        Check.objects.filter(pk__in=[check1.pk, check2.pk]).update(
+            next_run_at=next_run_at_expression()
+        )
+
+        r = self.client.get(url)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual([c["id"] for c in r.data["checks"]], [check2.pk])  # type: ignore
+
+        # definitions are cached until the check is edited
+        with self.assertNumQueries(3):
+            r = self.client.get(url)
+
+        # the result state is read fresh, not from the cached definitions
+        self.assertEqual(r.data["checks"][0]["status"], "passing")  # type: ignore
+        Check.objects.filter(pk=check2.pk).update(
+            status="failing", alert_severity="error"
+        )
+        r = self.client.get(url)
+        self.assertEqual(r.data["checks"][0]["status"], "failing")  # type: ignore
+        self.assertEqual(r.data["checks"][0]["alert_severity"], "error")  # type: ignore
+        r = self.client.get(f"/api/v3/{self.agent.agent_id}/runchecks/")
+        self.assertEqual(r.data["checks"][1]["status"], "failing")  # type: ignore
+
+        check2.refresh_from_db()
+        check2.run_interval = 90
+        check2.save()
+        check2.refresh_from_db()
+        self.assertEqual(
+            check2.next_run_at, check2.last_run + djangotime.timedelta(seconds=90)
+        )
+
+        r = self.client.get(url)
+        self.assertEqual(r.data["check_interval"], 90)  # type: ignore
+        self.assertFalse(r.data["checks"])  # type: ignore
+
+        r = self.client.get(f"/api/v3/{self.agent.agent_id}/runchecks/")
+        self.assertEqual(r.data["checks"][1]["run_interval"], 90)  # type: ignore
+
+        # changing the agent's check interval moves the next runs
+        self.agent.check_interval = 30
+        self.agent.save()
+        check1.refresh_from_db()
+        self.assertEqual(
+            check1.next_run_at, check1.last_run + djangotime.timedelta(seconds=30)
+        )
+
+        r = self.client.get(url)
+        self.assertEqual(r.data["check_interval"], 30)  # type: ignore
+        self.assertEqual(len(r.data["checks"]), 2)  # type: ignore
+
         url = "/api/v3/Maj34ACb324j234asdj2n34kASDjh34-DESKTOPTEST123/checkrunner/"
         r = self.client.get(url)
         self.assertEqual(r.status_code, 404)
@@ -79,6 +152,10 @@ class TestAPIv3(TacticalTestCase):
         r = self.client.patch(url, payload, format="json")
         self.assertEqual(r.status_code, 200)
 
+        hw = HardwareInventory.objects.get(agent=self.agent)
+        self.assertEqual(hw.make_model, "Dell Inc. Inspiron 3493")
+        self.assertEqual(hw.cpus, ["Intel(R) Core(TM) i5-1035G4 CPU @ 1.10GHz"])
+
         self.check_not_authenticated("patch", url)
 
     def test_checkrunner_interval(self):
@@ -3,6 +3,7 @@ import os
 import time
 
 from django.conf import settings
+from django.db.models import Q
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone as djangotime
@@ -19,9 +20,15 @@ from agents.models import Agent
 from agents.serializers import WinAgentSerializer
 from autotasks.models import AutomatedTask
 from autotasks.serializers import TaskGOGetSerializer, TaskRunnerPatchSerializer
-from checks.models import Check
-from checks.serializers import CheckRunnerGetSerializer
+from checks.models import (
+    CHECK_RUNNER_STATE_FIELDS,
+    HOT_STATE_CHECK_TYPES,
+    Check,
+    clear_check_runner_cache,
+    get_check_runner_checks,
+)
 from checks.utils import bytes2human
+from clients.models import clear_tree_cache
 from logs.models import PendingAction
 from software.models import InstalledSoftware
 from tacticalrmm.utils import SoftwareList, filter_software, notify_error, reload_nats
@@ -46,9 +53,13 @@ class CheckIn(APIView):
             settings.LATEST_AGENT_VER
         ):
             updated = True
+        # an overdue agent coming back changes the client tree rollups
+        was_overdue = agent.status == "overdue"
         agent.version = request.data["version"]
         agent.last_seen = djangotime.now()
         agent.save(update_fields=["version", "last_seen"])
+        if was_overdue:
+            clear_tree_cache()
 
         # change agent update pending status to completed if agent has just updated
         if (
@@ -63,7 +74,7 @@ class CheckIn(APIView):
 
         # handles any alerting actions
         if Alert.objects.filter(agent=agent, resolved=False).exists():
-            Alert.handle_alert_resolve(agent)
+            Alert.queue_alert_events([("resolve", agent)])
 
         # get any pending actions
         if agent.pendingactions.filter(status="pending").exists():  # type: ignore
@@ -266,11 +277,10 @@ class RunChecks(APIView):
 
     def get(self, request, agentid):
         agent = get_object_or_404(Agent, agent_id=agentid)
-        checks = Check.objects.filter(agent__pk=agent.pk, overriden_by_policy=False)
         ret = {
             "agent": agent.pk,
             "check_interval": agent.check_interval,
-            "checks": CheckRunnerGetSerializer(checks, many=True).data,
+            "checks": get_check_runner_checks(agent),
         }
         return Response(ret)
 
@@ -281,44 +291,63 @@ class CheckRunner(APIView):
 
     def get(self, request, agentid):
         agent = get_object_or_404(Agent, agent_id=agentid)
-        checks = agent.agentchecks.filter(overriden_by_policy=False)  # type: ignore
-
-        run_list = [
-            check
-            for check in checks
-            # always run if check hasn't run yet
-            if not check.last_run
-            # if a check interval is set, see if the correct amount of seconds have passed
-            or (
-                check.run_interval
-                and (
-                    check.last_run
-                    < djangotime.now()
-                    - djangotime.timedelta(seconds=check.run_interval)
-                )
-                # if check interval isn't set, make sure the agent's check interval has passed before running
-            )
-            or (
-                check.last_run
-                < djangotime.now() - djangotime.timedelta(seconds=agent.check_interval)
-            )
+        now = djangotime.now()
+        # checks that haven't run yet or whose interval has passed
+        rows = (
+            agent.agentchecks.filter(overriden_by_policy=False)  # type: ignore
+            .filter(Q(next_run_at__isnull=True) | Q(next_run_at__lt=now))
+            .values("pk", "check_type", *CHECK_RUNNER_STATE_FIELDS)
+        )
+        # rows of checks with hot state can be behind until the next flush
+        hot_states = Check.hot_states(
+            [row["pk"] for row in rows if row["check_type"] in HOT_STATE_CHECK_TYPES]
+        )
+        rows = [
+            row
+            for row in rows
+            if row["pk"] not in hot_states or hot_states[row["pk"]]["next_run_at"] < now
         ]
+        state = Check.runner_states(rows, hot_states)
+        due = set(state)
+
+        checks = get_check_runner_checks(agent, state)
+        if not due <= {check["id"] for check in checks}:
+            # a check was added since the definitions were cached
+            clear_check_runner_cache(agent.pk)
+            checks = get_check_runner_checks(agent, state)
+
         ret = {
             "agent": agent.pk,
             "check_interval": agent.check_run_interval(),
-            "checks": CheckRunnerGetSerializer(run_list, many=True).data,
+            "checks": [check for check in checks if check["id"] in due],
         }
         return Response(ret)
 
     def patch(self, request):
         check = get_object_or_404(Check, pk=request.data["id"])
-        check.last_run = djangotime.now()
-        check.save(update_fields=["last_run"])
         status = check.handle_checkv2(request.data)
 
         return Response(status)
 
 
+class CheckResults(APIView):
+    """Processes all results from one check run of an agent"""
+
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def patch(self, request):
+        agent = get_object_or_404(
+            Agent.objects.select_related("alert_template"),
+            agent_id=request.data["agent_id"],
+        )
+
+        if not isinstance(request.data["results"], list):
+            return notify_error("err")
+
+        return Response(Check.handle_check_results(agent, request.data["results"]))
+
+
 class CheckRunnerInterval(APIView):
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
@@ -361,9 +390,9 @@ class TaskRunner(APIView):
 
         if status == "passing":
             if Alert.objects.filter(assigned_task=new_task, resolved=False).exists():
-                Alert.handle_alert_resolve(new_task)
+                Alert.queue_alert_events([("resolve", new_task)])
         else:
-            Alert.handle_alert_failure(new_task)
+            Alert.queue_alert_events([("failure", new_task)])
 
         AuditLog.objects.create(
             username=agent.hostname,
@@ -389,6 +418,7 @@ class SysInfo(APIView):
 
         agent.wmi_detail = request.data["sysinfo"]
         agent.save(update_fields=["wmi_detail"])
+        agent.update_hardware_inventory()
         return Response("ok")
 
 
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from automation.models import AgentEffectivePolicy, Policy
+
+
+class Command(BaseCommand):
+    help = "Checks the effective policies and policy memberships of all agents"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--fix",
+            action="store_true",
+            help="Rewrite out of date agents and regenerate their policies",
+        )
+
+    def handle(self, *args, **kwargs):
+        stale = AgentEffectivePolicy.refresh(dry_run=not kwargs["fix"])
+
+        if not stale:
+            self.stdout.write(self.style.SUCCESS("All agents are up to date"))
+        elif kwargs["fix"]:
+            # their policy checks and tasks were generated from the old policies
+            Policy.queue_regeneration("agent", stale)
+            self.stdout.write(self.style.SUCCESS(f"Fixed {len(stale)} agents"))
+        else:
+            self.stdout.write(
+                self.style.WARNING(
+                    f"{len(stale)} agents are out of date, run with --fix to fix them"
+                )
+            )
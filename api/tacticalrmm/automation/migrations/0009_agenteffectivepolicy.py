@@ -0,0 +1,54 @@
+# Generated by Django 3.2 on 2026-10-17 02:28
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("agents", "0040_populate_hardwareinventory"),
+        ("automation", "0008_auto_20210302_0415"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AgentEffectivePolicy",
+            fields=[
+                (
+                    "agent",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="effective_policy",
+                        serialize=False,
+                        to="agents.agent",
+                    ),
+                ),
+                (
+                    "policies",
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.PositiveIntegerField(null=True),
+                        default=list,
+                        size=None,
+                    ),
+                ),
+                (
+                    "applied",
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.PositiveIntegerField(),
+                        default=list,
+                        size=None,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="agenteffectivepolicy",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["policies"], name="automation__policie_f15e16_gin"
+            ),
+        ),
+    ]
@@ -0,0 +1,97 @@
+from django.db import migrations
+
+# frozen copies of automation.utils as of this migration, so later changes to the
+# live helpers don't change what this migration writes
+POLICY_AGENT_FIELDS = (
+    "pk",
+    "monitoring_type",
+    "policy_id",
+    "site_id",
+    "site__server_policy_id",
+    "site__workstation_policy_id",
+    "site__client_id",
+    "site__client__server_policy_id",
+    "site__client__workstation_policy_id",
+)
+
+POLICY_EXCLUSION_FIELDS = ("excluded_clients", "excluded_sites", "excluded_agents")
+
+
+def policy_exclusions(policy_model, agent_pks):
+    excluded = set()
+    for field in POLICY_EXCLUSION_FIELDS:
+        descriptor = getattr(policy_model, field)
+        target = f"{descriptor.field.related_model._meta.model_name}_id"
+        rows = descriptor.through.objects.values_list("policy_id", target)
+        if field == "excluded_agents":
+            rows = rows.filter(agent_id__in=agent_pks)
+        excluded |= {(field, policy, pk) for policy, pk in rows}
+
+    return excluded
+
+
+def effective_policies(agent, core, excluded):
+    mon_type = agent["monitoring_type"]
+    policies = [
+        agent["policy_id"],
+        agent.get(f"site__{mon_type}_policy_id"),
+        agent.get(f"site__client__{mon_type}_policy_id"),
+        core.get(f"{mon_type}_policy_id") if core else None,
+    ]
+
+    applied = []
+    for pk in policies:
+        if (
+            pk is None
+            or pk in applied
+            or ("excluded_agents", pk, agent["pk"]) in excluded
+            or ("excluded_sites", pk, agent["site_id"]) in excluded
+            or ("excluded_clients", pk, agent["site__client_id"]) in excluded
+        ):
+            continue
+
+        applied.append(pk)
+
+    return policies, applied
+
+
+def populate_agent_effective_policy(apps, schema_editor):
+    Agent = apps.get_model("agents", "Agent")
+    AgentEffectivePolicy = apps.get_model("automation", "AgentEffectivePolicy")
+    CoreSettings = apps.get_model("core", "CoreSettings")
+    Policy = apps.get_model("automation", "Policy")
+
+    core = CoreSettings.objects.values(
+        "server_policy_id", "workstation_policy_id"
+    ).first()
+    rows = list(Agent.objects.values(*POLICY_AGENT_FIELDS))
+
+    for i in range(0, len(rows), 500):
+        chunk = rows[i : i + 500]
+        excluded = policy_exclusions(Policy, [agent["pk"] for agent in chunk])
+
+        effective = []
+        for agent in chunk:
+            policies, applied = effective_policies(agent, core, excluded)
+            effective.append(
+                AgentEffectivePolicy(
+                    agent_id=agent["pk"], policies=policies, applied=applied
+                )
+            )
+
+        AgentEffectivePolicy.objects.bulk_create(effective)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("automation", "0009_agenteffectivepolicy"),
+        ("clients", "0016_auto_20210329_1827"),
+        ("core", "0020_notification"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            populate_agent_effective_policy, migrations.RunPython.noop
+        ),
+    ]
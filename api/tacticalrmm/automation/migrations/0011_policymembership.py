@@ -0,0 +1,48 @@
+# Generated by Django 3.2 on 2026-10-17 02:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("agents", "0040_populate_hardwareinventory"),
+        ("automation", "0010_populate_agenteffectivepolicy"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PolicyMembership",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "agent",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="policy_memberships",
+                        to="agents.agent",
+                    ),
+                ),
+                (
+                    "policy",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="memberships",
+                        to="automation.policy",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("policy", "agent")},
+            },
+        ),
+    ]
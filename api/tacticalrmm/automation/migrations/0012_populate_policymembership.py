@@ -0,0 +1,32 @@
+from django.db import migrations
+
+
+def populate_policy_membership(apps, schema_editor):
+    AgentEffectivePolicy = apps.get_model("automation", "AgentEffectivePolicy")
+    PolicyMembership = apps.get_model("automation", "PolicyMembership")
+
+    memberships = []
+    for agent_pk, applied in AgentEffectivePolicy.objects.values_list(
+        "agent_id", "applied"
+    ).iterator():
+        memberships += [
+            PolicyMembership(agent_id=agent_pk, policy_id=policy_pk)
+            for policy_pk in applied
+        ]
+
+        if len(memberships) >= 500:
+            PolicyMembership.objects.bulk_create(memberships)
+            memberships = []
+
+    PolicyMembership.objects.bulk_create(memberships)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("automation", "0011_policymembership"),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_policy_membership, migrations.RunPython.noop),
+    ]
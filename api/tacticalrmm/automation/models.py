@@ -1,8 +1,64 @@
-from django.db import models
+import math
+import time
+from collections import defaultdict
+from typing import Iterable, Optional
+
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.db import models, transaction
+from django.db.models import Q, QuerySet
 
 from agents.models import Agent
+from autotasks.models import AutomatedTask
+from checks.models import Check
 from core.models import CoreSettings
 from logs.models import BaseAuditModel
+from tacticalrmm.redis_client import redis_client
+
+from .utils import POLICY_AGENT_FIELDS, effective_policies, policy_exclusions
+
+# agents whose policy checks and tasks are written per transaction
+POLICY_GENERATE_CHUNK = 500
+
+# "scope:value" members waiting for the policies of their agents to be refreshed
+# and regenerated, scored by the time they are due
+POLICY_REGENERATE_QUEUE_KEY = "policy_regenerate"
+# set while a run of the queue is scheduled
+POLICY_REGENERATE_SCHEDULED_KEY = "policy_regenerate_scheduled"
+# seconds a scope waits in the queue, requests for it in that time are merged
+POLICY_REGENERATE_DELAY = 10
+
+# the agents a queued scope covers
+POLICY_REGENERATE_SCOPES = {
+    "agent": lambda values: Q(pk__in=values),
+    "site": lambda values: Q(site_id__in=values),
+    "client": lambda values: Q(site__client_id__in=values),
+    "monitoring_type": lambda values: Q(monitoring_type__in=values),
+    "policy": lambda values: Q(effective_policy__policies__overlap=values),
+}
+# scopes whose agents are regenerated even if their policies didn't change
+POLICY_REGENERATE_FORCED_SCOPES = ("agent", "policy")
+
+# fields that make two checks the same check on an agent
+POLICY_CHECK_KEY_FIELDS = {
+    "diskspace": ("disk",),
+    "ping": ("ip",),
+    "cpuload": (),
+    "memory": (),
+    "winsvc": ("svc_name",),
+    "script": ("script_id",),
+    "eventlog": ("log_name", "event_id"),
+}
+
+
+def policy_check_key(check: Check) -> Optional[tuple]:
+    # an agent only gets one check with the same key
+    if check.check_type not in POLICY_CHECK_KEY_FIELDS:
+        return None
+
+    return (check.check_type,) + tuple(
+        getattr(check, i) for i in POLICY_CHECK_KEY_FIELDS[check.check_type]
+    )
 
 
 class Policy(BaseAuditModel):
@@ -29,30 +85,18 @@ class Policy(BaseAuditModel):
 
     def save(self, *args, **kwargs):
         from alerts.tasks import cache_agents_alert_template
-        from automation.tasks import generate_agent_checks_from_policies_task
 
         # get old policy if exists
         old_policy = type(self).objects.get(pk=self.pk) if self.pk else None
         super(BaseAuditModel, self).save(*args, **kwargs)
 
-        # generate agent checks only if active and enforced were changed
+        # regenerate agent checks only if active and enforced were changed
         if old_policy:
             if old_policy.active != self.active or old_policy.enforced != self.enforced:
-                generate_agent_checks_from_policies_task.delay(
-                    policypk=self.pk,
-                    create_tasks=True,
-                )
+                type(self).queue_regeneration("policy", [self.pk])
 
             if old_policy.alert_template != self.alert_template:
-                cache_agents_alert_template.delay()
-
-    def delete(self, *args, **kwargs):
-        from automation.tasks import generate_agent_checks_task
-
-        agents = list(self.related_agents().only("pk").values_list("pk", flat=True))
-        super(BaseAuditModel, self).delete(*args, **kwargs)
-
-        generate_agent_checks_task.delay(agents, create_tasks=True)
+                cache_agents_alert_template.delay(policy=self.pk)
 
     @property
     def is_default_server_policy(self):
@@ -65,54 +109,11 @@ class Policy(BaseAuditModel):
     def __str__(self):
         return self.name
 
-    def is_agent_excluded(self, agent):
-        return (
-            agent in self.excluded_agents.all()
-            or agent.site in self.excluded_sites.all()
-            or agent.client in self.excluded_clients.all()
-        )
-
     def related_agents(self):
-        return self.get_related("server") | self.get_related("workstation")
+        return Agent.objects.filter(policy_memberships__policy=self)
 
     def get_related(self, mon_type):
-        explicit_agents = (
-            self.agents.filter(monitoring_type=mon_type)  # type: ignore
-            .exclude(
-                pk__in=self.excluded_agents.only("pk").values_list("pk", flat=True)
-            )
-            .exclude(site__in=self.excluded_sites.all())
-            .exclude(site__client__in=self.excluded_clients.all())
-        )
-
-        explicit_clients = getattr(self, f"{mon_type}_clients").exclude(
-            pk__in=self.excluded_clients.all()
-        )
-        explicit_sites = getattr(self, f"{mon_type}_sites").exclude(
-            pk__in=self.excluded_sites.all()
-        )
-
-        filtered_agents_pks = Policy.objects.none()
-
-        filtered_agents_pks |= Agent.objects.filter(
-            site__in=[
-                site
-                for site in explicit_sites
-                if site.client not in explicit_clients
-                and site.client not in self.excluded_clients.all()
-            ],
-            monitoring_type=mon_type,
-        ).values_list("pk", flat=True)
-
-        filtered_agents_pks |= Agent.objects.filter(
-            site__client__in=[client for client in explicit_clients],
-            monitoring_type=mon_type,
-        ).values_list("pk", flat=True)
-
-        return Agent.objects.filter(
-            models.Q(pk__in=filtered_agents_pks)
-            | models.Q(pk__in=explicit_agents.only("pk"))
-        )
+        return self.related_agents().filter(monitoring_type=mon_type)
 
     @staticmethod
     def serialize(policy):
@@ -121,320 +122,481 @@ class Policy(BaseAuditModel):
 
         return PolicySerializer(policy).data
 
+    @classmethod
+    def queue_regeneration(cls, scope: str, values: Iterable) -> None:
+        """
+        Queues the agents of a scope in POLICY_REGENERATE_SCOPES to have their
+        effective policies refreshed and their policy checks and tasks regenerated
+        in POLICY_REGENERATE_DELAY seconds. A scope that is already queued keeps its
+        place, so repeated changes are handled once.
+        """
+        members = [f"{scope}:{value}" for value in values]
+        if not members:
+            return
+
+        due = time.time() + POLICY_REGENERATE_DELAY
+        redis_client.zadd(
+            POLICY_REGENERATE_QUEUE_KEY, dict.fromkeys(members, due), nx=True
+        )
+
+        # one run picks up everything queued until it starts
+        cls._schedule_regeneration(POLICY_REGENERATE_DELAY)
+
     @staticmethod
-    def cascade_policy_tasks(agent):
-        from autotasks.models import AutomatedTask
-        from autotasks.tasks import delete_win_task_schedule
-        from logs.models import PendingAction
+    def _schedule_regeneration(countdown: int) -> None:
+        # the key expires in case the run is lost, the periodic task catches up then
+        if redis_client.set(
+            POLICY_REGENERATE_SCHEDULED_KEY, 1, nx=True, ex=countdown + 60
+        ):
+            from .tasks import regenerate_queued_policies_task
 
-        # List of all tasks to be applied
-        tasks = list()
-        added_task_pks = list()
+            regenerate_queued_policies_task.apply_async(countdown=countdown)
 
-        agent_tasks_parent_pks = [
-            task.parent_task for task in agent.autotasks.filter(managed_by_policy=True)
-        ]
+    @staticmethod
+    def regeneration_queue_depth() -> int:
+        return redis_client.zcard(POLICY_REGENERATE_QUEUE_KEY)
+
+    @classmethod
+    def process_regeneration_queue(cls) -> int:
+        """
+        Handles the queued scopes that are due, POLICY_GENERATE_CHUNK at a time.
+        Returns the number of scopes handled.
+        """
+        # agents queued from now on need another run
+        redis_client.delete(POLICY_REGENERATE_SCHEDULED_KEY)
+
+        processed = 0
+        while True:
+            # popped atomically so overlapping runs don't regenerate the same agents
+            popped = redis_client.zpopmin(
+                POLICY_REGENERATE_QUEUE_KEY, POLICY_GENERATE_CHUNK
+            )
+            now = time.time()
+            due = [member for member, score in popped if score <= now]
+            waiting = {member: score for member, score in popped if score > now}
+            if waiting:
+                redis_client.zadd(POLICY_REGENERATE_QUEUE_KEY, waiting, nx=True)
+
+            if due:
+                try:
+                    cls._regenerate_scopes(due)
+                except Exception:
+                    # put them back for the next run
+                    redis_client.zadd(
+                        POLICY_REGENERATE_QUEUE_KEY, dict.fromkeys(due, now), nx=True
+                    )
+                    raise
+                processed += len(due)
+
+            if waiting or len(popped) < POLICY_GENERATE_CHUNK:
+                break
+
+        # schedule a run for scopes that are not due yet
+        first = redis_client.zrange(POLICY_REGENERATE_QUEUE_KEY, 0, 0, withscores=True)
+        if first:
+            cls._schedule_regeneration(max(math.ceil(first[0][1] - time.time()), 1))
+
+        return processed
+
+    @classmethod
+    def _regenerate_scopes(cls, members: list[bytes]) -> None:
+        from alerts.models import AlertTemplate
+
+        values = defaultdict(set)
+        for member in members:
+            scope, value = member.decode().split(":", 1)
+            values[scope].add(value if scope == "monitoring_type" else int(value))
+
+        refresh, forced = Q(), Q()
+        for scope, scope_values in values.items():
+            q = POLICY_REGENERATE_SCOPES[scope](list(scope_values))
+            refresh |= q
+            if scope in POLICY_REGENERATE_FORCED_SCOPES:
+                forced |= q
+
+        stale = AgentEffectivePolicy.refresh(Agent.objects.filter(refresh))
+        # policies can carry an alert template
+        if stale:
+            AlertTemplate.cache_on_agents(Agent.objects.filter(pk__in=stale))
+
+        agent_pks = set(stale)
+        if forced:
+            agent_pks.update(Agent.objects.filter(forced).values_list("pk", flat=True))
+
+        cls.generate_policy_checks_and_tasks(agent_pks, tasks=True)
+
+    @classmethod
+    def generate_policy_checks_and_tasks(
+        cls, agent_pks: Iterable[int], checks: bool = True, tasks: bool = False
+    ) -> None:
+        """
+        Applies the policy checks and optionally the policy tasks to the agents.
+        Policies are loaded once and each chunk of agents is compared with the
+        checks and tasks it should have, then the difference is written in bulk in
+        one transaction per chunk.
+        """
+        from checks.models import clear_check_runner_cache
+        from clients.models import clear_tree_cache
+
+        policies = {i.pk: i for i in cls.objects.filter(active=True)}
+        policy_checks: dict[int, list] = defaultdict(list)
+        policy_tasks: dict[int, list] = defaultdict(list)
+        if checks and policies:
+            for check in (
+                Check.objects.filter(policy__in=policies.keys())
+                .select_related("script")
+                .order_by("pk")
+            ):
+                policy_checks[check.policy_id].append(check)
+        if tasks and policies:
+            for task in (
+                AutomatedTask.objects.filter(policy__in=policies.keys())
+                .select_related("script", "assigned_check")
+                .order_by("pk")
+            ):
+                policy_tasks[task.policy_id].append(task)
+
+        agent_pks = list(agent_pks)
+        for i in range(0, len(agent_pks), POLICY_GENERATE_CHUNK):
+            chunk = agent_pks[i : i + POLICY_GENERATE_CHUNK]
+
+            # active policies applied to the agent in order of precedence
+            applied = {
+                agent["pk"]: [
+                    policies[pk]
+                    for pk in agent["effective_policy__applied"]
+                    if pk in policies
+                ]
+                for agent in AgentEffectivePolicy.agent_rows(
+                    Agent.objects.filter(pk__in=chunk), "pk"
+                )
+            }
 
-        # Get policies applied to agent and agent site and client
-        client = agent.client
-        site = agent.site
-
-        default_policy = None
-        client_policy = None
-        site_policy = None
-        agent_policy = agent.policy
-
-        # Get the Client/Site policy based on if the agent is server or workstation
-        if agent.monitoring_type == "server":
-            default_policy = CoreSettings.objects.first().server_policy
-            client_policy = client.server_policy
-            site_policy = site.server_policy
-        elif agent.monitoring_type == "workstation":
-            default_policy = CoreSettings.objects.first().workstation_policy
-            client_policy = client.workstation_policy
-            site_policy = site.workstation_policy
-
-        if (
-            agent_policy
-            and agent_policy.active
-            and not agent_policy.is_agent_excluded(agent)
-        ):
-            for task in agent_policy.autotasks.all():
-                if task.pk not in added_task_pks:
-                    tasks.append(task)
-                    added_task_pks.append(task.pk)
-        if (
-            site_policy
-            and site_policy.active
-            and not site_policy.is_agent_excluded(agent)
-        ):
-            for task in site_policy.autotasks.all():
-                if task.pk not in added_task_pks:
-                    tasks.append(task)
-                    added_task_pks.append(task.pk)
-        if (
-            client_policy
-            and client_policy.active
-            and not client_policy.is_agent_excluded(agent)
-        ):
-            for task in client_policy.autotasks.all():
-                if task.pk not in added_task_pks:
-                    tasks.append(task)
-                    added_task_pks.append(task.pk)
-
-        if (
-            default_policy
-            and default_policy.active
-            and not default_policy.is_agent_excluded(agent)
+            if checks:
+                cls._apply_policy_checks(applied, policy_checks)
+            if tasks:
+                cls._apply_policy_tasks(applied, policy_tasks)
+
+            clear_check_runner_cache(*applied.keys())
+            clear_tree_cache()
+
+    @staticmethod
+    def _apply_policy_checks(applied: dict[int, list], policy_checks: dict) -> None:
+        agent_checks = defaultdict(list)
+        for check in (
+            Check.objects.filter(agent_id__in=applied.keys())
+            .only(
+                "pk",
+                "agent_id",
+                "managed_by_policy",
+                "parent_check",
+                "overriden_by_policy",
+                "check_type",
+                "disk",
+                "ip",
+                "svc_name",
+                "script_id",
+                "log_name",
+                "event_id",
+            )
+            .order_by("pk")
         ):
-            for task in default_policy.autotasks.all():
-                if task.pk not in added_task_pks:
-                    tasks.append(task)
-                    added_task_pks.append(task.pk)
-
-        # remove policy tasks from agent not included in policy
-        for task in agent.autotasks.filter(
-            parent_task__in=[
-                taskpk
-                for taskpk in agent_tasks_parent_pks
-                if taskpk not in added_task_pks
+            agent_checks[check.agent_id].append(check)
+
+        overriden, delete, create = [], [], []
+        for agent_pk, policies in applied.items():
+            enforced_checks = [
+                check
+                for policy in policies
+                if policy.enforced
+                for check in policy_checks[policy.pk]
+            ]
+            checks = [
+                check
+                for policy in policies
+                if not policy.enforced
+                for check in policy_checks[policy.pk]
+            ]
+            managed = [i for i in agent_checks[agent_pk] if i.managed_by_policy]
+            unmanaged = [i for i in agent_checks[agent_pk] if not i.managed_by_policy]
+
+            # enforced policies are applied first, then the agent's own checks and
+            # then the rest. only the first check of a kind is kept, agent checks
+            # that lose are flagged as overriden
+            added, keep, overriden_pks = set(), set(), set()
+            for check in enforced_checks + unmanaged + checks:
+                key = policy_check_key(check)
+                if key is None:
+                    continue
+                if key not in added:
+                    added.add(key)
+                    if not check.agent_id:
+                        keep.add(check.pk)
+                elif check.agent_id:
+                    overriden_pks.add(check.pk)
+
+            for check in agent_checks[agent_pk]:
+                if check.overriden_by_policy != (check.pk in overriden_pks):
+                    check.overriden_by_policy = not check.overriden_by_policy
+                    overriden.append(check)
+
+            # remove policy checks from agent that fell out of policy scope
+            delete += [i.pk for i in managed if i.parent_check not in keep]
+
+            existing = {i.parent_check for i in managed}
+            create += [
+                check.policy_check_copy(agent_id=agent_pk)
+                for check in enforced_checks + checks
+                if check.pk in keep and check.pk not in existing
             ]
+
+        with transaction.atomic():
+            Check.objects.bulk_update(
+                overriden, ["overriden_by_policy"], batch_size=1000
+            )
+            if delete:
+                Check.objects.filter(pk__in=delete).delete()
+            Check.objects.bulk_create(create, batch_size=1000)
+
+    @staticmethod
+    def _apply_policy_tasks(applied: dict[int, list], policy_tasks: dict) -> None:
+        from autotasks.tasks import create_win_task_schedule, delete_win_task_schedule
+        from logs.models import PendingAction
+
+        agent_pks = list(applied.keys())
+        managed = defaultdict(list)
+        for task in AutomatedTask.objects.filter(
+            agent_id__in=agent_pks, managed_by_policy=True
+        ).only("pk", "agent_id", "parent_task"):
+            managed[task.agent_id].append(task)
+
+        # checks a new task can be assigned to, the policy check's copy on the agent
+        # or the agent check that overrides it
+        agent_checks = defaultdict(list)
+        for check in (
+            Check.objects.filter(agent_id__in=agent_pks)
+            .filter(Q(managed_by_policy=True) | Q(overriden_by_policy=True))
+            .only("pk", "agent_id", "parent_check", "check_type", "overriden_by_policy")
+            .order_by("pk")
         ):
-            delete_win_task_schedule.delay(task.pk)
+            agent_checks[check.agent_id].append(check)
 
-        # handle matching tasks that haven't synced to agent yet or pending deletion due to agent being offline
-        for action in agent.pendingactions.filter(action_type="taskaction").exclude(
-            status="completed"
+        pending_actions = defaultdict(list)
+        for action in (
+            PendingAction.objects.filter(
+                agent_id__in=agent_pks, action_type="taskaction"
+            )
+            .exclude(status="completed")
+            .only("pk", "agent_id", "details")
         ):
-            task = AutomatedTask.objects.get(pk=action.details["task_id"])
-            if (
-                task.parent_task in agent_tasks_parent_pks
-                and task.parent_task in added_task_pks
-            ):
-                agent.remove_matching_pending_task_actions(task.id)
+            pending_actions[action.agent_id].append(action)
+        pending_tasks = AutomatedTask.objects.only("pk", "parent_task").in_bulk(
+            {
+                action.details["task_id"]
+                for actions in pending_actions.values()
+                for action in actions
+            }
+        )
+
+        delete, create, delete_actions, create_actions, notsynced = [], [], [], [], {}
+        for agent_pk, policies in applied.items():
+            tasks = list(
+                {
+                    task.pk: task
+                    for policy in policies
+                    for task in policy_tasks[policy.pk]
+                }.values()
+            )
+            added = {task.pk for task in tasks}
+            existing = {task.parent_task for task in managed[agent_pk]}
+
+            # remove policy tasks from agent not included in policy
+            delete += [i.pk for i in managed[agent_pk] if i.parent_task not in added]
+
+            # handle matching tasks that haven't synced to agent yet or pending deletion due to agent being offline
+            for action in pending_actions[agent_pk]:
+                task = pending_tasks.get(action.details["task_id"])
+                if task and task.parent_task in existing & added:
+                    delete_actions.append(action.pk)
+                    notsynced[task.pk] = (agent_pk, task)
+
+            for task in tasks:
+                if task.pk in existing:
+                    continue
+
+                assigned_check = None
+                if task.assigned_check:
+                    checks = agent_checks[agent_pk]
+                    assigned_check = next(
+                        (i for i in checks if i.parent_check == task.assigned_check.pk),
+                        None,
+                    ) or next(
+                        (
+                            i
+                            for i in checks
+                            if i.check_type == task.assigned_check.check_type
+                            and i.overriden_by_policy
+                        ),
+                        None,
+                    )
+
+                create.append(
+                    task.policy_task_copy(
+                        agent_id=agent_pk, assigned_check=assigned_check
+                    )
+                )
 
+        for agent_pk, task in notsynced.values():
+            task.sync_status = "notsynced"
+            create_actions.append(
                 PendingAction(
-                    agent=agent,
+                    agent_id=agent_pk,
                     action_type="taskaction",
-                    details={"action": "taskcreate", "task_id": task.id},
-                ).save()
-                task.sync_status = "notsynced"
-                task.save(update_fields=["sync_status"])
+                    details={"action": "taskcreate", "task_id": task.pk},
+                )
+            )
 
-        return [task for task in tasks if task.pk not in agent_tasks_parent_pks]
+        with transaction.atomic():
+            PendingAction.objects.filter(pk__in=delete_actions).delete()
+            PendingAction.objects.bulk_create(create_actions)
+            AutomatedTask.objects.bulk_update(
+                [task for _, task in notsynced.values()], ["sync_status"]
+            )
+            AutomatedTask.objects.bulk_create(create, batch_size=1000)
 
-    @staticmethod
-    def cascade_policy_checks(agent):
-        # Get checks added to agent directly
-        agent_checks = list(agent.agentchecks.filter(managed_by_policy=False))
+        for pk in delete:
+            delete_win_task_schedule.delay(pk)
 
-        agent_checks_parent_pks = [
-            check.parent_check
-            for check in agent.agentchecks.filter(managed_by_policy=True)
-        ]
+        for task in create:
+            create_win_task_schedule.delay(task.pk)
 
-        # Get policies applied to agent and agent site and client
-        client = agent.client
-        site = agent.site
-
-        default_policy = None
-        client_policy = None
-        site_policy = None
-        agent_policy = agent.policy
-
-        if agent.monitoring_type == "server":
-            default_policy = CoreSettings.objects.first().server_policy
-            client_policy = client.server_policy
-            site_policy = site.server_policy
-        elif agent.monitoring_type == "workstation":
-            default_policy = CoreSettings.objects.first().workstation_policy
-            client_policy = client.workstation_policy
-            site_policy = site.workstation_policy
-
-        # Used to hold the policies that will be applied and the order in which they are applied
-        # Enforced policies are applied first
-        enforced_checks = list()
-        policy_checks = list()
-
-        if (
-            agent_policy
-            and agent_policy.active
-            and not agent_policy.is_agent_excluded(agent)
-        ):
-            if agent_policy.enforced:
-                for check in agent_policy.policychecks.all():
-                    enforced_checks.append(check)
-            else:
-                for check in agent_policy.policychecks.all():
-                    policy_checks.append(check)
-
-        if (
-            site_policy
-            and site_policy.active
-            and not site_policy.is_agent_excluded(agent)
-        ):
-            if site_policy.enforced:
-                for check in site_policy.policychecks.all():
-                    enforced_checks.append(check)
-            else:
-                for check in site_policy.policychecks.all():
-                    policy_checks.append(check)
-
-        if (
-            client_policy
-            and client_policy.active
-            and not client_policy.is_agent_excluded(agent)
-        ):
-            if client_policy.enforced:
-                for check in client_policy.policychecks.all():
-                    enforced_checks.append(check)
-            else:
-                for check in client_policy.policychecks.all():
-                    policy_checks.append(check)
-
-        if (
-            default_policy
-            and default_policy.active
-            and not default_policy.is_agent_excluded(agent)
-        ):
-            if default_policy.enforced:
-                for check in default_policy.policychecks.all():
-                    enforced_checks.append(check)
-            else:
-                for check in default_policy.policychecks.all():
-                    policy_checks.append(check)
-
-        # Sorted Checks already added
-        added_diskspace_checks = list()
-        added_ping_checks = list()
-        added_winsvc_checks = list()
-        added_script_checks = list()
-        added_eventlog_checks = list()
-        added_cpuload_checks = list()
-        added_memory_checks = list()
-
-        # Lists all agent and policy checks that will be created
-        diskspace_checks = list()
-        ping_checks = list()
-        winsvc_checks = list()
-        script_checks = list()
-        eventlog_checks = list()
-        cpuload_checks = list()
-        memory_checks = list()
-
-        # Loop over checks in with enforced policies first, then non-enforced policies
-        for check in enforced_checks + agent_checks + policy_checks:
-            if check.check_type == "diskspace":
-                # Check if drive letter was already added
-                if check.disk not in added_diskspace_checks:
-                    added_diskspace_checks.append(check.disk)
-                    # Dont create the check if it is an agent check
-                    if not check.agent:
-                        diskspace_checks.append(check)
-                elif check.agent:
-                    check.overriden_by_policy = True
-                    check.save()
-
-            if check.check_type == "ping":
-                # Check if IP/host was already added
-                if check.ip not in added_ping_checks:
-                    added_ping_checks.append(check.ip)
-                    # Dont create the check if it is an agent check
-                    if not check.agent:
-                        ping_checks.append(check)
-                elif check.agent:
-                    check.overriden_by_policy = True
-                    check.save()
-
-            if check.check_type == "cpuload":
-                # Check if cpuload list is empty
-                if not added_cpuload_checks:
-                    added_cpuload_checks.append(check)
-                    # Dont create the check if it is an agent check
-                    if not check.agent:
-                        cpuload_checks.append(check)
-                elif check.agent:
-                    check.overriden_by_policy = True
-                    check.save()
-
-            if check.check_type == "memory":
-                # Check if memory check list is empty
-                if not added_memory_checks:
-                    added_memory_checks.append(check)
-                    # Dont create the check if it is an agent check
-                    if not check.agent:
-                        memory_checks.append(check)
-                elif check.agent:
-                    check.overriden_by_policy = True
-                    check.save()
-
-            if check.check_type == "winsvc":
-                # Check if service name was already added
-                if check.svc_name not in added_winsvc_checks:
-                    added_winsvc_checks.append(check.svc_name)
-                    # Dont create the check if it is an agent check
-                    if not check.agent:
-                        winsvc_checks.append(check)
-                elif check.agent:
-                    check.overriden_by_policy = True
-                    check.save()
-
-            if check.check_type == "script":
-                # Check if script id was already added
-                if check.script.id not in added_script_checks:
-                    added_script_checks.append(check.script.id)
-                    # Dont create the check if it is an agent check
-                    if not check.agent:
-                        script_checks.append(check)
-                elif check.agent:
-                    check.overriden_by_policy = True
-                    check.save()
-
-            if check.check_type == "eventlog":
-                # Check if events were already added
-                if [check.log_name, check.event_id] not in added_eventlog_checks:
-                    added_eventlog_checks.append([check.log_name, check.event_id])
-                    if not check.agent:
-                        eventlog_checks.append(check)
-                elif check.agent:
-                    check.overriden_by_policy = True
-                    check.save()
-
-        final_list = (
-            diskspace_checks
-            + ping_checks
-            + cpuload_checks
-            + memory_checks
-            + winsvc_checks
-            + script_checks
-            + eventlog_checks
-        )
 
-        # remove policy checks from agent that fell out of policy scope
-        agent.agentchecks.filter(
-            parent_check__in=[
-                checkpk
-                for checkpk in agent_checks_parent_pks
-                if checkpk not in [check.pk for check in final_list]
-            ]
-        ).delete()
+class AgentEffectivePolicy(models.Model):
+    """
+    The policies that apply to an agent, refreshed by the policy regeneration
+    queue when the agent, its site or client, the default policies or policy
+    exclusions change
+    """
+
+    agent = models.OneToOneField(
+        "agents.Agent",
+        primary_key=True,
+        related_name="effective_policy",
+        on_delete=models.CASCADE,
+    )
+    # agent, site, client and default policy for the agent's monitoring type
+    policies = ArrayField(models.PositiveIntegerField(null=True), default=list)
+    # the distinct policies above that don't exclude the agent, in order of precedence
+    applied = ArrayField(models.PositiveIntegerField(), default=list)
+
+    class Meta:
+        indexes = [GinIndex(fields=["policies"])]
+
+    def __str__(self):
+        return self.agent.hostname
+
+    @classmethod
+    def refresh(
+        cls, agents: Optional[QuerySet[Agent]] = None, dry_run: bool = False
+    ) -> list[int]:
+        """
+        Recomputes the effective policies and policy memberships of the agents, all
+        of them unless a queryset is passed. Only agents that are out of date are
+        written, returns their pks. Nothing is written with dry_run.
+        """
+        if agents is None:
+            agents = Agent.objects.all()
+
+        core = CoreSettings.objects.values(
+            "server_policy_id", "workstation_policy_id"
+        ).first()
+        rows = list(agents.values(*POLICY_AGENT_FIELDS))
+
+        changed = []
+        for i in range(0, len(rows), POLICY_GENERATE_CHUNK):
+            chunk = rows[i : i + POLICY_GENERATE_CHUNK]
+            agent_pks = [agent["pk"] for agent in chunk]
+            excluded = policy_exclusions(Policy, agent_pks)
+            existing = cls.objects.in_bulk(agent_pks)
+            members = defaultdict(set)
+            for agent_pk, policy_pk in PolicyMembership.objects.filter(
+                agent_id__in=agent_pks
+            ).values_list("agent_id", "policy_id"):
+                members[agent_pk].add(policy_pk)
+
+            create, update, stale = [], [], {}
+            for agent in chunk:
+                policies, applied = effective_policies(agent, core, excluded)
+                row = existing.get(agent["pk"])
+                if not row:
+                    create.append(
+                        cls(agent_id=agent["pk"], policies=policies, applied=applied)
+                    )
+                elif (row.policies, row.applied) != (policies, applied):
+                    row.policies, row.applied = policies, applied
+                    update.append(row)
+                elif members[agent["pk"]] == set(applied):
+                    continue
+
+                stale[agent["pk"]] = applied
+
+            changed += stale.keys()
+            if dry_run or not stale:
+                continue
+
+            with transaction.atomic():
+                cls.objects.bulk_create(create, ignore_conflicts=True)
+                cls.objects.bulk_update(update, ["policies", "applied"])
+                PolicyMembership.objects.filter(agent_id__in=stale.keys()).delete()
+                PolicyMembership.objects.bulk_create(
+                    [
+                        PolicyMembership(agent_id=agent_pk, policy_id=policy_pk)
+                        for agent_pk, applied in stale.items()
+                        for policy_pk in applied
+                    ],
+                    ignore_conflicts=True,
+                )
+
+        return changed
 
-        return [
-            check for check in final_list if check.pk not in agent_checks_parent_pks
+    @classmethod
+    def agent_rows(cls, agents: QuerySet[Agent], *fields: str) -> list[dict]:
+        """
+        agents.values() with the agent's policies and applied policies added. Agents
+        that don't have a row yet get one.
+        """
+        fields = (*fields, "effective_policy__policies", "effective_policy__applied")
+        rows = list(agents.values(*fields))
+
+        missing = [
+            row["pk"] for row in rows if row["effective_policy__applied"] is None
         ]
+        if missing:
+            cls.refresh(Agent.objects.filter(pk__in=missing))
+            rows = list(agents.values(*fields))
 
-    @staticmethod
-    def generate_policy_checks(agent):
-        checks = Policy.cascade_policy_checks(agent)
+        return rows
 
-        if checks:
-            for check in checks:
-                check.create_policy_check(agent)
 
-    @staticmethod
-    def generate_policy_tasks(agent):
-        tasks = Policy.cascade_policy_tasks(agent)
+class PolicyMembership(models.Model):
+    """
+    An agent a policy applies to, kept in sync with AgentEffectivePolicy.applied
+    so the agents of a policy are one indexed lookup
+    """
 
-        if tasks:
-            for task in tasks:
-                task.create_policy_task(agent)
+    policy = models.ForeignKey(
+        Policy,
+        related_name="memberships",
+        on_delete=models.CASCADE,
+    )
+    agent = models.ForeignKey(
+        "agents.Agent",
+        related_name="policy_memberships",
+        on_delete=models.CASCADE,
+    )
+
+    class Meta:
+        unique_together = (("policy", "agent"),)
+
+    def __str__(self):
+        return f"{self.policy.name} - {self.agent.hostname}"
@@ -37,6 +37,10 @@ class PolicyTableSerializer(ModelSerializer):
         depth = 1
 
     def get_agents_count(self, policy):
+        # counted for all policies at once by the policies view
+        if "agents_count" in self.context:
+            return self.context["agents_count"].get(policy.pk, 0)
+
         return policy.related_agents().count()
 
 
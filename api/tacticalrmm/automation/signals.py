@@ -0,0 +1,106 @@
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from agents.models import Agent
+from clients.models import Client, Site
+from core.models import CoreSettings
+
+from .models import Policy
+
+# fields that change which policies apply to an agent
+AGENT_POLICY_FIELDS = ("policy_id", "site_id", "monitoring_type")
+SITE_POLICY_FIELDS = ("server_policy_id", "workstation_policy_id", "client_id")
+CLIENT_POLICY_FIELDS = ("server_policy_id", "workstation_policy_id")
+CORE_POLICY_FIELDS = ("server_policy_id", "workstation_policy_id")
+
+
+def policy_fields(instance, fields) -> tuple:
+    # read from __dict__ so deferred fields are not loaded
+    return tuple(instance.__dict__.get(i) for i in fields)
+
+
+@receiver(post_init, sender=Agent)
+def store_agent_policy_fields(sender, instance: Agent, **kwargs):
+    instance._policy_fields = policy_fields(instance, AGENT_POLICY_FIELDS)
+
+
+@receiver(post_save, sender=Agent)
+def agent_policy_fields_changed(sender, instance: Agent, created, **kwargs):
+    current = policy_fields(instance, AGENT_POLICY_FIELDS)
+    if created or current != instance._policy_fields:
+        Policy.queue_regeneration("agent", [instance.pk])
+
+    instance._policy_fields = current
+
+
+@receiver(post_init, sender=Site)
+def store_site_policy_fields(sender, instance: Site, **kwargs):
+    instance._policy_fields = policy_fields(instance, SITE_POLICY_FIELDS)
+
+
+@receiver(post_save, sender=Site)
+def site_policy_fields_changed(sender, instance: Site, created, **kwargs):
+    current = policy_fields(instance, SITE_POLICY_FIELDS)
+    if not created and current != instance._policy_fields:
+        Policy.queue_regeneration("site", [instance.pk])
+
+    instance._policy_fields = current
+
+
+@receiver(post_init, sender=Client)
+def store_client_policy_fields(sender, instance: Client, **kwargs):
+    instance._policy_fields = policy_fields(instance, CLIENT_POLICY_FIELDS)
+
+
+@receiver(post_save, sender=Client)
+def client_policy_fields_changed(sender, instance: Client, created, **kwargs):
+    current = policy_fields(instance, CLIENT_POLICY_FIELDS)
+    if not created and current != instance._policy_fields:
+        Policy.queue_regeneration("client", [instance.pk])
+
+    instance._policy_fields = current
+
+
+@receiver(post_init, sender=CoreSettings)
+def store_default_policies(sender, instance: CoreSettings, **kwargs):
+    instance._policy_fields = policy_fields(instance, CORE_POLICY_FIELDS)
+
+
+@receiver(post_save, sender=CoreSettings)
+def default_policies_changed(sender, instance: CoreSettings, **kwargs):
+    current = policy_fields(instance, CORE_POLICY_FIELDS)
+    mon_types = [
+        mon_type
+        for mon_type, old, new in zip(
+            ("server", "workstation"), instance._policy_fields, current
+        )
+        if old != new
+    ]
+    if mon_types:
+        Policy.queue_regeneration("monitoring_type", mon_types)
+
+    instance._policy_fields = current
+
+
+@receiver(m2m_changed, sender=Policy.excluded_agents.through)
+@receiver(m2m_changed, sender=Policy.excluded_sites.through)
+@receiver(m2m_changed, sender=Policy.excluded_clients.through)
+def policy_exclusions_changed(sender, instance, action, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+
+    # changed from the agent, site or client side
+    if isinstance(instance, Agent):
+        Policy.queue_regeneration("agent", [instance.pk])
+    elif isinstance(instance, Site):
+        Policy.queue_regeneration("site", [instance.pk])
+    elif isinstance(instance, Client):
+        Policy.queue_regeneration("client", [instance.pk])
+    else:
+        Policy.queue_regeneration("policy", [instance.pk])
+
+
+@receiver(post_delete, sender=Policy)
+def policy_deleted(sender, instance: Policy, **kwargs):
+    # the agent, site, client and default policies were already set to null
+    Policy.queue_regeneration("policy", [instance.pk])
@@ -1,64 +1,40 @@
 from agents.models import Agent
 from automation.models import Policy
 from autotasks.models import AutomatedTask
-from checks.models import Check
+from checks.models import Check, clear_check_runner_cache, next_run_at_expression
 from tacticalrmm.celery import app
 
 
-@app.task
-# generates policy checks on agents affected by a policy and optionally generate automated tasks
-def generate_agent_checks_from_policies_task(policypk, create_tasks=False):
-
-    policy = Policy.objects.get(pk=policypk)
-
-    if policy.is_default_server_policy and policy.is_default_workstation_policy:
-        agents = Agent.objects.prefetch_related("policy").only("pk", "monitoring_type")
-    elif policy.is_default_server_policy:
-        agents = Agent.objects.filter(monitoring_type="server").only(
-            "pk", "monitoring_type"
-        )
-    elif policy.is_default_workstation_policy:
-        agents = Agent.objects.filter(monitoring_type="workstation").only(
-            "pk", "monitoring_type"
-        )
-    else:
-        agents = policy.related_agents().only("pk")
-
-    for agent in agents:
-        agent.generate_checks_from_policies()
-        if create_tasks:
-            agent.generate_tasks_from_policies()
+def policy_agents(policy: Policy):
+    # excluded agents are included so policy checks and tasks are removed from them
+    return Agent.objects.filter(effective_policy__policies__contains=[policy.pk])
 
 
 @app.task
-# generates policy checks on a list of agents and optionally generate automated tasks
-def generate_agent_checks_task(agentpks, create_tasks=False):
-    for agent in Agent.objects.filter(pk__in=agentpks):
-        agent.generate_checks_from_policies()
+def regenerate_queued_policies_task() -> str:
+    Policy.process_regeneration_queue()
 
-        if create_tasks:
-            agent.generate_tasks_from_policies()
+    return "ok"
 
 
 @app.task
-# generates policy checks on agent servers or workstations within a certain client or site and optionally generate automated tasks
-def generate_agent_checks_by_location_task(location, mon_type, create_tasks=False):
+# generates policy checks on agents affected by a policy and optionally generate automated tasks
+def generate_agent_checks_from_policies_task(policypk, create_tasks=False):
 
-    for agent in Agent.objects.filter(**location).filter(monitoring_type=mon_type):
-        agent.generate_checks_from_policies()
+    policy = Policy.objects.get(pk=policypk)
 
-        if create_tasks:
-            agent.generate_tasks_from_policies()
+    Policy.generate_policy_checks_and_tasks(
+        policy_agents(policy).values_list("pk", flat=True), tasks=create_tasks
+    )
 
 
 @app.task
-# generates policy checks on all agent servers or workstations and optionally generate automated tasks
-def generate_all_agent_checks_task(mon_type, create_tasks=False):
-    for agent in Agent.objects.filter(monitoring_type=mon_type):
-        agent.generate_checks_from_policies()
-
-        if create_tasks:
-            agent.generate_tasks_from_policies()
+# generates policy checks on a list of agents and optionally generate automated tasks
+def generate_agent_checks_task(agentpks, create_tasks=False):
+    Policy.generate_policy_checks_and_tasks(
+        Agent.objects.filter(pk__in=agentpks).values_list("pk", flat=True),
+        tasks=create_tasks,
+    )
 
 
 @app.task
@@ -105,6 +81,10 @@ def update_policy_check_fields_task(checkpk):
         dashboard_alert=check.dashboard_alert,
     )
 
+    agent_checks = Check.objects.filter(parent_check=checkpk)
+    agent_checks.update(next_run_at=next_run_at_expression())
+    clear_check_runner_cache(*agent_checks.values_list("agent_id", flat=True))
+
 
 @app.task
 # generates policy tasks on agents affected by a policy
@@ -112,21 +92,9 @@ def generate_agent_tasks_from_policies_task(policypk):
 
     policy = Policy.objects.get(pk=policypk)
 
-    if policy.is_default_server_policy and policy.is_default_workstation_policy:
-        agents = Agent.objects.prefetch_related("policy").only("pk", "monitoring_type")
-    elif policy.is_default_server_policy:
-        agents = Agent.objects.filter(monitoring_type="server").only(
-            "pk", "monitoring_type"
-        )
-    elif policy.is_default_workstation_policy:
-        agents = Agent.objects.filter(monitoring_type="workstation").only(
-            "pk", "monitoring_type"
-        )
-    else:
-        agents = policy.related_agents().only("pk")
-
-    for agent in agents:
-        agent.generate_tasks_from_policies()
+    Policy.generate_policy_checks_and_tasks(
+        policy_agents(policy).values_list("pk", flat=True), checks=False, tasks=True
+    )
 
 
 @app.task
@@ -164,6 +132,13 @@ def update_policy_task_fields_task(taskpk, update_agent=False):
         enabled=task.enabled,
     )
 
+    # assigned tasks are sent to the check runner with their check
+    clear_check_runner_cache(
+        *AutomatedTask.objects.filter(
+            parent_task=taskpk, assigned_check__isnull=False
+        ).values_list("agent_id", flat=True)
+    )
+
     if update_agent:
         for task in AutomatedTask.objects.filter(parent_task=taskpk):
             enable_or_disable_win_task.delay(task.pk, task.enabled)
@@ -1,9 +1,12 @@
 from itertools import cycle
 from unittest.mock import patch
+from uuid import uuid4
 
 from model_bakery import baker, seq
 
 from agents.models import Agent
+from autotasks.models import AutomatedTask
+from checks.models import Check
 from core.models import CoreSettings
 from tacticalrmm.test import TacticalTestCase
 from winupdate.models import WinUpdatePolicy
@@ -90,13 +93,14 @@ class TestPolicyViews(TacticalTestCase):
 
         self.check_not_authenticated("post", url)
 
-    @patch("automation.tasks.generate_agent_checks_from_policies_task.delay")
-    def test_update_policy(self, generate_agent_checks_from_policies_task):
+    @patch("automation.models.Policy.queue_regeneration")
+    def test_update_policy(self, queue_regeneration):
         # returns 404 for invalid policy pk
         resp = self.client.put("/automation/policies/500/", format="json")
         self.assertEqual(resp.status_code, 404)
 
         policy = baker.make("automation.Policy", active=True, enforced=False)
+        queue_regeneration.reset_mock()
         url = f"/automation/policies/{policy.pk}/"  # type: ignore
 
         data = {
@@ -110,7 +114,7 @@ class TestPolicyViews(TacticalTestCase):
         self.assertEqual(resp.status_code, 200)
 
         # only called if active or enforced are updated
-        generate_agent_checks_from_policies_task.assert_not_called()
+        queue_regeneration.assert_not_called()
 
         data = {
             "name": "Test Policy Update",
@@ -121,14 +125,12 @@ class TestPolicyViews(TacticalTestCase):
 
         resp = self.client.put(url, data, format="json")
         self.assertEqual(resp.status_code, 200)
-        generate_agent_checks_from_policies_task.assert_called_with(
-            policypk=policy.pk, create_tasks=True  # type: ignore
-        )
+        queue_regeneration.assert_called_once_with("policy", [policy.pk])  # type: ignore
 
         self.check_not_authenticated("put", url)
 
-    @patch("automation.tasks.generate_agent_checks_task.delay")
-    def test_delete_policy(self, generate_agent_checks_task):
+    @patch("automation.models.Policy.queue_regeneration")
+    def test_delete_policy(self, queue_regeneration):
         # returns 404 for invalid policy pk
         resp = self.client.delete("/automation/policies/500/", format="json")
         self.assertEqual(resp.status_code, 404)
@@ -136,17 +138,15 @@ class TestPolicyViews(TacticalTestCase):
         # setup data
         policy = baker.make("automation.Policy")
         site = baker.make("clients.Site")
-        agents = baker.make_recipe(
-            "agents.agent", site=site, policy=policy, _quantity=3
-        )
+        baker.make_recipe("agents.agent", site=site, policy=policy, _quantity=3)
+        queue_regeneration.reset_mock()
         url = f"/automation/policies/{policy.pk}/"  # type: ignore
+        policy_pk = policy.pk  # type: ignore
 
         resp = self.client.delete(url, format="json")
         self.assertEqual(resp.status_code, 200)
 
-        generate_agent_checks_task.assert_called_with(
-            [agent.pk for agent in agents], create_tasks=True
-        )
+        queue_regeneration.assert_called_once_with("policy", [policy_pk])
 
         self.check_not_authenticated("delete", url)
 
@@ -451,7 +451,22 @@ class TestPolicyTasks(TacticalTestCase):
         self.authenticate()
         self.setup_coresettings()
 
+        # a regeneration queue per test that is due right away
+        for name, value in (
+            ("POLICY_REGENERATE_QUEUE_KEY", f"policy_regenerate_{uuid4()}"),
+            ("POLICY_REGENERATE_SCHEDULED_KEY", f"policy_scheduled_{uuid4()}"),
+            ("POLICY_REGENERATE_DELAY", 0),
+        ):
+            patcher = patch(f"automation.models.{name}", value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        patcher = patch("automation.tasks.regenerate_queued_policies_task.apply_async")
+        self.regenerate_task = patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_policy_related(self):
+        from .models import Policy
 
         # Get Site and Client from an agent in list
         clients = baker.make("clients.Client", _quantity=5)
@@ -470,8 +485,9 @@ class TestPolicyTasks(TacticalTestCase):
         policy = baker.make("automation.Policy", active=True)
 
         # Add Client to Policy
-        policy.server_clients.add(server_agents[13].client)  # type: ignore
-        policy.workstation_clients.add(workstation_agents[15].client)  # type: ignore
+        policy.server_clients.add(server_agents[13].client, bulk=False)  # type: ignore
+        policy.workstation_clients.add(workstation_agents[15].client, bulk=False)  # type: ignore
+        Policy.process_regeneration_queue()
 
         resp = self.client.get(
             f"/automation/policies/{policy.pk}/related/", format="json"  # type: ignore
@@ -485,24 +501,26 @@ class TestPolicyTasks(TacticalTestCase):
         self.assertEquals(len(resp.data["agents"]), 10)  # type: ignore
 
         # Add Site to Policy and the agents and sites length shouldn't change
-        policy.server_sites.add(server_agents[13].site)  # type: ignore
-        policy.workstation_sites.add(workstation_agents[15].site)  # type: ignore
+        policy.server_sites.add(server_agents[13].site, bulk=False)  # type: ignore
+        policy.workstation_sites.add(workstation_agents[15].site, bulk=False)  # type: ignore
         self.assertEquals(len(resp.data["server_sites"]), 5)  # type: ignore
         self.assertEquals(len(resp.data["workstation_sites"]), 5)  # type: ignore
         self.assertEquals(len(resp.data["agents"]), 10)  # type: ignore
 
         # Add Agent to Policy and the agents length shouldn't change
-        policy.agents.add(server_agents[13])  # type: ignore
-        policy.agents.add(workstation_agents[15])  # type: ignore
+        policy.agents.add(server_agents[13], bulk=False)  # type: ignore
+        policy.agents.add(workstation_agents[15], bulk=False)  # type: ignore
         self.assertEquals(len(resp.data["agents"]), 10)  # type: ignore
 
     def test_generating_agent_policy_checks(self):
+        from .models import Policy
         from .tasks import generate_agent_checks_from_policies_task
 
         # setup data
         policy = baker.make("automation.Policy", active=True)
         checks = self.create_checks(policy=policy)
         agent = baker.make_recipe("agents.agent", policy=policy)
+        Policy.process_regeneration_queue()
 
         # test policy assigned to agent
         generate_agent_checks_from_policies_task(policy.id)  # type: ignore
@@ -545,6 +563,7 @@ class TestPolicyTasks(TacticalTestCase):
                 self.assertEqual(check.event_type, checks[6].event_type)
 
     def test_generating_agent_policy_checks_with_enforced(self):
+        from .models import Policy
         from .tasks import generate_agent_checks_from_policies_task
 
         # setup data
@@ -553,6 +572,7 @@ class TestPolicyTasks(TacticalTestCase):
         self.create_checks(policy=policy, script=script)
         site = baker.make("clients.Site")
         agent = baker.make_recipe("agents.agent", site=site, policy=policy)
+        Policy.process_regeneration_queue()
         self.create_checks(agent=agent, script=script)
 
         generate_agent_checks_from_policies_task(policy.id, create_tasks=True)  # type: ignore
@@ -566,13 +586,8 @@ class TestPolicyTasks(TacticalTestCase):
             7,
         )
 
-    @patch("automation.tasks.generate_agent_checks_by_location_task.delay")
-    def test_generating_agent_policy_checks_by_location(
-        self, generate_agent_checks_by_location_task
-    ):
-        from automation.tasks import (
-            generate_agent_checks_by_location_task as generate_agent_checks,
-        )
+    def test_generating_agent_policy_checks_by_location(self):
+        from .models import Policy
 
         # setup data
         policy = baker.make("automation.Policy", active=True)
@@ -584,6 +599,7 @@ class TestPolicyTasks(TacticalTestCase):
 
         server_agent = baker.make_recipe("agents.server_agent")
         workstation_agent = baker.make_recipe("agents.workstation_agent")
+        Policy.process_regeneration_queue()
 
         # no checks should be preset on agents
         self.assertEqual(Agent.objects.get(pk=server_agent.id).agentchecks.count(), 0)
@@ -595,19 +611,9 @@ class TestPolicyTasks(TacticalTestCase):
         workstation_agent.client.workstation_policy = policy
         workstation_agent.client.save()
 
-        # should trigger task in save method on core
-        generate_agent_checks_by_location_task.assert_called_with(
-            location={"site__client_id": workstation_agent.client.pk},
-            mon_type="workstation",
-            create_tasks=True,
-        )
-        generate_agent_checks_by_location_task.reset_mock()
-
-        generate_agent_checks(
-            location={"site__client_id": workstation_agent.client.pk},
-            mon_type="workstation",
-            create_tasks=True,
-        )
+        # the agent was queued for regeneration
+        self.assertEqual(Policy.regeneration_queue_depth(), 1)
+        self.assertEqual(Policy.process_regeneration_queue(), 1)
 
         # make sure the checks were added
         self.assertEqual(
@@ -619,19 +625,9 @@ class TestPolicyTasks(TacticalTestCase):
         workstation_agent.client.workstation_policy = None
         workstation_agent.client.save()
 
-        # should trigger task in save method on core
-        generate_agent_checks_by_location_task.assert_called_with(
-            location={"site__client_id": workstation_agent.client.pk},
-            mon_type="workstation",
-            create_tasks=True,
-        )
-        generate_agent_checks_by_location_task.reset_mock()
-
-        generate_agent_checks(
-            location={"site__client_id": workstation_agent.client.pk},
-            mon_type="workstation",
-            create_tasks=True,
-        )
+        # the agent was queued for regeneration
+        self.assertEqual(Policy.regeneration_queue_depth(), 1)
+        self.assertEqual(Policy.process_regeneration_queue(), 1)
 
         # make sure the checks were removed
         self.assertEqual(
@@ -643,19 +639,9 @@ class TestPolicyTasks(TacticalTestCase):
         server_agent.client.server_policy = policy
         server_agent.client.save()
 
-        # should trigger task in save method on core
-        generate_agent_checks_by_location_task.assert_called_with(
-            location={"site__client_id": server_agent.client.pk},
-            mon_type="server",
-            create_tasks=True,
-        )
-        generate_agent_checks_by_location_task.reset_mock()
-
-        generate_agent_checks(
-            location={"site__client_id": server_agent.client.pk},
-            mon_type="server",
-            create_tasks=True,
-        )
+        # the agent was queued for regeneration
+        self.assertEqual(Policy.regeneration_queue_depth(), 1)
+        self.assertEqual(Policy.process_regeneration_queue(), 1)
 
         # make sure checks were added
         self.assertEqual(Agent.objects.get(pk=server_agent.id).agentchecks.count(), 7)
@@ -667,19 +653,9 @@ class TestPolicyTasks(TacticalTestCase):
         server_agent.client.server_policy = None
         server_agent.client.save()
 
-        # should trigger task in save method on core
-        generate_agent_checks_by_location_task.assert_called_with(
-            location={"site__client_id": server_agent.client.pk},
-            mon_type="server",
-            create_tasks=True,
-        )
-        generate_agent_checks_by_location_task.reset_mock()
-
-        generate_agent_checks(
-            location={"site__client_id": server_agent.client.pk},
-            mon_type="server",
-            create_tasks=True,
-        )
+        # the agent was queued for regeneration
+        self.assertEqual(Policy.regeneration_queue_depth(), 1)
+        self.assertEqual(Policy.process_regeneration_queue(), 1)
 
         # make sure checks were removed
         self.assertEqual(Agent.objects.get(pk=server_agent.id).agentchecks.count(), 0)
@@ -691,19 +667,9 @@ class TestPolicyTasks(TacticalTestCase):
         workstation_agent.site.workstation_policy = policy
         workstation_agent.site.save()
 
-        # should trigger task in save method on core
-        generate_agent_checks_by_location_task.assert_called_with(
-            location={"site_id": workstation_agent.site.pk},
-            mon_type="workstation",
-            create_tasks=True,
-        )
-        generate_agent_checks_by_location_task.reset_mock()
-
-        generate_agent_checks(
-            location={"site_id": workstation_agent.site.pk},
-            mon_type="workstation",
-            create_tasks=True,
-        )
+        # the agent was queued for regeneration
+        self.assertEqual(Policy.regeneration_queue_depth(), 1)
+        self.assertEqual(Policy.process_regeneration_queue(), 1)
 
         # make sure checks were added on workstation
         self.assertEqual(
@@ -715,19 +681,9 @@ class TestPolicyTasks(TacticalTestCase):
         workstation_agent.site.workstation_policy = None
         workstation_agent.site.save()
 
-        # should trigger task in save method on core
-        generate_agent_checks_by_location_task.assert_called_with(
-            location={"site_id": workstation_agent.site.pk},
-            mon_type="workstation",
-            create_tasks=True,
-        )
-        generate_agent_checks_by_location_task.reset_mock()
-
-        generate_agent_checks(
-            location={"site_id": workstation_agent.site.pk},
-            mon_type="workstation",
-            create_tasks=True,
-        )
+        # the agent was queued for regeneration
+        self.assertEqual(Policy.regeneration_queue_depth(), 1)
+        self.assertEqual(Policy.process_regeneration_queue(), 1)
 
         # make sure checks were removed
         self.assertEqual(
@@ -739,19 +695,9 @@ class TestPolicyTasks(TacticalTestCase):
         server_agent.site.server_policy = policy
         server_agent.site.save()
 
-        # should trigger task in save method on core
-        generate_agent_checks_by_location_task.assert_called_with(
-            location={"site_id": server_agent.site.pk},
-            mon_type="server",
-            create_tasks=True,
-        )
-        generate_agent_checks_by_location_task.reset_mock()
-
-        generate_agent_checks(
-            location={"site_id": server_agent.site.pk},
-            mon_type="server",
-            create_tasks=True,
-        )
+        # the agent was queued for regeneration
+        self.assertEqual(Policy.regeneration_queue_depth(), 1)
+        self.assertEqual(Policy.process_regeneration_queue(), 1)
 
         # make sure checks were added
         self.assertEqual(Agent.objects.get(pk=server_agent.id).agentchecks.count(), 7)
@@ -763,19 +709,9 @@ class TestPolicyTasks(TacticalTestCase):
         server_agent.site.server_policy = None
         server_agent.site.save()
 
-        # should trigger task in save method on core
-        generate_agent_checks_by_location_task.assert_called_with(
-            location={"site_id": server_agent.site.pk},
-            mon_type="server",
-            create_tasks=True,
-        )
-        generate_agent_checks_by_location_task.reset_mock()
-
-        generate_agent_checks(
-            location={"site_id": server_agent.site.pk},
-            mon_type="server",
-            create_tasks=True,
-        )
+        # the agent was queued for regeneration
+        self.assertEqual(Policy.regeneration_queue_depth(), 1)
+        self.assertEqual(Policy.process_regeneration_queue(), 1)
 
         # make sure checks were removed
         self.assertEqual(Agent.objects.get(pk=server_agent.id).agentchecks.count(), 0)
@@ -783,13 +719,10 @@ class TestPolicyTasks(TacticalTestCase):
             Agent.objects.get(pk=workstation_agent.id).agentchecks.count(), 0
         )
 
-    @patch("automation.tasks.generate_all_agent_checks_task.delay")
-    def test_generating_policy_checks_for_all_agents(
-        self, generate_all_agent_checks_task
-    ):
+    def test_generating_policy_checks_for_all_agents(self):
         from core.models import CoreSettings
 
-        from .tasks import generate_all_agent_checks_task as generate_all_checks
+        from .models import Policy
 
         # setup data
         policy = baker.make("automation.Policy", active=True)
@@ -797,15 +730,13 @@ class TestPolicyTasks(TacticalTestCase):
 
         server_agents = baker.make_recipe("agents.server_agent", _quantity=3)
         workstation_agents = baker.make_recipe("agents.workstation_agent", _quantity=4)
+        Policy.process_regeneration_queue()
         core = CoreSettings.objects.first()
         core.server_policy = policy
         core.save()
 
-        generate_all_agent_checks_task.assert_called_with(
-            mon_type="server", create_tasks=True
-        )
-        generate_all_agent_checks_task.reset_mock()
-        generate_all_checks(mon_type="server", create_tasks=True)
+        # only the server default policy changed
+        self.assertEqual(Policy.process_regeneration_queue(), 1)
 
         # all servers should have 7 checks
         for agent in server_agents:
@@ -818,15 +749,7 @@ class TestPolicyTasks(TacticalTestCase):
         core.workstation_policy = policy
         core.save()
 
-        generate_all_agent_checks_task.assert_any_call(
-            mon_type="workstation", create_tasks=True
-        )
-        generate_all_agent_checks_task.assert_any_call(
-            mon_type="server", create_tasks=True
-        )
-        generate_all_agent_checks_task.reset_mock()
-        generate_all_checks(mon_type="server", create_tasks=True)
-        generate_all_checks(mon_type="workstation", create_tasks=True)
+        self.assertEqual(Policy.process_regeneration_queue(), 2)
 
         # all workstations should have 7 checks
         for agent in server_agents:
@@ -838,11 +761,7 @@ class TestPolicyTasks(TacticalTestCase):
         core.workstation_policy = None
         core.save()
 
-        generate_all_agent_checks_task.assert_called_with(
-            mon_type="workstation", create_tasks=True
-        )
-        generate_all_agent_checks_task.reset_mock()
-        generate_all_checks(mon_type="workstation", create_tasks=True)
+        self.assertEqual(Policy.process_regeneration_queue(), 1)
 
         # nothing should have the checks
         for agent in server_agents:
@@ -858,6 +777,7 @@ class TestPolicyTasks(TacticalTestCase):
         policy = baker.make("automation.Policy", active=True)
         self.create_checks(policy=policy)
         agent = baker.make_recipe("agents.server_agent", policy=policy)
+        Policy.process_regeneration_queue()
 
         # make sure agent has 7 checks
         self.assertEqual(Agent.objects.get(pk=agent.id).agentchecks.count(), 7)
@@ -882,6 +802,7 @@ class TestPolicyTasks(TacticalTestCase):
         policy = baker.make("automation.Policy", active=True)
         self.create_checks(policy=policy)
         agent = baker.make_recipe("agents.server_agent", policy=policy)
+        Policy.process_regeneration_queue()
 
         # make sure agent has 7 checks
         self.assertEqual(Agent.objects.get(pk=agent.id).agentchecks.count(), 7)
@@ -906,6 +827,7 @@ class TestPolicyTasks(TacticalTestCase):
         )
 
     def test_generate_agent_tasks(self):
+        from .models import Policy
         from .tasks import generate_agent_tasks_from_policies_task
 
         # create test data
@@ -914,6 +836,7 @@ class TestPolicyTasks(TacticalTestCase):
             "autotasks.AutomatedTask", policy=policy, name=seq("Task"), _quantity=3
         )
         agent = baker.make_recipe("agents.server_agent", policy=policy)
+        Policy.process_regeneration_queue()
 
         generate_agent_tasks_from_policies_task(policy.id)  # type: ignore
 
@@ -936,11 +859,13 @@ class TestPolicyTasks(TacticalTestCase):
 
     @patch("autotasks.tasks.delete_win_task_schedule.delay")
     def test_delete_policy_tasks(self, delete_win_task_schedule):
+        from .models import Policy
         from .tasks import delete_policy_autotask_task
 
         policy = baker.make("automation.Policy", active=True)
         tasks = baker.make("autotasks.AutomatedTask", policy=policy, _quantity=3)
         agent = baker.make_recipe("agents.server_agent", policy=policy)
+        Policy.process_regeneration_queue()
 
         delete_policy_autotask_task(tasks[0].id)  # type: ignore
 
@@ -963,6 +888,7 @@ class TestPolicyTasks(TacticalTestCase):
 
     @patch("autotasks.tasks.enable_or_disable_win_task.delay")
     def test_update_policy_tasks(self, enable_or_disable_win_task):
+        from .models import Policy
         from .tasks import update_policy_task_fields_task
 
         # setup data
@@ -971,6 +897,7 @@ class TestPolicyTasks(TacticalTestCase):
             "autotasks.AutomatedTask", enabled=True, policy=policy, _quantity=3
         )
         agent = baker.make_recipe("agents.server_agent", policy=policy)
+        Policy.process_regeneration_queue()
 
         tasks[0].enabled = False  # type: ignore
         tasks[0].save()  # type: ignore
@@ -985,28 +912,95 @@ class TestPolicyTasks(TacticalTestCase):
             agent.autotasks.get(parent_task=tasks[0].id).id, False  # type: ignore
         )
 
-    @patch("agents.models.Agent.generate_tasks_from_policies")
-    @patch("agents.models.Agent.generate_checks_from_policies")
-    def test_generate_agent_checks_with_agentpks(self, generate_checks, generate_tasks):
+    @patch("automation.models.Policy.generate_policy_checks_and_tasks")
+    def test_generate_agent_checks_with_agentpks(self, generate_policy):
         from automation.tasks import generate_agent_checks_task
 
         agents = baker.make_recipe("agents.agent", _quantity=5)
 
         # reset because creating agents triggers it
-        generate_checks.reset_mock()
-        generate_tasks.reset_mock()
+        generate_policy.reset_mock()
 
         generate_agent_checks_task([agent.pk for agent in agents])
-        self.assertEquals(generate_checks.call_count, 5)
-        generate_tasks.assert_not_called()
-        generate_checks.reset_mock()
+        self.assertEquals(generate_policy.call_count, 1)
+        self.assertEqual(
+            set(generate_policy.call_args.args[0]), {agent.pk for agent in agents}
+        )
+        self.assertFalse(generate_policy.call_args.kwargs["tasks"])
+        generate_policy.reset_mock()
 
         generate_agent_checks_task([agent.pk for agent in agents], create_tasks=True)
-        self.assertEquals(generate_checks.call_count, 5)
-        self.assertEquals(generate_checks.call_count, 5)
+        self.assertEquals(generate_policy.call_count, 1)
+        self.assertTrue(generate_policy.call_args.kwargs["tasks"])
+
+    @patch("autotasks.tasks.delete_win_task_schedule.delay")
+    @patch("autotasks.tasks.create_win_task_schedule.delay")
+    def test_generate_policy_checks_and_tasks(self, create_task, delete_task):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        from .models import AgentEffectivePolicy, Policy
+
+        policy = baker.make("automation.Policy", active=True)
+        self.create_checks(policy=policy)
+        baker.make("autotasks.AutomatedTask", policy=policy, _quantity=2)
+        site = baker.make("clients.Site", server_policy=policy)
+        agents = baker.make_recipe(
+            "agents.agent", site=site, monitoring_type="server", _quantity=15
+        )
+        agent_pks = [agent.pk for agent in agents]
+
+        # the queries don't depend on the number of agents
+        with CaptureQueriesContext(connection) as few:
+            Policy.generate_policy_checks_and_tasks(agent_pks[:5], tasks=True)
+        with CaptureQueriesContext(connection) as many:
+            Policy.generate_policy_checks_and_tasks(agent_pks[5:], tasks=True)
+
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(
+            Check.objects.filter(agent__in=agent_pks, managed_by_policy=True).count(),
+            105,
+        )
+        self.assertEqual(AutomatedTask.objects.filter(agent__in=agent_pks).count(), 30)
+        self.assertEqual(create_task.call_count, 30)
+
+        # nothing changes when run again
+        create_task.reset_mock()
+        Policy.generate_policy_checks_and_tasks(agent_pks, tasks=True)
+        self.assertEqual(Check.objects.filter(agent__in=agent_pks).count(), 105)
+        create_task.assert_not_called()
+
+        # agent checks are overriden by the policy checks of the same kind
+        agent_check = baker.make_recipe("checks.memory_check", agent=agents[0])
+        Policy.generate_policy_checks_and_tasks([agents[0].pk])
+        self.assertFalse(Check.objects.get(pk=agent_check.pk).overriden_by_policy)
+        self.assertFalse(
+            agents[0]
+            .agentchecks.filter(managed_by_policy=True, check_type="memory")
+            .exists()
+        )
+
+        policy.enforced = True
+        policy.save()
+        Policy.generate_policy_checks_and_tasks([agents[0].pk])
+        self.assertTrue(Check.objects.get(pk=agent_check.pk).overriden_by_policy)
+
+        # excluded agents lose the policy checks and tasks
+        policy.excluded_agents.set(agent_pks[:5])
+        AgentEffectivePolicy.refresh()
+        Policy.generate_policy_checks_and_tasks(agent_pks, tasks=True)
+        self.assertFalse(
+            Check.objects.filter(
+                agent__in=agent_pks[:5], managed_by_policy=True
+            ).exists()
+        )
+        self.assertFalse(Check.objects.get(pk=agent_check.pk).overriden_by_policy)
+        self.assertEqual(delete_task.call_count, 10)
 
     @patch("autotasks.tasks.delete_win_task_schedule.delay")
     def test_policy_exclusions(self, delete_task):
+        from .models import Policy
+
         # setup data
         policy = baker.make("automation.Policy", active=True)
         baker.make_recipe("checks.memory_check", policy=policy)
@@ -1014,6 +1008,7 @@ class TestPolicyTasks(TacticalTestCase):
         agent = baker.make_recipe(
             "agents.agent", policy=policy, monitoring_type="server"
         )
+        Policy.process_regeneration_queue()
 
         # make sure related agents on policy returns correctly
         self.assertEqual(policy.related_agents().count(), 1)  # type: ignore
@@ -1023,6 +1018,7 @@ class TestPolicyTasks(TacticalTestCase):
         # add agent to policy exclusions
         policy.excluded_agents.set([agent])  # type: ignore
 
+        Policy.process_regeneration_queue()
         agent.generate_checks_from_policies()
         agent.generate_tasks_from_policies()
 
@@ -1035,6 +1031,7 @@ class TestPolicyTasks(TacticalTestCase):
         agent.autotasks.all().delete()
         policy.excluded_agents.clear()  # type: ignore
 
+        Policy.process_regeneration_queue()
         agent.generate_checks_from_policies()
         agent.generate_tasks_from_policies()
 
@@ -1046,6 +1043,7 @@ class TestPolicyTasks(TacticalTestCase):
         # add policy exclusions to site
         policy.excluded_sites.set([agent.site])  # type: ignore
 
+        Policy.process_regeneration_queue()
         agent.generate_checks_from_policies()
         agent.generate_tasks_from_policies()
 
@@ -1058,6 +1056,7 @@ class TestPolicyTasks(TacticalTestCase):
         agent.autotasks.all().delete()
         policy.excluded_sites.clear()  # type: ignore
 
+        Policy.process_regeneration_queue()
         agent.generate_checks_from_policies()
         agent.generate_tasks_from_policies()
 
@@ -1069,6 +1068,7 @@ class TestPolicyTasks(TacticalTestCase):
         # add policy exclusions to client
         policy.excluded_clients.set([agent.client])  # type: ignore
 
+        Policy.process_regeneration_queue()
         agent.generate_checks_from_policies()
         agent.generate_tasks_from_policies()
 
@@ -1088,6 +1088,7 @@ class TestPolicyTasks(TacticalTestCase):
         core.server_policy = policy
         core.save()
 
+        Policy.process_regeneration_queue()
         agent.generate_checks_from_policies()
         agent.generate_tasks_from_policies()
 
@@ -1098,6 +1099,7 @@ class TestPolicyTasks(TacticalTestCase):
         # add policy exclusions to client
         policy.excluded_clients.set([agent.client])  # type: ignore
 
+        Policy.process_regeneration_queue()
         agent.generate_checks_from_policies()
         agent.generate_tasks_from_policies()
 
@@ -1106,8 +1108,161 @@ class TestPolicyTasks(TacticalTestCase):
         delete_task.assert_called()
         delete_task.reset_mock()
 
+    @patch("automation.models.Policy.generate_policy_checks_and_tasks")
+    def test_policy_regeneration_queue(self, generate_policy):
+        from .models import Policy
+
+        agents = baker.make_recipe("agents.agent", _quantity=3)
+        Policy.process_regeneration_queue()
+        generate_policy.reset_mock()
+        self.regenerate_task.reset_mock()
+
+        # repeated requests for a scope are merged into one run
+        Policy.queue_regeneration("agent", [agents[0].pk, agents[1].pk])
+        Policy.queue_regeneration("agent", [agents[0].pk])
+        self.assertEqual(Policy.regeneration_queue_depth(), 2)
+        self.regenerate_task.assert_called_once()
+
+        resp = self.client.get("/automation/sync/", format="json")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, {"queued": 2})  # type: ignore
+
+        self.assertEqual(Policy.process_regeneration_queue(), 2)
+        generate_policy.assert_called_once()
+        self.assertEqual(
+            set(generate_policy.call_args[0][0]), {agents[0].pk, agents[1].pk}
+        )
+        self.assertEqual(Policy.regeneration_queue_depth(), 0)
+
+        # only the agents of the queued scopes are refreshed
+        generate_policy.reset_mock()
+        Policy.queue_regeneration("site", [agents[2].site_id])
+        self.assertEqual(Policy.process_regeneration_queue(), 1)
+        generate_policy.assert_called_once()
+        self.assertEqual(set(generate_policy.call_args[0][0]), set())
+
+        # scopes that aren't due wait for a later run
+        with patch("automation.models.POLICY_REGENERATE_DELAY", 60):
+            Policy.queue_regeneration("agent", [agents[2].pk])
+        self.regenerate_task.reset_mock()
+
+        self.assertEqual(Policy.process_regeneration_queue(), 0)
+        self.assertEqual(Policy.regeneration_queue_depth(), 1)
+        self.regenerate_task.assert_called_once()
+        self.assertGreater(self.regenerate_task.call_args[1]["countdown"], 50)
+
+        self.check_not_authenticated("get", "/automation/sync/")
+
     def test_removing_duplicate_pending_task_actions(self):
         pass
 
     def test_creating_checks_with_assigned_tasks(self):
         pass
+
+    def test_agent_effective_policy(self):
+        from .models import AgentEffectivePolicy, Policy
+
+        policies = baker.make("automation.Policy", active=True, _quantity=4)
+        agent = baker.make_recipe("agents.agent", monitoring_type="server")
+        workstation = baker.make_recipe(
+            "agents.agent", site=agent.site, monitoring_type="workstation"
+        )
+
+        def effective(agent):
+            Policy.process_regeneration_queue()
+            row = AgentEffectivePolicy.objects.get(agent=agent)
+            return row.policies, row.applied
+
+        # created with the agent
+        self.assertEqual(effective(agent), ([None, None, None, None], []))
+
+        agent.policy = policies[0]
+        agent.save()
+        agent.site.server_policy = policies[1]
+        agent.site.save()
+        agent.client.server_policy = policies[1]
+        agent.client.save()
+        core = CoreSettings.objects.first()
+        core.server_policy = policies[2]
+        core.save()
+
+        self.assertEqual(
+            effective(agent),
+            (
+                [policies[0].pk, policies[1].pk, policies[1].pk, policies[2].pk],
+                [policies[0].pk, policies[1].pk, policies[2].pk],
+            ),
+        )
+        # only the server policies changed
+        self.assertEqual(effective(workstation), ([None, None, None, None], []))
+
+        # exclusions are left out of the applied policies
+        policies[1].excluded_sites.add(agent.site)
+        self.assertEqual(effective(agent)[1], [policies[0].pk, policies[2].pk])
+        agent.client.policy_exclusions.add(policies[2])
+        self.assertEqual(effective(agent)[1], [policies[0].pk])
+        policies[1].excluded_sites.clear()
+        self.assertEqual(effective(agent)[1], [policies[0].pk, policies[1].pk])
+
+        policies[0].delete()
+        self.assertEqual(
+            effective(agent),
+            ([None, policies[1].pk, policies[1].pk, policies[2].pk], [policies[1].pk]),
+        )
+
+        # rows are computed for agents that don't have one
+        AgentEffectivePolicy.objects.all().delete()
+        rows = AgentEffectivePolicy.agent_rows(Agent.objects.filter(pk=agent.pk), "pk")
+        self.assertEqual(rows[0]["effective_policy__applied"], [policies[1].pk])
+
+        # one query once the rows exist
+        with self.assertNumQueries(1):
+            AgentEffectivePolicy.agent_rows(Agent.objects.filter(pk=agent.pk), "pk")
+
+    def test_policy_membership(self):
+        from io import StringIO
+
+        from django.core.management import call_command
+
+        from .models import Policy, PolicyMembership
+
+        policy = baker.make("automation.Policy", active=True)
+        site = baker.make("clients.Site")
+        agents = baker.make_recipe(
+            "agents.agent", site=site, monitoring_type="server", _quantity=3
+        )
+        baker.make_recipe("agents.agent", site=site, monitoring_type="workstation")
+
+        site.server_policy = policy
+        site.save()
+        Policy.process_regeneration_queue()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                set(policy.related_agents().values_list("pk", flat=True)),
+                {agent.pk for agent in agents},
+            )
+
+        policy.excluded_agents.add(agents[0])
+        Policy.process_regeneration_queue()
+        self.assertEqual(policy.related_agents().count(), 2)
+
+        # the checker finds and fixes agents that drifted
+        PolicyMembership.objects.all().delete()
+        out = StringIO()
+        call_command("check_policy_membership", stdout=out)
+        self.assertIn("2 agents are out of date", out.getvalue())
+        self.assertEqual(policy.related_agents().count(), 0)
+
+        self.regenerate_task.reset_mock()
+        call_command("check_policy_membership", "--fix", stdout=out)
+        self.assertEqual(policy.related_agents().count(), 2)
+
+        # the fixed agents are queued for regeneration
+        self.assertEqual(Policy.regeneration_queue_depth(), 2)
+        self.regenerate_task.assert_called_once()
+        Policy.process_regeneration_queue()
+
+        out = StringIO()
+        call_command("check_policy_membership", stdout=out)
+        self.assertIn("All agents are up to date", out.getvalue())
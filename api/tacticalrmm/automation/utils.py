@@ -0,0 +1,65 @@
+from typing import Iterable, Optional
+
+# agent fields needed to work out which policies apply to it
+POLICY_AGENT_FIELDS = (
+    "pk",
+    "monitoring_type",
+    "policy_id",
+    "site_id",
+    "site__server_policy_id",
+    "site__workstation_policy_id",
+    "site__client_id",
+    "site__client__server_policy_id",
+    "site__client__workstation_policy_id",
+)
+
+POLICY_EXCLUSION_FIELDS = ("excluded_clients", "excluded_sites", "excluded_agents")
+
+
+def policy_exclusions(policy_model, agent_pks: Iterable[int]) -> set:
+    """
+    (field, policy pk, excluded pk) of the policy exclusions. Agent exclusions are
+    only loaded for the agents passed.
+    """
+    excluded = set()
+    for field in POLICY_EXCLUSION_FIELDS:
+        descriptor = getattr(policy_model, field)
+        target = f"{descriptor.field.related_model._meta.model_name}_id"
+        rows = descriptor.through.objects.values_list("policy_id", target)
+        if field == "excluded_agents":
+            rows = rows.filter(agent_id__in=agent_pks)
+        excluded |= {(field, policy, pk) for policy, pk in rows}
+
+    return excluded
+
+
+def effective_policies(
+    agent: dict, core: Optional[dict], excluded: set
+) -> tuple[list[Optional[int]], list[int]]:
+    """
+    The agent, site, client and default policy of an agent for its monitoring type,
+    and the distinct ones of those that don't exclude the agent in order of
+    precedence. agent is a row of POLICY_AGENT_FIELDS and core the default policies.
+    """
+    mon_type = agent["monitoring_type"]
+    policies = [
+        agent["policy_id"],
+        agent.get(f"site__{mon_type}_policy_id"),
+        agent.get(f"site__client__{mon_type}_policy_id"),
+        core.get(f"{mon_type}_policy_id") if core else None,
+    ]
+
+    applied: list[int] = []
+    for pk in policies:
+        if (
+            pk is None
+            or pk in applied
+            or ("excluded_agents", pk, agent["pk"]) in excluded
+            or ("excluded_sites", pk, agent["site_id"]) in excluded
+            or ("excluded_clients", pk, agent["site__client_id"]) in excluded
+        ):
+            continue
+
+        applied.append(pk)
+
+    return policies, applied
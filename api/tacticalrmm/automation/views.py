@@ -1,3 +1,4 @@
+from django.db.models import Count
 from django.shortcuts import get_object_or_404
 from rest_framework.response import Response
 from rest_framework.views import APIView
@@ -6,13 +7,13 @@ from agents.models import Agent
 from agents.serializers import AgentHostnameSerializer
 from autotasks.models import AutomatedTask
 from checks.models import Check
-from clients.models import Client
+from clients.models import Client, Site
 from clients.serializers import ClientSerializer, SiteSerializer
 from tacticalrmm.utils import notify_error
 from winupdate.models import WinUpdatePolicy
 from winupdate.serializers import WinUpdatePolicySerializer
 
-from .models import Policy
+from .models import Policy, PolicyMembership
 from .serializers import (
     AutoTasksFieldSerializer,
     PolicyCheckSerializer,
@@ -28,8 +29,17 @@ from .tasks import run_win_policy_autotask_task
 class GetAddPolicies(APIView):
     def get(self, request):
         policies = Policy.objects.all()
+        agents_count = dict(
+            PolicyMembership.objects.values_list("policy")
+            .annotate(count=Count("pk"))
+            .order_by()
+        )
 
-        return Response(PolicyTableSerializer(policies, many=True).data)
+        return Response(
+            PolicyTableSerializer(
+                policies, many=True, context={"agents_count": agents_count}
+            ).data
+        )
 
     def post(self, request):
         serializer = PolicySerializer(data=request.data, partial=True)
@@ -74,6 +84,10 @@ class GetUpdateDeletePolicy(APIView):
 
 
 class PolicySync(APIView):
+    # agents waiting for their policy checks and tasks to be regenerated
+    def get(self, request):
+        return Response({"queued": Policy.regeneration_queue_depth()})
+
     def post(self, request):
         if "policy" in request.data.keys():
             from automation.tasks import generate_agent_checks_from_policies_task
@@ -149,26 +163,16 @@ class GetRelated(APIView):
             policy.workstation_clients.all(), many=True
         ).data
 
-        filtered_server_sites = list()
-        filtered_workstation_sites = list()
-
-        for client in policy.server_clients.all():
-            for site in client.sites.all():
-                if site not in policy.server_sites.all():
-                    filtered_server_sites.append(site)
-
-        response["server_sites"] = SiteSerializer(
-            filtered_server_sites + list(policy.server_sites.all()), many=True
-        ).data
-
-        for client in policy.workstation_clients.all():
-            for site in client.sites.all():
-                if site not in policy.workstation_sites.all():
-                    filtered_workstation_sites.append(site)
-
-        response["workstation_sites"] = SiteSerializer(
-            filtered_workstation_sites + list(policy.workstation_sites.all()), many=True
-        ).data
+        # sites under the policy's clients and then the sites it is assigned to
+        for mon_type in ("server", "workstation"):
+            sites = Site.objects.filter(
+                **{f"client__{mon_type}_policy": policy}
+            ).exclude(**{f"{mon_type}_policy": policy})
+            response[f"{mon_type}_sites"] = SiteSerializer(
+                list(sites.order_by("client__name", "name"))
+                + list(getattr(policy, f"{mon_type}_sites").all()),
+                many=True,
+            ).data
 
         response["agents"] = AgentHostnameSerializer(
             policy.related_agents().only("pk", "hostname"),
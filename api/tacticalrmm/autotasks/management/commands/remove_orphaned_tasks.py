@@ -8,8 +8,7 @@ class Command(BaseCommand):
     help = "Checks for orphaned tasks on all agents and removes them"
 
     def handle(self, *args, **kwargs):
-        agents = Agent.objects.only("pk", "last_seen", "overdue_time", "offline_time")
-        online = [i for i in agents if i.status == "online"]
+        online = Agent.objects.online().only("pk")
         for agent in online:
             remove_orphaned_win_tasks.delay(agent.pk)
 
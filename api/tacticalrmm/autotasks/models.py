@@ -196,11 +196,24 @@ class AutomatedTask(BaseAuditModel):
                     check_type=self.assigned_check.check_type
                 ).first()
 
-        task = AutomatedTask.objects.create(
-            agent=agent,
-            policy=policy,
-            managed_by_policy=bool(agent),
-            parent_task=(self.pk if agent else None),
+        task = self.policy_task_copy(
+            agent_id=agent.pk if agent else None,
+            policy_id=policy.pk if policy else None,
+            assigned_check=assigned_check,
+        )
+        task.save()
+
+        create_win_task_schedule.delay(task.pk)
+
+    def policy_task_copy(
+        self, agent_id=None, policy_id=None, assigned_check=None
+    ) -> "AutomatedTask":
+        # unsaved copy of the task for an agent or another policy
+        return AutomatedTask(
+            agent_id=agent_id,
+            policy_id=policy_id,
+            managed_by_policy=bool(agent_id),
+            parent_task=(self.pk if agent_id else None),
             alert_severity=self.alert_severity,
             email_alert=self.email_alert,
             text_alert=self.text_alert,
@@ -221,8 +234,6 @@ class AutomatedTask(BaseAuditModel):
             run_asap_after_missed=self.run_asap_after_missed,
         )
 
-        create_win_task_schedule.delay(task.pk)
-
     def should_create_alert(self, alert_template=None):
         return (
             self.dashboard_alert
@@ -238,7 +249,7 @@ class AutomatedTask(BaseAuditModel):
             )
         )
 
-    def send_email(self):
+    def send_email(self, idempotency_key=None):
         from core.models import CoreSettings
 
         CORE = CoreSettings.objects.first()
@@ -253,9 +264,14 @@ class AutomatedTask(BaseAuditModel):
             + f" - Return code: {self.retcode}\nStdout:{self.stdout}\nStderr: {self.stderr}"
         )
 
-        CORE.send_mail(subject, body, self.agent.alert_template)
+        CORE.send_mail(
+            subject,
+            body,
+            alert_template=self.agent.alert_template,
+            idempotency_key=idempotency_key,
+        )
 
-    def send_sms(self):
+    def send_sms(self, idempotency_key=None):
 
         from core.models import CoreSettings
 
@@ -271,9 +287,13 @@ class AutomatedTask(BaseAuditModel):
             + f" - Return code: {self.retcode}\nStdout:{self.stdout}\nStderr: {self.stderr}"
         )
 
-        CORE.send_sms(body, alert_template=self.agent.alert_template)
+        CORE.send_sms(
+            body,
+            alert_template=self.agent.alert_template,
+            idempotency_key=idempotency_key,
+        )
 
-    def send_resolved_email(self):
+    def send_resolved_email(self, idempotency_key=None):
         from core.models import CoreSettings
 
         CORE = CoreSettings.objects.first()
@@ -283,9 +303,14 @@ class AutomatedTask(BaseAuditModel):
             + f" - Return code: {self.retcode}\nStdout:{self.stdout}\nStderr: {self.stderr}"
         )
 
-        CORE.send_mail(subject, body, alert_template=self.agent.alert_template)
+        CORE.send_mail(
+            subject,
+            body,
+            alert_template=self.agent.alert_template,
+            idempotency_key=idempotency_key,
+        )
 
-    def send_resolved_sms(self):
+    def send_resolved_sms(self, idempotency_key=None):
         from core.models import CoreSettings
 
         CORE = CoreSettings.objects.first()
@@ -294,4 +319,8 @@ class AutomatedTask(BaseAuditModel):
             subject
             + f" - Return code: {self.retcode}\nStdout:{self.stdout}\nStderr: {self.stderr}"
         )
-        CORE.send_sms(body, alert_template=self.agent.alert_template)
+        CORE.send_sms(
+            body,
+            alert_template=self.agent.alert_template,
+            idempotency_key=idempotency_key,
+        )
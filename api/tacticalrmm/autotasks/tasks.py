@@ -1,7 +1,5 @@
 import asyncio
 import datetime as dt
-import random
-from time import sleep
 from typing import Union
 
 import pytz
@@ -257,23 +255,7 @@ def remove_orphaned_win_tasks(agentpk):
 def handle_task_email_alert(pk: int, alert_interval: Union[float, None] = None) -> str:
     from alerts.models import Alert
 
-    alert = Alert.objects.get(pk=pk)
-
-    # first time sending email
-    if not alert.email_sent:
-        sleep(random.randint(1, 10))
-        alert.assigned_task.send_email()
-        alert.email_sent = djangotime.now()
-        alert.save(update_fields=["email_sent"])
-    else:
-        if alert_interval:
-            # send an email only if the last email sent is older than alert interval
-            delta = djangotime.now() - dt.timedelta(days=alert_interval)
-            if alert.email_sent < delta:
-                sleep(random.randint(1, 10))
-                alert.assigned_task.send_email()
-                alert.email_sent = djangotime.now()
-                alert.save(update_fields=["email_sent"])
+    Alert.notify(pk, "email_sent", "send_email", alert_interval)
 
     return "ok"
 
@@ -282,23 +264,7 @@ def handle_task_email_alert(pk: int, alert_interval: Union[float, None] = None)
 def handle_task_sms_alert(pk: int, alert_interval: Union[float, None] = None) -> str:
     from alerts.models import Alert
 
-    alert = Alert.objects.get(pk=pk)
-
-    # first time sending text
-    if not alert.sms_sent:
-        sleep(random.randint(1, 3))
-        alert.assigned_task.send_sms()
-        alert.sms_sent = djangotime.now()
-        alert.save(update_fields=["sms_sent"])
-    else:
-        if alert_interval:
-            # send a text only if the last text sent is older than alert interval
-            delta = djangotime.now() - dt.timedelta(days=alert_interval)
-            if alert.sms_sent < delta:
-                sleep(random.randint(1, 3))
-                alert.assigned_task.send_sms()
-                alert.sms_sent = djangotime.now()
-                alert.save(update_fields=["sms_sent"])
+    Alert.notify(pk, "sms_sent", "send_sms", alert_interval)
 
     return "ok"
 
@@ -307,14 +273,7 @@ def handle_task_sms_alert(pk: int, alert_interval: Union[float, None] = None) ->
 def handle_resolved_task_sms_alert(pk: int) -> str:
     from alerts.models import Alert
 
-    alert = Alert.objects.get(pk=pk)
-
-    # first time sending text
-    if not alert.resolved_sms_sent:
-        sleep(random.randint(1, 3))
-        alert.assigned_task.send_resolved_sms()
-        alert.resolved_sms_sent = djangotime.now()
-        alert.save(update_fields=["resolved_sms_sent"])
+    Alert.notify(pk, "resolved_sms_sent", "send_resolved_sms")
 
     return "ok"
 
@@ -323,13 +282,6 @@ def handle_resolved_task_sms_alert(pk: int) -> str:
 def handle_resolved_task_email_alert(pk: int) -> str:
     from alerts.models import Alert
 
-    alert = Alert.objects.get(pk=pk)
-
-    # first time sending email
-    if not alert.resolved_email_sent:
-        sleep(random.randint(1, 10))
-        alert.assigned_task.send_resolved_email()
-        alert.resolved_email_sent = djangotime.now()
-        alert.save(update_fields=["resolved_email_sent"])
+    Alert.notify(pk, "resolved_email_sent", "send_resolved_email")
 
     return "ok"
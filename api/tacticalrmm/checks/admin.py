@@ -1,6 +1,8 @@
 from django.contrib import admin
 
-from .models import Check, CheckHistory
+from .models import Check, CheckHistory, CheckHistoryDaily, CheckHistoryHourly
 
 admin.site.register(Check)
 admin.site.register(CheckHistory)
+admin.site.register(CheckHistoryHourly)
+admin.site.register(CheckHistoryDaily)
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class ChecksConfig(AppConfig):
     name = "checks"
+
+    def ready(self):
+        from . import signals
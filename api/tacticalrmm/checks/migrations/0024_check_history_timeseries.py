@@ -0,0 +1,212 @@
+import datetime as dt
+
+import django.db.models.deletion
+from django.db import DatabaseError, migrations, models, transaction
+
+ROLLUP_TABLE_SQL = """
+CREATE TABLE "{table}" (
+    "id" serial NOT NULL,
+    "x" timestamp with time zone NOT NULL,
+    "y_min" integer NULL CHECK ("y_min" >= 0),
+    "y_max" integer NULL CHECK ("y_max" >= 0),
+    "y_sum" bigint NULL,
+    "count" integer NOT NULL CHECK ("count" >= 0),
+    "fail_count" integer NOT NULL CHECK ("fail_count" >= 0),
+    "check_history_id" integer NOT NULL
+        REFERENCES "checks_check" ("id") DEFERRABLE INITIALLY DEFERRED,
+    PRIMARY KEY ("id", "x"),
+    UNIQUE ("check_history_id", "x")
+) PARTITION BY RANGE ("x");
+CREATE INDEX "{table}_x_idx" ON "{table}" ("x");
+CREATE TABLE "{table}_default" PARTITION OF "{table}" DEFAULT;
+"""
+
+
+# frozen copies of checks.utils as of this migration, so later changes to the live
+# helpers don't change the schema this migration builds
+def partition_bounds(day, period):
+    if period == "day":
+        lower = day
+        upper = day + dt.timedelta(days=1)
+        return lower, upper, lower.strftime("%Y%m%d")
+
+    lower = day.replace(day=1)
+    upper = (lower + dt.timedelta(days=32)).replace(day=1)
+    return lower, upper, lower.strftime("%Y%m")
+
+
+def create_partitions(cursor, table, period, start, end):
+    day = start
+    while day <= end:
+        lower, upper, suffix = partition_bounds(day, period)
+        try:
+            with transaction.atomic(using=cursor.db.alias):
+                cursor.execute(
+                    f'CREATE TABLE IF NOT EXISTS "{table}_p{suffix}" '
+                    f'PARTITION OF "{table}" FOR VALUES FROM (%s) TO (%s)',
+                    [f"{lower} 00:00:00+00", f"{upper} 00:00:00+00"],
+                )
+        except DatabaseError:
+            # rows for the range are already in the default partition, they are
+            # removed by the retention delete
+            pass
+
+        day = upper
+
+
+def partition_check_history(apps, schema_editor):
+    # rebuilds checks_checkhistory as a table range partitioned by day on x
+    today = dt.datetime.now(dt.timezone.utc).date()
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            'ALTER TABLE "checks_checkhistory" RENAME TO "checks_checkhistory_old"'
+        )
+        cursor.execute(
+            'ALTER TABLE "checks_checkhistory_old" '
+            'RENAME CONSTRAINT "checks_checkhistory_pkey" TO "checks_checkhistory_old_pkey"'
+        )
+        cursor.execute('DROP INDEX "checks_checkhistory_check_history_id_3ff4d9e8"')
+        cursor.execute(
+            """
+            CREATE TABLE "checks_checkhistory" (
+                "id" integer NOT NULL
+                    DEFAULT nextval('checks_checkhistory_id_seq'::regclass),
+                "x" timestamp with time zone NOT NULL,
+                "y" integer NULL CHECK ("y" >= 0),
+                "results" jsonb NULL,
+                "check_history_id" integer NOT NULL
+                    REFERENCES "checks_check" ("id") DEFERRABLE INITIALLY DEFERRED,
+                PRIMARY KEY ("id", "x")
+            ) PARTITION BY RANGE ("x")
+            """
+        )
+        cursor.execute(
+            'CREATE INDEX "checks_checkhistory_check_history_id_3ff4d9e8" '
+            'ON "checks_checkhistory" ("check_history_id")'
+        )
+        cursor.execute(
+            'CREATE TABLE "checks_checkhistory_default" '
+            'PARTITION OF "checks_checkhistory" DEFAULT'
+        )
+
+        # create partitions for the existing rows so they don't end up in the default
+        cursor.execute('SELECT MIN("x") FROM "checks_checkhistory_old"')
+        earliest = cursor.fetchone()[0]
+        start = earliest.astimezone(dt.timezone.utc).date() if earliest else today
+        create_partitions(
+            cursor, "checks_checkhistory", "day", start, today + dt.timedelta(days=3)
+        )
+
+        cursor.execute(
+            'INSERT INTO "checks_checkhistory" ("id", "x", "y", "results", "check_history_id") '
+            'SELECT "id", "x", "y", "results", "check_history_id" FROM "checks_checkhistory_old"'
+        )
+        # validate the deferred foreign keys now so the new table can be indexed
+        cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        cursor.execute(
+            'ALTER SEQUENCE "checks_checkhistory_id_seq" OWNED BY "checks_checkhistory"."id"'
+        )
+        cursor.execute('DROP TABLE "checks_checkhistory_old"')
+
+
+def create_rollup_partitions(apps, schema_editor):
+    today = dt.datetime.now(dt.timezone.utc).date()
+
+    with schema_editor.connection.cursor() as cursor:
+        for table in ("checks_checkhistoryhourly", "checks_checkhistorydaily"):
+            create_partitions(
+                cursor, table, "month", today, today + dt.timedelta(days=3)
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("checks", "0023_check_run_interval"),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_check_history, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="checkhistory",
+            index=models.Index(
+                fields=["check_history", "x"], name="checks_chec_check_h_ce3ac0_idx"
+            ),
+        ),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    ROLLUP_TABLE_SQL.format(table="checks_checkhistoryhourly")
+                    + ROLLUP_TABLE_SQL.format(table="checks_checkhistorydaily"),
+                    'DROP TABLE "checks_checkhistoryhourly"; '
+                    'DROP TABLE "checks_checkhistorydaily";',
+                ),
+            ],
+            state_operations=[
+                migrations.CreateModel(
+                    name="CheckHistoryHourly",
+                    fields=[
+                        (
+                            "id",
+                            models.AutoField(
+                                auto_created=True,
+                                primary_key=True,
+                                serialize=False,
+                                verbose_name="ID",
+                            ),
+                        ),
+                        ("x", models.DateTimeField(db_index=True)),
+                        ("y_min", models.PositiveIntegerField(blank=True, null=True)),
+                        ("y_max", models.PositiveIntegerField(blank=True, null=True)),
+                        ("y_sum", models.BigIntegerField(blank=True, null=True)),
+                        ("count", models.PositiveIntegerField(default=0)),
+                        ("fail_count", models.PositiveIntegerField(default=0)),
+                        (
+                            "check_history",
+                            models.ForeignKey(
+                                on_delete=django.db.models.deletion.CASCADE,
+                                related_name="check_history_hourly",
+                                to="checks.check",
+                            ),
+                        ),
+                    ],
+                    options={
+                        "unique_together": {("check_history", "x")},
+                    },
+                ),
+                migrations.CreateModel(
+                    name="CheckHistoryDaily",
+                    fields=[
+                        (
+                            "id",
+                            models.AutoField(
+                                auto_created=True,
+                                primary_key=True,
+                                serialize=False,
+                                verbose_name="ID",
+                            ),
+                        ),
+                        ("x", models.DateTimeField(db_index=True)),
+                        ("y_min", models.PositiveIntegerField(blank=True, null=True)),
+                        ("y_max", models.PositiveIntegerField(blank=True, null=True)),
+                        ("y_sum", models.BigIntegerField(blank=True, null=True)),
+                        ("count", models.PositiveIntegerField(default=0)),
+                        ("fail_count", models.PositiveIntegerField(default=0)),
+                        (
+                            "check_history",
+                            models.ForeignKey(
+                                on_delete=django.db.models.deletion.CASCADE,
+                                related_name="check_history_daily",
+                                to="checks.check",
+                            ),
+                        ),
+                    ],
+                    options={
+                        "unique_together": {("check_history", "x")},
+                    },
+                ),
+            ],
+        ),
+        migrations.RunPython(create_rollup_partitions, migrations.RunPython.noop),
+    ]
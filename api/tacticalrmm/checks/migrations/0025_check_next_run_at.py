@@ -0,0 +1,40 @@
+# Generated by Django 3.2 on 2026-10-17 01:35
+
+from django.db import migrations, models
+
+POPULATE_NEXT_RUN_AT = """
+UPDATE "checks_check" AS c
+SET "next_run_at" = c."last_run" + make_interval(
+    secs => CASE
+        WHEN c."run_interval" > 0 AND c."run_interval" < a."check_interval"
+        THEN c."run_interval"
+        ELSE a."check_interval"
+    END
+)
+FROM "agents_agent" AS a
+WHERE c."agent_id" = a."id" AND c."last_run" IS NOT NULL
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("checks", "0024_check_history_timeseries"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="check",
+            name="next_run_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="check",
+            index=models.Index(
+                condition=models.Q(overriden_by_policy=False),
+                fields=["agent", "next_run_at"],
+                name="checks_check_next_run_idx",
+            ),
+        ),
+        migrations.RunSQL(POPULATE_NEXT_RUN_AT, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.2 on 2026-10-17 01:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("checks", "0025_check_next_run_at"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="check",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("passing", "Passing"),
+                    ("failing", "Failing"),
+                    ("pending", "Pending"),
+                    ("remediating", "Remediating"),
+                ],
+                default="pending",
+                max_length=100,
+            ),
+        ),
+    ]
@@ -1,22 +1,40 @@
 import asyncio
+import hashlib
+import heapq
 import json
 import os
 import string
+from collections import defaultdict
 from statistics import mean
-from typing import Any
+from typing import Any, Iterable, Optional
 
 import pytz
 from django.conf import settings
 from django.contrib.postgres.fields import ArrayField
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import (
+    Case,
+    DateTimeField,
+    DurationField,
+    ExpressionWrapper,
+    F,
+    OuterRef,
+    Q,
+    Subquery,
+    When,
+)
+from django.utils import timezone as djangotime
+from django.utils.dateparse import parse_datetime
 from loguru import logger
 
 from alerts.models import SEVERITY_CHOICES
 from core.models import CoreSettings
 from logs.models import BaseAuditModel
+from tacticalrmm.redis_client import redis_client
 
-from .utils import bytes2human
+from .utils import bytes2human, compile_eventlog_matcher
 
 logger.configure(**settings.LOG_CONFIG)
 
@@ -30,12 +48,57 @@ CHECK_TYPE_CHOICES = [
     ("eventlog", "Event Log Check"),
 ]
 
+# fields written when a check result is processed
+CHECK_RESULT_FIELDS = [
+    "last_run",
+    "next_run_at",
+    "status",
+    "fail_count",
+    "alert_severity",
+    "history",
+    "more_info",
+    "stdout",
+    "stderr",
+    "retcode",
+    "execution_time",
+    "extra_details",
+]
+
+# check types whose result state is kept in redis and flushed to postgres in bulk,
+# only status changes are written through
+HOT_STATE_CHECK_TYPES = ["cpuload", "memory"]
+HOT_STATE_FIELDS = [
+    "last_run",
+    "next_run_at",
+    "status",
+    "fail_count",
+    "alert_severity",
+    "history",
+]
+CHECK_STATE_KEY = "check_state:{}"
+CHECK_STATE_DIRTY_KEY = "check_state_dirty"
+# the state is reloaded from the row if the flusher hasn't run for this long
+CHECK_STATE_TIMEOUT = 86400
+
+# check types whose history y is 1 when failing and 0 when passing
+PASS_FAIL_CHECK_TYPES = ["ping", "script", "winsvc", "eventlog"]
+
 CHECK_STATUS_CHOICES = [
     ("passing", "Passing"),
     ("failing", "Failing"),
     ("pending", "Pending"),
+    ("remediating", "Remediating"),
 ]
 
+# stopped services of winsvc checks with restart_if_stopped are restarted by a
+# celery task, off the agent's request
+WINSVC_REMEDIATION_QUEUE_KEY = "winsvc_remediation_queue"
+# one restart in flight per service of an agent
+WINSVC_REMEDIATION_LOCK_KEY = "winsvc_remediation:{}:{}"
+WINSVC_REMEDIATION_LOCK_TIMEOUT = 300
+WINSVC_REMEDIATION_BATCH = 200
+WINSVC_REMEDIATION_CONCURRENCY = 50
+
 EVT_LOG_NAME_CHOICES = [
     ("Application", "Application"),
     ("System", "System"),
@@ -55,6 +118,91 @@ EVT_LOG_FAIL_WHEN_CHOICES = [
     ("not_contains", "Log does not contain"),
 ]
 
+CHECK_RUNNER_CACHE_KEY = "checkrunner_checks:{}"
+# safety net, the cache is cleared on every change to a check definition
+CHECK_RUNNER_CACHE_TIMEOUT = 3600
+# result state sent to the check runner, changes with every result so never cached
+CHECK_RUNNER_STATE_FIELDS = ["status", "alert_severity"]
+
+
+def get_check_runner_checks(
+    agent, state: Optional[dict[int, dict[str, Any]]] = None
+) -> list[dict]:
+    """
+    Returns what the check runner needs for all of the agent's active checks,
+    ordered by pk. The definitions are cached in redis until one of the checks is
+    edited, the result state is merged in from `state` or read from the checks.
+    """
+    key = CHECK_RUNNER_CACHE_KEY.format(agent.pk)
+    cached = redis_client.get(key)
+    if cached:
+        checks = json.loads(cached)
+    else:
+        from .serializers import CheckRunnerGetSerializer
+
+        definitions = (
+            agent.agentchecks.filter(overriden_by_policy=False)
+            .select_related("script")
+            .prefetch_related("assignedtask")
+            .order_by("pk")
+        )
+        payload = json.dumps(
+            CheckRunnerGetSerializer(definitions, many=True).data,
+            cls=DjangoJSONEncoder,
+        )
+        redis_client.set(key, payload, ex=CHECK_RUNNER_CACHE_TIMEOUT)
+        checks = json.loads(payload)
+
+    if state is None:
+        state = Check.runner_states(
+            agent.agentchecks.filter(overriden_by_policy=False).values(
+                "pk", "check_type", *CHECK_RUNNER_STATE_FIELDS
+            )
+        )
+
+    for check in checks:
+        check.update(state.get(check["id"], {}))
+
+    return checks
+
+
+def clear_check_runner_cache(*agent_pks: int) -> None:
+    keys = [CHECK_RUNNER_CACHE_KEY.format(pk) for pk in agent_pks if pk]
+    if keys:
+        redis_client.delete(*keys)
+
+
+def clear_check_state(*check_pks: int) -> None:
+    if check_pks:
+        redis_client.delete(*[CHECK_STATE_KEY.format(pk) for pk in check_pks])
+        redis_client.srem(CHECK_STATE_DIRTY_KEY, *check_pks)
+
+
+def next_run_at_expression() -> ExpressionWrapper:
+    """
+    SQL version of Check.next_run_interval, for updating next_run_at in bulk
+    when run intervals change
+    """
+    from agents.models import Agent
+
+    check_interval = Subquery(
+        Agent.objects.filter(pk=OuterRef("agent_id")).values("check_interval")[:1]
+    )
+    interval = Case(
+        When(
+            Q(run_interval__gt=0) & Q(run_interval__lt=check_interval),
+            then=F("run_interval"),
+        ),
+        default=check_interval,
+    )
+    return ExpressionWrapper(
+        F("last_run")
+        + ExpressionWrapper(
+            interval * djangotime.timedelta(seconds=1), output_field=DurationField()
+        ),
+        output_field=DateTimeField(),
+    )
+
 
 class Check(BaseAuditModel):
 
@@ -94,6 +242,8 @@ class Check(BaseAuditModel):
     outage_history = models.JSONField(null=True, blank=True)  # store
     extra_details = models.JSONField(null=True, blank=True)
     run_interval = models.PositiveIntegerField(blank=True, default=0)
+    # when the check is next due on the agent, null if it hasn't run yet
+    next_run_at = models.DateTimeField(null=True, blank=True)
     # check specific fields
 
     # for eventlog, script, ip, and service alert severity
@@ -186,6 +336,16 @@ class Check(BaseAuditModel):
         null=True, blank=True, default=1
     )
 
+    class Meta:
+        indexes = [
+            # due checks polled by the check runner
+            models.Index(
+                fields=["agent", "next_run_at"],
+                condition=Q(overriden_by_policy=False),
+                name="checks_check_next_run_idx",
+            ),
+        ]
+
     def __str__(self):
         if self.agent:
             return f"{self.agent.hostname} - {self.readable_desc}"
@@ -244,6 +404,7 @@ class Check(BaseAuditModel):
             "status",
             "more_info",
             "last_run",
+            "next_run_at",
             "fail_count",
             "outage_history",
             "extra_details",
@@ -279,11 +440,270 @@ class Check(BaseAuditModel):
             )
         )
 
+    def next_run_interval(self, check_interval: int) -> int:
+        # the agent's check interval applies unless the check has a shorter one set
+        if self.run_interval and self.run_interval < check_interval:
+            return self.run_interval
+
+        return check_interval
+
+    def result_fields(self) -> list[str]:
+        # the fields to write for an evaluated result
+        unchanged = getattr(self, "unchanged_result_fields", set())
+        return [i for i in CHECK_RESULT_FIELDS if i not in unchanged]
+
+    @property
+    def alert_state(self) -> tuple[str, Optional[str]]:
+        return self.status, self.alert_severity
+
+    def needs_write_through(self, previous_state: tuple[str, Optional[str]]) -> bool:
+        """
+        Whether an evaluated result has to be saved right away. Results of checks
+        with hot state are only kept in redis unless alerting needs the row.
+        """
+        if self.check_type not in HOT_STATE_CHECK_TYPES:
+            return True
+
+        return self.alert_state != previous_state or (
+            self.status == "failing" and self.fail_count == self.fails_b4_alert
+        )
+
+    @classmethod
+    def load_hot_states(cls, checks: list["Check"]) -> None:
+        # redis is ahead of the rows until the next flush
+        hot = [check for check in checks if check.check_type in HOT_STATE_CHECK_TYPES]
+        if not hot:
+            return
+
+        states = redis_client.mget([CHECK_STATE_KEY.format(c.pk) for c in hot])
+        for check, state in zip(hot, states):
+            if state:
+                for field, value in cls.parse_hot_state(state).items():
+                    setattr(check, field, value)
+
+    @classmethod
+    def store_hot_states(cls, checks: list["Check"], written: list["Check"]) -> None:
+        written_pks = {check.pk for check in written}
+        pipe = redis_client.pipeline(transaction=False)
+        for check in checks:
+            if check.check_type not in HOT_STATE_CHECK_TYPES:
+                continue
+
+            state = {field: getattr(check, field) for field in HOT_STATE_FIELDS}
+            pipe.set(
+                CHECK_STATE_KEY.format(check.pk),
+                json.dumps(state, cls=DjangoJSONEncoder),
+                ex=CHECK_STATE_TIMEOUT,
+            )
+            if check.pk in written_pks:
+                pipe.srem(CHECK_STATE_DIRTY_KEY, check.pk)
+            else:
+                pipe.sadd(CHECK_STATE_DIRTY_KEY, check.pk)
+
+        pipe.execute()
+
+    @staticmethod
+    def parse_hot_state(state: bytes) -> dict[str, Any]:
+        ret = json.loads(state)
+        for field in ("last_run", "next_run_at"):
+            if ret[field]:
+                ret[field] = parse_datetime(ret[field])
+
+        return ret
+
+    @classmethod
+    def hot_states(cls, check_pks: list[int]) -> dict[int, dict[str, Any]]:
+        if not check_pks:
+            return {}
+
+        states = redis_client.mget([CHECK_STATE_KEY.format(pk) for pk in check_pks])
+        return {
+            pk: cls.parse_hot_state(state)
+            for pk, state in zip(check_pks, states)
+            if state
+        }
+
+    @classmethod
+    def runner_states(
+        cls,
+        rows: Iterable[dict[str, Any]],
+        hot: Optional[dict[int, dict[str, Any]]] = None,
+    ) -> dict[int, dict[str, Any]]:
+        """
+        The check runner state of check rows with pk, check_type and the
+        CHECK_RUNNER_STATE_FIELDS, taken from the hot state where it is ahead.
+        """
+        rows = list(rows)
+        if hot is None:
+            hot = cls.hot_states(
+                [
+                    row["pk"]
+                    for row in rows
+                    if row["check_type"] in HOT_STATE_CHECK_TYPES
+                ]
+            )
+
+        return {
+            row["pk"]: {
+                field: hot[row["pk"]][field] if row["pk"] in hot else row[field]
+                for field in CHECK_RUNNER_STATE_FIELDS
+            }
+            for row in rows
+        }
+
+    @classmethod
+    def flush_hot_states(cls, batch_size: int = 500) -> int:
+        """
+        Writes the hot state of checks with unsaved results to postgres in bulk.
+        Returns the number of checks written.
+        """
+        flushed = 0
+        while True:
+            pks = redis_client.spop(CHECK_STATE_DIRTY_KEY, batch_size)
+            if not pks:
+                return flushed
+
+            states = redis_client.mget([CHECK_STATE_KEY.format(int(pk)) for pk in pks])
+            checks = [
+                cls(pk=int(pk), **cls.parse_hot_state(state))
+                for pk, state in zip(pks, states)
+                if state
+            ]
+            saved_status = dict(
+                cls.objects.filter(pk__in=[check.pk for check in checks]).values_list(
+                    "pk", "status"
+                )
+            )
+            # rows of deleted checks are skipped by the update
+            cls.objects.bulk_update(checks, HOT_STATE_FIELDS)
+            flushed += len(checks)
+
+            # bulk_update skips the signal that keeps the client tree cache current
+            if any(
+                check.pk in saved_status and check.status != saved_status[check.pk]
+                for check in checks
+            ):
+                from clients.models import clear_tree_cache
+
+                clear_tree_cache()
+
+    @staticmethod
+    def queue_winsvc_remediations(checks: list["Check"]) -> None:
+        """
+        Queues a service restart for the remediating checks. The restart result
+        updates the check from remediate_winsvc_task.
+        """
+        remediating = [check for check in checks if check.status == "remediating"]
+        if not remediating:
+            return
+
+        lock_keys = [
+            WINSVC_REMEDIATION_LOCK_KEY.format(check.agent_id, check.svc_name)
+            for check in remediating
+        ]
+        pipe = redis_client.pipeline(transaction=False)
+        for check, lock_key in zip(remediating, lock_keys):
+            pipe.set(lock_key, check.pk, nx=True, ex=WINSVC_REMEDIATION_LOCK_TIMEOUT)
+
+        # the lock keys are queued so the worker can release every one of them,
+        # even for checks that are gone by the time it runs
+        acquired = [lock_key for lock_key, ok in zip(lock_keys, pipe.execute()) if ok]
+        if not acquired:
+            return
+
+        # the worker drains the whole queue, so only start one if it was empty
+        queued = redis_client.rpush(WINSVC_REMEDIATION_QUEUE_KEY, *acquired)
+        if queued == len(acquired):
+            from .tasks import remediate_winsvc_task
+
+            remediate_winsvc_task.delay()
+
+    @classmethod
+    def run_winsvc_remediations(cls) -> int:
+        """
+        Restarts the services of queued remediating checks with at most
+        WINSVC_REMEDIATION_CONCURRENCY restarts in flight and applies the results.
+        Returns the number of checks remediated.
+        """
+        remediated = 0
+        while True:
+            pipe = redis_client.pipeline()
+            pipe.lrange(WINSVC_REMEDIATION_QUEUE_KEY, 0, WINSVC_REMEDIATION_BATCH - 1)
+            pipe.ltrim(WINSVC_REMEDIATION_QUEUE_KEY, WINSVC_REMEDIATION_BATCH, -1)
+            lock_keys = pipe.execute()[0]
+            if not lock_keys:
+                return remediated
+
+            # each lock holds the pk of the check that queued the restart
+            queued = {
+                lock_key.decode(): int(pk)
+                for lock_key, pk in zip(lock_keys, redis_client.mget(lock_keys))
+                if pk is not None
+            }
+            checks = []
+            for check in cls.objects.filter(
+                pk__in=list(queued.values()), status="remediating"
+            ).select_related("agent"):
+                lock_key = WINSVC_REMEDIATION_LOCK_KEY.format(
+                    check.agent_id, check.svc_name
+                )
+                # skip checks whose service was edited since they were queued
+                if queued.get(lock_key) == check.pk:
+                    checks.append(check)
+
+            async def restart_services() -> list[Any]:
+                sem = asyncio.Semaphore(WINSVC_REMEDIATION_CONCURRENCY)
+
+                async def restart(check: "Check") -> Any:
+                    nats_data = {
+                        "func": "winsvcaction",
+                        "payload": {"name": check.svc_name, "action": "start"},
+                    }
+                    async with sem:
+                        return await check.agent.nats_cmd(nats_data, timeout=32)
+
+                return await asyncio.gather(*[restart(check) for check in checks])
+
+            for check, r in zip(checks, asyncio.run(restart_services())):
+                check.apply_winsvc_remediation(r)
+                remediated += 1
+
+            # also releases the locks of checks that were deleted, edited or are no
+            # longer remediating since they were queued
+            redis_client.delete(*lock_keys)
+
+    def apply_winsvc_remediation(self, r: Any) -> None:
+        if r == "timeout" or r == "natsdown" or not isinstance(r, dict):
+            self.status = "failing"
+        elif r["success"]:
+            self.status = "passing"
+            self.more_info = "Status RUNNING"
+        else:
+            self.status = "failing"
+
+        if self.status == "failing":
+            self.fail_count += 1
+        else:
+            self.fail_count = 0
+
+        self.save(update_fields=["status", "more_info", "fail_count"])
+        self.handle_alert()
+
     def add_check_history(self, value: int, more_info: Any = None) -> None:
         CheckHistory.objects.create(check_history=self, y=value, results=more_info)
 
-    def handle_checkv2(self, data):
-        from alerts.models import Alert
+    def evaluate_result(self, data) -> Optional["CheckHistory"]:
+        """
+        Applies a check result from the agent to this instance without saving it.
+        Returns the unsaved CheckHistory row for the result, if any.
+        """
+        history = None
+        # result fields left as they were, which don't have to be written
+        self.unchanged_result_fields: set[str] = set()
+        self.last_run = djangotime.now()
+        self.next_run_at = self.last_run + djangotime.timedelta(
+            seconds=self.next_run_interval(self.agent.check_interval)
+        )
 
         # cpuload or mem checks
         if self.check_type == "cpuload" or self.check_type == "memory":
@@ -293,8 +713,6 @@ class Check(BaseAuditModel):
             if len(self.history) > 15:
                 self.history = self.history[-15:]
 
-            self.save(update_fields=["history"])
-
             avg = int(mean(self.history))
 
             if self.error_threshold and avg > self.error_threshold:
@@ -307,7 +725,7 @@ class Check(BaseAuditModel):
                 self.status = "passing"
 
             # add check history
-            self.add_check_history(data["percent"])
+            history = CheckHistory(check_history=self, y=data["percent"])
 
         # diskspace checks
         elif self.check_type == "diskspace":
@@ -332,14 +750,12 @@ class Check(BaseAuditModel):
                 self.more_info = f"Total: {total}B, Free: {free}B"
 
                 # add check history
-                self.add_check_history(100 - percent_used)
+                history = CheckHistory(check_history=self, y=100 - percent_used)
             else:
                 self.status = "failing"
                 self.alert_severity = "error"
                 self.more_info = f"Disk {self.disk} does not exist"
 
-            self.save(update_fields=["more_info"])
-
         # script checks
         elif self.check_type == "script":
             self.stdout = data["stdout"]
@@ -364,19 +780,11 @@ class Check(BaseAuditModel):
             else:
                 self.status = "passing"
 
-            self.save(
-                update_fields=[
-                    "stdout",
-                    "stderr",
-                    "retcode",
-                    "execution_time",
-                ]
-            )
-
             # add check history
-            self.add_check_history(
-                1 if self.status == "failing" else 0,
-                {
+            history = CheckHistory(
+                check_history=self,
+                y=1 if self.status == "failing" else 0,
+                results={
                     "retcode": data["retcode"],
                     "stdout": data["stdout"][:60],
                     "stderr": data["stderr"][:60],
@@ -398,10 +806,11 @@ class Check(BaseAuditModel):
                 self.status = "failing"
 
             self.more_info = output
-            self.save(update_fields=["more_info"])
 
-            self.add_check_history(
-                1 if self.status == "failing" else 0, self.more_info[:60]
+            history = CheckHistory(
+                check_history=self,
+                y=1 if self.status == "failing" else 0,
+                results=self.more_info[:60],
             )
 
         # windows service checks
@@ -416,20 +825,8 @@ class Check(BaseAuditModel):
                     self.status = "passing"
                 else:
                     if self.agent and self.restart_if_stopped:
-                        nats_data = {
-                            "func": "winsvcaction",
-                            "payload": {"name": self.svc_name, "action": "start"},
-                        }
-                        r = asyncio.run(self.agent.nats_cmd(nats_data, timeout=32))
-                        if r == "timeout" or r == "natsdown":
-                            self.status = "failing"
-                        elif not r["success"] and r["errormsg"]:
-                            self.status = "failing"
-                        elif r["success"]:
-                            self.status = "passing"
-                            self.more_info = f"Status RUNNING"
-                        else:
-                            self.status = "failing"
+                        # see queue_winsvc_remediations
+                        self.status = "remediating"
                     else:
                         self.status = "failing"
 
@@ -441,55 +838,21 @@ class Check(BaseAuditModel):
 
                 self.more_info = f"Service {self.svc_name} does not exist"
 
-            self.save(update_fields=["more_info"])
-
-            self.add_check_history(
-                1 if self.status == "failing" else 0, self.more_info[:60]
+            history = CheckHistory(
+                check_history=self,
+                y=0 if self.status == "passing" else 1,
+                results=self.more_info[:60],
             )
 
         elif self.check_type == "eventlog":
-            log = []
-            is_wildcard = self.event_id_is_wildcard
-            eventType = self.event_type
-            eventID = self.event_id
-            source = self.event_source
-            message = self.event_message
-            r = data["log"]
-
-            for i in r:
-                if i["eventType"] == eventType:
-                    if not is_wildcard and not int(i["eventID"]) == eventID:
-                        continue
-
-                    if not source and not message:
-                        if is_wildcard:
-                            log.append(i)
-                        elif int(i["eventID"]) == eventID:
-                            log.append(i)
-                        continue
-
-                    if source and message:
-                        if is_wildcard:
-                            if source in i["source"] and message in i["message"]:
-                                log.append(i)
-
-                        elif int(i["eventID"]) == eventID:
-                            if source in i["source"] and message in i["message"]:
-                                log.append(i)
-
-                        continue
-
-                    if source and source in i["source"]:
-                        if is_wildcard:
-                            log.append(i)
-                        elif int(i["eventID"]) == eventID:
-                            log.append(i)
-
-                    if message and message in i["message"]:
-                        if is_wildcard:
-                            log.append(i)
-                        elif int(i["eventID"]) == eventID:
-                            log.append(i)
+            matcher = compile_eventlog_matcher(
+                self.event_type,
+                self.event_id,
+                self.event_id_is_wildcard,
+                self.event_source,
+                self.event_message,
+            )
+            log = matcher.filter(data["log"])
 
             if self.fail_when == "contains":
                 if log and len(log) >= self.number_of_events_b4_alert:
@@ -503,30 +866,155 @@ class Check(BaseAuditModel):
                 else:
                     self.status = "failing"
 
-            self.extra_details = {"log": log}
-            self.save(update_fields=["extra_details"])
-
-            self.add_check_history(
-                1 if self.status == "failing" else 0,
-                "Events Found:" + str(len(self.extra_details["log"])),
+            digest = hashlib.sha1(
+                json.dumps(log, sort_keys=True, default=str).encode()
+            ).hexdigest()
+            if self.extra_details and self.extra_details.get("hash") == digest:
+                self.unchanged_result_fields.add("extra_details")
+            else:
+                self.extra_details = {
+                    "log": heapq.nlargest(
+                        settings.CHECK_EVENTLOG_MAX_STORED_EVENTS,
+                        log,
+                        key=lambda i: str(i.get("time", "")),
+                    ),
+                    "count": len(log),
+                    "hash": digest,
+                }
+
+            history = CheckHistory(
+                check_history=self,
+                y=1 if self.status == "failing" else 0,
+                results="Events Found:" + str(len(log)),
             )
 
-        # handle status
         if self.status == "failing":
             self.fail_count += 1
-            self.save(update_fields=["status", "fail_count", "alert_severity"])
+        elif self.status == "passing":
+            self.fail_count = 0
+
+        return history
+
+    def alert_event(self, unresolved_alert=None, transitions_only=False):
+        """
+        The alert event ("failure" or "resolve") for the evaluated status, or None.
+        With transitions_only the caller passes the check's unresolved alert (or None)
+        and an event is only returned when something changed: a new failure, a
+        severity change, a periodic reminder that may be due, or a recovery.
+        """
+        from alerts.models import Alert
+
+        if self.status == "failing":
+            if self.fail_count < self.fails_b4_alert:
+                return None
+
+            if transitions_only and unresolved_alert is not None:
+                alert_template = self.agent.alert_template
+                if unresolved_alert.severity == self.alert_severity and not (
+                    alert_template and alert_template.check_periodic_alert_days
+                ):
+                    return None
 
-            if self.fail_count >= self.fails_b4_alert:
-                Alert.handle_alert_failure(self)
+            return "failure"
 
         elif self.status == "passing":
-            self.fail_count = 0
-            self.save(update_fields=["status", "fail_count", "alert_severity"])
-            if Alert.objects.filter(assigned_check=self, resolved=False).exists():
-                Alert.handle_alert_resolve(self)
+            if transitions_only:
+                if unresolved_alert is not None:
+                    return "resolve"
+
+            elif Alert.objects.filter(assigned_check=self, resolved=False).exists():
+                return "resolve"
+
+        return None
+
+    def handle_alert(self, unresolved_alert=None, transitions_only=False) -> None:
+        from alerts.models import Alert
+
+        event = self.alert_event(unresolved_alert, transitions_only)
+        if event:
+            Alert.queue_alert_events([(event, self)])
+
+    def handle_checkv2(self, data):
+        Check.load_hot_states([self])
+        previous_state = self.alert_state
+        history = self.evaluate_result(data)
 
+        written = []
+        if self.needs_write_through(previous_state):
+            self.save(update_fields=self.result_fields())
+            written.append(self)
+
+        Check.store_hot_states([self], written)
+        if history:
+            history.save()
+
+        Check.queue_winsvc_remediations([self])
+
+        self.handle_alert()
         return self.status
 
+    @classmethod
+    def handle_check_results(cls, agent, results: list[dict]) -> dict[int, str]:
+        """
+        Processes all results from one check run of an agent. Results are evaluated
+        in memory, persisted in one transaction and only the status transitions are
+        handed to alerting.
+        """
+        from alerts.models import Alert
+
+        results_by_pk = {int(r["id"]): r for r in results}
+        checks = list(agent.agentchecks.filter(pk__in=results_by_pk.keys()))
+        # bulk_update skips the signal that keeps the client tree cache current
+        saved_status = {check.pk: check.status for check in checks}
+
+        cls.load_hot_states(checks)
+
+        histories, written = [], []
+        for check in checks:
+            check.agent = agent
+            previous_state = check.alert_state
+            history = check.evaluate_result(results_by_pk[check.pk])
+            if history:
+                histories.append(history)
+            if check.needs_write_through(previous_state):
+                written.append(check)
+
+        with transaction.atomic():
+            by_fields = defaultdict(list)
+            for check in written:
+                by_fields[tuple(check.result_fields())].append(check)
+
+            for fields, objs in by_fields.items():
+                cls.objects.bulk_update(objs, fields)
+            CheckHistory.objects.bulk_create(histories)
+
+        if any(check.status != saved_status[check.pk] for check in written):
+            from clients.models import clear_tree_cache
+
+            clear_tree_cache()
+
+        cls.store_hot_states(checks, written)
+        cls.queue_winsvc_remediations(checks)
+
+        unresolved_alerts = {
+            alert.assigned_check_id: alert
+            for alert in Alert.objects.filter(
+                assigned_check__in=checks, resolved=False
+            ).only("pk", "assigned_check_id", "severity")
+        }
+
+        events = []
+        for check in checks:
+            event = check.alert_event(
+                unresolved_alerts.get(check.pk), transitions_only=True
+            )
+            if event:
+                events.append((event, check))
+
+        Alert.queue_alert_events(events)
+
+        return {check.pk: check.status for check in checks}
+
     @staticmethod
     def serialize(check):
         # serializes the check and returns json
@@ -554,11 +1042,18 @@ class Check(BaseAuditModel):
         if not agent and not policy or agent and policy:
             return
 
-        Check.objects.create(
-            agent=agent,
-            policy=policy,
-            managed_by_policy=bool(agent),
-            parent_check=(self.pk if agent else None),
+        self.policy_check_copy(
+            agent_id=agent.pk if agent else None,
+            policy_id=policy.pk if policy else None,
+        ).save()
+
+    def policy_check_copy(self, agent_id=None, policy_id=None) -> "Check":
+        # unsaved copy of the check for an agent or another policy
+        return Check(
+            agent_id=agent_id,
+            policy_id=policy_id,
+            managed_by_policy=bool(agent_id),
+            parent_check=(self.pk if agent_id else None),
             name=self.name,
             alert_severity=self.alert_severity,
             check_type=self.check_type,
@@ -616,7 +1111,7 @@ class Check(BaseAuditModel):
         elif self.check_type == "eventlog":
             return [self.log_name, self.event_id] == [check.log_name, check.event_id]
 
-    def send_email(self):
+    def send_email(self, idempotency_key=None):
 
         CORE = CoreSettings.objects.first()
 
@@ -694,9 +1189,14 @@ class Check(BaseAuditModel):
                 except:
                     continue
 
-        CORE.send_mail(subject, body, alert_template=self.agent.alert_template)
+        CORE.send_mail(
+            subject,
+            body,
+            alert_template=self.agent.alert_template,
+            idempotency_key=idempotency_key,
+        )
 
-    def send_sms(self):
+    def send_sms(self, idempotency_key=None):
 
         CORE = CoreSettings.objects.first()
         body: str = ""
@@ -743,24 +1243,40 @@ class Check(BaseAuditModel):
         elif self.check_type == "eventlog":
             body = subject
 
-        CORE.send_sms(body, alert_template=self.agent.alert_template)
+        CORE.send_sms(
+            body,
+            alert_template=self.agent.alert_template,
+            idempotency_key=idempotency_key,
+        )
 
-    def send_resolved_email(self):
+    def send_resolved_email(self, idempotency_key=None):
         CORE = CoreSettings.objects.first()
 
         subject = f"{self.agent.client.name}, {self.agent.site.name}, {self} Resolved"
         body = f"{self} is now back to normal"
 
-        CORE.send_mail(subject, body, alert_template=self.agent.alert_template)
+        CORE.send_mail(
+            subject,
+            body,
+            alert_template=self.agent.alert_template,
+            idempotency_key=idempotency_key,
+        )
 
-    def send_resolved_sms(self):
+    def send_resolved_sms(self, idempotency_key=None):
         CORE = CoreSettings.objects.first()
 
         subject = f"{self.agent.client.name}, {self.agent.site.name}, {self} Resolved"
-        CORE.send_sms(subject, alert_template=self.agent.alert_template)
+        CORE.send_sms(
+            subject,
+            alert_template=self.agent.alert_template,
+            idempotency_key=idempotency_key,
+        )
 
 
 class CheckHistory(models.Model):
+    # the table is range partitioned by day on x, see migration 0024
+    PARTITION_PERIOD = "day"
+
     check_history = models.ForeignKey(
         Check,
         related_name="check_history",
@@ -770,5 +1286,112 @@ class CheckHistory(models.Model):
     y = models.PositiveIntegerField(null=True, blank=True, default=None)
     results = models.JSONField(null=True, blank=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["check_history", "x"])]
+
     def __str__(self):
         return self.check_history.readable_desc
+
+
+class CheckHistoryRollup(models.Model):
+    # rollup tables are range partitioned by month on x
+    PARTITION_PERIOD = "month"
+
+    # start of the bucket
+    x = models.DateTimeField(db_index=True)
+    y_min = models.PositiveIntegerField(null=True, blank=True)
+    y_max = models.PositiveIntegerField(null=True, blank=True)
+    y_sum = models.BigIntegerField(null=True, blank=True)
+    count = models.PositiveIntegerField(default=0)
+    fail_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+    def __str__(self):
+        return f"{self.check_history.readable_desc} - {self.x}"
+
+    @property
+    def y_avg(self) -> Optional[float]:
+        if self.y_sum is None or not self.count:
+            return None
+
+        return self.y_sum / self.count
+
+    @classmethod
+    def rollup(cls) -> None:
+        """
+        Recomputes the buckets from the latest existing bucket onwards, so the
+        current partial bucket is kept up to date and nothing is computed twice.
+        """
+        table = cls._meta.db_table
+        source = cls.source._meta.db_table  # type: ignore
+
+        start = cls.objects.aggregate(latest=models.Max("x"))["latest"]
+        if start is None:
+            start = cls.source.objects.aggregate(earliest=models.Min("x"))[  # type: ignore
+                "earliest"
+            ]
+            if start is None:
+                return
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO "{table}"
+                    (check_history_id, x, y_min, y_max, y_sum, count, fail_count)
+                SELECT
+                    h.check_history_id,
+                    date_trunc(%s, h.x AT TIME ZONE 'UTC') AT TIME ZONE 'UTC',
+                    {cls.aggregates}
+                FROM "{source}" h
+                JOIN checks_check c ON c.id = h.check_history_id
+                WHERE h.x >= date_trunc(%s, %s::timestamptz AT TIME ZONE 'UTC')
+                    AT TIME ZONE 'UTC'
+                GROUP BY 1, 2
+                ON CONFLICT (check_history_id, x) DO UPDATE SET
+                    y_min = EXCLUDED.y_min,
+                    y_max = EXCLUDED.y_max,
+                    y_sum = EXCLUDED.y_sum,
+                    count = EXCLUDED.count,
+                    fail_count = EXCLUDED.fail_count
+                """,
+                [cls.bucket, *cls.aggregate_params, cls.bucket, start],
+            )
+
+
+class CheckHistoryHourly(CheckHistoryRollup):
+    source = CheckHistory
+    bucket = "hour"
+    aggregates = """
+        MIN(h.y), MAX(h.y), SUM(h.y), COUNT(*),
+        COUNT(*) FILTER (WHERE c.check_type = ANY(%s) AND h.y = 1)
+    """
+    aggregate_params = [PASS_FAIL_CHECK_TYPES]
+
+    check_history = models.ForeignKey(
+        Check,
+        related_name="check_history_hourly",
+        on_delete=models.CASCADE,
+    )
+
+    class Meta:
+        unique_together = (("check_history", "x"),)
+
+
+class CheckHistoryDaily(CheckHistoryRollup):
+    source = CheckHistoryHourly
+    bucket = "day"
+    aggregates = """
+        MIN(h.y_min), MAX(h.y_max), SUM(h.y_sum), SUM(h.count), SUM(h.fail_count)
+    """
+    aggregate_params: list = []
+
+    check_history = models.ForeignKey(
+        Check,
+        related_name="check_history_daily",
+        on_delete=models.CASCADE,
+    )
+
+    class Meta:
+        unique_together = (("check_history", "x"),)
@@ -1,3 +1,5 @@
+from functools import cached_property
+
 import pytz
 import validators as _v
 from rest_framework import serializers
@@ -5,7 +7,7 @@ from rest_framework import serializers
 from autotasks.models import AutomatedTask
 from scripts.serializers import ScriptCheckSerializer, ScriptSerializer
 
-from .models import Check, CheckHistory
+from .models import PASS_FAIL_CHECK_TYPES, Check, CheckHistory
 
 
 class AssignedTaskField(serializers.ModelSerializer):
@@ -51,6 +53,7 @@ class CheckSerializer(serializers.ModelSerializer):
     class Meta:
         model = Check
         fields = "__all__"
+        read_only_fields = ["next_run_at"]
 
     # https://www.django-rest-framework.org/api-guide/serializers/#object-level-validation
     def validate(self, val):
@@ -162,13 +165,16 @@ class CheckRunnerGetSerializer(serializers.ModelSerializer):
     script = ScriptCheckSerializer(read_only=True)
 
     def get_assigned_tasks(self, obj):
-        if obj.assignedtask.exists():
-            tasks = obj.assignedtask.all()
+        tasks = obj.assignedtask.all()
+        if tasks:
             return AssignedTaskCheckRunnerField(tasks, many=True).data
 
     class Meta:
         model = Check
+        # the result state is merged in by get_check_runner_checks, not cached
         exclude = [
+            "status",
+            "alert_severity",
             "policy",
             "managed_by_policy",
             "overriden_by_policy",
@@ -176,6 +182,7 @@ class CheckRunnerGetSerializer(serializers.ModelSerializer):
             "name",
             "more_info",
             "last_run",
+            "next_run_at",
             "email_alert",
             "text_alert",
             "fails_b4_alert",
@@ -208,10 +215,45 @@ class CheckResultsSerializer(serializers.ModelSerializer):
 class CheckHistorySerializer(serializers.ModelSerializer):
     x = serializers.SerializerMethodField()
 
+    @cached_property
+    def tz(self):
+        # the child serializer is shared by every row of the list
+        return pytz.timezone(self.context["timezone"])
+
     def get_x(self, obj):
-        return obj.x.astimezone(pytz.timezone(self.context["timezone"])).isoformat()
+        return obj.x.astimezone(self.tz).isoformat()
 
     # used for return large amounts of graph data
     class Meta:
         model = CheckHistory
         fields = ("x", "y", "results")
+
+
+class CheckHistoryRollupSerializer(serializers.Serializer):
+    # hourly and daily rollups in the same shape as CheckHistorySerializer
+    x = serializers.SerializerMethodField()
+
+    @cached_property
+    def tz(self):
+        return pytz.timezone(self.context["timezone"])
+
+    y = serializers.SerializerMethodField()
+    results = serializers.SerializerMethodField()
+
+    def get_x(self, obj):
+        return obj.x.astimezone(self.tz).isoformat()
+
+    def get_y(self, obj):
+        if self.context["check_type"] in PASS_FAIL_CHECK_TYPES:
+            return 1 if obj.fail_count else 0
+
+        return round(obj.y_avg) if obj.y_avg is not None else None
+
+    def get_results(self, obj):
+        if self.context["check_type"] in PASS_FAIL_CHECK_TYPES:
+            return f"Failing {obj.fail_count} of {obj.count} runs"
+
+        if obj.y_avg is None:
+            return None
+
+        return f"Min: {obj.y_min}%, Max: {obj.y_max}%, Avg: {obj.y_avg:.1f}%"
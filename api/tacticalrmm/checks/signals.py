@@ -0,0 +1,105 @@
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from agents.models import Agent
+from autotasks.models import AutomatedTask
+from scripts.models import Script
+
+from .models import (
+    CHECK_RESULT_FIELDS,
+    HOT_STATE_FIELDS,
+    Check,
+    clear_check_runner_cache,
+    clear_check_state,
+    next_run_at_expression,
+)
+
+# task fields sent to the check runner with the assigned check
+TASK_CHECK_RUNNER_FIELDS = ("assigned_check_id", "enabled")
+
+
+@receiver(post_init, sender=Agent)
+def store_agent_check_interval(sender, instance: Agent, **kwargs):
+    # read from __dict__ so deferred fields are not loaded
+    instance._check_interval = instance.__dict__.get("check_interval")
+
+
+@receiver(post_save, sender=Agent)
+def agent_check_interval_changed(sender, instance: Agent, created, **kwargs):
+    check_interval = instance.__dict__.get("check_interval")
+    if not created and check_interval != instance._check_interval:
+        Check.objects.filter(agent=instance).update(
+            next_run_at=next_run_at_expression()
+        )
+
+    instance._check_interval = check_interval
+
+
+@receiver(post_init, sender=Check)
+def store_check_run_interval(sender, instance: Check, **kwargs):
+    instance._run_interval = instance.__dict__.get("run_interval")
+
+
+@receiver(post_save, sender=Check)
+def check_definition_changed(sender, instance: Check, created, update_fields, **kwargs):
+    # saving a check result doesn't change what the check runner is sent
+    if update_fields and set(update_fields) <= set(CHECK_RESULT_FIELDS):
+        return
+
+    if not instance.agent_id:
+        return
+
+    # the saved row replaces any result state that hasn't been flushed yet
+    if update_fields is None or set(update_fields) & set(HOT_STATE_FIELDS):
+        clear_check_state(instance.pk)
+
+    run_interval = instance.__dict__.get("run_interval")
+    if not created and run_interval != instance._run_interval:
+        Check.objects.filter(pk=instance.pk).update(
+            next_run_at=next_run_at_expression()
+        )
+
+    instance._run_interval = run_interval
+    clear_check_runner_cache(instance.agent_id)
+
+
+@receiver(post_delete, sender=Check)
+def check_deleted(sender, instance: Check, **kwargs):
+    clear_check_runner_cache(instance.agent_id)
+    clear_check_state(instance.pk)
+
+
+@receiver(post_init, sender=AutomatedTask)
+def store_task_check_runner_fields(sender, instance: AutomatedTask, **kwargs):
+    instance._check_runner_fields = tuple(
+        instance.__dict__.get(i) for i in TASK_CHECK_RUNNER_FIELDS
+    )
+
+
+@receiver(post_save, sender=AutomatedTask)
+def task_check_runner_fields_changed(
+    sender, instance: AutomatedTask, created, **kwargs
+):
+    current = tuple(instance.__dict__.get(i) for i in TASK_CHECK_RUNNER_FIELDS)
+    if current != instance._check_runner_fields and (
+        instance.assigned_check_id or instance._check_runner_fields[0]
+    ):
+        clear_check_runner_cache(instance.agent_id)
+
+    instance._check_runner_fields = current
+
+
+@receiver(post_delete, sender=AutomatedTask)
+def task_deleted(sender, instance: AutomatedTask, **kwargs):
+    if instance.assigned_check_id:
+        clear_check_runner_cache(instance.agent_id)
+
+
+@receiver(post_save, sender=Script)
+def script_saved(sender, instance: Script, **kwargs):
+    # script checks are sent with the script's code
+    clear_check_runner_cache(
+        *Check.objects.filter(script=instance, agent__isnull=False).values_list(
+            "agent_id", flat=True
+        )
+    )
@@ -1,34 +1,18 @@
-import datetime as dt
-import random
-from time import sleep
-from typing import Union
+from typing import Optional, Union
 
+from django.db import connection
 from django.utils import timezone as djangotime
 
 from tacticalrmm.celery import app
 
+from .utils import create_partitions, drop_partitions
+
 
 @app.task
 def handle_check_email_alert_task(pk, alert_interval: Union[float, None] = None) -> str:
     from alerts.models import Alert
 
-    alert = Alert.objects.get(pk=pk)
-
-    # first time sending email
-    if not alert.email_sent:
-        sleep(random.randint(1, 10))
-        alert.assigned_check.send_email()
-        alert.email_sent = djangotime.now()
-        alert.save(update_fields=["email_sent"])
-    else:
-        if alert_interval:
-            # send an email only if the last email sent is older than alert interval
-            delta = djangotime.now() - dt.timedelta(days=alert_interval)
-            if alert.email_sent < delta:
-                sleep(random.randint(1, 10))
-                alert.assigned_check.send_email()
-                alert.email_sent = djangotime.now()
-                alert.save(update_fields=["email_sent"])
+    Alert.notify(pk, "email_sent", "send_email", alert_interval)
 
     return "ok"
 
@@ -37,23 +21,7 @@ def handle_check_email_alert_task(pk, alert_interval: Union[float, None] = None)
 def handle_check_sms_alert_task(pk, alert_interval: Union[float, None] = None) -> str:
     from alerts.models import Alert
 
-    alert = Alert.objects.get(pk=pk)
-
-    # first time sending text
-    if not alert.sms_sent:
-        sleep(random.randint(1, 3))
-        alert.assigned_check.send_sms()
-        alert.sms_sent = djangotime.now()
-        alert.save(update_fields=["sms_sent"])
-    else:
-        if alert_interval:
-            # send a text only if the last text sent is older than 24 hours
-            delta = djangotime.now() - dt.timedelta(days=alert_interval)
-            if alert.sms_sent < delta:
-                sleep(random.randint(1, 3))
-                alert.assigned_check.send_sms()
-                alert.sms_sent = djangotime.now()
-                alert.save(update_fields=["sms_sent"])
+    Alert.notify(pk, "sms_sent", "send_sms", alert_interval)
 
     return "ok"
 
@@ -62,14 +30,7 @@ def handle_check_sms_alert_task(pk, alert_interval: Union[float, None] = None) -
 def handle_resolved_check_sms_alert_task(pk: int) -> str:
     from alerts.models import Alert
 
-    alert = Alert.objects.get(pk=pk)
-
-    # first time sending text
-    if not alert.resolved_sms_sent:
-        sleep(random.randint(1, 3))
-        alert.assigned_check.send_resolved_sms()
-        alert.resolved_sms_sent = djangotime.now()
-        alert.save(update_fields=["resolved_sms_sent"])
+    Alert.notify(pk, "resolved_sms_sent", "send_resolved_sms")
 
     return "ok"
 
@@ -78,25 +39,75 @@ def handle_resolved_check_sms_alert_task(pk: int) -> str:
 def handle_resolved_check_email_alert_task(pk: int) -> str:
     from alerts.models import Alert
 
-    alert = Alert.objects.get(pk=pk)
+    Alert.notify(pk, "resolved_email_sent", "send_resolved_email")
+
+    return "ok"
+
+
+@app.task
+def prune_check_history(
+    older_than_days: int,
+    hourly_older_than_days: Optional[int] = None,
+    daily_older_than_days: Optional[int] = None,
+) -> str:
+    from .models import CheckHistory, CheckHistoryDaily, CheckHistoryHourly
+
+    now = djangotime.now()
+    tiers = [
+        (CheckHistory, older_than_days),
+        (CheckHistoryHourly, hourly_older_than_days),
+        (CheckHistoryDaily, daily_older_than_days),
+    ]
+
+    with connection.cursor() as cursor:
+        for model, days in tiers:
+            table = model._meta.db_table
+
+            # make sure the upcoming partitions exist before rows arrive for them
+            create_partitions(
+                cursor,
+                table,
+                model.PARTITION_PERIOD,
+                now.date(),
+                now.date() + djangotime.timedelta(days=3),
+            )
+
+            if days is None:
+                continue
+
+            older_than = now - djangotime.timedelta(days=days)
+            drop_partitions(cursor, table, model.PARTITION_PERIOD, older_than)
+
+            # the partition holding the cutoff and the default partition
+            model.objects.filter(x__lt=older_than).delete()
+
+    return "ok"
+
+
+@app.task
+def rollup_check_history_task() -> str:
+    from .models import CheckHistoryDaily, CheckHistoryHourly
+
+    # daily rollups are computed from the hourly ones
+    CheckHistoryHourly.rollup()
+    CheckHistoryDaily.rollup()
+
+    return "ok"
+
+
+@app.task
+def flush_check_state_task() -> str:
+    from .models import Check
 
-    # first time sending email
-    if not alert.resolved_email_sent:
-        sleep(random.randint(1, 10))
-        alert.assigned_check.send_resolved_email()
-        alert.resolved_email_sent = djangotime.now()
-        alert.save(update_fields=["resolved_email_sent"])
+    Check.flush_hot_states()
 
     return "ok"
 
 
 @app.task
-def prune_check_history(older_than_days: int) -> str:
-    from .models import CheckHistory
+def remediate_winsvc_task() -> str:
+    from .models import Check
 
-    CheckHistory.objects.filter(
-        x__lt=djangotime.make_aware(dt.datetime.today())
-        - djangotime.timedelta(days=older_than_days)
-    ).delete()
+    Check.run_winsvc_remediations()
 
     return "ok"
@@ -1,9 +1,11 @@
 from unittest.mock import patch
 
+from django.test import override_settings
 from django.utils import timezone as djangotime
 from model_bakery import baker
 
-from checks.models import CheckHistory
+from checks.models import CheckHistory, CheckHistoryDaily, CheckHistoryHourly
+from core.models import CoreSettings
 from tacticalrmm.test import TacticalTestCase
 
 from .serializers import CheckSerializer
@@ -344,38 +346,95 @@ class TestCheckViews(TacticalTestCase):
         self.check_not_authenticated("get", url)
 
     def test_get_check_history(self):
+        from .tasks import rollup_check_history_task
+
         # setup data
         agent = baker.make_recipe("agents.agent")
         check = baker.make_recipe("checks.diskspace_check", agent=agent)
-        baker.make("checks.CheckHistory", check_history=check, _quantity=30)
+        now = djangotime.now()
         check_history_data = baker.make(
-            "checks.CheckHistory",
-            check_history=check,
-            _quantity=30,
+            "checks.CheckHistory", check_history=check, y=50, _quantity=30
+        )
+
+        # spread the history 2 hours apart
+        for i, check_history in enumerate(check_history_data):  # type: ignore
+            check_history.x = now - djangotime.timedelta(hours=i * 2)  # type: ignore
+            check_history.save()
+
+        old_check_history_data = baker.make(
+            "checks.CheckHistory", check_history=check, y=50, _quantity=30
         )
 
         # need to manually set the date back 35 days
-        for check_history in check_history_data:  # type: ignore
-            check_history.x = djangotime.now() - djangotime.timedelta(days=35)  # type: ignore
+        for check_history in old_check_history_data:  # type: ignore
+            check_history.x = now - djangotime.timedelta(days=35)  # type: ignore
             check_history.save()
 
+        rollup_check_history_task()
+
         # test invalid check pk
         resp = self.client.patch("/checks/history/500/", format="json")
         self.assertEqual(resp.status_code, 404)
 
         url = f"/checks/history/{check.id}/"
 
-        # test with timeFilter last 30 days
+        # test with timeFilter last 24 hours is served from the raw history
+        data = {"timeFilter": 1}
+        resp = self.client.patch(url, data, format="json")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.data), 12)  # type: ignore
+        self.assertEqual(resp.data[0]["results"], None)  # type: ignore
+
+        # raw history is served for as long as it is kept
         data = {"timeFilter": 30}
         resp = self.client.patch(url, data, format="json")
         self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data[0]["results"], None)  # type: ignore
+
+        # test with timeFilter past the raw history is served from hourly rollups
+        core = CoreSettings.objects.first()
+        core.check_history_prune_days = 7
+        core.save()
+        resp = self.client.patch(url, data, format="json")
+        self.assertEqual(resp.status_code, 200)
         self.assertEqual(len(resp.data), 30)  # type: ignore
+        self.assertEqual(resp.data[0]["y"], 50)  # type: ignore
+        self.assertEqual(
+            resp.data[0]["results"], "Min: 50%, Max: 50%, Avg: 50.0%"  # type: ignore
+        )
+
+        # downsampled to the chart width
+        data = {"timeFilter": 7, "maxPoints": 10}
+        resp = self.client.patch(url, data, format="json")
+        self.assertEqual(resp.status_code, 200)
+        self.assertLessEqual(len(resp.data), 10)  # type: ignore
+        self.assertGreater(len(resp.data), 0)  # type: ignore
+
+        data = {"timeFilter": 30, "maxPoints": 10}
+        resp = self.client.patch(url, data, format="json")
+        self.assertEqual(resp.status_code, 200)
+        self.assertLessEqual(len(resp.data), 10)  # type: ignore
+        self.assertEqual(resp.data[0]["y"], 50)  # type: ignore
 
-        # test with timeFilter equal to 0
+        # maxPoints is clamped and must be a number
+        data = {"timeFilter": 7, "maxPoints": 0}
+        resp = self.client.patch(url, data, format="json")
+        self.assertEqual(resp.status_code, 200)
+        self.assertLessEqual(len(resp.data), 2)  # type: ignore
+
+        data = {"timeFilter": 7, "maxPoints": "abc"}
+        resp = self.client.patch(url, data, format="json")
+        self.assertEqual(resp.status_code, 400)
+
+        # test with timeFilter equal to 0 is served from daily rollups
+        days = {
+            h.x.astimezone(djangotime.timezone.utc).date()
+            for h in check_history_data + old_check_history_data  # type: ignore
+        }
         data = {"timeFilter": 0}
         resp = self.client.patch(url, data, format="json")
         self.assertEqual(resp.status_code, 200)
-        self.assertEqual(len(resp.data), 60)  # type: ignore
+        self.assertEqual(len(resp.data), len(days))  # type: ignore
 
         self.check_not_authenticated("patch", url)
 
@@ -387,7 +446,10 @@ class TestCheckTasks(TacticalTestCase):
         self.agent = baker.make_recipe("agents.agent")
 
     def test_prune_check_history(self):
+        from django.db import connection
+
         from .tasks import prune_check_history
+        from .utils import create_partitions
 
         # setup data
         check = baker.make_recipe("checks.diskspace_check")
@@ -403,14 +465,96 @@ class TestCheckTasks(TacticalTestCase):
             check_history.x = djangotime.now() - djangotime.timedelta(days=35)  # type: ignore
             check_history.save()
 
+        # rows in a partition older than the retention are removed by dropping it
+        old_day = (djangotime.now() - djangotime.timedelta(days=40)).date()
+        with connection.cursor() as cursor:
+            create_partitions(cursor, "checks_checkhistory", "day", old_day, old_day)
+
+        old = baker.make("checks.CheckHistory", check_history=check)
+        old.x = djangotime.now() - djangotime.timedelta(days=40)  # type: ignore
+        old.save()  # type: ignore
+        partition = f"checks_checkhistory_p{old_day:%Y%m%d}"
+
+        def partitions() -> list[str]:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT c.relname FROM pg_inherits i "
+                    "JOIN pg_class c ON c.oid = i.inhrelid "
+                    "WHERE i.inhparent = 'checks_checkhistory'::regclass"
+                )
+                return [row[0] for row in cursor.fetchall()]
+
+        self.assertIn(partition, partitions())
+
+        # the task runs in autocommit, check the deferred foreign keys of this test
+        with connection.cursor() as cursor:
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+
         # prune data 30 days old
         prune_check_history(30)
         self.assertEqual(CheckHistory.objects.count(), 30)
+        self.assertNotIn(partition, partitions())
+
+        # upcoming partitions are created
+        tomorrow = (djangotime.now() + djangotime.timedelta(days=1)).date()
+        self.assertIn(f"checks_checkhistory_p{tomorrow:%Y%m%d}", partitions())
 
         # prune all Check history Data
         prune_check_history(0)
         self.assertEqual(CheckHistory.objects.count(), 0)
 
+        # rollups have their own retention
+        baker.make(
+            "checks.CheckHistoryHourly",
+            check_history=check,
+            x=djangotime.now() - djangotime.timedelta(days=100),
+        )
+        baker.make(
+            "checks.CheckHistoryDaily",
+            check_history=check,
+            x=djangotime.now() - djangotime.timedelta(days=100),
+        )
+        prune_check_history(30, 90, 365)
+        self.assertEqual(CheckHistoryHourly.objects.count(), 0)
+        self.assertEqual(CheckHistoryDaily.objects.count(), 1)
+
+    def test_rollup_check_history(self):
+        from .tasks import rollup_check_history_task
+
+        script = baker.make_recipe("checks.script_check", agent=self.agent)
+        hour = djangotime.now().replace(minute=0, second=0, microsecond=0)
+        for i, y in enumerate([0, 1, 1, 0]):
+            history = baker.make("checks.CheckHistory", check_history=script, y=y)
+            history.x = hour - djangotime.timedelta(hours=1, minutes=-i)  # type: ignore
+            history.save()  # type: ignore
+
+        rollup_check_history_task()
+
+        hourly = CheckHistoryHourly.objects.get(check_history=script)
+        self.assertEqual(hourly.x, hour - djangotime.timedelta(hours=1))
+        self.assertEqual(hourly.count, 4)
+        self.assertEqual(hourly.fail_count, 2)
+        self.assertEqual(hourly.y_min, 0)
+        self.assertEqual(hourly.y_max, 1)
+        self.assertEqual(hourly.y_avg, 0.5)
+
+        daily = CheckHistoryDaily.objects.get(check_history=script)
+        self.assertEqual(daily.count, 4)
+        self.assertEqual(daily.fail_count, 2)
+
+        # new data updates the latest bucket without duplicating it
+        history = baker.make("checks.CheckHistory", check_history=script, y=1)
+        history.x = hour - djangotime.timedelta(minutes=1)  # type: ignore
+        history.save()  # type: ignore
+
+        rollup_check_history_task()
+        hourly.refresh_from_db()
+        self.assertEqual(CheckHistoryHourly.objects.count(), 1)
+        self.assertEqual(hourly.count, 5)
+        self.assertEqual(hourly.fail_count, 3)
+        daily.refresh_from_db()
+        self.assertEqual(daily.count, 5)
+
     def test_handle_script_check(self):
         from checks.models import Check
 
@@ -765,6 +909,73 @@ class TestCheckTasks(TacticalTestCase):
         self.assertEqual(new_check.status, "failing")
         self.assertEqual(new_check.alert_severity, "warning")
 
+    def test_handle_hot_check_state(self):
+        from checks.models import CHECK_STATE_DIRTY_KEY, Check
+        from tacticalrmm.redis_client import redis_client
+
+        url = "/api/v3/checkrunner/"
+        redis_client.delete(CHECK_STATE_DIRTY_KEY)
+
+        cpuload = baker.make_recipe(
+            "checks.cpuload_check",
+            warning_threshold=40,
+            error_threshold=90,
+            agent=self.agent,
+        )
+
+        # first result changes the status and is written through
+        resp = self.client.patch(url, {"id": cpuload.id, "percent": 10}, format="json")
+        self.assertEqual(resp.status_code, 200)
+        new_check = Check.objects.get(pk=cpuload.id)
+        self.assertEqual(new_check.status, "passing")
+        self.assertEqual(new_check.history, [10])
+        self.assertFalse(redis_client.sismember(CHECK_STATE_DIRTY_KEY, cpuload.id))
+
+        # results that don't change the status are only kept in redis
+        for percent in (20, 30):
+            resp = self.client.patch(
+                url, {"id": cpuload.id, "percent": percent}, format="json"
+            )
+            self.assertEqual(resp.status_code, 200)
+
+        new_check = Check.objects.get(pk=cpuload.id)
+        self.assertEqual(new_check.history, [10])
+        self.assertTrue(redis_client.sismember(CHECK_STATE_DIRTY_KEY, cpuload.id))
+        self.assertEqual(CheckHistory.objects.filter(check_history=cpuload).count(), 3)
+
+        # the check isn't due until the interval from the hot state has passed
+        Check.objects.filter(pk=cpuload.id).update(
+            next_run_at=djangotime.now() - djangotime.timedelta(seconds=10)
+        )
+        r = self.client.get(f"/api/v3/{self.agent.agent_id}/checkrunner/")
+        self.assertFalse(r.data["checks"])  # type: ignore
+
+        # the rolling window is evaluated from the hot state
+        resp = self.client.patch(url, {"id": cpuload.id, "percent": 100}, format="json")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, "passing")  # type: ignore
+
+        self.assertEqual(Check.flush_hot_states(), 1)
+        new_check = Check.objects.get(pk=cpuload.id)
+        self.assertEqual(new_check.history, [10, 20, 30, 100])
+        self.assertEqual(new_check.status, "passing")
+        self.assertGreater(new_check.next_run_at, djangotime.now())
+        self.assertFalse(redis_client.sismember(CHECK_STATE_DIRTY_KEY, cpuload.id))
+        self.assertEqual(Check.flush_hot_states(), 0)
+
+        # a status change is written through right away
+        resp = self.client.patch(url, {"id": cpuload.id, "percent": 100}, format="json")
+        self.assertEqual(resp.data, "failing")  # type: ignore
+        new_check = Check.objects.get(pk=cpuload.id)
+        self.assertEqual(new_check.status, "failing")
+        self.assertEqual(new_check.history, [10, 20, 30, 100, 100])
+
+        # editing the check replaces the hot state with the saved row
+        new_check.history = []
+        new_check.save()
+        resp = self.client.patch(url, {"id": cpuload.id, "percent": 10}, format="json")
+        self.assertEqual(resp.data, "passing")  # type: ignore
+
     def test_handle_ping_check(self):
         from checks.models import Check
 
@@ -854,9 +1065,15 @@ class TestCheckTasks(TacticalTestCase):
         new_check = Check.objects.get(pk=ping.id)
         self.assertEqual(new_check.status, "passing")
 
+    @patch("checks.tasks.remediate_winsvc_task.delay")
     @patch("agents.models.Agent.nats_cmd")
-    def test_handle_winsvc_check(self, nats_cmd):
-        from checks.models import Check
+    def test_handle_winsvc_check(self, nats_cmd, remediate_winsvc_task):
+        from checks.models import (
+            WINSVC_REMEDIATION_LOCK_KEY,
+            WINSVC_REMEDIATION_QUEUE_KEY,
+            Check,
+        )
+        from tacticalrmm.redis_client import redis_client
 
         url = "/api/v3/checkrunner/"
 
@@ -899,18 +1116,31 @@ class TestCheckTasks(TacticalTestCase):
         winsvc.restart_if_stopped = True
         winsvc.alert_severity = "warning"
         winsvc.save()
+        redis_client.delete(
+            WINSVC_REMEDIATION_QUEUE_KEY,
+            WINSVC_REMEDIATION_LOCK_KEY.format(self.agent.pk, winsvc.svc_name),
+        )
 
         nats_cmd.return_value = "timeout"
 
         data = {"id": winsvc.id, "exists": True, "status": "not running"}
 
-        resp = self.client.patch(url, data, format="json")
-        self.assertEqual(resp.status_code, 200)
+        # the restart is queued instead of run in the request, once per service
+        for _ in range(2):
+            resp = self.client.patch(url, data, format="json")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.data, "remediating")  # type: ignore
 
+        remediate_winsvc_task.assert_called_once()
+        remediate_winsvc_task.reset_mock()
+        nats_cmd.assert_not_called()
+        self.assertEqual(redis_client.llen(WINSVC_REMEDIATION_QUEUE_KEY), 1)
+
+        self.assertEqual(Check.run_winsvc_remediations(), 1)
         new_check = Check.objects.get(pk=winsvc.id)
         self.assertEqual(new_check.status, "failing")
         self.assertEqual(new_check.alert_severity, "warning")
-        nats_cmd.assert_called()
+        nats_cmd.assert_called_once()
         nats_cmd.reset_mock()
 
         # test failing and attempt start
@@ -922,7 +1152,10 @@ class TestCheckTasks(TacticalTestCase):
 
         resp = self.client.patch(url, data, format="json")
         self.assertEqual(resp.status_code, 200)
+        remediate_winsvc_task.assert_called_once()
+        remediate_winsvc_task.reset_mock()
 
+        self.assertEqual(Check.run_winsvc_remediations(), 1)
         new_check = Check.objects.get(pk=winsvc.id)
         self.assertEqual(new_check.status, "failing")
         self.assertEqual(new_check.alert_severity, "error")
@@ -936,11 +1169,28 @@ class TestCheckTasks(TacticalTestCase):
 
         resp = self.client.patch(url, data, format="json")
         self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Check.objects.get(pk=winsvc.id).status, "remediating")
 
+        self.assertEqual(Check.run_winsvc_remediations(), 1)
         new_check = Check.objects.get(pk=winsvc.id)
         self.assertEqual(new_check.status, "passing")
+        self.assertEqual(new_check.more_info, "Status RUNNING")
         nats_cmd.assert_called()
         nats_cmd.reset_mock()
+        self.assertEqual(Check.run_winsvc_remediations(), 0)
+
+        # the lock is released for checks that are no longer remediating
+        resp = self.client.patch(url, data, format="json")
+        self.assertEqual(resp.status_code, 200)
+        Check.objects.filter(pk=winsvc.id).update(status="failing")
+
+        self.assertEqual(Check.run_winsvc_remediations(), 0)
+        nats_cmd.assert_not_called()
+        self.assertFalse(
+            redis_client.exists(
+                WINSVC_REMEDIATION_LOCK_KEY.format(self.agent.pk, winsvc.svc_name)
+            )
+        )
 
         # test failing and service not exist
         data = {"id": winsvc.id, "exists": False, "status": ""}
@@ -1165,3 +1415,205 @@ class TestCheckTasks(TacticalTestCase):
         new_check = Check.objects.get(pk=eventlog.id)
 
         self.assertEquals(new_check.status, "passing")
+
+    def test_eventlog_matcher(self):
+        from checks.utils import EventLogMatcher
+
+        events = [
+            {"eventType": "error", "eventID": 123, "source": "disk", "message": "a"},
+            {"eventType": "error", "eventID": "123", "source": "ntfs", "message": "b"},
+            {"eventType": "error", "eventID": 150, "source": "disk", "message": "ab"},
+            {"eventType": "warning", "eventID": 123, "source": "disk", "message": "a"},
+        ]
+        columns = {k: [i[k] for i in events] for k in events[0].keys()}
+
+        cases = [
+            (("error", 123, False, None, None), [0, 1]),
+            (("error", 123, True, None, None), [0, 1, 2]),
+            (("error", 123, True, "disk", None), [0, 2]),
+            (("error", 123, True, None, "b"), [1, 2]),
+            (("error", 150, False, "disk", "b"), [2]),
+            (("information", 123, True, None, None), []),
+        ]
+        for criteria, expected in cases:
+            matcher = EventLogMatcher(*criteria)
+            self.assertEqual(matcher.filter_columns(columns), expected)
+            self.assertEqual(matcher.filter_rows(events), [events[i] for i in expected])
+            self.assertEqual(matcher.filter(columns), [events[i] for i in expected])
+
+    @override_settings(CHECK_EVENTLOG_MAX_STORED_EVENTS=2)
+    def test_eventlog_stored_matches(self):
+        from checks.models import Check
+
+        url = "/api/v3/checkrunner/"
+
+        eventlog = baker.make_recipe(
+            "checks.eventlog_check",
+            event_type="warning",
+            fail_when="contains",
+            event_id=123,
+            event_id_is_wildcard=True,
+            event_source=None,
+            event_message=None,
+            agent=self.agent,
+        )
+
+        data = {
+            "id": eventlog.id,
+            "log": [
+                {
+                    "eventType": "warning",
+                    "eventID": 123,
+                    "source": "source",
+                    "message": f"message {i}",
+                    "time": f"2021-04-0{i} 10:00:00 -0500 CDT",
+                }
+                for i in range(1, 5)
+            ],
+        }
+
+        resp = self.client.patch(url, data, format="json")
+        self.assertEqual(resp.status_code, 200)
+
+        # only the most recent matches are stored
+        new_check = Check.objects.get(pk=eventlog.id)
+        self.assertEqual(new_check.extra_details["count"], 4)
+        self.assertEqual(
+            [i["message"] for i in new_check.extra_details["log"]],
+            ["message 4", "message 3"],
+        )
+
+        # an unchanged result set isn't written again
+        Check.objects.filter(pk=eventlog.id).update(
+            extra_details={**new_check.extra_details, "log": []}
+        )
+        resp = self.client.patch(url, data, format="json")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Check.objects.get(pk=eventlog.id).extra_details["log"], [])
+
+        data["log"].pop()
+        resp = self.client.patch(url, data, format="json")
+        self.assertEqual(resp.status_code, 200)
+        new_check = Check.objects.get(pk=eventlog.id)
+        self.assertEqual(new_check.extra_details["count"], 3)
+        self.assertEqual(
+            [i["message"] for i in new_check.extra_details["log"]],
+            ["message 3", "message 2"],
+        )
+
+    @patch("clients.models.clear_tree_cache")
+    @patch("alerts.models.Alert.queue_alert_events")
+    def test_handle_check_results(self, queue_events, clear_tree_cache):
+        from alerts.models import Alert
+        from checks.models import Check
+
+        url = "/api/v3/checkresults/"
+
+        script = baker.make_recipe("checks.script_check", agent=self.agent)
+        diskspace = baker.make_recipe(
+            "checks.diskspace_check",
+            warning_threshold=20,
+            error_threshold=10,
+            agent=self.agent,
+        )
+        cpuload = baker.make_recipe(
+            "checks.cpuload_check",
+            warning_threshold=70,
+            error_threshold=90,
+            agent=self.agent,
+        )
+        # belongs to another agent and should be ignored
+        other = baker.make_recipe(
+            "checks.ping_check", agent=baker.make_recipe("agents.agent")
+        )
+
+        data = {
+            "agent_id": self.agent.agent_id,
+            "results": [
+                {
+                    "id": script.id,
+                    "retcode": 500,
+                    "stderr": "error",
+                    "stdout": "message",
+                    "runtime": 5.000,
+                },
+                {
+                    "id": diskspace.id,
+                    "exists": True,
+                    "percent_used": 50,
+                    "total": 500,
+                    "free": 250,
+                },
+                {"id": cpuload.id, "percent": 10},
+                {"id": other.id, "output": "", "has_stdout": False, "has_stderr": True},
+            ],
+        }
+
+        with self.assertNumQueries(7):
+            resp = self.client.patch(url, data, format="json")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            resp.json(),
+            {
+                str(script.id): "failing",
+                str(diskspace.id): "passing",
+                str(cpuload.id): "passing",
+            },
+        )
+        self.assertEqual(Check.objects.get(pk=script.id).fail_count, 1)
+        self.assertEqual(Check.objects.get(pk=script.id).retcode, 500)
+        self.assertEqual(
+            Check.objects.get(pk=diskspace.id).more_info, "Total: 500BB, Free: 250BB"
+        )
+        self.assertEqual(Check.objects.get(pk=cpuload.id).history, [10])
+        self.assertEqual(CheckHistory.objects.count(), 3)
+        self.assertIsNotNone(Check.objects.get(pk=cpuload.id).last_run)
+        self.assertEqual(Check.objects.get(pk=other.id).status, "pending")
+
+        def queued():
+            return [
+                (e, i.pk) for c in queue_events.call_args_list for e, i in c.args[0]
+            ]
+
+        # new failure is queued for alerting, passing checks without alerts are not
+        self.assertEqual(queued(), [("failure", script.id)])
+
+        # the client tree shows the new statuses
+        clear_tree_cache.assert_called_once()
+
+        # an existing alert with the same severity isn't handled again
+        queue_events.reset_mock()
+        baker.make(
+            "alerts.Alert",
+            assigned_check=script,
+            alert_type="check",
+            severity="error",
+            resolved=False,
+        )
+        clear_tree_cache.reset_mock()
+        resp = self.client.patch(url, data, format="json")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(queued(), [])
+        clear_tree_cache.assert_not_called()
+
+        # a severity change is handled
+        script.warning_return_codes = [500]
+        script.save()
+        resp = self.client.patch(url, data, format="json")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(queued(), [("failure", script.id)])
+
+        # recovery is handled
+        queue_events.reset_mock()
+        data["results"][0]["retcode"] = 0
+        resp = self.client.patch(url, data, format="json")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(queued(), [("resolve", script.id)])
+        self.assertEqual(Check.objects.get(pk=script.id).fail_count, 0)
+
+        data["results"] = "bad"
+        resp = self.client.patch(url, data, format="json")
+        self.assertEqual(resp.status_code, 400)
+
+        self.check_not_authenticated("patch", url)
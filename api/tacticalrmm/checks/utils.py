@@ -1,3 +1,15 @@
+import datetime as dt
+import re
+from functools import lru_cache
+from typing import Any, Optional
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from loguru import logger
+
+logger.configure(**settings.LOG_CONFIG)
+
+
 def bytes2human(n):
     # http://code.activestate.com/recipes/578019
     symbols = ("K", "M", "G", "T", "P", "E", "Z", "Y")
@@ -9,3 +21,151 @@ def bytes2human(n):
             value = float(n) / prefix[s]
             return "%.1f%s" % (value, s)
     return "%sB" % n
+
+
+class EventLogMatcher:
+    """
+    The match criteria of an eventlog check. Events match on their type, their id
+    unless the check is a wildcard and on substrings of their source and message.
+    Works on a list of event dicts or on columns, a dict of equal length lists.
+    """
+
+    def __init__(
+        self,
+        event_type: Optional[str],
+        event_id: Optional[int],
+        is_wildcard: bool,
+        source: Optional[str],
+        message: Optional[str],
+    ) -> None:
+        self.event_type = event_type
+        self.event_id = event_id
+        # agents send the id as an int or a str
+        self.event_ids = None if is_wildcard else {event_id, str(event_id)}
+        self.source = source
+        self.message = message
+
+    def id_matches(self, value: Any) -> bool:
+        if value in self.event_ids:  # type: ignore
+            return True
+
+        try:
+            return int(value) == self.event_id
+        except (TypeError, ValueError):
+            return False
+
+    def filter_columns(self, columns: dict[str, list]) -> list[int]:
+        """Returns the indexes of the matching events"""
+        # cheapest criteria first, each one only looks at the previous matches
+        event_types = columns["eventType"]
+        idx = [i for i in range(len(event_types)) if event_types[i] == self.event_type]
+
+        if self.event_ids is not None:
+            event_ids = columns["eventID"]
+            idx = [i for i in idx if self.id_matches(event_ids[i])]
+
+        if self.source:
+            sources = columns["source"]
+            idx = [i for i in idx if self.source in sources[i]]
+
+        if self.message:
+            messages = columns["message"]
+            idx = [i for i in idx if self.message in messages[i]]
+
+        return idx
+
+    def filter_rows(self, events: list[dict]) -> list[dict]:
+        ret = [i for i in events if i["eventType"] == self.event_type]
+
+        if self.event_ids is not None:
+            ret = [i for i in ret if self.id_matches(i["eventID"])]
+
+        if self.source:
+            ret = [i for i in ret if self.source in i["source"]]
+
+        if self.message:
+            ret = [i for i in ret if self.message in i["message"]]
+
+        return ret
+
+    def filter(self, log: Any) -> list[dict]:
+        if not isinstance(log, dict):
+            return self.filter_rows(log)
+
+        keys = list(log.keys())
+        return [{k: log[k][i] for k in keys} for i in self.filter_columns(log)]
+
+
+@lru_cache(maxsize=1024)
+def compile_eventlog_matcher(
+    event_type: Optional[str],
+    event_id: Optional[int],
+    is_wildcard: bool,
+    source: Optional[str],
+    message: Optional[str],
+) -> EventLogMatcher:
+    return EventLogMatcher(event_type, event_id, is_wildcard, source, message)
+
+
+def partition_bounds(day: dt.date, period: str) -> tuple[dt.date, dt.date, str]:
+    # returns the lower and upper bound and the name suffix of the partition holding day
+    if period == "day":
+        lower = day
+        upper = day + dt.timedelta(days=1)
+        return lower, upper, lower.strftime("%Y%m%d")
+
+    lower = day.replace(day=1)
+    upper = (lower + dt.timedelta(days=32)).replace(day=1)
+    return lower, upper, lower.strftime("%Y%m")
+
+
+def create_partitions(
+    cursor, table: str, period: str, start: dt.date, end: dt.date
+) -> None:
+    """
+    Creates the range partitions of table covering start through end.
+    A partition can't be created while rows for its range are in the default
+    partition, those are skipped and the rows are removed by the retention delete.
+    """
+    day = start
+    while day <= end:
+        lower, upper, suffix = partition_bounds(day, period)
+        try:
+            with transaction.atomic(using=cursor.db.alias):
+                cursor.execute(
+                    f'CREATE TABLE IF NOT EXISTS "{table}_p{suffix}" '
+                    f'PARTITION OF "{table}" FOR VALUES FROM (%s) TO (%s)',
+                    [f"{lower} 00:00:00+00", f"{upper} 00:00:00+00"],
+                )
+        except DatabaseError as e:
+            logger.error(f"Unable to create partition {table}_p{suffix}: {e}")
+
+        day = upper
+
+
+def drop_partitions(cursor, table: str, period: str, before: dt.datetime) -> list[str]:
+    # drops the partitions of table which only hold rows older than before
+    cursor.execute(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = %s::regclass",
+        [table],
+    )
+    fmt = "%Y%m%d" if period == "day" else "%Y%m"
+    dropped = []
+    for (name,) in cursor.fetchall():
+        match = re.fullmatch(rf"{table}_p(\d+)", name)
+        if not match:
+            continue
+
+        try:
+            lower = dt.datetime.strptime(match.group(1), fmt).date()
+        except ValueError:
+            continue
+
+        _, upper, _ = partition_bounds(lower, period)
+        if dt.datetime.combine(upper, dt.time(), tzinfo=dt.timezone.utc) <= before:
+            cursor.execute(f'DROP TABLE "{name}"')
+            dropped.append(name)
+
+    return dropped
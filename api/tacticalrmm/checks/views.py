@@ -1,7 +1,7 @@
 import asyncio
 from datetime import datetime as dt
 
-from django.db.models import Q
+from django.db.models import ExpressionWrapper, F, FloatField, Q
 from django.shortcuts import get_object_or_404
 from django.utils import timezone as djangotime
 from packaging import version as pyver
@@ -16,11 +16,20 @@ from automation.tasks import (
     generate_agent_checks_from_policies_task,
     update_policy_check_fields_task,
 )
+from core.models import CoreSettings
 from scripts.models import Script
-from tacticalrmm.utils import notify_error
+from tacticalrmm.utils import downsample_minmax, notify_error
 
-from .models import Check
-from .serializers import CheckHistorySerializer, CheckSerializer
+from .models import PASS_FAIL_CHECK_TYPES, Check
+from .serializers import (
+    CheckHistoryRollupSerializer,
+    CheckHistorySerializer,
+    CheckSerializer,
+)
+
+# bounds for the number of points a check history chart asks for
+CHECK_HISTORY_MIN_POINTS = 2
+CHECK_HISTORY_MAX_POINTS = 5000
 
 
 class AddCheck(APIView):
@@ -139,21 +148,69 @@ class CheckHistory(APIView):
     def patch(self, request, checkpk):
         check = get_object_or_404(Check, pk=checkpk)
 
+        # optional limit for charts, usually the chart width in pixels
+        max_points = request.data.get("maxPoints")
+        if max_points is not None:
+            try:
+                max_points = int(max_points)
+            except (ValueError, TypeError):
+                return notify_error("Invalid maxPoints")
+
+            max_points = min(
+                max(max_points, CHECK_HISTORY_MIN_POINTS), CHECK_HISTORY_MAX_POINTS
+            )
+
         timeFilter = Q()
+        days = request.data.get("timeFilter", 0)
 
-        if "timeFilter" in request.data:
-            if request.data["timeFilter"] != 0:
-                timeFilter = Q(
-                    x__lte=djangotime.make_aware(dt.today()),
-                    x__gt=djangotime.make_aware(dt.today())
-                    - djangotime.timedelta(days=request.data["timeFilter"]),
+        if days != 0:
+            timeFilter = Q(
+                x__lte=djangotime.make_aware(dt.today()),
+                x__gt=djangotime.make_aware(dt.today())
+                - djangotime.timedelta(days=days),
+            )
+
+        # pick the storage tier from the requested time range, each tier is kept for
+        # as many days as its prune setting
+        core = CoreSettings.objects.first()
+        if days != 0 and days <= core.check_history_prune_days:  # type: ignore
+            check_history = check.check_history.filter(timeFilter).order_by("-x")  # type: ignore
+            if max_points:
+                check_history = downsample_minmax(check_history, max_points, F("y"))
+
+            return Response(
+                CheckHistorySerializer(
+                    check_history,
+                    context={"timezone": check.agent.timezone},
+                    many=True,
+                ).data
+            )
+
+        if days != 0 and days <= core.check_history_hourly_prune_days:  # type: ignore
+            rollups = check.check_history_hourly  # type: ignore
+        else:
+            rollups = check.check_history_daily  # type: ignore
+
+        rollups = rollups.filter(timeFilter).order_by("-x")
+        if max_points:
+            # downsample on the value the chart shows
+            if check.check_type in PASS_FAIL_CHECK_TYPES:
+                value = F("fail_count")
+            else:
+                value = ExpressionWrapper(
+                    F("y_sum") * 1.0 / F("count"), output_field=FloatField()
                 )
 
-        check_history = check.check_history.filter(timeFilter).order_by("-x")  # type: ignore
+            rollups = downsample_minmax(rollups, max_points, value)
 
         return Response(
-            CheckHistorySerializer(
-                check_history, context={"timezone": check.agent.timezone}, many=True
+            CheckHistoryRollupSerializer(
+                rollups,
+                context={
+                    "timezone": check.agent.timezone,
+                    "check_type": check.check_type,
+                },
+                many=True,
             ).data
         )
 
@@ -1,10 +1,70 @@
+import json
 import uuid
 
 from django.contrib.postgres.fields import ArrayField
 from django.db import models
+from django.db.models import Count, Exists, OuterRef, Q
 
 from agents.models import Agent
 from logs.models import BaseAuditModel
+from tacticalrmm.redis_client import redis_client
+
+CLIENT_TREE_CACHE_KEY = "client_tree_rollups"
+# safety net, the cache is cleared on every change that affects the rollups
+CLIENT_TREE_CACHE_TIMEOUT = 600
+
+
+def get_tree_rollups() -> dict[str, dict[str, list[bool]]]:
+    """
+    Returns [failing_checks, maintenance_mode] for every client and site that has
+    agents, keyed by the str pk. Computed with one grouped query and cached in redis.
+    """
+    cached = redis_client.get(CLIENT_TREE_CACHE_KEY)
+    if cached:
+        return json.loads(cached)
+
+    from checks.models import Check
+
+    rows = (
+        Agent.objects.filter(site__isnull=False)
+        .alias(
+            failing_check=Exists(
+                Check.objects.filter(agent=OuterRef("pk"), status="failing")
+            )
+        )
+        .values("site_id", "site__client_id")
+        .annotate(
+            failing=Count(
+                "pk",
+                filter=Q(failing_check=True)
+                | (
+                    (Q(overdue_email_alert=True) | Q(overdue_text_alert=True))
+                    & Agent.objects.overdue_q()
+                ),
+            ),
+            maintenance=Count("pk", filter=Q(maintenance_mode=True)),
+        )
+        .order_by()
+    )
+
+    rollups: dict[str, dict[str, list[bool]]] = {"clients": {}, "sites": {}}
+    for row in rows:
+        site = rollups["sites"].setdefault(str(row["site_id"]), [False, False])
+        client = rollups["clients"].setdefault(
+            str(row["site__client_id"]), [False, False]
+        )
+        for node in (site, client):
+            node[0] = node[0] or row["failing"] > 0
+            node[1] = node[1] or row["maintenance"] > 0
+
+    redis_client.set(
+        CLIENT_TREE_CACHE_KEY, json.dumps(rollups), ex=CLIENT_TREE_CACHE_TIMEOUT
+    )
+    return rollups
+
+
+def clear_tree_cache() -> None:
+    redis_client.delete(CLIENT_TREE_CACHE_KEY)
 
 
 class Client(BaseAuditModel):
@@ -34,30 +94,14 @@ class Client(BaseAuditModel):
 
     def save(self, *args, **kw):
         from alerts.tasks import cache_agents_alert_template
-        from automation.tasks import generate_agent_checks_by_location_task
 
         # get old client if exists
         old_client = type(self).objects.get(pk=self.pk) if self.pk else None
         super(BaseAuditModel, self).save(*args, **kw)
 
-        # check if server polcies have changed and initiate task to reapply policies if so
-        if old_client and old_client.server_policy != self.server_policy:
-            generate_agent_checks_by_location_task.delay(
-                location={"site__client_id": self.pk},
-                mon_type="server",
-                create_tasks=True,
-            )
-
-        # check if workstation polcies have changed and initiate task to reapply policies if so
-        if old_client and old_client.workstation_policy != self.workstation_policy:
-            generate_agent_checks_by_location_task.delay(
-                location={"site__client_id": self.pk},
-                mon_type="workstation",
-                create_tasks=True,
-            )
-
+        # policy changes are handled by the policy regeneration queue
         if old_client and old_client.alert_template != self.alert_template:
-            cache_agents_alert_template.delay()
+            cache_agents_alert_template.delay(client=self.pk)
 
     class Meta:
         ordering = ("name",)
@@ -67,35 +111,11 @@ class Client(BaseAuditModel):
 
     @property
     def has_maintenanace_mode_agents(self):
-        return (
-            Agent.objects.filter(site__client=self, maintenance_mode=True).count() > 0
-        )
+        return get_tree_rollups()["clients"].get(str(self.pk), [False, False])[1]
 
     @property
     def has_failing_checks(self):
-        agents = (
-            Agent.objects.only(
-                "pk",
-                "overdue_email_alert",
-                "overdue_text_alert",
-                "last_seen",
-                "overdue_time",
-                "offline_time",
-            )
-            .filter(site__client=self)
-            .prefetch_related("agentchecks")
-        )
-
-        failing = 0
-        for agent in agents:
-            if agent.checks["has_failing_checks"]:
-                failing += 1
-
-            if agent.overdue_email_alert or agent.overdue_text_alert:
-                if agent.status == "overdue":
-                    failing += 1
-
-        return failing > 0
+        return get_tree_rollups()["clients"].get(str(self.pk), [False, False])[0]
 
     @staticmethod
     def serialize(client):
@@ -133,30 +153,14 @@ class Site(BaseAuditModel):
 
     def save(self, *args, **kw):
         from alerts.tasks import cache_agents_alert_template
-        from automation.tasks import generate_agent_checks_by_location_task
 
         # get old client if exists
         old_site = type(self).objects.get(pk=self.pk) if self.pk else None
         super(Site, self).save(*args, **kw)
 
-        # check if server polcies have changed and initiate task to reapply policies if so
-        if old_site and old_site.server_policy != self.server_policy:
-            generate_agent_checks_by_location_task.delay(
-                location={"site_id": self.pk},
-                mon_type="server",
-                create_tasks=True,
-            )
-
-        # check if workstation polcies have changed and initiate task to reapply policies if so
-        if old_site and old_site.workstation_policy != self.workstation_policy:
-            generate_agent_checks_by_location_task.delay(
-                location={"site_id": self.pk},
-                mon_type="workstation",
-                create_tasks=True,
-            )
-
+        # policy changes are handled by the policy regeneration queue
         if old_site and old_site.alert_template != self.alert_template:
-            cache_agents_alert_template.delay()
+            cache_agents_alert_template.delay(site=self.pk)
 
     class Meta:
         ordering = ("name",)
@@ -167,33 +171,11 @@ class Site(BaseAuditModel):
 
     @property
     def has_maintenanace_mode_agents(self):
-        return Agent.objects.filter(site=self, maintenance_mode=True).count() > 0
+        return get_tree_rollups()["sites"].get(str(self.pk), [False, False])[1]
 
     @property
     def has_failing_checks(self):
-        agents = (
-            Agent.objects.only(
-                "pk",
-                "overdue_email_alert",
-                "overdue_text_alert",
-                "last_seen",
-                "overdue_time",
-                "offline_time",
-            )
-            .filter(site=self)
-            .prefetch_related("agentchecks")
-        )
-
-        failing = 0
-        for agent in agents:
-            if agent.checks["has_failing_checks"]:
-                failing += 1
-
-            if agent.overdue_email_alert or agent.overdue_text_alert:
-                if agent.status == "overdue":
-                    failing += 1
-
-        return failing > 0
+        return get_tree_rollups()["sites"].get(str(self.pk), [False, False])[0]
 
     @staticmethod
     def serialize(site):
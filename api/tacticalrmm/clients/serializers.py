@@ -1,6 +1,18 @@
-from rest_framework.serializers import ModelSerializer, ReadOnlyField, ValidationError
-
-from .models import Client, ClientCustomField, Deployment, Site, SiteCustomField
+from rest_framework.serializers import (
+    ModelSerializer,
+    ReadOnlyField,
+    SerializerMethodField,
+    ValidationError,
+)
+
+from .models import (
+    Client,
+    ClientCustomField,
+    Deployment,
+    Site,
+    SiteCustomField,
+    get_tree_rollups,
+)
 
 
 class SiteCustomFieldSerializer(ModelSerializer):
@@ -89,8 +101,18 @@ class ClientSerializer(ModelSerializer):
 
 
 class SiteTreeSerializer(ModelSerializer):
-    maintenance_mode = ReadOnlyField(source="has_maintenanace_mode_agents")
-    failing_checks = ReadOnlyField(source="has_failing_checks")
+    maintenance_mode = SerializerMethodField()
+    failing_checks = SerializerMethodField()
+
+    def get_rollup(self, obj) -> list[bool]:
+        rollups = self.context.get("rollups") or get_tree_rollups()
+        return rollups["sites"].get(str(obj.pk), [False, False])
+
+    def get_maintenance_mode(self, obj) -> bool:
+        return self.get_rollup(obj)[1]
+
+    def get_failing_checks(self, obj) -> bool:
+        return self.get_rollup(obj)[0]
 
     class Meta:
         model = Site
@@ -100,8 +122,18 @@ class SiteTreeSerializer(ModelSerializer):
 
 class ClientTreeSerializer(ModelSerializer):
     sites = SiteTreeSerializer(many=True, read_only=True)
-    maintenance_mode = ReadOnlyField(source="has_maintenanace_mode_agents")
-    failing_checks = ReadOnlyField(source="has_failing_checks")
+    maintenance_mode = SerializerMethodField()
+    failing_checks = SerializerMethodField()
+
+    def get_rollup(self, obj) -> list[bool]:
+        rollups = self.context.get("rollups") or get_tree_rollups()
+        return rollups["clients"].get(str(obj.pk), [False, False])
+
+    def get_maintenance_mode(self, obj) -> bool:
+        return self.get_rollup(obj)[1]
+
+    def get_failing_checks(self, obj) -> bool:
+        return self.get_rollup(obj)[0]
 
     class Meta:
         model = Client
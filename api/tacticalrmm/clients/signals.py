@@ -0,0 +1,57 @@
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from agents.models import Agent
+from checks.models import Check
+
+from .models import Site, clear_tree_cache
+
+# agent fields that feed the client tree rollups
+AGENT_TREE_FIELDS = (
+    "site_id",
+    "maintenance_mode",
+    "overdue_email_alert",
+    "overdue_text_alert",
+)
+
+
+@receiver(post_init, sender=Agent)
+def store_agent_tree_fields(sender, instance: Agent, **kwargs):
+    # read from __dict__ so deferred fields are not loaded
+    instance._tree_fields = tuple(instance.__dict__.get(i) for i in AGENT_TREE_FIELDS)
+
+
+@receiver(post_save, sender=Agent)
+def agent_tree_fields_changed(sender, instance: Agent, created, **kwargs):
+    current = tuple(instance.__dict__.get(i) for i in AGENT_TREE_FIELDS)
+    if created or current != instance._tree_fields:
+        clear_tree_cache()
+
+    instance._tree_fields = current
+
+
+@receiver(post_init, sender=Check)
+def store_check_status(sender, instance: Check, **kwargs):
+    instance._tree_status = instance.__dict__.get("status")
+
+
+@receiver(post_save, sender=Check)
+def check_status_changed(sender, instance: Check, created, **kwargs):
+    status = instance.__dict__.get("status")
+    if instance.agent_id and (created or status != instance._tree_status):
+        clear_tree_cache()
+
+    instance._tree_status = status
+
+
+@receiver(post_save, sender=Site)
+def site_saved(sender, instance: Site, **kwargs):
+    # a site can be moved to another client
+    clear_tree_cache()
+
+
+@receiver(post_delete, sender=Agent)
+@receiver(post_delete, sender=Check)
+@receiver(post_delete, sender=Site)
+def tree_node_deleted(sender, instance, **kwargs):
+    clear_tree_cache()
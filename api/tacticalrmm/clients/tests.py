@@ -4,6 +4,7 @@ from unittest.mock import patch
 from model_bakery import baker
 from rest_framework.serializers import ValidationError
 
+from agents.models import Agent
 from tacticalrmm.test import TacticalTestCase
 
 from .models import Client, ClientCustomField, Deployment, Site, SiteCustomField
@@ -179,13 +180,10 @@ class TestClientViews(TacticalTestCase):
 
         self.check_not_authenticated("put", url)
 
-    @patch("automation.tasks.generate_all_agent_checks_task.delay")
-    @patch("automation.tasks.generate_all_agent_checks_task.delay")
-    def test_delete_client(self, task1, task2):
+    @patch("automation.models.Policy.queue_regeneration")
+    def test_delete_client(self, queue_regeneration):
         from agents.models import Agent
 
-        task1.return_value = "ok"
-        task2.return_value = "ok"
         # setup data
         client_to_delete = baker.make("clients.Client")
         client_to_move = baker.make("clients.Client")
@@ -352,13 +350,10 @@ class TestClientViews(TacticalTestCase):
 
         self.check_not_authenticated("put", url)
 
-    @patch("automation.tasks.generate_all_agent_checks_task.delay")
-    @patch("automation.tasks.generate_all_agent_checks_task.delay")
-    def test_delete_site(self, task1, task2):
+    @patch("automation.models.Policy.queue_regeneration")
+    def test_delete_site(self, queue_regeneration):
         from agents.models import Agent
 
-        task1.return_value = "ok"
-        task2.return_value = "ok"
         # setup data
         client = baker.make("clients.Client")
         site_to_delete = baker.make("clients.Site", client=client)
@@ -470,3 +465,116 @@ class TestClientViews(TacticalTestCase):
         url = f"/clients/{uid}/deploy/"
         r = self.client.get(url)
         self.assertEqual(r.status_code, 404)
+
+
+class TestClientTree(TacticalTestCase):
+    def setUp(self):
+        self.authenticate()
+        self.setup_coresettings()
+
+    @patch("clients.models.redis_client")
+    def test_get_tree_rollups(self, redis_client):
+        from django.utils import timezone as djangotime
+
+        from .models import CLIENT_TREE_CACHE_KEY, get_tree_rollups
+
+        redis_client.get.return_value = None
+
+        client1 = baker.make("clients.Client")
+        client2 = baker.make("clients.Client")
+        failing_site = baker.make("clients.Site", client=client1)
+        maintenance_site = baker.make("clients.Site", client=client1)
+        overdue_site = baker.make("clients.Site", client=client2)
+        ok_site = baker.make("clients.Site", client=client2)
+
+        agent = baker.make_recipe("agents.online_agent", site=failing_site)
+        baker.make_recipe("checks.ping_check", agent=agent, status="failing")
+        baker.make_recipe(
+            "agents.online_agent", site=maintenance_site, maintenance_mode=True
+        )
+        overdue = djangotime.now() - djangotime.timedelta(minutes=40)
+        baker.make_recipe(
+            "agents.agent",
+            site=overdue_site,
+            last_seen=overdue,
+            overdue_email_alert=True,
+        )
+        # overdue without alerts enabled is not failing
+        baker.make_recipe("agents.agent", site=ok_site, last_seen=overdue)
+        agent = baker.make_recipe("agents.online_agent", site=ok_site)
+        baker.make_recipe("checks.ping_check", agent=agent, status="passing")
+
+        with self.assertNumQueries(1):
+            rollups = get_tree_rollups()
+
+        self.assertEqual(
+            rollups,
+            {
+                "clients": {
+                    str(client1.pk): [True, True],
+                    str(client2.pk): [True, False],
+                },
+                "sites": {
+                    str(failing_site.pk): [True, False],
+                    str(maintenance_site.pk): [False, True],
+                    str(overdue_site.pk): [True, False],
+                    str(ok_site.pk): [False, False],
+                },
+            },
+        )
+        self.assertEqual(redis_client.set.call_args.args[0], CLIENT_TREE_CACHE_KEY)
+
+    @patch("clients.models.redis_client")
+    def test_get_tree_cached(self, redis_client):
+        import json
+
+        site = baker.make("clients.Site")
+        baker.make("clients.Site", client=site.client, _quantity=5)
+        redis_client.get.return_value = json.dumps(
+            {
+                "clients": {str(site.client.pk): [True, False]},
+                "sites": {str(site.pk): [True, False]},
+            }
+        )
+
+        # one query for clients and one for their sites, no matter how many
+        with self.assertNumQueries(2):
+            r = self.client.get("/clients/tree/", format="json")
+
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.data[0]["failing_checks"])  # type: ignore
+        self.assertFalse(r.data[0]["maintenance_mode"])  # type: ignore
+        sites = {i["id"]: i for i in r.data[0]["sites"]}  # type: ignore
+        self.assertTrue(sites[site.pk]["failing_checks"])
+        self.assertEqual(len([i for i in sites.values() if i["failing_checks"]]), 1)
+
+    @patch("clients.signals.clear_tree_cache")
+    def test_tree_cache_invalidation(self, clear_tree_cache):
+        agent = baker.make_recipe("agents.online_agent")
+        check = baker.make_recipe("checks.ping_check", agent=agent, status="passing")
+        clear_tree_cache.reset_mock()
+
+        # saving without changing anything the tree shows
+        check.save()
+        agent.last_seen = agent.last_seen
+        agent.save(update_fields=["last_seen"])
+        clear_tree_cache.assert_not_called()
+
+        check.status = "failing"
+        check.save(update_fields=["status"])
+        clear_tree_cache.assert_called_once()
+
+        clear_tree_cache.reset_mock()
+        agent = Agent.objects.only("pk", "maintenance_mode").get(pk=agent.pk)
+        agent.maintenance_mode = True
+        agent.save(update_fields=["maintenance_mode"])
+        clear_tree_cache.assert_called_once()
+
+        clear_tree_cache.reset_mock()
+        agent.site = baker.make("clients.Site")
+        agent.save(update_fields=["site"])
+        clear_tree_cache.assert_called()
+
+        clear_tree_cache.reset_mock()
+        check.delete()
+        clear_tree_cache.assert_called_once()
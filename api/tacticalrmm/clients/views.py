@@ -15,7 +15,14 @@ from agents.models import Agent
 from core.models import CoreSettings
 from tacticalrmm.utils import notify_error
 
-from .models import Client, ClientCustomField, Deployment, Site, SiteCustomField
+from .models import (
+    Client,
+    ClientCustomField,
+    Deployment,
+    Site,
+    SiteCustomField,
+    get_tree_rollups,
+)
 from .serializers import (
     ClientCustomFieldSerializer,
     ClientSerializer,
@@ -111,7 +118,7 @@ class GetUpdateClient(APIView):
 
 class DeleteClient(APIView):
     def delete(self, request, pk, sitepk):
-        from automation.tasks import generate_all_agent_checks_task
+        from automation.models import Policy
 
         client = get_object_or_404(Client, pk=pk)
         agents = Agent.objects.filter(site__client=client)
@@ -124,8 +131,8 @@ class DeleteClient(APIView):
         site = get_object_or_404(Site, pk=sitepk)
         agents.update(site=site)
 
-        generate_all_agent_checks_task.delay("workstation", create_tasks=True)
-        generate_all_agent_checks_task.delay("server", create_tasks=True)
+        # the moved agents can have other policies in their new site
+        Policy.queue_regeneration("site", [site.pk])
 
         client.delete()
         return Response(f"{client.name} was deleted!")
@@ -133,8 +140,12 @@ class DeleteClient(APIView):
 
 class GetClientTree(APIView):
     def get(self, request):
-        clients = Client.objects.all()
-        return Response(ClientTreeSerializer(clients, many=True).data)
+        clients = Client.objects.prefetch_related("sites")
+        return Response(
+            ClientTreeSerializer(
+                clients, many=True, context={"rollups": get_tree_rollups()}
+            ).data
+        )
 
 
 class GetAddSites(APIView):
@@ -207,7 +218,7 @@ class GetUpdateSite(APIView):
 
 class DeleteSite(APIView):
     def delete(self, request, pk, sitepk):
-        from automation.tasks import generate_all_agent_checks_task
+        from automation.models import Policy
 
         site = get_object_or_404(Site, pk=pk)
         if site.client.sites.count() == 1:
@@ -224,8 +235,8 @@ class DeleteSite(APIView):
 
         agents.update(site=agent_site)
 
-        generate_all_agent_checks_task.delay("workstation", create_tasks=True)
-        generate_all_agent_checks_task.delay("server", create_tasks=True)
+        # the moved agents can have other policies in their new site
+        Policy.queue_regeneration("site", [agent_site.pk])
 
         site.delete()
         return Response(f"{site.name} was deleted!")
@@ -1,10 +1,12 @@
-import asyncio
+import json
 
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from django.contrib.auth.models import AnonymousUser
 
-from agents.models import Agent
+from tacticalrmm.redis_client import redis_client
+
+from .tasks import DASH_INFO_GROUP, DASH_INFO_KEY, get_dashboard_info
 
 
 class DashInfo(AsyncJsonWebsocketConsumer):
@@ -14,66 +16,57 @@ class DashInfo(AsyncJsonWebsocketConsumer):
 
         if isinstance(self.user, AnonymousUser):
             await self.close()
+            return
 
+        await self.channel_layer.group_add(DASH_INFO_GROUP, self.channel_name)
         await self.accept()
-        self.connected = True
-        self.dash_info = asyncio.create_task(self.send_dash_info())
+        await self.send_json(await self.get_dashboard_info())
 
     async def disconnect(self, close_code):
 
         try:
-            self.dash_info.cancel()
+            await self.channel_layer.group_discard(DASH_INFO_GROUP, self.channel_name)
         except:
             pass
 
-        self.connected = False
-        await self.close()
-
     async def receive(self, json_data=None):
         pass
 
     @database_sync_to_async
     def get_dashboard_info(self):
-        server_offline_count = len(
-            [
-                agent
-                for agent in Agent.objects.filter(monitoring_type="server").only(
-                    "pk",
-                    "last_seen",
-                    "overdue_time",
-                    "offline_time",
-                )
-                if not agent.status == "online"
-            ]
-        )
-
-        workstation_offline_count = len(
-            [
-                agent
-                for agent in Agent.objects.filter(monitoring_type="workstation").only(
-                    "pk",
-                    "last_seen",
-                    "overdue_time",
-                    "offline_time",
-                )
-                if not agent.status == "online"
-            ]
-        )
-
-        ret = {
-            "total_server_offline_count": server_offline_count,
-            "total_workstation_offline_count": workstation_offline_count,
-            "total_server_count": Agent.objects.filter(
-                monitoring_type="server"
-            ).count(),
-            "total_workstation_count": Agent.objects.filter(
-                monitoring_type="workstation"
-            ).count(),
-        }
-        return ret
-
-    async def send_dash_info(self):
-        while self.connected:
-            c = await self.get_dashboard_info()
-            await self.send_json(c)
-            await asyncio.sleep(30)
+        # last snapshot from dashboard_info_task, only computed here until it has run
+        cached = redis_client.get(DASH_INFO_KEY)
+        if cached:
+            return json.loads(cached)
+
+        return get_dashboard_info()
+
+    async def dashinfo_update(self, event):
+        await self.send_json(event["data"])
+
+
+class BulkJobProgress(AsyncJsonWebsocketConsumer):
+    async def connect(self):
+
+        self.user = self.scope["user"]
+
+        if isinstance(self.user, AnonymousUser):
+            await self.close()
+            return
+
+        self.group_name = f"bulkjob_{self.scope['url_route']['kwargs']['pk']}"
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+
+        try:
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        except:
+            pass
+
+    async def receive(self, json_data=None):
+        pass
+
+    async def bulkjob_progress(self, event):
+        await self.send_json(event["data"])
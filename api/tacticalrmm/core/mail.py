@@ -0,0 +1,138 @@
+"""
+Outgoing email. Queued emails to the same recipients are sent as one digest,
+reusing one authenticated SMTP session per worker process.
+"""
+
+from __future__ import annotations
+
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+from typing import TYPE_CHECKING, Optional
+
+from django.conf import settings
+from loguru import logger
+
+from tacticalrmm.redis_client import redis_client
+
+if TYPE_CHECKING:
+    from core.models import CoreSettings, Notification
+
+logger.configure(**settings.LOG_CONFIG)
+
+# emails sent in a minute, used for the rate limit
+EMAIL_SENT_KEY = "email_sent:{}"
+
+
+def build_message(
+    from_address: str, recipients: list[str], subject: str, body: str
+) -> EmailMessage:
+    msg = EmailMessage()
+    msg["Subject"] = subject
+    msg["From"] = from_address
+    msg["To"] = ", ".join(recipients)
+    msg.set_content(body)
+    return msg
+
+
+class SMTPPool:
+    """Keeps an authenticated SMTP session open between sends"""
+
+    def __init__(self, idle_timeout: int = 60) -> None:
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._key: Optional[tuple] = None
+        self._server: Optional[smtplib.SMTP] = None
+        self._last_used = 0.0
+
+    @staticmethod
+    def _session_key(core: CoreSettings) -> tuple:
+        return (
+            core.smtp_host,
+            core.smtp_port,
+            core.smtp_requires_auth,
+            core.smtp_host_user,
+            core.smtp_host_password,
+        )
+
+    @staticmethod
+    def _connect(core: CoreSettings) -> smtplib.SMTP:
+        server = smtplib.SMTP(core.smtp_host, core.smtp_port, timeout=20)
+        if core.smtp_requires_auth:
+            server.ehlo()
+            server.starttls()
+            server.login(core.smtp_host_user, core.smtp_host_password)
+
+        return server
+
+    def _close(self) -> None:
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except smtplib.SMTPException:
+                pass
+
+        self._key = None
+        self._server = None
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+
+    def _session(self, core: CoreSettings) -> smtplib.SMTP:
+        key = self._session_key(core)
+        idle = time.monotonic() - self._last_used
+        if self._server is None or self._key != key or idle > self.idle_timeout:
+            self._close()
+            self._server = self._connect(core)
+            self._key = key
+
+        return self._server
+
+    def send(self, core: CoreSettings, messages: list[EmailMessage]) -> None:
+        with self._lock:
+            try:
+                for msg in messages:
+                    try:
+                        self._session(core).send_message(msg)
+                    except smtplib.SMTPServerDisconnected:
+                        # the server closed the session, retry once on a new one
+                        self._close()
+                        self._session(core).send_message(msg)
+                    self._last_used = time.monotonic()
+            except Exception:
+                self._close()
+                raise
+
+
+# one session per worker process
+smtp_pool = SMTPPool()
+
+
+def digest_message(notifications: list[Notification]) -> EmailMessage:
+    """One email for the queued notifications of a digest"""
+    first = notifications[0]
+    if len(notifications) == 1:
+        return build_message(first.sender, first.recipients, first.subject, first.body)
+
+    return build_message(
+        first.sender,
+        first.recipients,
+        f"{len(notifications)} alerts: {first.subject}",
+        "\n\n".join(f"{i.subject}\n{i.body}" for i in notifications),
+    )
+
+
+def email_allowance() -> int:
+    """How many more emails the rate limit allows this minute"""
+    sent = redis_client.get(EMAIL_SENT_KEY.format(int(time.time() // 60)))
+    return settings.EMAIL_RATE_LIMIT - int(sent or 0)
+
+
+def count_sent_emails(count: int) -> None:
+    key = EMAIL_SENT_KEY.format(int(time.time() // 60))
+    pipe = redis_client.pipeline()
+    pipe.incrby(key, count)
+    pipe.expire(key, 120)
+    pipe.execute()
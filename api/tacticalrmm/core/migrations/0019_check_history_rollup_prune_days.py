@@ -0,0 +1,23 @@
+# Generated by Django 3.2 on 2026-10-17 01:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_auto_20210329_1709'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coresettings',
+            name='check_history_daily_prune_days',
+            field=models.PositiveIntegerField(default=365),
+        ),
+        migrations.AddField(
+            model_name='coresettings',
+            name='check_history_hourly_prune_days',
+            field=models.PositiveIntegerField(default=90),
+        ),
+    ]
@@ -1,13 +1,20 @@
-import smtplib
-from email.message import EmailMessage
+from __future__ import annotations
+
+import datetime as dt
+import hashlib
+import json
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 import pytz
 from django.conf import settings
 from django.contrib.postgres.fields import ArrayField
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone as djangotime
 from loguru import logger
-from twilio.rest import Client as TwClient
 
 from logs.models import BaseAuditModel
 
@@ -51,6 +58,9 @@ class CoreSettings(BaseAuditModel):
     )
     # removes check history older than days
     check_history_prune_days = models.PositiveIntegerField(default=30)
+    # removes hourly and daily check history rollups older than days
+    check_history_hourly_prune_days = models.PositiveIntegerField(default=90)
+    check_history_daily_prune_days = models.PositiveIntegerField(default=365)
     mesh_token = models.CharField(max_length=255, null=True, blank=True, default="")
     mesh_username = models.CharField(max_length=255, null=True, blank=True, default="")
     mesh_site = models.CharField(max_length=255, null=True, blank=True, default="")
@@ -79,7 +89,6 @@ class CoreSettings(BaseAuditModel):
 
     def save(self, *args, **kwargs):
         from alerts.tasks import cache_agents_alert_template
-        from automation.tasks import generate_all_agent_checks_task
 
         if not self.pk and CoreSettings.objects.exists():
             raise ValidationError("There can only be one CoreSettings instance")
@@ -96,16 +105,6 @@ class CoreSettings(BaseAuditModel):
         old_settings = type(self).objects.get(pk=self.pk) if self.pk else None
         super(BaseAuditModel, self).save(*args, **kwargs)
 
-        # check if server polcies have changed and initiate task to reapply policies if so
-        if old_settings and old_settings.server_policy != self.server_policy:
-            generate_all_agent_checks_task.delay(mon_type="server", create_tasks=True)
-
-        # check if workstation polcies have changed and initiate task to reapply policies if so
-        if old_settings and old_settings.workstation_policy != self.workstation_policy:
-            generate_all_agent_checks_task.delay(
-                mon_type="workstation", create_tasks=True
-            )
-
         if old_settings and old_settings.alert_template != self.alert_template:
             cache_agents_alert_template.delay()
 
@@ -124,36 +123,36 @@ class CoreSettings(BaseAuditModel):
         )
 
     @property
-    def email_is_configured(self):
+    def smtp_is_configured(self):
         # smtp with username/password authentication
-        if (
-            self.smtp_requires_auth
-            and self.email_alert_recipients
-            and self.smtp_from_email
-            and self.smtp_host
-            and self.smtp_host_user
-            and self.smtp_host_password
-            and self.smtp_port
-        ):
-            return True
+        if self.smtp_requires_auth:
+            return bool(
+                self.smtp_host
+                and self.smtp_host_user
+                and self.smtp_host_password
+                and self.smtp_port
+            )
         # smtp relay
-        elif (
-            not self.smtp_requires_auth
-            and self.email_alert_recipients
-            and self.smtp_from_email
-            and self.smtp_host
-            and self.smtp_port
-        ):
-            return True
+        return bool(self.smtp_host and self.smtp_port)
 
-        return False
+    @property
+    def email_is_configured(self):
+        return bool(
+            self.email_alert_recipients
+            and self.smtp_from_email
+            and self.smtp_is_configured
+        )
 
-    def send_mail(self, subject, body, alert_template=None, test=False):
-
-        if not alert_template and not self.email_is_configured:
-            if test:
-                return "Missing required fields (need at least 1 recipient)"
-            return False
+    def send_mail(
+        self,
+        subject,
+        body,
+        alert_template=None,
+        test=False,
+        recipients=None,
+        idempotency_key=None,
+    ):
+        from .mail import build_message, smtp_pool
 
         # override email from if alert_template is passed and is set
         if alert_template and alert_template.email_from:
@@ -161,54 +160,60 @@ class CoreSettings(BaseAuditModel):
         else:
             from_address = self.smtp_from_email
 
-        # override email recipients if alert_template is passed and is set
-        if alert_template and alert_template.email_recipients:
-            email_recipients = ", ".join(alert_template.email_recipients)
+        # override email recipients if passed or set on the alert_template
+        if recipients:
+            email_recipients = recipients
+        elif alert_template and alert_template.email_recipients:
+            email_recipients = alert_template.email_recipients
         else:
-            email_recipients = ", ".join(self.email_alert_recipients)
+            email_recipients = self.email_alert_recipients
 
-        try:
-            msg = EmailMessage()
-            msg["Subject"] = subject
-            msg["From"] = from_address
-            msg["To"] = email_recipients
-            msg.set_content(body)
-
-            with smtplib.SMTP(self.smtp_host, self.smtp_port, timeout=20) as server:
-                if self.smtp_requires_auth:
-                    server.ehlo()
-                    server.starttls()
-                    server.login(self.smtp_host_user, self.smtp_host_password)
-                    server.send_message(msg)
-                    server.quit()
-                else:
-                    # smtp relay. no auth required
-                    server.send_message(msg)
-                    server.quit()
+        # the server has to be configured even when the recipients are passed
+        if not (email_recipients and from_address and self.smtp_is_configured):
+            if test:
+                return "Missing required fields (need at least 1 recipient)"
+            return False
 
+        # test emails are sent right away so errors can be shown
+        if not test:
+            Notification.queue(
+                "email",
+                from_address,
+                [email_recipients],
+                body,
+                subject=subject,
+                idempotency_key=idempotency_key,
+            )
+            return True
+
+        try:
+            smtp_pool.send(
+                self, [build_message(from_address, email_recipients, subject, body)]
+            )
         except Exception as e:
             logger.error(f"Sending email failed with error: {e}")
-            if test:
-                return str(e)
+            return str(e)
         else:
             return True
 
-    def send_sms(self, body, alert_template=None):
+    def send_sms(self, body, alert_template=None, idempotency_key=None):
         if not alert_template and not self.sms_is_configured:
             return
 
-        # override email recipients if alert_template is passed and is set
+        # override text recipients if alert_template is passed and is set
         if alert_template and alert_template.text_recipients:
-            text_recipients = alert_template.email_recipients
+            text_recipients = alert_template.text_recipients
         else:
             text_recipients = self.sms_alert_recipients
 
-        tw_client = TwClient(self.twilio_account_sid, self.twilio_auth_token)
-        for num in text_recipients:
-            try:
-                tw_client.messages.create(body=body, to=num, from_=self.twilio_number)
-            except Exception as e:
-                logger.error(f"SMS failed to send: {e}")
+        # one message per number so a failing number is retried on its own
+        Notification.queue(
+            "sms",
+            self.twilio_number,
+            [[num] for num in text_recipients],
+            body,
+            idempotency_key=idempotency_key,
+        )
 
     @staticmethod
     def serialize(core):
@@ -266,3 +271,236 @@ class CustomField(models.Model):
             return self.default_value_bool
         else:
             return self.default_value_string
+
+
+NOTIFICATION_CHANNEL_CHOICES = [
+    ("email", "Email"),
+    ("sms", "SMS"),
+]
+
+NOTIFICATION_STATUS_CHOICES = [
+    ("pending", "Pending"),
+    ("sending", "Sending"),
+    ("sent", "Sent"),
+    ("dead", "Dead"),
+]
+
+
+class Notification(models.Model):
+    """
+    Outbox of emails and text messages. Rows are added in the transaction that
+    triggers the notification and send_notifications_task delivers them.
+    """
+
+    channel = models.CharField(max_length=10, choices=NOTIFICATION_CHANNEL_CHOICES)
+    status = models.CharField(
+        max_length=10, choices=NOTIFICATION_STATUS_CHOICES, default="pending"
+    )
+    idempotency_key = models.CharField(max_length=255, unique=True)
+    # emails with the same digest are sent together
+    digest = models.CharField(max_length=40, blank=True)
+    sender = models.CharField(max_length=255, null=True, blank=True)
+    recipients = ArrayField(models.CharField(max_length=255))
+    subject = models.TextField(blank=True)
+    body = models.TextField()
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    next_attempt_at = models.DateTimeField(default=djangotime.now)
+    # a row that is still sending after this was claimed by a worker that died
+    locked_until = models.DateTimeField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["next_attempt_at"],
+                condition=models.Q(status__in=["pending", "sending"]),
+                name="core_notification_due_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.channel} to {', '.join(self.recipients)}"
+
+    @classmethod
+    def queue(
+        cls,
+        channel: str,
+        sender: Optional[str],
+        recipients: list[list[str]],
+        body: str,
+        subject: str = "",
+        idempotency_key: Optional[str] = None,
+    ) -> None:
+        """
+        Adds one notification per recipient list. Rows with an idempotency key that
+        was already queued are skipped, so a retried task doesn't send twice.
+        """
+        key = idempotency_key or uuid.uuid4().hex
+        delay = settings.EMAIL_DIGEST_WINDOW if channel == "email" else 0
+        cls.objects.bulk_create(
+            [
+                cls(
+                    channel=channel,
+                    idempotency_key=f"{key}:{':'.join(to)}"
+                    if len(recipients) > 1
+                    else key,
+                    digest=hashlib.sha1(
+                        json.dumps([sender, sorted(to)]).encode()
+                    ).hexdigest()
+                    if channel == "email"
+                    else "",
+                    sender=sender,
+                    recipients=to,
+                    subject=subject,
+                    body=body,
+                    next_attempt_at=djangotime.now() + dt.timedelta(seconds=delay),
+                )
+                for to in recipients
+            ],
+            ignore_conflicts=True,
+        )
+
+        from .tasks import send_notifications_task
+
+        transaction.on_commit(
+            lambda: send_notifications_task.apply_async(countdown=delay)
+        )
+
+    @classmethod
+    def claim(cls) -> list[Notification]:
+        """
+        Marks the due notifications as sending and returns them. Emails are
+        claimed per digest, and only as many digests as the rate limit allows this
+        minute.
+        """
+        from .mail import email_allowance
+
+        now = djangotime.now()
+        due = cls.objects.filter(
+            models.Q(status="pending")
+            | models.Q(status="sending", locked_until__lt=now),
+            next_attempt_at__lte=now,
+        )
+
+        with transaction.atomic():
+            sms = list(
+                due.filter(channel="sms")
+                .select_for_update(skip_locked=True)
+                .order_by("pk")[: settings.NOTIFICATION_BATCH]
+            )
+
+            digests = []
+            allowance = email_allowance()
+            if allowance > 0:
+                digests = list(
+                    due.filter(channel="email")
+                    .values("digest")
+                    .annotate(first=models.Min("next_attempt_at"))
+                    .order_by("first")
+                    .values_list("digest", flat=True)[:allowance]
+                )
+            emails = list(
+                due.filter(channel="email", digest__in=digests)
+                .select_for_update(skip_locked=True)
+                .order_by("pk")
+            )
+
+            claimed = sms + emails
+            cls.objects.filter(pk__in=[i.pk for i in claimed]).update(
+                status="sending",
+                locked_until=now
+                + dt.timedelta(seconds=settings.NOTIFICATION_SEND_TIMEOUT),
+            )
+
+        return claimed
+
+    @classmethod
+    def send_pending(cls) -> int:
+        """
+        Sends the due notifications, text messages concurrently and emails as one
+        digest per recipient list over a single SMTP session. Failed notifications
+        are retried with exponential backoff and given up on after
+        NOTIFICATION_MAX_ATTEMPTS. Returns the number of notifications sent.
+        """
+        from .mail import count_sent_emails, digest_message, smtp_pool
+        from .sms import get_sms_backend
+
+        claimed = cls.claim()
+        if not claimed:
+            return 0
+
+        core = CoreSettings.objects.first()
+        sent: list[Notification] = []
+        failed: list[tuple[Notification, str]] = []
+
+        def send_sms(notification: Notification) -> None:
+            get_sms_backend().send(
+                core, notification.sender, notification.recipients[0], notification.body
+            )
+
+        def send_emails(digests: list[list[Notification]]) -> None:
+            count_sent_emails(len(digests))
+            for digest in digests:
+                try:
+                    smtp_pool.send(core, [digest_message(digest)])
+                except Exception as e:
+                    failed.extend((i, str(e)) for i in digest)
+                else:
+                    sent.extend(digest)
+
+        digests: dict[str, list[Notification]] = defaultdict(list)
+        for notification in claimed:
+            if notification.channel == "email":
+                digests[notification.digest].append(notification)
+
+        with ThreadPoolExecutor(max_workers=settings.NOTIFICATION_CONCURRENCY) as pool:
+            futures = {
+                pool.submit(send_sms, i): i for i in claimed if i.channel == "sms"
+            }
+            if digests:
+                pool.submit(send_emails, list(digests.values())).result()
+
+            for future, notification in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    failed.append((notification, str(e)))
+                else:
+                    sent.append(notification)
+
+        now = djangotime.now()
+        for notification in sent:
+            notification.status = "sent"
+            notification.sent_at = now
+            notification.locked_until = None
+
+        for notification, error in failed:
+            notification.attempts += 1
+            notification.last_error = error
+            notification.locked_until = None
+            if notification.attempts >= settings.NOTIFICATION_MAX_ATTEMPTS:
+                notification.status = "dead"
+                logger.error(
+                    f"Giving up on {notification} after {notification.attempts} attempts: {error}"
+                )
+            else:
+                notification.status = "pending"
+                notification.next_attempt_at = now + dt.timedelta(
+                    seconds=settings.NOTIFICATION_RETRY_BACKOFF
+                    * 2 ** (notification.attempts - 1)
+                )
+
+        cls.objects.bulk_update(
+            [*sent, *(i for i, _ in failed)],
+            [
+                "status",
+                "sent_at",
+                "attempts",
+                "last_error",
+                "next_attempt_at",
+                "locked_until",
+            ],
+        )
+        return len(sent)
@@ -0,0 +1,56 @@
+"""
+Text message backends. SMS_BACKEND selects the one used by the notification
+outbox, LocMemBackend keeps the messages in memory for tests.
+"""
+
+from __future__ import annotations
+
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client as TwClient
+
+if TYPE_CHECKING:
+    from core.models import CoreSettings
+
+
+class BaseSMSBackend:
+    def send(self, core: CoreSettings, sender: str, to: str, body: str) -> None:
+        raise NotImplementedError
+
+
+class TwilioBackend(BaseSMSBackend):
+    # a slow api call fails and is retried instead of holding up the other messages
+    timeout = 20
+
+    @lru_cache(maxsize=8)
+    def client(self, account_sid: str, auth_token: str) -> TwClient:
+        return TwClient(
+            account_sid,
+            auth_token,
+            http_client=TwilioHttpClient(timeout=self.timeout),
+        )
+
+    def send(self, core: CoreSettings, sender: str, to: str, body: str) -> None:
+        self.client(core.twilio_account_sid, core.twilio_auth_token).messages.create(
+            body=body, to=to, from_=sender
+        )
+
+
+class LocMemBackend(BaseSMSBackend):
+    outbox: list[dict[str, str]] = []
+
+    def send(self, core: CoreSettings, sender: str, to: str, body: str) -> None:
+        self.outbox.append({"from": sender, "to": to, "body": body})
+
+
+@lru_cache
+def load_sms_backend(path: str) -> BaseSMSBackend:
+    return import_string(path)()
+
+
+def get_sms_backend() -> BaseSMSBackend:
+    return load_sms_backend(settings.SMS_BACKEND)
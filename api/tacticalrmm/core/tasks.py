@@ -1,16 +1,26 @@
+import json
+
 import pytz
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from django.conf import settings
+from django.db.models import Count, Q
 from django.utils import timezone as djangotime
 from loguru import logger
 
+from agents.models import Agent
 from autotasks.models import AutomatedTask
 from autotasks.tasks import delete_win_task_schedule
 from checks.tasks import prune_check_history
-from core.models import CoreSettings
+from core.models import CoreSettings, Notification
 from tacticalrmm.celery import app
+from tacticalrmm.redis_client import redis_client
 
 logger.configure(**settings.LOG_CONFIG)
 
+DASH_INFO_GROUP = "dashinfo"
+DASH_INFO_KEY = "dashinfo"
+
 
 @app.task
 def core_maintenance_tasks():
@@ -28,6 +38,62 @@ def core_maintenance_tasks():
         if now > task_time_utc:
             delete_win_task_schedule.delay(task.pk)
 
+    # remove sent notifications from the outbox
+    Notification.objects.filter(
+        status="sent", sent_at__lt=djangotime.now() - djangotime.timedelta(days=7)
+    ).delete()
+
     # remove old CheckHistory data
-    older_than = CoreSettings.objects.first().check_history_prune_days
-    prune_check_history.delay(older_than)
+    core = CoreSettings.objects.first()
+    prune_check_history.delay(
+        core.check_history_prune_days,
+        core.check_history_hourly_prune_days,
+        core.check_history_daily_prune_days,
+    )
+
+
+def get_dashboard_info() -> dict[str, int]:
+    not_online = ~Agent.objects.online_q()
+    return Agent.objects.aggregate(
+        total_server_offline_count=Count(
+            "pk", filter=Q(monitoring_type="server") & not_online
+        ),
+        total_workstation_offline_count=Count(
+            "pk", filter=Q(monitoring_type="workstation") & not_online
+        ),
+        total_server_count=Count("pk", filter=Q(monitoring_type="server")),
+        total_workstation_count=Count("pk", filter=Q(monitoring_type="workstation")),
+    )
+
+
+@app.task
+def dashboard_info_task() -> None:
+    # single producer for every connected dashboard, only changed counters are sent
+    info = get_dashboard_info()
+
+    cached = redis_client.get(DASH_INFO_KEY)
+    old = json.loads(cached) if cached else {}
+
+    # the snapshot expires so a stopped beat never leaves stale counters behind
+    redis_client.set(DASH_INFO_KEY, json.dumps(info), ex=120)
+
+    changed = {k: v for k, v in info.items() if old.get(k) != v}
+    if not changed:
+        return
+
+    channel_layer = get_channel_layer()
+    if channel_layer is not None:
+        async_to_sync(channel_layer.group_send)(
+            DASH_INFO_GROUP, {"type": "dashinfo.update", "data": changed}
+        )
+
+
+@app.task
+def send_notifications_task() -> str:
+    from .models import Notification
+
+    # keep going while full batches are being sent
+    while Notification.send_pending() >= settings.NOTIFICATION_BATCH:
+        pass
+
+    return "ok"
@@ -1,15 +1,47 @@
+import json
+import smtplib
+import socket
+from email import message_from_bytes, policy
+from unittest import skipIf
 from unittest.mock import patch
+from uuid import uuid4
 
 from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
 from channels.testing import WebsocketCommunicator
+from django.test import override_settings
 from model_bakery import baker
 
 from tacticalrmm.test import TacticalTestCase
 
 from .consumers import DashInfo
-from .models import CoreSettings, CustomField
+from .models import CoreSettings, CustomField, Notification
 from .serializers import CustomFieldSerializer
-from .tasks import core_maintenance_tasks
+from .tasks import (
+    core_maintenance_tasks,
+    dashboard_info_task,
+    send_notifications_task,
+)
+
+try:
+    from aiosmtpd.controller import Controller
+except ImportError:  # installed from requirements-test.txt
+    Controller = None
+
+
+class SMTPRecorder:
+    """aiosmtpd handler that keeps the received messages"""
+
+    def __init__(self):
+        self.messages = []
+        self.sessions = set()
+
+    async def handle_DATA(self, server, session, envelope):
+        self.sessions.add(id(session))
+        self.messages.append(
+            message_from_bytes(envelope.content, policy=policy.default)
+        )
+        return "250 Message accepted for delivery"
 
 
 class TestConsumers(TacticalTestCase):
@@ -24,7 +56,16 @@ class TestConsumers(TacticalTestCase):
         token = Token.objects.create(user=self.john)
         return token.key
 
-    async def test_dash_info(self):
+    @patch("core.consumers.redis_client")
+    async def test_dash_info(self, redis_client):
+        snapshot = {
+            "total_server_offline_count": 1,
+            "total_workstation_offline_count": 2,
+            "total_server_count": 3,
+            "total_workstation_count": 4,
+        }
+        redis_client.get.return_value = json.dumps(snapshot)
+
         key = self.get_token()
         communicator = WebsocketCommunicator(
             DashInfo.as_asgi(), f"/ws/dashinfo/?access_token={key}"
@@ -32,6 +73,16 @@ class TestConsumers(TacticalTestCase):
         communicator.scope["user"] = self.john
         connected, _ = await communicator.connect()
         assert connected
+
+        # new connections get the cached snapshot right away
+        self.assertEqual(await communicator.receive_json_from(), snapshot)
+
+        await get_channel_layer().group_send(
+            "dashinfo", {"type": "dashinfo.update", "data": {"total_server_count": 5}}
+        )
+        self.assertEqual(
+            await communicator.receive_json_from(), {"total_server_count": 5}
+        )
         await communicator.disconnect()
 
 
@@ -44,6 +95,255 @@ class TestCoreTasks(TacticalTestCase):
         task = core_maintenance_tasks.s().apply()
         self.assertEqual(task.state, "SUCCESS")
 
+    @patch("core.tasks.async_to_sync")
+    @patch("core.tasks.redis_client")
+    def test_dashboard_info_task(self, redis_client, async_to_sync):
+        from django.utils import timezone as djangotime
+
+        baker.make_recipe(
+            "agents.agent",
+            monitoring_type="server",
+            last_seen=djangotime.now(),
+            _quantity=3,
+        )
+        baker.make_recipe("agents.agent", monitoring_type="server", last_seen=None)
+        baker.make_recipe(
+            "agents.agent",
+            monitoring_type="workstation",
+            last_seen=djangotime.now() - djangotime.timedelta(minutes=40),
+            _quantity=2,
+        )
+        info = {
+            "total_server_offline_count": 1,
+            "total_workstation_offline_count": 2,
+            "total_server_count": 4,
+            "total_workstation_count": 2,
+        }
+
+        # nothing cached yet, full snapshot is broadcast
+        redis_client.get.return_value = None
+        dashboard_info_task()
+        redis_client.set.assert_called_with("dashinfo", json.dumps(info), ex=120)
+        async_to_sync.return_value.assert_called_with(
+            "dashinfo", {"type": "dashinfo.update", "data": info}
+        )
+
+        # only the changed counter is sent
+        async_to_sync.reset_mock()
+        redis_client.get.return_value = json.dumps({**info, "total_server_count": 10})
+        dashboard_info_task()
+        async_to_sync.return_value.assert_called_with(
+            "dashinfo", {"type": "dashinfo.update", "data": {"total_server_count": 4}}
+        )
+
+        # nothing changed, nothing sent
+        async_to_sync.reset_mock()
+        redis_client.get.return_value = json.dumps(info)
+        dashboard_info_task()
+        async_to_sync.assert_not_called()
+
+    def setup_email(self):
+        core = CoreSettings.objects.first()
+        core.smtp_host = "smtp.example.com"
+        core.smtp_port = 587
+        core.smtp_requires_auth = True
+        core.smtp_host_user = "user"
+        core.smtp_host_password = "password"
+        core.smtp_from_email = "rmm@example.com"
+        core.email_alert_recipients = ["admin@example.com"]
+        core.save()
+        return core
+
+    @override_settings(EMAIL_DIGEST_WINDOW=0, EMAIL_RATE_LIMIT=2)
+    @patch("core.mail.time.time", return_value=1_000_000_020.0)
+    @patch("core.mail.EMAIL_SENT_KEY", f"email_sent_{uuid4()}:{{}}")
+    @patch("smtplib.SMTP")
+    def test_send_email_notifications(self, smtp, time):
+        from .mail import smtp_pool
+
+        self.addCleanup(smtp_pool.close)
+        core = self.setup_email()
+
+        # explicit recipients still need a configured server
+        core.smtp_host = ""
+        self.assertFalse(core.send_mail("Test", "ok", recipients=["tech@example.com"]))
+        self.assertFalse(Notification.objects.exists())
+        core.smtp_host = "smtp.example.com"
+
+        # emails are added to the outbox
+        for i in range(3):
+            self.assertTrue(core.send_mail(f"Alert {i}", f"Body {i}"))
+        core.send_mail("Results", "ok", recipients=["tech@example.com"])
+        core.send_mail("Other", "ok", recipients=["other@example.com"])
+        self.assertEqual(Notification.objects.filter(status="pending").count(), 5)
+        smtp.assert_not_called()
+
+        # emails to the same recipients are sent as one digest within the rate limit
+        send_notifications_task()
+        server = smtp.return_value
+        smtp.assert_called_once_with("smtp.example.com", 587, timeout=20)
+        server.login.assert_called_once_with("user", "password")
+        sent = {
+            i.args[0]["Subject"]: i.args[0] for i in server.send_message.call_args_list
+        }
+        self.assertEqual(set(sent), {"3 alerts: Alert 0", "Results"})
+        self.assertEqual(sent["3 alerts: Alert 0"]["To"], "admin@example.com")
+        self.assertIn("Alert 2\nBody 2", sent["3 alerts: Alert 0"].get_content())
+        self.assertEqual(Notification.objects.filter(status="sent").count(), 4)
+
+        # the rest is sent the next minute over the same session
+        time.return_value += 60
+        send_notifications_task()
+        smtp.assert_called_once()
+        self.assertEqual(server.send_message.call_args.args[0]["Subject"], "Other")
+        self.assertFalse(Notification.objects.exclude(status="sent").exists())
+
+        # a dropped session is reconnected
+        server.send_message.side_effect = [smtplib.SMTPServerDisconnected, None]
+        core.send_mail("Again", "ok")
+        send_notifications_task()
+        self.assertEqual(smtp.call_count, 2)
+        self.assertFalse(Notification.objects.exclude(status="sent").exists())
+
+        # queuing with the same idempotency key again is ignored
+        core.send_mail("Once", "ok", idempotency_key="alert:1")
+        core.send_mail("Once", "ok", idempotency_key="alert:1")
+        self.assertEqual(Notification.objects.filter(subject="Once").count(), 1)
+
+        # test emails are sent right away
+        server.send_message.side_effect = None
+        self.assertTrue(core.send_mail("Test", "Test", test=True))
+        self.assertEqual(server.send_message.call_args.args[0]["Subject"], "Test")
+        self.assertFalse(Notification.objects.filter(subject="Test").exists())
+
+        # messages of a digest that aren't due yet wait for a later run
+        from django.utils import timezone as djangotime
+
+        time.return_value += 60
+        core.send_mail("Later", "ok")
+        Notification.objects.filter(subject="Later").update(
+            next_attempt_at=djangotime.now() + djangotime.timedelta(hours=1)
+        )
+        core.send_mail("Now", "ok")
+        send_notifications_task()
+        self.assertEqual(Notification.objects.get(subject="Now").status, "sent")
+        self.assertEqual(Notification.objects.get(subject="Later").status, "pending")
+
+    @skipIf(Controller is None, "aiosmtpd is not installed")
+    @override_settings(EMAIL_DIGEST_WINDOW=0, EMAIL_RATE_LIMIT=2)
+    @patch("core.mail.time.time", return_value=1_000_000_020.0)
+    @patch("core.mail.EMAIL_SENT_KEY", f"email_sent_{uuid4()}:{{}}")
+    def test_send_email_notifications_smtp(self, time):
+        from .mail import smtp_pool
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+
+        handler = SMTPRecorder()
+        controller = Controller(handler, hostname="127.0.0.1", port=port)
+        controller.start()
+        self.addCleanup(controller.stop)
+        self.addCleanup(smtp_pool.close)
+
+        # smtp relay, the test server doesn't do starttls
+        core = self.setup_email()
+        core.smtp_host = "127.0.0.1"
+        core.smtp_port = port
+        core.smtp_requires_auth = False
+        core.save()
+
+        for i in range(3):
+            core.send_mail(f"Alert {i}", f"Body {i}")
+        core.send_mail("Results", "ok", recipients=["tech@example.com"])
+        core.send_mail("Other", "ok", recipients=["other@example.com"])
+
+        # one digest per recipient list, at most EMAIL_RATE_LIMIT a minute
+        send_notifications_task()
+        sent = {i["Subject"]: i for i in handler.messages}
+        self.assertEqual(set(sent), {"3 alerts: Alert 0", "Results"})
+        self.assertEqual(sent["3 alerts: Alert 0"]["To"], "admin@example.com")
+        self.assertIn("Alert 2\r\nBody 2", sent["3 alerts: Alert 0"].get_content())
+        self.assertEqual(sent["Results"]["To"], "tech@example.com")
+
+        # the rest goes out the next minute over the same session
+        time.return_value += 60
+        send_notifications_task()
+        self.assertEqual(len(handler.messages), 3)
+        self.assertEqual(handler.messages[-1]["Subject"], "Other")
+        self.assertEqual(len(handler.sessions), 1)
+        self.assertFalse(Notification.objects.exclude(status="sent").exists())
+
+    @override_settings(
+        SMS_BACKEND="core.sms.LocMemBackend",
+        NOTIFICATION_MAX_ATTEMPTS=2,
+        NOTIFICATION_RETRY_BACKOFF=30,
+    )
+    def test_send_sms_notifications(self):
+        from django.utils import timezone as djangotime
+
+        from .sms import LocMemBackend
+
+        LocMemBackend.outbox.clear()
+        core = CoreSettings.objects.first()
+        core.sms_alert_recipients = ["+1111", "+2222", "+3333"]
+        core.twilio_number = "+9999"
+        core.twilio_account_sid = "sid"
+        core.twilio_auth_token = "token"
+        core.save()
+
+        # one text per number
+        core.send_sms("Agent overdue")
+        send_notifications_task()
+        self.assertEqual(
+            sorted(i["to"] for i in LocMemBackend.outbox), ["+1111", "+2222", "+3333"]
+        )
+        self.assertEqual(LocMemBackend.outbox[0]["from"], "+9999")
+        self.assertEqual(Notification.objects.filter(status="sent").count(), 3)
+
+        # the alert template's text recipients replace the global ones
+        template = baker.make(
+            "alerts.AlertTemplate",
+            email_recipients=["admin@example.com"],
+            text_recipients=["+4444"],
+        )
+        core.send_sms("Template", alert_template=template)
+        send_notifications_task()
+        self.assertEqual(LocMemBackend.outbox[-1]["to"], "+4444")
+        self.assertEqual(Notification.objects.filter(body="Template").count(), 1)
+
+        # failed texts are retried with backoff, then dead lettered
+        with patch.object(LocMemBackend, "send", side_effect=Exception("unavailable")):
+            core.send_sms("Agent recovered")
+            send_notifications_task()
+            failed = Notification.objects.filter(body="Agent recovered")
+            self.assertEqual(failed.filter(status="pending", attempts=1).count(), 3)
+            self.assertGreater(failed[0].next_attempt_at, djangotime.now())
+            self.assertEqual(failed[0].last_error, "unavailable")
+
+            # not due yet
+            send_notifications_task()
+            self.assertEqual(failed.filter(attempts=1).count(), 3)
+
+            failed.update(next_attempt_at=djangotime.now())
+            send_notifications_task()
+            self.assertEqual(failed.filter(status="dead", attempts=2).count(), 3)
+
+        # a notification left sending by a worker that died is sent again
+        stuck = baker.make(
+            "core.Notification",
+            channel="sms",
+            status="sending",
+            recipients=["+1111"],
+            sender="+9999",
+            body="Stuck",
+            locked_until=djangotime.now() - djangotime.timedelta(seconds=1),
+        )
+        send_notifications_task()
+        stuck.refresh_from_db()
+        self.assertEqual(stuck.status, "sent")
+        self.assertEqual(LocMemBackend.outbox[-1]["body"], "Stuck")
+
     def test_dashboard_info(self):
         url = "/core/dashinfo/"
         r = self.client.get(url)
@@ -65,8 +365,8 @@ class TestCoreTasks(TacticalTestCase):
 
         self.check_not_authenticated("get", url)
 
-    @patch("automation.tasks.generate_all_agent_checks_task.delay")
-    def test_edit_coresettings(self, generate_all_agent_checks_task):
+    @patch("automation.models.Policy.queue_regeneration")
+    def test_edit_coresettings(self, queue_regeneration):
         url = "/core/editsettings/"
 
         # setup
@@ -83,7 +383,7 @@ class TestCoreTasks(TacticalTestCase):
         )
         self.assertEqual(CoreSettings.objects.first().mesh_token, data["mesh_token"])
 
-        generate_all_agent_checks_task.assert_not_called()
+        queue_regeneration.assert_not_called()
 
         # test adding policy
         data = {
@@ -97,9 +397,11 @@ class TestCoreTasks(TacticalTestCase):
             CoreSettings.objects.first().workstation_policy.id, policies[0].id  # type: ignore
         )
 
-        self.assertEqual(generate_all_agent_checks_task.call_count, 2)
+        queue_regeneration.assert_called_once_with(
+            "monitoring_type", ["server", "workstation"]
+        )
 
-        generate_all_agent_checks_task.reset_mock()
+        queue_regeneration.reset_mock()
 
         # test remove policy
         data = {
@@ -109,7 +411,7 @@ class TestCoreTasks(TacticalTestCase):
         self.assertEqual(r.status_code, 200)
         self.assertEqual(CoreSettings.objects.first().workstation_policy, None)
 
-        self.assertEqual(generate_all_agent_checks_task.call_count, 1)
+        queue_regeneration.assert_called_once_with("monitoring_type", ["workstation"])
 
         self.check_not_authenticated("patch", url)
 
@@ -1,12 +1,12 @@
-import asyncio
-
-from agents.models import Agent
+from agents.models import BulkJob
 from scripts.models import Script
 from tacticalrmm.celery import app
 
 
-@app.task
-def handle_bulk_command_task(agentpks, cmd, shell, timeout) -> None:
+# acks_late so that a job interrupted by a worker restart is redelivered and resumed
+@app.task(acks_late=True, reject_on_worker_lost=True)
+def handle_bulk_command_task(jobpk, cmd, shell, timeout) -> None:
+    job = BulkJob.objects.get(pk=jobpk)
     nats_data = {
         "func": "rawcmd",
         "timeout": timeout,
@@ -15,15 +15,15 @@ def handle_bulk_command_task(agentpks, cmd, shell, timeout) -> None:
             "shell": shell,
         },
     }
-    for agent in Agent.objects.filter(pk__in=agentpks):
-        asyncio.run(agent.nats_cmd(nats_data, wait=False))
+    job.run(nats_data, timeout=timeout + 2)
 
 
-@app.task
-def handle_bulk_script_task(scriptpk, agentpks, args, timeout) -> None:
+@app.task(acks_late=True, reject_on_worker_lost=True)
+def handle_bulk_script_task(jobpk, scriptpk, args, timeout) -> None:
+    job = BulkJob.objects.get(pk=jobpk)
     script = Script.objects.get(pk=scriptpk)
     nats_data = {
-        "func": "runscript",
+        "func": "runscriptfull",
         "timeout": timeout,
         "script_args": args,
         "payload": {
@@ -31,5 +31,4 @@ def handle_bulk_script_task(scriptpk, agentpks, args, timeout) -> None:
             "shell": script.shell,
         },
     }
-    for agent in Agent.objects.filter(pk__in=agentpks):
-        asyncio.run(agent.nats_cmd(nats_data, wait=False))
+    job.run(nats_data, timeout=timeout + 2)
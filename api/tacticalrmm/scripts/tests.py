@@ -2,6 +2,7 @@ from email.policy import default
 import json
 import os
 from pathlib import Path
+from unittest.mock import patch
 
 from django.conf import settings
 from django.core.files.uploadedfile import SimpleUploadedFile
@@ -260,3 +261,55 @@ class TestScriptViews(TacticalTestCase):
             for script in info:
                 fn: str = script["filename"]
                 self.assertTrue(" " not in fn)
+
+
+class TestScriptTasks(TacticalTestCase):
+    def setUp(self):
+        self.setup_coresettings()
+
+    @patch("agents.models.Agent.nats_cmd_many")
+    def test_handle_bulk_command_task(self, nats_cmd_many):
+        from agents.models import BulkJob
+
+        from .tasks import handle_bulk_command_task
+
+        nats_cmd_many.side_effect = lambda agent_ids, data, **kwargs: [
+            (agent_id, "ok") for agent_id in agent_ids
+        ]
+        agents = baker.make_recipe("agents.agent", _quantity=3)
+        job = BulkJob.create_job("command", "tactical", [i.pk for i in agents])
+        handle_bulk_command_task(job.pk, "gpupdate /force", "cmd", 30)
+
+        nats_cmd_many.assert_called_once()
+        data = nats_cmd_many.call_args.args[1]
+        self.assertEqual(data["func"], "rawcmd")
+        self.assertEqual(data["payload"]["command"], "gpupdate /force")
+        self.assertEqual(nats_cmd_many.call_args.kwargs["timeout"], 32)
+        self.assertEqual(job.results.filter(status="completed").count(), 3)
+
+    @patch("agents.models.Agent.nats_cmd_many")
+    def test_handle_bulk_script_task(self, nats_cmd_many):
+        from agents.models import BulkJob
+
+        from .tasks import handle_bulk_script_task
+
+        nats_cmd_many.side_effect = lambda agent_ids, data, **kwargs: [
+            (
+                agent_id,
+                {"stdout": "ok", "stderr": "", "retcode": 0, "execution_time": 1.2},
+            )
+            for agent_id in agent_ids
+        ]
+        script = baker.make_recipe("scripts.script")
+        agents = baker.make_recipe("agents.agent", _quantity=3)
+        job = BulkJob.create_job("script", "tactical", [i.pk for i in agents])
+        handle_bulk_script_task(job.pk, script.pk, [], 30)
+
+        nats_cmd_many.assert_called_once()
+        data = nats_cmd_many.call_args.args[1]
+        self.assertEqual(data["func"], "runscriptfull")
+        self.assertEqual(data["payload"]["code"], script.code)
+        result = job.results.first()
+        self.assertEqual(result.retcode, 0)
+        self.assertEqual(result.stdout, "ok")
+        self.assertEqual(result.execution_time, "1.2000")
@@ -55,9 +55,27 @@ def debug_task(self):
 def setup_periodic_tasks(sender, **kwargs):
 
     from agents.tasks import agent_outages_task
-    from alerts.tasks import unsnooze_alerts
-    from core.tasks import core_maintenance_tasks
+    from alerts.tasks import process_alert_events_task, unsnooze_alerts
+    from automation.tasks import regenerate_queued_policies_task
+    from checks.tasks import (
+        flush_check_state_task,
+        remediate_winsvc_task,
+        rollup_check_history_task,
+    )
+    from core.tasks import (
+        core_maintenance_tasks,
+        dashboard_info_task,
+        send_notifications_task,
+    )
 
     sender.add_periodic_task(60.0, agent_outages_task.s())
+    sender.add_periodic_task(60.0 * 60, agent_outages_task.s(full=True))
+    sender.add_periodic_task(30.0, dashboard_info_task.s())
     sender.add_periodic_task(60.0 * 30, core_maintenance_tasks.s())
     sender.add_periodic_task(60.0 * 60, unsnooze_alerts.s())
+    sender.add_periodic_task(60.0 * 10, rollup_check_history_task.s())
+    sender.add_periodic_task(60.0, flush_check_state_task.s())
+    sender.add_periodic_task(60.0, remediate_winsvc_task.s())
+    sender.add_periodic_task(60.0, process_alert_events_task.s())
+    sender.add_periodic_task(60.0, send_notifications_task.s())
+    sender.add_periodic_task(60.0, regenerate_queued_policies_task.s())
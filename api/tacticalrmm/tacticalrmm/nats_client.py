@@ -0,0 +1,217 @@
+import asyncio
+import concurrent.futures
+import os
+import queue
+import threading
+from typing import Any, Iterable, Iterator, Optional
+
+import msgpack
+from django.conf import settings
+from loguru import logger
+from nats.aio.client import Client as NATS
+from nats.aio.errors import ErrConnectionClosed, ErrNoServers, ErrTimeout
+
+logger.configure(**settings.LOG_CONFIG)
+
+# seconds the first connect may take before nats is reported down
+NATS_CONNECT_TIMEOUT = 8
+# seconds a publish may take, including the flush
+NATS_PUBLISH_TIMEOUT = 5
+
+
+class NatsManager:
+    """
+    Holds one long-lived, authenticated NATS connection per process.
+
+    The connection lives on a private event loop running in a daemon thread so that it
+    can be shared by sync django views, celery workers and channels consumers, no matter
+    which event loop (if any) the caller is running on.
+    Forked children (celery prefork, uwsgi workers) get their own loop and connection.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._nc: Optional[NATS] = None
+        self._connect_lock: Optional[asyncio.Lock] = None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._loop = asyncio.new_event_loop()
+                    self._nc = None
+                    self._connect_lock = None
+                    threading.Thread(
+                        target=self._loop.run_forever, name="nats-manager", daemon=True
+                    ).start()
+                    self._pid = os.getpid()
+
+        return self._loop  # type: ignore
+
+    async def _get_connection(self) -> NATS:
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+
+        async with self._connect_lock:
+            if self._nc is not None and not self._nc.is_closed:
+                return self._nc
+
+            nc = NATS()
+            options = {
+                "servers": f"tls://{settings.ALLOWED_HOSTS[0]}:4222",
+                "user": "tacticalrmm",
+                "password": settings.SECRET_KEY,
+                "connect_timeout": 3,
+                # an unreachable server fails the first connect instead of retrying
+                "max_reconnect_attempts": 1,
+                "reconnect_time_wait": 2,
+            }
+            try:
+                await asyncio.wait_for(nc.connect(**options), NATS_CONNECT_TIMEOUT)
+            except Exception:
+                try:
+                    await nc.close()
+                except Exception:
+                    pass
+                raise
+
+            # once connected keep retrying in the background, the connection is shared
+            nc.options["max_reconnect_attempts"] = -1
+            self._nc = nc
+            return nc
+
+    async def _request(self, subject: str, data: dict, timeout: int) -> Any:
+        try:
+            nc = await self._get_connection()
+        except Exception:
+            return "natsdown"
+
+        if nc.is_reconnecting:
+            return "natsdown"
+
+        try:
+            msg = await nc.request(subject, msgpack.dumps(data), timeout=timeout)
+        except ErrTimeout:
+            return "timeout"
+        except (ErrConnectionClosed, ErrNoServers):
+            return "natsdown"
+
+        try:
+            return msgpack.loads(msg.data)  # type: ignore
+        except Exception as e:
+            logger.error(e)
+            return str(e)
+
+    async def _publish(self, subject: str, data: dict) -> Optional[str]:
+        try:
+            nc = await self._get_connection()
+            await nc.publish(subject, msgpack.dumps(data))
+            await nc.flush(timeout=NATS_PUBLISH_TIMEOUT)
+        except Exception:
+            return "natsdown"
+
+        return None
+
+    async def _submit(self, coro, timeout: int) -> Any:
+        # run on the manager loop and await the result from the caller's loop
+        fut = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(fut), timeout + NATS_CONNECT_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            fut.cancel()
+            return "natsdown"
+
+    def _submit_sync(self, coro, timeout: int) -> Any:
+        fut = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return fut.result(timeout + NATS_CONNECT_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            fut.cancel()
+            return "natsdown"
+
+    async def request(self, subject: str, data: dict, timeout: int = 30) -> Any:
+        return await self._submit(self._request(subject, data, timeout), timeout)
+
+    async def publish(self, subject: str, data: dict) -> Optional[str]:
+        return await self._submit(self._publish(subject, data), NATS_PUBLISH_TIMEOUT)
+
+    def request_sync(self, subject: str, data: dict, timeout: int = 30) -> Any:
+        return self._submit_sync(self._request(subject, data, timeout), timeout)
+
+    def publish_sync(self, subject: str, data: dict) -> Optional[str]:
+        return self._submit_sync(self._publish(subject, data), NATS_PUBLISH_TIMEOUT)
+
+    def request_many(
+        self,
+        messages: Iterable[tuple[str, dict]],
+        timeout: int = 30,
+        wait: bool = True,
+        concurrency: int = 100,
+    ) -> Iterator[tuple[str, Any]]:
+        """
+        Sends (subject, data) messages over the shared connection with at most
+        `concurrency` in flight and yields (subject, result) as each one completes.
+        The next message is only pulled from `messages` once a slot is free, so a
+        generator can do its own bookkeeping right before its messages are sent.
+        Messages that get no result in time are yielded as natsdown.
+        """
+        loop = self.loop
+        results: queue.SimpleQueue = queue.SimpleQueue()
+        in_flight: dict[str, concurrent.futures.Future] = {}
+        # every send finishes within its own timeout unless the loop is stuck
+        result_timeout = (
+            timeout if wait else NATS_PUBLISH_TIMEOUT
+        ) + NATS_CONNECT_TIMEOUT
+
+        async def send(subject: str, data: dict) -> None:
+            try:
+                if wait:
+                    r = await self._request(subject, data, timeout)
+                else:
+                    r = await self._publish(subject, data)
+            except Exception as e:
+                logger.error(e)
+                r = str(e)
+
+            results.put((subject, r))
+
+        def collect() -> Iterator[tuple[str, Any]]:
+            try:
+                subject, r = results.get(timeout=result_timeout)
+            except queue.Empty:
+                logger.error(f"No result from nats for {len(in_flight)} messages")
+                for subject, fut in in_flight.items():
+                    fut.cancel()
+                    yield subject, "natsdown"
+                in_flight.clear()
+                return
+
+            # results of messages that were already given up on are dropped
+            if in_flight.pop(subject, None) is not None:
+                yield subject, r
+
+        messages = iter(messages)
+        while True:
+            # wait for a free slot before pulling the next message
+            while len(in_flight) >= concurrency:
+                yield from collect()
+
+            try:
+                subject, data = next(messages)
+            except StopIteration:
+                break
+
+            in_flight[subject] = asyncio.run_coroutine_threadsafe(
+                send(subject, data), loop
+            )
+
+        while in_flight:
+            yield from collect()
+
+
+nats_manager = NatsManager()
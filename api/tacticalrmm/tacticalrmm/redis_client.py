@@ -0,0 +1,6 @@
+import redis
+from django.conf import settings
+
+# connections are created lazily and the pool is reset after fork, so a single
+# module level client is safe to share between django, celery and channels
+redis_client = redis.Redis(host=settings.REDIS_HOST, port=6379)
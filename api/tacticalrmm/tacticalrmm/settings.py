@@ -40,6 +40,22 @@ EXE_GEN_URLS = [
 
 DEFAULT_AUTO_FIELD = "django.db.models.AutoField"
 
+# most recent matched events stored on an eventlog check
+CHECK_EVENTLOG_MAX_STORED_EVENTS = 100
+
+# alert emails to the same recipients within this many seconds are sent as one digest
+EMAIL_DIGEST_WINDOW = 60
+# max emails sent per minute, the rest wait for the next minute
+EMAIL_RATE_LIMIT = 30
+
+# notification outbox, failed sends are retried after 30s, 60s, 120s...
+SMS_BACKEND = "core.sms.TwilioBackend"
+NOTIFICATION_BATCH = 100
+NOTIFICATION_CONCURRENCY = 10
+NOTIFICATION_SEND_TIMEOUT = 300
+NOTIFICATION_MAX_ATTEMPTS = 8
+NOTIFICATION_RETRY_BACKOFF = 30
+
 ASGI_APPLICATION = "tacticalrmm.asgi.application"
 
 try:
@@ -196,3 +212,12 @@ if "AZPIPELINE" in os.environ:
     MESH_TOKEN_KEY = "bd65e957a1e70c622d32523f61508400d6cd0937001a7ac12042227eba0b9ed625233851a316d4f489f02994145f74537a331415d00047dbbf13d940f556806dffe7a8ce1de216dc49edbad0c1a7399c"
     REDIS_HOST = "localhost"
     KEEP_SALT = False
+    CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+if not "AZPIPELINE" in os.environ:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {"hosts": [(REDIS_HOST, 6379)]},  # type: ignore
+        }
+    }
@@ -1,16 +1,23 @@
+import asyncio
 import json
 import os
-from unittest.mock import mock_open, patch
+from unittest.mock import AsyncMock, MagicMock, mock_open, patch
 
+import msgpack
 import requests
 from django.conf import settings
 from django.test import TestCase, override_settings
 
+from .nats_client import NatsManager
+from .test import TacticalTestCase
 from .utils import (
     bitdays_to_string,
+    decode_cursor,
+    downsample_minmax,
     filter_software,
     generate_winagent_exe,
     get_bit_days,
+    keyset_paginate,
     reload_nats,
     run_nats_api_cmd,
 )
@@ -109,3 +116,191 @@ class TestUtils(TestCase):
 
         r = filter_software(sw)
         self.assertIsInstance(r, list)
+
+
+class TestKeysetPaginate(TacticalTestCase):
+    def setUp(self):
+        self.setup_coresettings()
+
+    def test_keyset_paginate(self):
+        from django.utils import timezone as djangotime
+        from model_bakery import baker
+
+        from agents.models import Agent
+
+        now = djangotime.now()
+        baker.make_recipe("agents.agent", last_seen=None, _quantity=3)
+        for i in range(7):
+            # two agents share every last_seen value so ties are broken by pk
+            baker.make_recipe(
+                "agents.agent",
+                last_seen=now - djangotime.timedelta(minutes=i // 2),
+            )
+
+        for descending in (False, True):
+            expected = sorted(
+                Agent.objects.all(),
+                key=lambda a: (a.last_seen.timestamp() if a.last_seen else 0, a.pk),
+                reverse=descending,
+            )
+            # nulls always come last
+            expected = [a for a in expected if a.last_seen] + sorted(
+                [a for a in expected if not a.last_seen],
+                key=lambda a: a.pk,
+                reverse=descending,
+            )
+
+            seen = []
+            cursor = None
+            while True:
+                rows, cursor = keyset_paginate(
+                    Agent.objects.all(), "last_seen", descending, 3, cursor
+                )
+                seen += rows
+                if not cursor:
+                    break
+
+                self.assertEqual(decode_cursor(cursor)[1], rows[-1].pk)
+
+            self.assertEqual([a.pk for a in seen], [a.pk for a in expected])
+
+
+class TestDownsample(TacticalTestCase):
+    def test_downsample_minmax(self):
+        from django.db.models import F
+        from django.utils import timezone as djangotime
+        from model_bakery import baker
+
+        from checks.models import CheckHistory
+
+        check = baker.make_recipe("checks.cpuload_check")
+        now = djangotime.now()
+        for i in range(100):
+            history = baker.make(
+                "checks.CheckHistory",
+                check_history=check,
+                # a single spike in otherwise flat data
+                y=95 if i == 42 else 10 + i % 3,
+            )
+            history.x = now - djangotime.timedelta(minutes=i)  # type: ignore
+            history.save()  # type: ignore
+
+        queryset = CheckHistory.objects.filter(check_history=check)
+
+        # small enough, returned as is
+        rows = list(downsample_minmax(queryset, 100, F("y")))
+        self.assertEqual(len(rows), 100)
+
+        rows = list(downsample_minmax(queryset, 20, F("y")))
+        self.assertLessEqual(len(rows), 20)
+        self.assertIn(95, [r.y for r in rows])
+        self.assertIn(10, [r.y for r in rows])
+        self.assertEqual(rows, sorted(rows, key=lambda r: r.x, reverse=True))
+
+
+class TestNatsManager(TestCase):
+    def setUp(self):
+        self.manager = NatsManager()
+
+    def mock_connection(self, reply):
+        nc = MagicMock()
+        nc.is_closed = False
+        nc.is_reconnecting = False
+        nc.request = AsyncMock(return_value=MagicMock(data=msgpack.dumps(reply)))
+        nc.publish = AsyncMock()
+        nc.flush = AsyncMock()
+        return nc
+
+    def test_loop_is_reused(self):
+        loop = self.manager.loop
+        self.assertIs(self.manager.loop, loop)
+
+        # forked processes get their own loop
+        with patch("os.getpid", return_value=-1):
+            self.assertIsNot(self.manager.loop, loop)
+
+    def test_request(self):
+        nc = self.mock_connection("pong")
+        with patch.object(NatsManager, "_get_connection", AsyncMock(return_value=nc)):
+            r = self.manager.request_sync("agent1", {"func": "ping"}, timeout=1)
+            self.assertEqual(r, "pong")
+
+            r = asyncio.run(self.manager.request("agent1", {"func": "ping"}))
+            self.assertEqual(r, "pong")
+            self.assertEqual(nc.request.call_count, 2)
+
+            r = asyncio.run(self.manager.publish("agent1", {"func": "ping"}))
+            self.assertIsNone(r)
+            nc.publish.assert_called_once_with(
+                "agent1", msgpack.dumps({"func": "ping"})
+            )
+
+        nc.is_reconnecting = True
+        with patch.object(NatsManager, "_get_connection", AsyncMock(return_value=nc)):
+            r = self.manager.request_sync("agent1", {"func": "ping"})
+            self.assertEqual(r, "natsdown")
+
+    def test_natsdown(self):
+        with patch.object(
+            NatsManager, "_get_connection", AsyncMock(side_effect=Exception("down"))
+        ):
+            r = self.manager.request_sync("agent1", {"func": "ping"})
+            self.assertEqual(r, "natsdown")
+
+            r = self.manager.publish_sync("agent1", {"func": "ping"})
+            self.assertEqual(r, "natsdown")
+
+    @patch("tacticalrmm.nats_client.NATS_CONNECT_TIMEOUT", 1)
+    def test_connect_hangs(self):
+        async def hang(*args, **kwargs):
+            await asyncio.sleep(60)
+
+        # a connect that never finishes is reported as nats being down
+        with patch.object(NatsManager, "_get_connection", hang):
+            r = self.manager.request_sync("agent1", {"func": "ping"}, timeout=1)
+            self.assertEqual(r, "natsdown")
+
+            r = asyncio.run(self.manager.request("agent1", {"func": "ping"}, 1))
+            self.assertEqual(r, "natsdown")
+
+    def test_request_many(self):
+        nc = self.mock_connection("ok")
+        with patch.object(NatsManager, "_get_connection", AsyncMock(return_value=nc)):
+            messages = [(f"agent{i}", {"func": "ping"}) for i in range(10)]
+            r = list(self.manager.request_many(messages, concurrency=3))
+            self.assertEqual(len(r), 10)
+            self.assertEqual({i[0] for i in r}, {f"agent{i}" for i in range(10)})
+            self.assertTrue(all(i[1] == "ok" for i in r))
+            self.assertEqual(nc.request.call_count, 10)
+
+            # messages are only pulled once a slot is free
+            pulled = []
+
+            def pull():
+                for message in messages:
+                    pulled.append(message)
+                    yield message
+
+            results = self.manager.request_many(pull(), concurrency=3)
+            next(results)
+            self.assertEqual(len(pulled), 3)
+            self.assertEqual(len(list(results)), 9)
+
+            r = list(self.manager.request_many(messages, wait=False))
+            self.assertTrue(all(i[1] is None for i in r))
+            self.assertEqual(nc.publish.call_count, 10)
+
+    @patch("tacticalrmm.nats_client.NATS_CONNECT_TIMEOUT", 0.1)
+    def test_request_many_no_result(self):
+        nc = self.mock_connection("ok")
+
+        async def request(subject, *args, **kwargs):
+            if subject == "agent1":
+                await asyncio.sleep(10)
+            return MagicMock(data=msgpack.dumps("ok"))
+
+        nc.request = AsyncMock(side_effect=request)
+        with patch.object(NatsManager, "_get_connection", AsyncMock(return_value=nc)):
+            messages = [(f"agent{i}", {"func": "ping"}) for i in range(3)]
+            r = dict(self.manager.request_many(messages, timeout=0, concurrency=2))
+            self.assertEqual(r, {"agent0": "ok", "agent1": "natsdown", "agent2": "ok"})
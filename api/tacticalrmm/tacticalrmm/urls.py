@@ -33,4 +33,5 @@ if hasattr(settings, "ADMIN_ENABLED") and settings.ADMIN_ENABLED:
 
 ws_urlpatterns = [
     path("ws/dashinfo/", consumers.DashInfo.as_asgi()),  # type: ignore
+    path("ws/bulkjobs/<int:pk>/", consumers.BulkJobProgress.as_asgi()),  # type: ignore
 ]
@@ -1,10 +1,12 @@
+import base64
 import json
 import os
 import string
 import subprocess
 import tempfile
 import time
-from typing import Union
+from datetime import datetime
+from typing import Optional, Union
 
 import pytz
 import requests
@@ -12,6 +14,23 @@ from channels.auth import AuthMiddlewareStack
 from channels.db import database_sync_to_async
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.db.models import (
+    Count,
+    Expression,
+    F,
+    Func,
+    IntegerField,
+    Max,
+    Min,
+    Q,
+    QuerySet,
+    Value,
+    Window,
+)
+from django.db.models.functions import Extract, RowNumber
+from django.db.models.query import RawQuerySet
 from django.http import FileResponse
 from knox.auth import TokenAuthentication
 from loguru import logger
@@ -245,3 +264,117 @@ def run_nats_api_cmd(mode: str, ids: list[str], timeout: int = 30) -> None:
             subprocess.run(cmd, capture_output=True, timeout=timeout)
         except Exception as e:
             logger.error(e)
+
+
+def encode_cursor(values: list) -> str:
+    # DjangoJSONEncoder drops microseconds, keyset comparisons need all of them
+    values = [i.isoformat() if isinstance(i, datetime) else i for i in values]
+    return base64.urlsafe_b64encode(
+        json.dumps(values, cls=DjangoJSONEncoder).encode()
+    ).decode()
+
+
+def decode_cursor(cursor: str) -> list:
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+
+def keyset_paginate(
+    queryset: QuerySet,
+    sort_by: str,
+    descending: bool,
+    page_size: int,
+    cursor: Optional[str] = None,
+) -> tuple[list, Optional[str]]:
+    """
+    Returns one page ordered by (sort_by, pk) and the cursor for the next page, or None
+    on the last page. Rows where sort_by is null always come last.
+    """
+    queryset = queryset.annotate(sort_value=F(sort_by))
+    gt = "lt" if descending else "gt"
+
+    if cursor:
+        value, pk = decode_cursor(cursor)
+        if value is None:
+            queryset = queryset.filter(sort_value__isnull=True, **{f"pk__{gt}": pk})
+        else:
+            queryset = queryset.filter(
+                Q(**{f"sort_value__{gt}": value})
+                | Q(sort_value=value, **{f"pk__{gt}": pk})
+                | Q(sort_value__isnull=True)
+            )
+
+    if descending:
+        queryset = queryset.order_by(F("sort_value").desc(nulls_last=True), "-pk")
+    else:
+        queryset = queryset.order_by(F("sort_value").asc(nulls_last=True), "pk")
+
+    rows = list(queryset[: page_size + 1])
+    if len(rows) <= page_size:
+        return rows, None
+
+    rows = rows[:page_size]
+    return rows, encode_cursor([rows[-1].sort_value, rows[-1].pk])
+
+
+def estimated_count(model) -> Optional[int]:
+    # planner statistics, a lot cheaper than count(*) on big tables
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT reltuples::bigint FROM pg_class WHERE relname = %s",
+            [model._meta.db_table],
+        )
+        row = cursor.fetchone()
+
+    # -1 or 0 when the table has never been vacuumed or analyzed
+    if not row or row[0] <= 0:
+        return None
+
+    return row[0]
+
+
+def downsample_minmax(
+    queryset: QuerySet,
+    max_points: int,
+    value: Union[Expression, F],
+    time_field: str = "x",
+) -> Union[QuerySet, RawQuerySet]:
+    """
+    Reduces a time series to at most max_points rows, newest first. The time range is
+    split into max_points / 2 buckets and only the rows with the lowest and the highest
+    value of each bucket are kept, so spikes survive. Bucketing is done in SQL.
+    """
+    stats = queryset.aggregate(
+        start=Min(time_field), end=Max(time_field), count=Count("pk")
+    )
+    if stats["count"] <= max_points or max_points < 2:
+        return queryset.order_by(f"-{time_field}")
+
+    # width_bucket puts the upper bound into an overflow bucket, so extend the range
+    bucket = Func(
+        Extract(time_field, "epoch"),
+        Value(stats["start"].timestamp()),
+        Value(stats["end"].timestamp() + 1),
+        Value(max_points // 2),
+        function="width_bucket",
+        output_field=IntegerField(),
+    )
+    queryset = queryset.order_by().annotate(
+        rank_min=Window(
+            RowNumber(),
+            partition_by=[bucket],
+            order_by=[value.asc(nulls_last=True), F(time_field).asc()],
+        ),
+        rank_max=Window(
+            RowNumber(),
+            partition_by=[bucket],
+            order_by=[value.desc(nulls_last=True), F(time_field).asc()],
+        ),
+    )
+
+    sql, params = queryset.query.sql_with_params()
+    column = queryset.model._meta.get_field(time_field).column
+    return queryset.model.objects.raw(
+        f"SELECT * FROM ({sql}) AS s WHERE rank_min = 1 OR rank_max = 1 "
+        f'ORDER BY "{column}" DESC',
+        params,
+    )
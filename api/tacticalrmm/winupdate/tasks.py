@@ -8,7 +8,7 @@ from django.utils import timezone as djangotime
 from loguru import logger
 from packaging import version as pyver
 
-from agents.models import Agent
+from agents.models import Agent, BulkJob
 from tacticalrmm.celery import app
 
 logger.configure(**settings.LOG_CONFIG)
@@ -18,9 +18,7 @@ logger.configure(**settings.LOG_CONFIG)
 def auto_approve_updates_task():
     # scheduled task that checks and approves updates daily
 
-    agents = Agent.objects.only(
-        "pk", "agent_id", "version", "last_seen", "overdue_time", "offline_time"
-    )
+    agents = Agent.objects.only("pk", "agent_id", "version")
     for agent in agents:
         agent.delete_superseded_updates()
         try:
@@ -29,9 +27,7 @@ def auto_approve_updates_task():
             continue
 
     online = [
-        i
-        for i in agents
-        if i.status == "online" and pyver.parse(i.version) >= pyver.parse("1.3.0")
+        i for i in agents.online() if pyver.parse(i.version) >= pyver.parse("1.3.0")
     ]
 
     chunks = (online[i : i + 40] for i in range(0, len(online), 40))
@@ -45,15 +41,11 @@ def auto_approve_updates_task():
 @app.task
 def check_agent_update_schedule_task():
     # scheduled task that installs updates on agents if enabled
-    agents = Agent.objects.only(
-        "pk", "agent_id", "version", "last_seen", "overdue_time", "offline_time"
-    )
+    agents = Agent.objects.online().only("pk", "agent_id", "version")
     online = [
         i
         for i in agents
-        if pyver.parse(i.version) >= pyver.parse("1.3.0")
-        and i.has_patches_pending
-        and i.status == "online"
+        if pyver.parse(i.version) >= pyver.parse("1.3.0") and i.has_patches_pending
     ]
 
     for agent in online:
@@ -124,35 +116,43 @@ def check_agent_update_schedule_task():
                 agent.save(update_fields=["patches_last_installed"])
 
 
-@app.task
-def bulk_install_updates_task(pks: list[int]) -> None:
-    q = Agent.objects.filter(pk__in=pks)
-    agents = [i for i in q if pyver.parse(i.version) >= pyver.parse("1.3.0")]
-    chunks = (agents[i : i + 40] for i in range(0, len(agents), 40))
-    for chunk in chunks:
-        for agent in chunk:
-            agent.delete_superseded_updates()
-            try:
-                agent.approve_updates()
-            except:
-                pass
-            nats_data = {
-                "func": "installwinupdates",
-                "guids": agent.get_approved_update_guids(),
-            }
-            asyncio.run(agent.nats_cmd(nats_data, wait=False))
-            time.sleep(0.05)
-        time.sleep(15)
+def _supported_bulk_agents(job: BulkJob) -> list[Agent]:
+    agents = []
+    unsupported = []
+    for agent in job.pending_agents():
+        if pyver.parse(agent.version) >= pyver.parse("1.3.0"):
+            agents.append(agent)
+        else:
+            unsupported.append(agent.pk)
 
+    if unsupported:
+        job.skip(unsupported, "Requires agent version 1.3.0 or greater")
 
-@app.task
-def bulk_check_for_updates_task(pks: list[int]) -> None:
-    q = Agent.objects.filter(pk__in=pks)
-    agents = [i for i in q if pyver.parse(i.version) >= pyver.parse("1.3.0")]
-    chunks = (agents[i : i + 40] for i in range(0, len(agents), 40))
-    for chunk in chunks:
-        for agent in chunk:
-            agent.delete_superseded_updates()
-            asyncio.run(agent.nats_cmd({"func": "getwinupdates"}, wait=False))
-            time.sleep(0.05)
-        time.sleep(15)
+    return agents
+
+
+@app.task(acks_late=True, reject_on_worker_lost=True)
+def bulk_install_updates_task(jobpk: int) -> None:
+    job = BulkJob.objects.get(pk=jobpk)
+    guids: dict[str, list[str]] = {}
+    for agent in _supported_bulk_agents(job):
+        agent.delete_superseded_updates()
+        try:
+            agent.approve_updates()
+        except:
+            pass
+        guids[agent.agent_id] = agent.get_approved_update_guids()
+
+    def nats_data(agent_id: str) -> dict:
+        return {"func": "installwinupdates", "guids": guids[agent_id]}
+
+    job.run(nats_data, wait=False)
+
+
+@app.task(acks_late=True, reject_on_worker_lost=True)
+def bulk_check_for_updates_task(jobpk: int) -> None:
+    job = BulkJob.objects.get(pk=jobpk)
+    for agent in _supported_bulk_agents(job):
+        agent.delete_superseded_updates()
+
+    job.run({"func": "getwinupdates"}, wait=False)
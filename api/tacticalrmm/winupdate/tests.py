@@ -201,6 +201,49 @@ class WinupdateTasks(TacticalTestCase):
         agent_salt_cmd.assert_called_with(func="win_agent.install_updates")
         self.assertEquals(agent_salt_cmd.call_count, 2) """
 
+    @patch("agents.models.Agent.nats_cmd_many")
+    def test_bulk_check_for_updates_task(self, nats_cmd_many):
+        from agents.models import BulkJob
+
+        from .tasks import bulk_check_for_updates_task
+
+        nats_cmd_many.side_effect = lambda agent_ids, data, **kwargs: [
+            (agent_id, None) for agent_id in agent_ids
+        ]
+        old_agent = baker.make_recipe("agents.agent", version="1.2.0")
+        pks = [i.pk for i in self.online_agents] + [self.offline_agent.pk, old_agent.pk]
+        job = BulkJob.create_job("scan", "tactical", pks)
+
+        bulk_check_for_updates_task(job.pk)
+        nats_cmd_many.assert_called_once()
+        data = nats_cmd_many.call_args.args[1]
+        self.assertEqual(data, {"func": "getwinupdates"})
+        self.assertFalse(nats_cmd_many.call_args.kwargs["wait"])
+
+        self.assertEqual(
+            job.results.filter(status="sent").count(), len(self.online_agents) + 1
+        )
+        self.assertEqual(job.results.get(agent=old_agent).status, "failed")
+
+    @patch("agents.models.Agent.nats_cmd_many")
+    def test_bulk_install_updates_task(self, nats_cmd_many):
+        from agents.models import BulkJob
+
+        from .tasks import bulk_install_updates_task
+
+        agent = self.online_agents[0]
+        baker.make_recipe("winupdate.winupdate_approve", agent=agent)
+        updates = baker.make_recipe("winupdate.winupdate", agent=agent, _quantity=2)
+        job = BulkJob.create_job("install", "tactical", [agent.pk])
+
+        bulk_install_updates_task(job.pk)
+        nats_cmd_many.assert_called_once()
+        data = nats_cmd_many.call_args.args[1]
+        self.assertEqual(data(agent.agent_id)["func"], "installwinupdates")
+        self.assertEqual(
+            sorted(data(agent.agent_id)["guids"]), sorted(i.guid for i in updates)
+        )
+
     """ @patch("agents.models.Agent.salt_api_async")
     def test_check_agent_update_monthly_schedule(self, agent_salt_cmd):
         from .tasks import check_agent_update_schedule_task